@@ -0,0 +1,423 @@
+#!/usr/bin/env python
+"""
+UKBB Extraction Benchmark
+
+This module times the extractor on a synthetic release (see synthetic.py)
+over a fixed set of scenarios, each exercising a different part of the
+pipeline:
+
+- small_cohort: a cohort of a few subjects, all fields
+- category_expansion: fields selected through the category tree
+- recoding: value and field name recoding of all fields
+- replication: replication of non-instanced fields
+- wide_typing: the wide pivot with typed columns
+- output_<format>: a full extraction written to tsv, csv, arrow or parquet
+
+Every scenario runs in a fresh process, so that the peak resident set size
+of one scenario does not carry over to the next. The results (wall time,
+peak RSS, rows and throughput) are written to a JSON file together with the
+commit, the library versions and the dataset parameters, so that runs can be
+compared across commits with --compare.
+
+The dataset can also be ingested into stores of several layouts and codecs
+(see STORE_VARIANTS), which are benchmarked alongside the data files. The
+disk footprint of every data file or store is recorded with its results, to
+weigh the decode cost of a codec against the space it saves.
+"""
+from __future__ import annotations
+
+import concurrent.futures
+import datetime
+import json
+import logging
+import multiprocessing
+import pathlib as p
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import polars as pl
+
+from config import Config, load_config
+from ingest import ingest_melted_data
+from melted_UKBB_extract import extract_UKBB_tabular_data, write_outputs
+from synthetic import generate_dataset
+
+# Config overrides and output formats of every scenario, applied on top of
+# BASE_CONFIG
+SCENARIOS = {
+    "small_cohort": (
+        {"SubjectIDs": list(range(1_000_000, 1_000_100))},
+        [],
+    ),
+    "category_expansion": (
+        {"FieldIDs": [], "Categories": [100], "recode_data_values": False},
+        [],
+    ),
+    "recoding": ({"recode_data_values": True, "recode_field_names": True}, []),
+    "replication": ({"replicate_non_instanced": True}, []),
+    "wide_typing": (
+        {
+            "recode_data_values": True,
+            "wide": True,
+            "recode_wide_column_valuetypes": True,
+        },
+        [],
+    ),
+    **{
+        f"output_{format}": (
+            {"recode_data_values": True, "recode_field_names": True, "wide": True},
+            [format],
+        )
+        for format in ["tsv", "csv", "arrow", "parquet"]
+    },
+}
+
+# Store layout and codec of every store variant, see ingest.py
+STORE_VARIANTS = {
+    "partitioned": ("partitioned", "zstd"),
+    "partitioned-lz4": ("partitioned", "lz4"),
+    "mapped": ("mapped", "uncompressed"),
+    "mapped-lz4": ("mapped", "lz4"),
+    "subject": ("subject", None),
+}
+
+# All fields, no recoding, no replication, narrow output only
+BASE_CONFIG = {
+    "FieldIDs": [],
+    "Categories": [],
+    "replicate_non_instanced": False,
+    "recode_field_names": False,
+    "recode_data_values": False,
+    "wide": False,
+    "recode_wide_column_valuetypes": False,
+    "convert_less_than_value_integer": 0,
+}
+
+
+def scenario_config(name: str) -> Config:
+    """Config of a scenario, the template config with the overrides applied."""
+    config = load_config(p.Path(__file__).parent / "config.template.yaml")
+    config.update(BASE_CONFIG)
+    config.update(SCENARIOS[name][0])
+    return config
+
+
+def run_scenario(name: str, data_file: str, dataset_dir: str, optimize: bool = True) -> dict:
+    """
+    Run one scenario and measure it.
+
+    Meant to run in a fresh process, the peak RSS is that of the process.
+
+    Returns
+    -------
+    dict
+        Timings in seconds, peak RSS in bytes and row counts.
+    """
+    dataset_dir = p.Path(dataset_dir)
+    config = scenario_config(name)
+    output_formats = SCENARIOS[name][1]
+
+    start = time.perf_counter()
+    data, data_wide, dictionary, codings = extract_UKBB_tabular_data(
+        config=config,
+        data_file=data_file,
+        dictionary_file=str(dataset_dir / "Data_Dictionary_Showcase.tsv"),
+        coding_file=str(dataset_dir / "Codings.tsv"),
+        category_tree_file=str(dataset_dir / "13.txt"),
+        data_field_prop_file=str(dataset_dir / "1.txt"),
+        optimize=optimize,
+    )
+    extracted = time.perf_counter()
+    if output_formats:
+        with tempfile.TemporaryDirectory(dir=dataset_dir) as output_dir:
+            write_outputs(
+                data,
+                data_wide,
+                dictionary,
+                codings,
+                f"{output_dir}/{name}_",
+                output_formats,
+            )
+    written = time.perf_counter()
+
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != "darwin":
+        peak_rss *= 1024
+    return {
+        "wall_seconds": written - start,
+        "extract_seconds": extracted - start,
+        "write_seconds": written - extracted,
+        "peak_rss_bytes": peak_rss,
+        "output_rows": data.height,
+        "wide_shape": list(data_wide.shape) if data_wide is not None else None,
+    }
+
+
+def disk_bytes(path: str) -> int:
+    """Size on disk of a data file, or of all the files of a store."""
+    path = p.Path(path)
+    if path.is_dir():
+        return sum(file.stat().st_size for file in path.rglob("*") if file.is_file())
+    return path.stat().st_size
+
+
+def build_store_variants(dataset_dir: str, variants: list[str]) -> list[str]:
+    """
+    Ingest the dataset into the store variants missing from dataset_dir.
+
+    Returns
+    -------
+    list[str]
+        Paths of the stores, current.melt.<variant> in dataset_dir.
+    """
+    dataset_dir = p.Path(dataset_dir)
+    stores = []
+    for variant in variants:
+        store_path = dataset_dir / f"current.melt.{variant}"
+        if not store_path.exists():
+            layout, compression = STORE_VARIANTS[variant]
+            logging.info(f"Building the {variant} store {store_path}")
+            ingest_melted_data(
+                str(dataset_dir / "current.melt.arrow"),
+                str(store_path),
+                compression=compression,
+                layout=layout,
+            )
+        stores.append(str(store_path))
+    return stores
+
+
+def git_commit() -> str | None:
+    """Commit of the checkout the benchmark runs from, if any."""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=p.Path(__file__).parent,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(
+    dataset_dir: str,
+    data_files: list[str] | None = None,
+    scenarios: list[str] | None = None,
+    repeat: int = 1,
+    optimize: bool = True,
+) -> dict:
+    """
+    Run the benchmark scenarios on a synthetic dataset.
+
+    Parameters
+    ----------
+    dataset_dir : str
+        Directory written by synthetic.generate_dataset().
+    data_files : list[str], optional
+        Data files or stores to benchmark, defaults to current.melt.arrow of
+        the dataset.
+    scenarios : list[str], optional
+        Scenarios to run, defaults to all of SCENARIOS.
+    repeat : int, default=1
+        Runs per scenario; the fastest run is reported, with the largest
+        peak RSS.
+    optimize : bool, default=True
+        Passed on to extract_UKBB_tabular_data().
+
+    Returns
+    -------
+    dict
+        Benchmark results, see the module docstring.
+    """
+    dataset_dir = p.Path(dataset_dir)
+    with open(dataset_dir / "synthetic.json") as stream:
+        dataset = json.load(stream)
+    data_files = data_files or [str(dataset_dir / "current.melt.arrow")]
+    scenarios = scenarios or list(SCENARIOS)
+
+    results = []
+    for data_file in data_files:
+        for name in scenarios:
+            runs = []
+            for _ in range(repeat):
+                with concurrent.futures.ProcessPoolExecutor(
+                    max_workers=1, mp_context=multiprocessing.get_context("spawn")
+                ) as executor:
+                    runs.append(
+                        executor.submit(
+                            run_scenario, name, data_file, str(dataset_dir), optimize
+                        ).result()
+                    )
+            result = min(runs, key=lambda run: run["wall_seconds"])
+            result["peak_rss_bytes"] = max(run["peak_rss_bytes"] for run in runs)
+            result["wall_seconds_runs"] = [run["wall_seconds"] for run in runs]
+            result["input_rows"] = dataset["rows"]
+            result["rows_per_second"] = dataset["rows"] / result["wall_seconds"]
+            result["disk_bytes"] = disk_bytes(data_file)
+            results.append({"scenario": name, "data_file": data_file, **result})
+            logging.info(
+                f"{name} on {data_file}: {result['wall_seconds']:.3f} s, "
+                f"{result['peak_rss_bytes'] / 2**20:.1f} MiB peak RSS, "
+                f"{result['rows_per_second']:.0f} rows/s, "
+                f"{result['disk_bytes'] / 2**20:.1f} MiB on disk"
+            )
+
+    return {
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "polars": pl.__version__,
+        "platform": platform.platform(),
+        "optimize": optimize,
+        "repeat": repeat,
+        "dataset": dataset,
+        "results": results,
+    }
+
+
+def compare_results(results: dict, previous: dict) -> pl.DataFrame:
+    """
+    Compare benchmark results with those of a previous run.
+
+    Scenarios are matched by name and data file name. Ratios above 1 mean
+    the current run is slower or uses more memory.
+    """
+    columns = ["scenario", "data_file", "wall_seconds", "peak_rss_bytes"]
+
+    def frame(run: dict) -> pl.DataFrame:
+        return pl.DataFrame(
+            [{column: result[column] for column in columns} for result in run["results"]]
+        ).with_columns(pl.col("data_file").apply(lambda path: p.Path(path).name))
+
+    return (
+        frame(results)
+        .join(frame(previous), on=["scenario", "data_file"], suffix="_previous")
+        .with_columns(
+            [
+                (pl.col("wall_seconds") / pl.col("wall_seconds_previous")).alias(
+                    "wall_ratio"
+                ),
+                (pl.col("peak_rss_bytes") / pl.col("peak_rss_bytes_previous")).alias(
+                    "rss_ratio"
+                ),
+            ]
+        )
+    )
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog="UKBB Extraction Benchmark",
+        description="Times the extractor on a synthetic UKBB release over a set of scenarios, recording wall time, peak memory and throughput",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "--dataset-dir",
+        help="Synthetic dataset directory, generated with the parameters below if it does not exist yet",
+        required=True,
+    )
+    parser.add_argument(
+        "--data-files",
+        help="Data files or stores to benchmark (default: current.melt.arrow of the dataset)",
+        nargs="+",
+        default=None,
+    )
+    parser.add_argument(
+        "--store-variants",
+        help="Also benchmark the dataset ingested into stores of these layouts and codecs, built in the dataset directory if missing",
+        choices=list(STORE_VARIANTS),
+        nargs="+",
+        default=[],
+    )
+    parser.add_argument(
+        "--scenarios",
+        help="Scenarios to run",
+        choices=list(SCENARIOS),
+        nargs="+",
+        default=list(SCENARIOS),
+    )
+    parser.add_argument("--repeat", help="Runs per scenario", type=int, default=1)
+    parser.add_argument(
+        "--no-optimization",
+        help="Benchmark the conservative query plan",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--output-file", help="JSON file the results are written to", default="benchmark.json"
+    )
+    parser.add_argument(
+        "--compare", help="JSON results of a previous run to compare with", default=None
+    )
+    parser.add_argument("--subjects", help="Number of subjects", type=int, default=10_000)
+    parser.add_argument("--fields", help="Number of fields", type=int, default=100)
+    parser.add_argument("--instances", help="Number of instances", type=int, default=4)
+    parser.add_argument("--max-array", help="Largest array size", type=int, default=5)
+    parser.add_argument(
+        "--coded-fraction",
+        help="Fraction of coded (categorical) fields",
+        type=float,
+        default=0.6,
+    )
+    parser.add_argument(
+        "--non-instanced", help="Number of non-instanced fields", type=int, default=5
+    )
+    parser.add_argument("--seed", help="Random seed", type=int, default=0)
+
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format="%(asctime)s %(message)s",
+        datefmt="%Y-%m-%dT%H:%M:%S",
+        level=logging.INFO,
+    )
+
+    if not (p.Path(args.dataset_dir) / "synthetic.json").exists():
+        logging.info(f"Generating synthetic dataset in {args.dataset_dir}")
+        generate_dataset(
+            output_dir=args.dataset_dir,
+            n_subjects=args.subjects,
+            n_fields=args.fields,
+            n_instances=args.instances,
+            max_array=args.max_array,
+            coded_fraction=args.coded_fraction,
+            n_non_instanced=args.non_instanced,
+            seed=args.seed,
+        )
+
+    data_files = args.data_files
+    if args.store_variants:
+        data_files = (
+            data_files or [str(p.Path(args.dataset_dir) / "current.melt.arrow")]
+        ) + build_store_variants(args.dataset_dir, args.store_variants)
+
+    results = run_benchmark(
+        dataset_dir=args.dataset_dir,
+        data_files=data_files,
+        scenarios=args.scenarios,
+        repeat=args.repeat,
+        optimize=not args.no_optimization,
+    )
+    with open(args.output_file, "w") as stream:
+        json.dump(results, stream, indent=2)
+    logging.info(f"Wrote {args.output_file}")
+
+    if args.compare:
+        with open(args.compare) as stream:
+            previous = json.load(stream)
+        if previous["dataset"] != results["dataset"]:
+            logging.warning(f"{args.compare} was run on a different dataset")
+        with pl.Config(tbl_rows=-1, tbl_cols=-1):
+            print(
+                compare_results(results, previous).select(
+                    ["scenario", "data_file", "wall_seconds", "wall_ratio", "rss_ratio"]
+                )
+            )
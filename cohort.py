@@ -0,0 +1,178 @@
+"""
+UKBB Cohort Files
+
+This module reads the SubjectID lists used to select (SubjectIDFiles) or
+exclude (ExcludeSubjectIDFiles) participants of an extraction.
+
+A cohort file is one of:
+- a Parquet (.parquet) or Arrow IPC (.arrow/.feather) table
+- a delimited text table (.tsv, .csv) with a header
+- a flat list of SubjectIDs, one per line, without a header (any other
+  extension, or a .tsv/.csv file whose first line is a SubjectID)
+
+Tables are read from their SubjectID column, or their first column if they
+have none (e.g. eid). Cohorts are scanned lazily and applied to the data as
+a semi-join (selection) or an anti-join (exclusion), so lists of hundreds of
+thousands of subjects never become literals of the query plan. Scans and
+store parts are pruned by the SubjectID range of the cohort, aggregated from
+the files (see cohort_statistics()).
+"""
+from __future__ import annotations
+
+import logging
+import pathlib as p
+import sys
+
+import polars as pl
+
+from config import Config
+
+
+def _has_header(file: str) -> bool:
+    """Whether the first line of a text file is not a SubjectID."""
+    with open(file, "r") as stream:
+        first = stream.readline().strip().split("\t")[0].split(",")[0]
+    try:
+        int(first)
+        return False
+    except ValueError:
+        return True
+
+
+def scan_subject_ids(file: str) -> pl.LazyFrame:
+    """
+    Lazily read the SubjectIDs of a cohort file.
+
+    Parameters
+    ----------
+    file : str
+        Cohort file, see the module docstring for the supported formats.
+
+    Returns
+    -------
+    pl.LazyFrame
+        Single Int64 column SubjectID, possibly with duplicates.
+    """
+    file_extension = p.Path(file).suffix
+    try:
+        if file_extension == ".parquet":
+            data = pl.scan_parquet(file)
+        elif file_extension in [".arrow", ".feather"]:
+            data = pl.scan_ipc(file)
+        elif file_extension in [".tsv", ".csv"] and _has_header(file):
+            data = pl.scan_csv(
+                file,
+                separator="\t" if file_extension == ".tsv" else ",",
+                infer_schema_length=0,
+            )
+        else:
+            data = pl.scan_csv(
+                file, has_header=False, new_columns=["SubjectID"], infer_schema_length=0
+            )
+        column = "SubjectID" if "SubjectID" in data.columns else data.columns[0]
+    except (FileNotFoundError, pl.ComputeError) as exc:
+        logging.exception(exc)
+        sys.exit(1)
+
+    return data.select(
+        pl.col(column).cast(pl.Utf8).str.strip().cast(pl.Int64).alias("SubjectID")
+    ).drop_nulls()
+
+
+def scan_cohort(files: list[str], subject_ids: list[int] | None = None) -> pl.LazyFrame:
+    """
+    Union of the SubjectIDs of cohort files and an explicit SubjectID list.
+
+    Parameters
+    ----------
+    files : list[str]
+        Cohort files.
+    subject_ids : list[int], optional
+        Additional SubjectIDs, e.g. the SubjectIDs of the config.
+
+    Returns
+    -------
+    pl.LazyFrame
+        Single column SubjectID of unique SubjectIDs.
+    """
+    cohorts = [scan_subject_ids(file) for file in files]
+    if subject_ids:
+        cohorts.append(pl.LazyFrame({"SubjectID": subject_ids}, schema={"SubjectID": pl.Int64}))
+    return pl.concat(cohorts).unique(subset="SubjectID")
+
+
+def check_cohort_files(config: Config) -> None:
+    """Exit with an error if a cohort file of config does not exist."""
+    for key in ["SubjectIDFiles", "ExcludeSubjectIDFiles"]:
+        for file in config.get(key) or []:
+            if not p.Path(file).is_file():
+                logging.error(f"{key} file {file} not found")
+                sys.exit(1)
+
+
+def filter_subjects(data: pl.LazyFrame, config: Config) -> pl.LazyFrame:
+    """
+    Apply the SubjectID selection and exclusion of config to data.
+
+    SubjectIDs alone are applied as an is_in filter. With SubjectIDFiles,
+    the union of the files and SubjectIDs is applied as a semi-join, and
+    ExcludeSubjectIDFiles are applied as an anti-join. Both joins keep the
+    order of the rows of data.
+    """
+    if config["SubjectIDFiles"]:
+        data = data.join(
+            scan_cohort(config["SubjectIDFiles"], config["SubjectIDs"]),
+            on="SubjectID",
+            how="semi",
+        )
+    elif config["SubjectIDs"]:
+        data = data.filter(pl.col("SubjectID").is_in(config["SubjectIDs"]))
+    if config.get("ExcludeSubjectIDFiles"):
+        data = data.join(
+            scan_cohort(config["ExcludeSubjectIDFiles"]), on="SubjectID", how="anti"
+        )
+    return data
+
+
+def selected_subjects(config: Config) -> list[int] | pl.LazyFrame:
+    """
+    SubjectIDs selected by config, for the pruning of scans and store parts.
+
+    The SubjectIDs of the config when it has no SubjectIDFiles, otherwise the
+    lazy union of the files and SubjectIDs (see scan_cohort()), so that the
+    cohort is never loaded into a list. Empty if config selects all subjects.
+    """
+    if not config["SubjectIDFiles"]:
+        return config["SubjectIDs"]
+    return scan_cohort(config["SubjectIDFiles"], config["SubjectIDs"])
+
+
+def cohort_statistics(config: Config) -> dict | None:
+    """
+    Number, smallest and largest of the SubjectIDs selected by config.
+
+    Aggregated by a streamed scan of the cohort files, None if config selects
+    all subjects.
+
+    Returns
+    -------
+    dict or None
+        subjects, SubjectID_min and SubjectID_max, the latter None for an
+        empty cohort.
+    """
+    subjects = selected_subjects(config)
+    if isinstance(subjects, list):
+        if not subjects:
+            return None
+        subjects = pl.LazyFrame({"SubjectID": subjects}, schema={"SubjectID": pl.Int64})
+    return (
+        subjects.select(
+            [
+                pl.col("SubjectID").n_unique().alias("subjects"),
+                pl.col("SubjectID").min().alias("SubjectID_min"),
+                pl.col("SubjectID").max().alias("SubjectID_max"),
+            ]
+        )
+        .collect(streaming=True)
+        .row(0, named=True)
+    )
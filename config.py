@@ -11,11 +11,16 @@ loading to allow for cleaner configuration files.
 from __future__ import annotations
 
 import logging
+import pprint
 import sys
 from typing import TypedDict
 
 import yaml
 
+# Longest list logged in full by format_config(), longer lists are logged as
+# their number of values
+LOG_LIST_LENGTH = 50
+
 
 class Config(TypedDict):
     """
@@ -44,8 +49,12 @@ class Config(TypedDict):
     SubjectIDs : list[int] | list[None]
         Specific subject IDs to extract. None or empty extracts all subjects.
     SubjectIDFiles : list[str] | list[None]
-        Paths to text files containing SubjectIDs (one per line). Loaded and
-        merged into the SubjectIDs list.
+        Cohort files of SubjectIDs, flat lists (one per line) or Parquet,
+        Arrow or TSV/CSV tables, see cohort.py. Subjects in any of them or
+        in SubjectIDs are extracted.
+    ExcludeSubjectIDFiles : list[str] | list[None], optional
+        Cohort files of SubjectIDs to leave out of the extraction, e.g.
+        withdrawn participants.
     ArrayIDs : list[int] | list[None]
         Array indices for multi-value fields. None or empty extracts all arrays.
     Categories : list[int] | list[None]
@@ -55,8 +64,10 @@ class Config(TypedDict):
     Output Control Section
     ---------------------
     replicate_non_instanced : bool
-        If True, replicate non-instanced fields (e.g., Sex) across all instances.
-        Non-instanced fields exist only once per subject in the raw data.
+        If True, replicate non-instanced fields (e.g., Sex) to every instance
+        a subject attended, i.e. has a date of attending assessment centre
+        (field 53) for. Non-instanced fields exist only once per subject in
+        the raw data.
     recode_field_names : bool
         If True, replace FieldID values with "Field_FieldID" format using
         the data dictionary.
@@ -104,6 +115,8 @@ class Config(TypedDict):
     # Specific subjects to extract, null for all
     SubjectIDs: list[int] | list[None]
     SubjectIDFiles: list[str] | list[None]
+    # Subjects to exclude, optional
+    ExcludeSubjectIDFiles: list[str] | list[None]
 
     # For fields with array components, null for all
     ArrayIDs: list[int] | list[None]
@@ -190,16 +203,42 @@ def load_config(config_file: str) -> Config:
     try:
         with open(config_file, "r") as stream:
             try:
-                tempdict = yaml.safe_load(stream)
-                # Remove None values from all list fields to avoid issues
-                # with filtering logic that checks for empty/non-empty lists
-                for key in tempdict.keys():
-                    if isinstance(tempdict[key], list):
-                        tempdict[key] = [i for i in tempdict[key] if i is not None]
-                return tempdict
+                return clean_config(yaml.safe_load(stream))
             except yaml.YAMLError as exc:
                 logging.exception(exc)
                 sys.exit(1)
     except FileNotFoundError as exc:
         logging.exception(exc)
         sys.exit(1)
+
+
+def clean_config(config: dict) -> Config:
+    """
+    Remove None values from all list fields of a parsed config, in place.
+
+    This avoids issues with the filtering logic, which checks for empty or
+    non-empty lists. Used by load_config() and for configs received by the
+    extraction server.
+    """
+    for key in config.keys():
+        if isinstance(config[key], list):
+            config[key] = [i for i in config[key] if i is not None]
+    return config
+
+
+def format_config(config: Config) -> str:
+    """
+    Pretty-print a config for the log.
+
+    Lists longer than LOG_LIST_LENGTH, such as large SubjectIDs lists, are
+    replaced by their number of values.
+    """
+    return pprint.pformat(
+        {
+            key: f"<{len(value)} values>"
+            if isinstance(value, list) and len(value) > LOG_LIST_LENGTH
+            else value
+            for key, value in config.items()
+        },
+        compact=True,
+    )
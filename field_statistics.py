@@ -0,0 +1,344 @@
+#!/usr/bin/env python
+"""
+UKBB Field Statistics Index
+
+This module computes the statistics index of a melted store, built at
+ingest time and stored next to the data (see store.py). The index holds one
+row per FieldID and InstanceID present in the data:
+
+- rows: number of melted rows
+- subjects: number of distinct subjects
+- ArrayID_max: largest ArrayID
+- value_min, value_max: range of the values which parse as numbers, other
+  than the null numerics
+- null_strings: rows whose coded value means one of the null strings, null
+  when the store was built without a dictionary and coding file
+- null_numerics: rows whose value is one of the null numerics
+- empty_strings: rows with an empty value, null in indexes built before it
+  was counted
+
+The null strings and numerics counted are the drop_null_strings and
+drop_null_numerics of config.template.yaml, and are recorded in the store
+manifest.
+
+The extractor uses the index to skip fields and instances without data and,
+when the filters of an extraction are all counted, to know its wide columns
+without reading the data (see wide_fields()), and planning.py to estimate extractions from exact row counts. From the command
+line, the index answers questions such as which fields have data at
+instance 2:
+
+    $ python field_statistics.py --store current.melt.store --instances 2 --field-ids
+"""
+from __future__ import annotations
+
+import logging
+import pathlib as p
+import sys
+
+import polars as pl
+
+from config import Config, load_config
+
+STATISTICS_FILE = "field_statistics.arrow"
+
+STATISTICS_SCHEMA = {
+    "FieldID": pl.Int64,
+    "InstanceID": pl.Int64,
+    "rows": pl.Int64,
+    "subjects": pl.Int64,
+    "ArrayID_max": pl.Int64,
+    "value_min": pl.Float64,
+    "value_max": pl.Float64,
+    "null_strings": pl.Int64,
+    "null_numerics": pl.Int64,
+    "empty_strings": pl.Int64,
+}
+
+
+def template_null_values() -> tuple[list[str], list[float]]:
+    """The drop_null_strings and drop_null_numerics of config.template.yaml."""
+    config = load_config(p.Path(__file__).parent / "config.template.yaml")
+    return config["drop_null_strings"], config["drop_null_numerics"]
+
+
+def read_null_codes(
+    dictionary_file: str, coding_file: str, null_strings: list[str]
+) -> pl.DataFrame:
+    """
+    Coded values of every field whose meaning is one of null_strings.
+
+    Returns
+    -------
+    pl.DataFrame
+        FieldID and FieldValue (the coded value, as stored in the data).
+    """
+    dictionary = pl.read_csv(
+        dictionary_file,
+        separator="\t",
+        columns=["FieldID", "Coding"],
+        dtypes={"FieldID": pl.Int64, "Coding": pl.Utf8},
+        encoding="utf8-lossy",
+        quote_char=None,
+    ).with_columns(pl.col("Coding").cast(pl.Int64, strict=False))
+    codings = pl.read_csv(
+        coding_file,
+        separator="\t",
+        dtypes={"Coding": pl.Int64, "Value": pl.Utf8, "Meaning": pl.Utf8},
+        encoding="utf8-lossy",
+    ).filter(pl.col("Meaning").is_in(null_strings))
+    return (
+        dictionary.join(codings, on="Coding")
+        .select(["FieldID", pl.col("Value").alias("FieldValue")])
+        .unique()
+    )
+
+
+def field_statistics(
+    data: pl.DataFrame,
+    null_numerics: list[float],
+    null_codes: pl.DataFrame | None = None,
+) -> pl.DataFrame:
+    """
+    Compute the statistics of melted rows per FieldID and InstanceID.
+
+    Parameters
+    ----------
+    data : pl.DataFrame
+        Melted rows with the columns of store.MELTED_SCHEMA.
+    null_numerics : list[float]
+        Values counted as null numerics.
+    null_codes : pl.DataFrame, optional
+        Coded null strings of every field, see read_null_codes(). Without
+        them, null_strings is left null.
+
+    Returns
+    -------
+    pl.DataFrame
+        Statistics with the columns of STATISTICS_SCHEMA.
+    """
+    number = pl.col("FieldValue").cast(pl.Utf8).cast(pl.Float64, strict=False)
+    null_numeric = number.is_in(null_numerics)
+    if null_codes is not None:
+        data = data.with_columns(pl.col("FieldValue").cast(pl.Utf8)).join(
+            null_codes.with_columns(pl.lit(True).alias("null_string")),
+            on=["FieldID", "FieldValue"],
+            how="left",
+        )
+        null_strings = pl.col("null_string").sum()
+    else:
+        null_strings = pl.lit(None)
+    return (
+        data.groupby(["FieldID", "InstanceID"])
+        .agg(
+            [
+                pl.count().alias("rows"),
+                pl.col("SubjectID").n_unique().alias("subjects"),
+                pl.col("ArrayID").max().alias("ArrayID_max"),
+                number.filter(null_numeric.is_not()).min().alias("value_min"),
+                number.filter(null_numeric.is_not()).max().alias("value_max"),
+                null_strings.alias("null_strings"),
+                null_numeric.sum().alias("null_numerics"),
+                (pl.col("FieldValue").cast(pl.Utf8).str.lengths() == 0)
+                .sum()
+                .alias("empty_strings"),
+            ]
+        )
+        .select(
+            [pl.col(column).cast(dtype) for column, dtype in STATISTICS_SCHEMA.items()]
+        )
+        .sort(["FieldID", "InstanceID"])
+    )
+
+
+def combine_statistics(statistics: list[pl.DataFrame]) -> pl.DataFrame:
+    """
+    Combine the statistics of disjoint sets of subjects.
+
+    Subject counts are summed, so every subject must be in a single set, as
+    with the SubjectID ranges of a subject-sorted store.
+    """
+    return (
+        pl.concat([pl.DataFrame(schema=STATISTICS_SCHEMA)] + statistics)
+        .groupby(["FieldID", "InstanceID"])
+        .agg(
+            [
+                pl.col("rows").sum(),
+                pl.col("subjects").sum(),
+                pl.col("ArrayID_max").max(),
+                pl.col("value_min").min(),
+                pl.col("value_max").max(),
+                # Null when any set was counted without the null codes
+                pl.when(pl.col("null_strings").is_null().any())
+                .then(None)
+                .otherwise(pl.col("null_strings").sum())
+                .alias("null_strings"),
+                pl.col("null_numerics").sum(),
+                pl.when(pl.col("empty_strings").is_null().any())
+                .then(None)
+                .otherwise(pl.col("empty_strings").sum())
+                .alias("empty_strings"),
+            ]
+        )
+        .select(
+            [pl.col(column).cast(dtype) for column, dtype in STATISTICS_SCHEMA.items()]
+        )
+        .sort(["FieldID", "InstanceID"])
+    )
+
+
+def fields_with_data(
+    statistics: pl.DataFrame,
+    instance_ids: list[int] | None = None,
+    field_ids: list[int] | None = None,
+) -> list[int]:
+    """
+    FieldIDs with data, at any of instance_ids when given.
+
+    Parameters
+    ----------
+    statistics : pl.DataFrame
+        Statistics index, see store.read_field_statistics().
+    instance_ids, field_ids : list[int], optional
+        Only consider these instances and fields, None or empty for all.
+
+    Returns
+    -------
+    list[int]
+        Sorted FieldIDs.
+    """
+    if instance_ids:
+        statistics = statistics.filter(pl.col("InstanceID").is_in(instance_ids))
+    if field_ids:
+        statistics = statistics.filter(pl.col("FieldID").is_in(field_ids))
+    return (
+        statistics.filter(pl.col("rows") > 0)
+        .get_column("FieldID")
+        .unique()
+        .sort()
+        .to_list()
+    )
+
+
+def wide_fields(
+    statistics: pl.DataFrame, counted: dict, config: Config
+) -> list[int] | None:
+    """
+    FieldIDs of the wide columns of an extraction, from the statistics index.
+
+    A field is a wide column when rows remain after the filters of config.
+    The index counts the rows dropped by drop_empty_strings and by the null
+    strings and numerics it was built with, so for most extractions it tells
+    which fields keep rows without a pass over the data. It cannot tell when
+    only some of the rows of a field are dropped by two of the filters, nor
+    for subject and ArrayID selections, nor for the instances non-instanced
+    fields are replicated to; None is returned then.
+
+    Parameters
+    ----------
+    statistics : pl.DataFrame
+        Statistics index, see store.read_field_statistics().
+    counted : dict
+        Statistics entry of the store manifest, with the null_strings and
+        null_numerics counted.
+    config : Config
+        Expanded extraction configuration.
+
+    Returns
+    -------
+    list[int] | None
+        Sorted FieldIDs, or None when the index cannot tell.
+    """
+    if (
+        config["SubjectIDs"]
+        or config["SubjectIDFiles"]
+        or config.get("ExcludeSubjectIDFiles")
+        or config["ArrayIDs"]
+        or (config["replicate_non_instanced"] and config["InstanceIDs"])
+    ):
+        return None
+    dropped = []
+    if config["drop_empty_strings"]:
+        dropped.append("empty_strings")
+    if config["drop_null_strings"]:
+        if counted["null_strings"] is None or set(counted["null_strings"]) != set(
+            config["drop_null_strings"]
+        ):
+            return None
+        dropped.append("null_strings")
+    if config["drop_null_numerics"]:
+        if set(counted["null_numerics"]) != set(config["drop_null_numerics"]):
+            return None
+        dropped.append("null_numerics")
+    if config["InstanceIDs"]:
+        statistics = statistics.filter(
+            pl.col("InstanceID").is_in(config["InstanceIDs"])
+        )
+    if config["FieldIDs"]:
+        statistics = statistics.filter(pl.col("FieldID").is_in(config["FieldIDs"]))
+    if any(statistics.get_column(column).null_count() for column in dropped):
+        # Not counted by an older index
+        return None
+    field_ids = []
+    for field in (
+        statistics.groupby("FieldID")
+        .agg([pl.col(column).sum() for column in ["rows"] + dropped])
+        .sort("FieldID")
+        .iter_rows(named=True)
+    ):
+        drops = [field[column] for column in dropped]
+        if field["rows"] > sum(drops):
+            field_ids.append(field["FieldID"])
+        elif field["rows"] not in drops:
+            # The drops overlap, rows may remain or not
+            return None
+    return field_ids
+
+if __name__ == "__main__":
+    import argparse
+
+    from store import read_field_statistics
+
+    parser = argparse.ArgumentParser(
+        prog="UKBB Field Statistics",
+        description="Prints the field statistics index of a melted store, optionally restricted to some fields and instances",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("--store", help="Melted store directory", required=True)
+    parser.add_argument(
+        "--fields", help="Only these FieldIDs", type=int, nargs="*", default=None
+    )
+    parser.add_argument(
+        "--instances", help="Only these InstanceIDs", type=int, nargs="*", default=None
+    )
+    parser.add_argument(
+        "--field-ids",
+        help="Only print the FieldIDs with data, one per line",
+        action="store_true",
+    )
+
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format="%(asctime)s %(message)s",
+        datefmt="%Y-%m-%dT%H:%M:%S",
+        level=logging.INFO,
+    )
+
+    try:
+        statistics = read_field_statistics(args.store)
+    except (FileNotFoundError, ValueError) as exc:
+        logging.exception(exc)
+        sys.exit(1)
+    if statistics is None:
+        logging.error(f"{args.store} has no field statistics, ingest it again")
+        sys.exit(1)
+
+    if args.field_ids:
+        for field_id in fields_with_data(statistics, args.instances, args.fields):
+            print(field_id)
+    else:
+        if args.instances:
+            statistics = statistics.filter(pl.col("InstanceID").is_in(args.instances))
+        if args.fields:
+            statistics = statistics.filter(pl.col("FieldID").is_in(args.fields))
+        statistics.write_csv(sys.stdout, separator="\t")
@@ -0,0 +1,733 @@
+#!/usr/bin/env python
+"""
+UKBB Melted Store Ingest Tool
+
+This module converts UKBB tabular data into a partitioned melted store, see
+store.py for a description of the layout. Two kinds of input are supported:
+
+- The raw ultra-wide UKBB .tab file, which is melted natively: the file is
+  split into byte ranges of whole rows, and a process pool melts each range,
+  drops NAs and spills typed SubjectID/FieldID/InstanceID/ArrayID/FieldValue
+  runs straight into the store. No melted TSV is ever written.
+- Melted data (the TSV produced by ukb_awk/melt_tab.awk, or its Arrow
+  conversion), which is read in row batches.
+
+In both cases rows are streamed through MeltedStoreWriter, so ingest never
+needs to hold the full release in memory.
+
+The "mapped" layout is the partitioned layout with uncompressed (or LZ4)
+Arrow IPC part files instead of Parquet, which the extractor memory-maps.
+
+Every store gets a statistics index of its fields and instances (see
+field_statistics.py), which counts the null strings of the config template
+when the dictionary and coding files are given.
+"""
+from __future__ import annotations
+
+import concurrent.futures
+import io
+import logging
+import multiprocessing
+import os
+import pathlib as p
+import re
+import shutil
+import sys
+from collections.abc import Iterator
+
+import polars as pl
+
+from field_statistics import read_null_codes, template_null_values
+from store import (
+    MELTED_SCHEMA,
+    PARTITIONED_LAYOUT,
+    MeltedStoreWriter,
+    SubjectSortedStoreWriter,
+    read_manifest,
+    update_melted_store,
+    write_spill_run,
+)
+
+# Column headers of the raw .tab file: f.<field>.<instance>.<array>, or the
+# <field>-<instance>.<array> form used by the UKBB csv/r conversions
+TAB_HEADER_PATTERN = re.compile(r"^(?:f\.(\d+)\.(\d+)\.(\d+)|(\d+)-(\d+)\.(\d+))$")
+
+
+def iter_melted_batches(data_file: str, batch_size: int) -> Iterator[pl.DataFrame]:
+    """
+    Read a melted TSV or Arrow file in batches of roughly batch_size rows.
+
+    Parameters
+    ----------
+    data_file : str
+        Path to melted data, .tsv or .arrow/.feather.
+    batch_size : int
+        Number of rows per batch.
+
+    Yields
+    ------
+    pl.DataFrame
+        Melted rows with the columns of MELTED_SCHEMA.
+    """
+    file_extension = p.Path(data_file).suffix
+
+    if file_extension == ".tsv":
+        reader = pl.read_csv_batched(
+            data_file,
+            separator="\t",
+            dtypes=MELTED_SCHEMA,
+            encoding="utf8-lossy",
+            batch_size=batch_size,
+        )
+        while True:
+            batches = reader.next_batches(1)
+            if not batches:
+                break
+            yield batches[0]
+    elif file_extension in [".arrow", ".feather"]:
+        data = pl.scan_ipc(data_file)
+        n_rows = data.select(pl.count()).collect().item()
+        for offset in range(0, n_rows, batch_size):
+            yield data.slice(offset, batch_size).collect()
+    else:
+        logging.error(f"Unsupported file extension: {file_extension}")
+        sys.exit(1)
+
+
+def make_store_writer(
+    store_path: str,
+    layout: str,
+    rows_per_part: int,
+    row_group_size: int,
+    compression: str | None,
+    release: str | None = None,
+    dictionary_file: str | None = None,
+    coding_file: str | None = None,
+) -> MeltedStoreWriter:
+    """Create the store writer of the requested layout."""
+    null_codes = null_codes_of(dictionary_file, coding_file)
+    if layout == "subject":
+        if dictionary_file is not None:
+            logging.warning(
+                "Typed value columns are only stored in the partitioned layout"
+            )
+        # Kept uncompressed so that the data file can be memory-mapped
+        return SubjectSortedStoreWriter(
+            store_path,
+            rows_per_part=rows_per_part,
+            row_group_size=row_group_size,
+            null_codes=null_codes,
+        )
+    value_types = None
+    if dictionary_file is not None:
+        value_types = read_value_types(dictionary_file)
+    part_format = "arrow" if layout == "mapped" else "parquet"
+    if compression is None:
+        compression = "uncompressed" if part_format == "arrow" else "zstd"
+    return MeltedStoreWriter(
+        store_path,
+        rows_per_part=rows_per_part,
+        row_group_size=row_group_size,
+        compression=compression,
+        release=release,
+        value_types=value_types,
+        part_format=part_format,
+        null_codes=null_codes,
+    )
+
+
+def null_codes_of(
+    dictionary_file: str | None, coding_file: str | None
+) -> pl.DataFrame | None:
+    """Coded null strings of the config template, when both files are given."""
+    if coding_file is None:
+        return None
+    if dictionary_file is None:
+        logging.warning("Null strings are only counted with a dictionary file")
+        return None
+    return read_null_codes(dictionary_file, coding_file, template_null_values()[0])
+
+
+def read_value_types(dictionary_file: str) -> dict[int, str]:
+    """Read the ValueType of every FieldID from Data_Dictionary_Showcase.tsv."""
+    dictionary = pl.read_csv(
+        dictionary_file,
+        separator="\t",
+        columns=["FieldID", "ValueType"],
+        dtypes={"FieldID": pl.Int64, "ValueType": pl.Utf8},
+        encoding="utf8-lossy",
+        quote_char=None,
+    )
+    return dict(dictionary.iter_rows())
+
+
+def parse_tab_header(columns: list[str]) -> pl.DataFrame:
+    """
+    Parse the value column headers of a raw UKBB .tab file.
+
+    Parameters
+    ----------
+    columns : list[str]
+        Header of the .tab file, the first column being the subject ID
+        (f.eid).
+
+    Returns
+    -------
+    pl.DataFrame
+        One row per value column, in file order, with columns FieldID,
+        InstanceID and ArrayID.
+    """
+    ids = []
+    for column in columns[1:]:
+        match = TAB_HEADER_PATTERN.match(column)
+        if match is None:
+            raise ValueError(f"Unrecognized .tab column header: {column}")
+        ids.append([int(x) for x in match.groups() if x is not None])
+    return pl.DataFrame(
+        ids,
+        schema={"FieldID": pl.Int64, "InstanceID": pl.Int64, "ArrayID": pl.Int64},
+        orient="row",
+    )
+
+
+def tab_chunk_ranges(tab_file: str, chunk_bytes: int) -> list[tuple[int, int]]:
+    """
+    Split the body of a .tab file into byte ranges made of whole rows.
+
+    Parameters
+    ----------
+    tab_file : str
+        Path to the raw .tab file.
+    chunk_bytes : int
+        Approximate size of each range.
+
+    Returns
+    -------
+    list[tuple[int, int]]
+        (start, end) byte offsets, the first range starting after the header.
+    """
+    size = os.path.getsize(tab_file)
+    ranges = []
+    with open(tab_file, "rb") as stream:
+        stream.readline()
+        start = stream.tell()
+        while start < size:
+            stream.seek(min(start + chunk_bytes, size))
+            # Complete the current row
+            stream.readline()
+            end = min(stream.tell(), size)
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+
+def unquote_values(values: pl.Expr) -> pl.Expr:
+    """
+    Remove the CSV quoting of quoted .tab values, e.g. "" for an empty string.
+
+    Quotes are not parsed when reading .tab files, as free-text values may
+    hold stray quote characters. Values quoted as a whole are unquoted here,
+    as the melted TSV reader does, so that both inputs give the same rows.
+    """
+    quoted = values.str.extract(r'^"((?s).*)"$', 1)
+    return (
+        pl.when(quoted.is_not_null())
+        .then(quoted.str.replace_all('""', '"', literal=True))
+        .otherwise(values)
+        .alias("FieldValue")
+    )
+
+
+def melt_tab_chunk(
+    tab_file: str,
+    columns: list[str],
+    header: pl.DataFrame,
+    start: int,
+    end: int,
+    run_path: str,
+    spill_key: str = "FieldID",
+    selected: list[int] | None = None,
+) -> pl.DataFrame:
+    """
+    Melt one byte range of a .tab file and spill it as a store run.
+
+    This is the process pool worker of ingest_tab_file().
+
+    Parameters
+    ----------
+    tab_file : str
+        Path to the raw .tab file.
+    columns : list[str]
+        Header of the .tab file.
+    header : pl.DataFrame
+        Parsed headers of the melted value columns, see parse_tab_header().
+    start, end : int
+        Byte range of whole rows to melt.
+    run_path : str
+        Destination of the spill run.
+    spill_key : str, default="FieldID"
+        Sort key of the spill run, see store.write_spill_run().
+    selected : list[int], optional
+        Indices of the columns to read, the subject ID column first. None
+        reads all columns.
+
+    Returns
+    -------
+    pl.DataFrame
+        Run index, see store.write_spill_run().
+    """
+    with open(tab_file, "rb") as stream:
+        stream.seek(start)
+        buffer = stream.read(end - start)
+    if selected is None:
+        selected = list(range(len(columns)))
+    chunk = pl.read_csv(
+        io.BytesIO(buffer),
+        has_header=False,
+        columns=selected,
+        separator="\t",
+        quote_char=None,
+        infer_schema_length=0,
+        null_values="NA",
+        missing_utf8_is_empty_string=True,
+        encoding="utf8-lossy",
+    )
+    chunk.columns = [columns[i] for i in selected]
+    subject_column = columns[0]
+    # melt stacks the value columns one after the other, so the parsed header
+    # is attached by repeating each of its rows once per subject
+    melted = chunk.melt(id_vars=subject_column, value_name="FieldValue")
+    melted = pl.concat(
+        [
+            melted.select(
+                [
+                    pl.col(subject_column).cast(pl.Int64).alias("SubjectID"),
+                    unquote_values(pl.col("FieldValue")),
+                ]
+            ),
+            header.select(pl.all().repeat_by(chunk.height).explode()),
+        ],
+        how="horizontal",
+    ).filter(pl.col("FieldValue").is_not_null())
+    return write_spill_run(melted, run_path, spill_key)
+
+
+def ingest_tab_file(
+    tab_file: str,
+    store_path: str,
+    workers: int | None = None,
+    chunk_bytes: int = 128 * 1024**2,
+    rows_per_part: int = 1_000_000,
+    row_group_size: int = 100_000,
+    compression: str | None = None,
+    layout: str = "partitioned",
+    release: str | None = None,
+    field_ids: list[int] | None = None,
+    dictionary_file: str | None = None,
+    coding_file: str | None = None,
+) -> dict:
+    """
+    Melt a raw UKBB .tab file in parallel into a partitioned melted store.
+
+    The header is parsed once, the file body is split into byte ranges of
+    whole rows, and each range is melted, stripped of NAs, typed and spilled
+    by a worker process. The runs are then merged into the store by
+    MeltedStoreWriter.
+
+    Parameters
+    ----------
+    tab_file : str
+        Path to the raw ultra-wide .tab file.
+    store_path : str
+        Output store directory, must not exist or be empty.
+    workers : int, optional
+        Number of worker processes, defaults to the number of CPUs.
+    chunk_bytes : int, default=128 MiB
+        Size of the .tab byte range melted by each task. Each worker holds
+        roughly one melted range in memory.
+    rows_per_part, row_group_size, compression, layout, release, field_ids,
+    dictionary_file, coding_file
+        See ingest_melted_data(). Columns of other fields are not read.
+
+    Returns
+    -------
+    dict
+        The store manifest.
+    """
+    workers = workers or os.cpu_count()
+    with open(tab_file, "r", encoding="utf8", errors="replace") as stream:
+        columns = stream.readline().rstrip("\r\n").split("\t")
+    header = parse_tab_header(columns).with_row_count("column", offset=1)
+    if field_ids:
+        header = header.filter(pl.col("FieldID").is_in(field_ids))
+    selected = [0] + header.get_column("column").to_list()
+    header = header.drop("column")
+    ranges = tab_chunk_ranges(tab_file, chunk_bytes)
+    logging.info(
+        f"Melting {header.height} columns of {tab_file} in {len(ranges)} chunks"
+        f" with {workers} workers"
+    )
+
+    writer = make_store_writer(
+        store_path,
+        layout,
+        rows_per_part,
+        row_group_size,
+        compression,
+        release,
+        dictionary_file,
+        coding_file,
+    )
+    # Share the cores between the workers' Polars thread pools, the variable
+    # is read by the spawned processes when they import Polars
+    polars_max_threads = os.environ.get("POLARS_MAX_THREADS")
+    os.environ["POLARS_MAX_THREADS"] = str(max(1, os.cpu_count() // workers))
+    try:
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            futures = {}
+            for start, end in ranges:
+                run_path = writer.next_run_path()
+                future = executor.submit(
+                    melt_tab_chunk,
+                    tab_file,
+                    columns,
+                    header,
+                    start,
+                    end,
+                    run_path,
+                    writer.spill_key,
+                    selected,
+                )
+                futures[future] = run_path
+            for future in concurrent.futures.as_completed(futures):
+                writer.add_run(futures[future], future.result())
+                logging.debug(f"Melted {futures[future]}")
+    finally:
+        if polars_max_threads is None:
+            del os.environ["POLARS_MAX_THREADS"]
+        else:
+            os.environ["POLARS_MAX_THREADS"] = polars_max_threads
+    return writer.close()
+
+
+def ingest_melted_data(
+    data_file: str,
+    store_path: str,
+    batch_size: int = 10_000_000,
+    rows_per_part: int = 1_000_000,
+    row_group_size: int = 100_000,
+    compression: str | None = None,
+    layout: str = "partitioned",
+    release: str | None = None,
+    field_ids: list[int] | None = None,
+    dictionary_file: str | None = None,
+    coding_file: str | None = None,
+) -> dict:
+    """
+    Build a partitioned melted store from a melted TSV or Arrow file.
+
+    Parameters
+    ----------
+    data_file : str
+        Melted input data, .tsv or .arrow/.feather.
+    store_path : str
+        Output store directory, must not exist or be empty.
+    batch_size : int, default=10_000_000
+        Rows read and spilled per batch, bounds memory during the first pass.
+    rows_per_part : int, default=1_000_000
+        Target rows per part file within a FieldID partition.
+    row_group_size : int, default=100_000
+        Parquet row group size, or Arrow record batch size, within each part
+        file.
+    compression : str, optional
+        Compression codec of the part files, zstd by default for the
+        partitioned layout, and uncompressed (or lz4) for the mapped layout.
+        The subject-sorted layout is always written as uncompressed Arrow IPC
+        so that it can be memory-mapped.
+    layout : str, default="partitioned"
+        Store layout, "partitioned" (by FieldID), "mapped" (by FieldID, with
+        memory-mappable Arrow IPC part files) or "subject" (sorted by
+        SubjectID with a subject offset index), see store.py.
+    release : str, optional
+        Name of the release, recorded in the manifest.
+    field_ids : list[int], optional
+        Only ingest these FieldIDs, None ingests all fields.
+    dictionary_file : str, optional
+        UKBB data dictionary. When given, the partitioned layout stores typed
+        value columns alongside FieldValue according to each field's
+        ValueType (see store.typed_values()).
+    coding_file : str, optional
+        UKBB codings. With the dictionary, the statistics index counts the
+        values coded as null strings (see field_statistics.py).
+
+    Returns
+    -------
+    dict
+        The store manifest.
+    """
+    writer = make_store_writer(
+        store_path,
+        layout,
+        rows_per_part,
+        row_group_size,
+        compression,
+        release,
+        dictionary_file,
+        coding_file,
+    )
+    for batch in iter_melted_batches(data_file, batch_size):
+        if field_ids:
+            batch = batch.filter(pl.col("FieldID").is_in(field_ids))
+        logging.info(f"Spilling batch of {batch.height} rows")
+        writer.write_batch(batch)
+    return writer.close()
+
+
+def update_store(
+    data_file: str,
+    store_path: str,
+    release: str | None = None,
+    withdrawn_file: str | None = None,
+    field_ids: list[int] | None = None,
+    workers: int | None = None,
+    chunk_bytes: int = 128 * 1024**2,
+    batch_size: int = 10_000_000,
+    dictionary_file: str | None = None,
+    coding_file: str | None = None,
+) -> dict:
+    """
+    Merge a new UKBB release or basket into an existing partitioned store.
+
+    The new data (raw .tab or melted) is ingested into a staging store inside
+    the existing one, using the existing store's settings, and then merged
+    by store.update_melted_store(): only the partitions of added or changed
+    fields, and the parts holding withdrawn participants, are rewritten.
+
+    Parameters
+    ----------
+    data_file : str
+        New raw .tab or melted data.
+    store_path : str
+        Existing fieldid-partitioned store.
+    release : str, optional
+        Name of the new release, recorded in the manifest.
+    withdrawn_file : str, optional
+        File of withdrawn SubjectIDs, one per line.
+    field_ids : list[int], optional
+        Only take these FieldIDs from the new data, None takes all fields.
+    workers, chunk_bytes, batch_size
+        See ingest_tab_file() and ingest_melted_data().
+    dictionary_file : str, optional
+        UKBB data dictionary, required when the store has typed value
+        columns.
+    coding_file : str, optional
+        UKBB codings, required with the dictionary when the statistics index
+        of the store counts null strings.
+
+    Returns
+    -------
+    dict
+        The updated store manifest.
+
+    Raises
+    ------
+    ValueError
+        If the store is not fieldid-partitioned, or has typed value columns
+        and no dictionary file is given.
+    """
+    manifest = read_manifest(store_path)
+    if manifest.get("layout", PARTITIONED_LAYOUT) != PARTITIONED_LAYOUT:
+        # Checked before ingesting, subject-sorted stores have no part settings
+        raise ValueError(f"Only {PARTITIONED_LAYOUT} stores can be updated")
+    if "value_types" in manifest and dictionary_file is None:
+        raise ValueError(
+            f"{store_path} has typed value columns, a dictionary file is required"
+        )
+    staging_path = p.Path(store_path) / "_staging"
+    if staging_path.exists():
+        # Left over from an interrupted update
+        shutil.rmtree(staging_path)
+    options = {
+        "rows_per_part": manifest.get("rows_per_part", 1_000_000),
+        "row_group_size": manifest["row_group_size"],
+        "compression": manifest["compression"],
+        "layout": "mapped"
+        if manifest.get("part_format", "parquet") == "arrow"
+        else "partitioned",
+        "release": release,
+        "field_ids": field_ids,
+        "dictionary_file": dictionary_file,
+        "coding_file": coding_file,
+    }
+    if p.Path(data_file).suffix == ".tab":
+        ingest_tab_file(
+            data_file, staging_path, workers=workers, chunk_bytes=chunk_bytes, **options
+        )
+    else:
+        ingest_melted_data(data_file, staging_path, batch_size=batch_size, **options)
+
+    withdrawn_subjects = []
+    if withdrawn_file is not None:
+        with open(withdrawn_file, "r") as stream:
+            withdrawn_subjects = [int(x) for x in stream.read().split()]
+    return update_melted_store(
+        store_path,
+        staging_path,
+        release,
+        withdrawn_subjects,
+        null_codes_of(dictionary_file, coding_file),
+    )
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog="UKBB Melted Store Ingest",
+        description="Converts raw or melted UKBB tabular data into a FieldID-partitioned, SubjectID-sorted Parquet store",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+
+    parser.add_argument(
+        "--data-file",
+        help="UKBB raw tabular data (.tab) or melted tabular data (.tsv or .arrow/.feather)",
+        required=True,
+    )
+    parser.add_argument(
+        "--store", help="Output store directory", required=True
+    )
+    parser.add_argument(
+        "--update",
+        help="Merge the data file into the existing store as a new release, rewriting only added or changed fields and parts holding withdrawn participants",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--release",
+        help="Name of the release recorded in the store manifest, defaults to the data file name",
+        default=None,
+    )
+    parser.add_argument(
+        "--withdrawn-file",
+        help="File of withdrawn SubjectIDs (one per line) to remove from the store when updating",
+        default=None,
+    )
+    parser.add_argument(
+        "--fields",
+        help="Only ingest these FieldIDs from the data file",
+        type=int,
+        nargs="*",
+        default=None,
+    )
+    parser.add_argument(
+        "--dictionary-file",
+        help="UKBB data dictionary showcase file, when given the partitioned layout also stores typed value columns (ValueFloat, ValueInt, ValueDate, ValueDatetime) according to each field's ValueType",
+        default=None,
+    )
+    parser.add_argument(
+        "--coding-file",
+        help="UKBB data coding file, when given with the dictionary file the field statistics also count the values coded as the drop_null_strings of the config template",
+        default=None,
+    )
+    parser.add_argument(
+        "--layout",
+        help="Store layout: partitioned by FieldID, partitioned by FieldID with memory-mapped Arrow IPC part files, or sorted by SubjectID with a subject offset index for cohort extractions",
+        choices=["partitioned", "mapped", "subject"],
+        default="partitioned",
+    )
+    parser.add_argument(
+        "--batch-size",
+        help="Number of rows read and spilled per batch",
+        type=int,
+        default=10_000_000,
+    )
+    parser.add_argument(
+        "--workers",
+        help="Number of worker processes melting a raw .tab file, defaults to the number of CPUs",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "--chunk-bytes",
+        help="Size in bytes of the raw .tab ranges melted by each worker task",
+        type=int,
+        default=128 * 1024**2,
+    )
+    parser.add_argument(
+        "--rows-per-part",
+        help="Target number of rows per part file within a FieldID partition",
+        type=int,
+        default=1_000_000,
+    )
+    parser.add_argument(
+        "--row-group-size",
+        help="Parquet row group size, or Arrow record batch size of the mapped layout",
+        type=int,
+        default=100_000,
+    )
+    parser.add_argument(
+        "--compression",
+        help="Compression codec of the part files, zstd for the partitioned layout and uncompressed for the mapped layout (which also takes lz4) by default",
+        default=None,
+    )
+    parser.add_argument(
+        "-v", "--verbose", help="increase output verbosity", action="store_true"
+    )
+
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format="%(asctime)s %(message)s",
+        datefmt="%Y-%m-%dT%H:%M:%S",
+        level=logging.DEBUG if args.verbose else logging.INFO,
+    )
+
+    release = args.release or p.Path(args.data_file).stem
+
+    try:
+        if args.update:
+            update_store(
+                data_file=args.data_file,
+                store_path=args.store,
+                release=release,
+                withdrawn_file=args.withdrawn_file,
+                field_ids=args.fields,
+                workers=args.workers,
+                chunk_bytes=args.chunk_bytes,
+                batch_size=args.batch_size,
+                dictionary_file=args.dictionary_file,
+                coding_file=args.coding_file,
+            )
+        elif p.Path(args.data_file).suffix == ".tab":
+            ingest_tab_file(
+                tab_file=args.data_file,
+                store_path=args.store,
+                workers=args.workers,
+                chunk_bytes=args.chunk_bytes,
+                rows_per_part=args.rows_per_part,
+                row_group_size=args.row_group_size,
+                compression=args.compression,
+                layout=args.layout,
+                release=release,
+                field_ids=args.fields,
+                dictionary_file=args.dictionary_file,
+                coding_file=args.coding_file,
+            )
+        else:
+            ingest_melted_data(
+                data_file=args.data_file,
+                store_path=args.store,
+                batch_size=args.batch_size,
+                rows_per_part=args.rows_per_part,
+                row_group_size=args.row_group_size,
+                compression=args.compression,
+                layout=args.layout,
+                release=release,
+                field_ids=args.fields,
+                dictionary_file=args.dictionary_file,
+                coding_file=args.coding_file,
+            )
+    except (FileExistsError, FileNotFoundError, ValueError) as exc:
+        logging.exception(exc)
+        sys.exit(1)
@@ -12,7 +12,8 @@ The module supports:
 - Optional pivoting to wide format with proper type assignment
 - Output to TSV, Arrow/Feather, Parquet, or CSV formats
 
-Input data can be in TSV format or compressed binary Arrow format.
+Input data can be in TSV format, compressed binary Arrow format, or a
+FieldID-partitioned Parquet store built by ingest.py (see store.py).
 All processing uses Polars LazyFrames with streaming for memory efficiency.
 
 Required UKBB Showcase files:
@@ -23,15 +24,1377 @@ Required UKBB Showcase files:
 """
 from __future__ import annotations
 
+import contextlib
+import copy
+import json
 import logging
 import pathlib as p
 import sys
+import tempfile
+from collections.abc import Iterator
 
 import pprint
 
 import polars as pl
 
-from config import Config, load_config
+from cohort import (
+    check_cohort_files,
+    cohort_statistics,
+    filter_subjects,
+    selected_subjects,
+)
+from config import Config, format_config, load_config
+from field_statistics import fields_with_data, wide_fields
+from metadata import Metadata, load_metadata, metadata_key
+from profiling import Profile, profile_stage
+from result_cache import (
+    DEFAULT_RESULT_CACHE_SIZE,
+    find_result,
+    read_result,
+    result_keys,
+    write_result,
+)
+from store import (
+    MELTED_SCHEMA,
+    TYPED_VALUE_COLUMNS,
+    VALUE_TYPE_COLUMNS,
+    is_melted_store,
+    read_field_statistics,
+    read_manifest,
+    scan_melted_store,
+)
+from writers import (
+    COMPRESSIONS,
+    OUTPUT_FORMATS,
+    is_streamable,
+    sink_frame,
+    write_outputs,
+)
+
+# Mapping of UKBB ValueType strings to Polars data types
+# Used when recode_wide_column_valuetypes=True to properly type pivoted columns
+datatype_dictionary = {
+    "Date": pl.Date,
+    "Time": pl.Datetime,
+    "Continuous": pl.Float64,
+    "Text": pl.Utf8,
+    "Integer": pl.Int64,
+    "Categorical multiple": pl.Categorical,
+    "Categorical single": pl.Categorical,
+    "Compound": pl.Utf8,
+}
+
+# Index columns of the wide output
+WIDE_INDEX = ["SubjectID", "InstanceID", "ArrayID"]
+
+# Date of attending assessment centre, recorded at every visit of a subject
+ATTENDANCE_FIELD_ID = 53
+
+
+def wide_column_expression(column: str, val_type: str, config: Config) -> pl.Expr:
+    """
+    Build the expression converting a pivoted string column to its ValueType.
+
+    Parameters
+    ----------
+    column : str
+        Name of the wide column.
+    val_type : str
+        UKBB ValueType of the column's FieldID.
+    config : Config
+        Extraction configuration, for convert_compound_to_list.
+
+    Returns
+    -------
+    pl.Expr
+        Expression producing the typed column under the same name.
+    """
+    if val_type == "Date":
+        return pl.col(column).str.strptime(pl.Date)
+    elif val_type == "Time":
+        return pl.col(column).str.strptime(pl.Datetime)
+    elif val_type == "Compound" and config["convert_compound_to_list"]:
+        # Compound fields contain comma-separated values
+        return pl.col(column).str.split(",")
+    else:
+        return pl.col(column).cast(datatype_dictionary[val_type])
+
+
+def wide_column_order(columns: list[str]) -> list[str]:
+    """
+    Sort wide column names by FieldID.
+
+    Column names may be FieldID only or Field_FieldID depending on
+    recode_field_names, so the numeric ID is taken from the end.
+    """
+    return sorted(columns, key=lambda column: int(column.rsplit("_", 1)[-1]))
+
+
+def sort_wide(data_wide: pl.DataFrame | pl.LazyFrame) -> pl.DataFrame | pl.LazyFrame:
+    """
+    Order wide data independently of the order of the narrow input.
+
+    The pivot keeps the order in which fields and subjects first appear in
+    the input, which differs between e.g. a melted file and a store. Columns
+    are sorted by FieldID and rows by SubjectID, InstanceID and ArrayID.
+    """
+    return data_wide.select(
+        WIDE_INDEX + wide_column_order(data_wide.columns[len(WIDE_INDEX) :])
+    ).sort(
+        [
+            pl.col("SubjectID"),
+            pl.col("InstanceID").cast(pl.Utf8).cast(pl.Int64),
+            pl.col("ArrayID").cast(pl.Utf8).cast(pl.Int64),
+        ]
+    )
+
+
+def wide_value_types(columns: list[str], dictionary: pl.DataFrame) -> dict[str, str]:
+    """
+    Resolve the ValueType of wide column names with a single dictionary join.
+
+    Column names may be FieldID only or Field_FieldID depending on
+    recode_field_names, so the numeric ID is taken from the end.
+    """
+    value_types = (
+        pl.DataFrame({"column": columns}, schema={"column": pl.Utf8})
+        .with_columns(pl.col("column").str.split("_").list.last().alias("key"))
+        .join(
+            dictionary.select(
+                [pl.col("FieldID").cast(pl.Utf8).alias("key"), "ValueType"]
+            ),
+            on="key",
+            how="left",
+        )
+    )
+    return {
+        column: val_type
+        for column, _, val_type in value_types.iter_rows()
+        if val_type is not None
+    }
+
+
+def set_wide_column_types(
+    data_wide: pl.DataFrame,
+    dictionary: pl.DataFrame,
+    config: Config,
+    columns: list[str] | None = None,
+) -> pl.DataFrame:
+    """
+    Convert the pivoted string columns of a wide frame to their ValueTypes.
+
+    The ValueTypes of all columns are resolved with a single join against the
+    dictionary and all conversions are applied in one with_columns. Only when
+    that fails (columns with mixed value types) are the conversions retried
+    column by column, leaving the failing columns as strings.
+
+    Parameters
+    ----------
+    data_wide : pl.DataFrame
+        Pivoted data, index columns followed by one string column per FieldID.
+    dictionary : pl.DataFrame
+        Data dictionary subset with FieldID and ValueType.
+    config : Config
+        Extraction configuration, for convert_compound_to_list.
+    columns : list[str], optional
+        String columns to convert, all non-index columns by default.
+
+    Returns
+    -------
+    pl.DataFrame
+        The wide frame with typed columns.
+    """
+    if columns is None:
+        columns = data_wide.columns[len(WIDE_INDEX) :]
+    expressions = {
+        column: wide_column_expression(column, val_type, config)
+        for column, val_type in wide_value_types(columns, dictionary).items()
+        if val_type in datatype_dictionary
+    }
+    try:
+        return data_wide.with_columns(list(expressions.values()))
+    except pl.exceptions.ComputeError:
+        pass
+
+    typed_columns = []
+    for column, expression in expressions.items():
+        try:
+            typed_columns.append(data_wide.select(expression).to_series())
+        except pl.exceptions.ComputeError as exe:
+            logging.warning(exe)
+            logging.warning(
+                f"Column {column} data type could not be set due to mixed value types"
+            )
+    return data_wide.with_columns(typed_columns)
+
+
+def pivot_typed_values(
+    data: pl.DataFrame, dictionary: pl.DataFrame, config: Config
+) -> pl.DataFrame:
+    """
+    Pivot narrow data with typed value columns to a typed wide frame.
+
+    The pivot only spreads row numbers of the narrow frame. Each wide column
+    is then gathered from the typed value column of its ValueType (see
+    store.VALUE_TYPE_COLUMNS) when that column holds a value for every row of
+    the field, i.e. when no value was recoded or failed to parse at ingest,
+    so the values are not parsed again. Other columns are gathered from
+    FieldValue and converted by set_wide_column_types(), which yields the
+    same result as pivoting and converting the strings.
+
+    Parameters
+    ----------
+    data : pl.DataFrame
+        Narrow data with FieldValue and the typed value columns.
+    dictionary : pl.DataFrame
+        Data dictionary subset with FieldID and ValueType.
+    config : Config
+        Extraction configuration, for convert_compound_to_list.
+
+    Returns
+    -------
+    pl.DataFrame
+        The typed wide frame.
+    """
+    typed = [column for column in TYPED_VALUE_COLUMNS if column in data.columns]
+    data = data.with_columns(pl.col("FieldValue").cast(pl.Utf8)).with_row_count("row")
+    rows = data.pivot(
+        index=WIDE_INDEX,
+        values="row",
+        columns="FieldID",
+        aggregate_function=None,
+    )
+    columns = rows.columns[len(WIDE_INDEX) :]
+    # Fields whose typed values survived for every row
+    complete = (
+        data.groupby(pl.col("FieldID").cast(pl.Utf8))
+        .agg(
+            [
+                (pl.col(column).is_not_null().sum() == pl.count()).alias(column)
+                for column in typed
+            ]
+        )
+        .rows_by_key("FieldID", named=True, unique=True)
+    )
+    value_types = wide_value_types(columns, dictionary)
+    string_columns = []
+    wide_columns = []
+    for column in columns:
+        source = VALUE_TYPE_COLUMNS.get(value_types.get(column))
+        if source not in typed or not complete[column][source]:
+            source = "FieldValue"
+            string_columns.append(column)
+        wide_columns.append(
+            data.get_column(source).take(rows.get_column(column)).alias(column)
+        )
+    data_wide = rows.select(WIDE_INDEX).with_columns(wide_columns)
+    return set_wide_column_types(data_wide, dictionary, config, string_columns)
+
+
+def resolve_wide_column_types(
+    data: pl.DataFrame | pl.LazyFrame,
+    dictionary: pl.DataFrame,
+    config: Config,
+    columns: list[str] | None = None,
+) -> dict[str, str]:
+    """
+    Determine the ValueType every wide column can be converted to.
+
+    Rather than trying each conversion on the pivoted frame, the conversions
+    are checked once on the narrow FieldValues of each column, so that every
+    batch of a streaming pivot gets the same column types.
+
+    Parameters
+    ----------
+    data : pl.DataFrame or pl.LazyFrame
+        Narrow data as returned by extract_UKBB_tabular_data(), or the lazy
+        narrow query, which is then run once per ValueType.
+    dictionary : pl.DataFrame
+        Data dictionary subset with FieldID and ValueType.
+    config : Config
+        Extraction configuration.
+    columns : list[str], optional
+        Wide column names, when already known. Taken from the FieldIDs of
+        data otherwise.
+
+    Returns
+    -------
+    dict[str, str]
+        ValueType per wide column name. Columns with values which cannot be
+        converted (mixed value types) are left out and stay strings.
+    """
+    if columns is None:
+        columns = (
+            data.lazy()
+            .select(pl.col("FieldID").cast(pl.Utf8).unique())
+            .collect()
+            .get_column("FieldID")
+            .to_list()
+        )
+    value_types = wide_value_types(columns, dictionary)
+    column_types = {}
+    # The rows of one ValueType at a time are checked, without copying the
+    # whole narrow frame
+    for val_type in sorted(set(value_types.values())):
+        if val_type not in datatype_dictionary:
+            continue
+        type_columns = [
+            column
+            for column, column_type in value_types.items()
+            if column_type == val_type
+        ]
+        if val_type in ("Date", "Time"):
+            converted = pl.col("FieldValue").str.strptime(
+                datatype_dictionary[val_type], strict=False
+            )
+        elif datatype_dictionary[val_type] in (pl.Float64, pl.Int64):
+            converted = pl.col("FieldValue").cast(
+                datatype_dictionary[val_type], strict=False
+            )
+        else:
+            column_types.update(dict.fromkeys(type_columns, val_type))
+            continue
+        failures = (
+            data.lazy()
+            .select([pl.col("FieldID").cast(pl.Utf8).alias("column"), "FieldValue"])
+            .filter(pl.col("column").is_in(type_columns))
+            .groupby("column", maintain_order=True)
+            .agg(
+                (converted.null_count() - pl.col("FieldValue").null_count()).alias(
+                    "failures"
+                )
+            )
+            .collect()
+        )
+        for column, failed in failures.iter_rows():
+            if failed:
+                logging.warning(
+                    f"Column {column} data type could not be set due to mixed value types"
+                )
+            else:
+                column_types[column] = val_type
+    return column_types
+
+
+def iter_wide_batches(
+    data: pl.DataFrame | pl.LazyFrame,
+    dictionary: pl.DataFrame,
+    config: Config,
+    batch_size: int,
+    columns: list[str] | None = None,
+) -> Iterator[pl.DataFrame]:
+    """
+    Pivot narrow data to wide format in batches of subjects.
+
+    Every batch holds the rows of at most batch_size consecutive SubjectIDs
+    and has the same, precomputed set of columns and column types, so batches
+    can be appended to a single output. Peak memory of the pivot is bounded by
+    the batch rather than the full extraction. Given the lazy narrow query
+    (e.g. ExtractionQuery.narrow()), the narrow data is never held in memory
+    either: the SubjectIDs, columns and column types are aggregated from the
+    query, and each batch collects its range of SubjectIDs only, which is
+    pushed down to the scan of the data.
+
+    Parameters
+    ----------
+    data : pl.DataFrame or pl.LazyFrame
+        Narrow data as returned by extract_UKBB_tabular_data(), or the lazy
+        narrow query, which is then run once per batch.
+    dictionary : pl.DataFrame
+        Data dictionary subset with FieldID and ValueType.
+    config : Config
+        Extraction configuration, recode_wide_column_valuetypes and
+        convert_compound_to_list apply as for the eager pivot.
+    batch_size : int
+        Maximum number of subjects per batch.
+    columns : list[str], optional
+        Wide columns of the extraction when known up front, e.g. from
+        ExtractionQuery.wide_columns(), which saves aggregating them from
+        the data.
+
+    Yields
+    ------
+    pl.DataFrame
+        Wide batches, columns as returned by extract_UKBB_tabular_data().
+
+    Notes
+    -----
+    Run under a pl.StringCache() when the batches are combined, so that
+    Categorical columns of different batches are compatible.
+    """
+    data = data.lazy().with_columns(pl.col("FieldValue").cast(pl.Utf8))
+    if columns is None:
+        subject_ids, columns = pl.collect_all(
+            [
+                data.select(pl.col("SubjectID").unique().sort()),
+                data.select(pl.col("FieldID").cast(pl.Utf8).unique()),
+            ]
+        )
+        columns = columns.get_column("FieldID").to_list()
+    else:
+        subject_ids = data.select(pl.col("SubjectID").unique().sort()).collect()
+    subject_ids = subject_ids.get_column("SubjectID")
+    columns = wide_column_order(columns)
+    if config["recode_wide_column_valuetypes"]:
+        column_types = resolve_wide_column_types(data, dictionary, config, columns)
+    else:
+        column_types = {}
+    logging.info(
+        f"Pivoting {subject_ids.len()} subjects to {len(columns)} columns"
+        f" in batches of {batch_size}"
+    )
+    for offset in range(0, max(subject_ids.len(), 1), batch_size):
+        if subject_ids.len():
+            # Batches are ranges of SubjectIDs, which the scan can filter on
+            first = subject_ids[offset]
+            last = subject_ids[min(offset + batch_size, subject_ids.len()) - 1]
+            batch = data.filter(pl.col("SubjectID").is_between(first, last)).collect()
+            batch = batch.pivot(
+                index=WIDE_INDEX,
+                values="FieldValue",
+                columns="FieldID",
+                aggregate_function=None,
+            )
+        else:
+            # polars does not pivot empty frames
+            batch = data.select(WIDE_INDEX).collect()
+        batch = sort_wide(
+            batch.select(
+                WIDE_INDEX
+                + [
+                    pl.col(column)
+                    if column in batch.columns
+                    else pl.lit(None, dtype=pl.Utf8).alias(column)
+                    for column in columns
+                ]
+            )
+        )
+        yield batch.with_columns(
+            [
+                wide_column_expression(column, val_type, config)
+                for column, val_type in column_types.items()
+            ]
+        )
+
+
+def write_wide_batches(
+    batches: Iterator[pl.DataFrame],
+    output_prefix: str,
+    output_formats: list[str],
+    compression: str = "zstd",
+    compression_level: int | None = None,
+    row_group_size: int | None = None,
+) -> None:
+    """
+    Append wide batches to the wide output files as they are produced.
+
+    TSV and CSV outputs are appended directly. Arrow and Parquet outputs are
+    assembled from intermediate Parquet parts with a streaming sink, so the
+    full wide frame is never held in memory.
+
+    Parameters
+    ----------
+    batches : Iterator[pl.DataFrame]
+        Wide batches with identical schemas, see iter_wide_batches().
+    output_prefix : str
+        Prefix for output files.
+    output_formats : list[str]
+        Output formats from tsv, csv, arrow/feather, parquet.
+    compression, compression_level, row_group_size
+        See writers.write_outputs().
+
+    Notes
+    -----
+    Arrow IPC files only allow one dictionary per column, which is unknown
+    until all batches are seen, so Categorical columns are written as strings
+    to streamed arrow/feather outputs.
+    """
+    text_formats = {
+        format: open(f"{output_prefix}wide.{format}", "w")
+        for format in output_formats
+        if format in ["tsv", "csv"]
+    }
+    binary_formats = [
+        format for format in output_formats if format in ["arrow", "feather", "parquet"]
+    ]
+    with tempfile.TemporaryDirectory(
+        prefix="wide_parts_", dir=p.Path(f"{output_prefix}wide").parent
+    ) as parts_dir:
+        try:
+            for i, batch in enumerate(batches):
+                for format, stream in text_formats.items():
+                    batch.write_csv(
+                        stream,
+                        separator="\t" if format == "tsv" else ",",
+                        has_header=i == 0,
+                    )
+                if binary_formats:
+                    batch.write_parquet(
+                        f"{parts_dir}/part-{i:05d}.parquet", compression="lz4"
+                    )
+                logging.info(f"Wrote wide batch {i} ({batch.height} rows)")
+        finally:
+            for stream in text_formats.values():
+                stream.close()
+
+        for format in binary_formats:
+            parts = pl.scan_parquet(f"{parts_dir}/part-*.parquet")
+            logging.info(f"Writing {output_prefix}wide.{format}")
+            if format == "parquet":
+                parts.sink_parquet(
+                    f"{output_prefix}wide.parquet",
+                    compression=compression,
+                    compression_level=compression_level,
+                    row_group_size=row_group_size,
+                )
+            else:
+                parts.with_columns(
+                    pl.col(pl.Categorical).cast(pl.Utf8)
+                ).sink_ipc(
+                    f"{output_prefix}wide.{format}",
+                    compression=None if compression == "uncompressed" else compression,
+                )
+
+
+def expand_config(config: Config, metadata: Metadata) -> Config:
+    """
+    Expand Categories into the FieldIDs list.
+
+    The cohort files of SubjectIDFiles and ExcludeSubjectIDFiles are only
+    checked for existence, they are applied as joins by transform_data().
+
+    Parameters
+    ----------
+    config : Config
+        Extraction configuration, modified in place.
+    metadata : Metadata
+        Showcase metadata, see metadata.load_metadata().
+
+    Returns
+    -------
+    Config
+        The expanded configuration.
+    """
+    # Cohort files are joined lazily by transform_data(), only check them here
+    check_cohort_files(config)
+
+    # Expand FieldIDs if Categories are provided
+    if config["Categories"]:
+        logging.info(
+            "Categories provided, recursing down Category tree to ensure all FieldIDs are discovered"
+        )
+        # UKBB categories form a hierarchical tree, its transitive closure is
+        # precomputed in the metadata bundle
+        if metadata["category_closure"].height == 0:
+            logging.error("Category tree file (Schema 13) not found")
+            sys.exit(1)
+        config["Categories"].extend(
+            metadata["category_closure"]
+            .filter(
+                pl.col("Category").is_in(config["Categories"])
+                & pl.col("Descendant").is_in(config["Categories"]).is_not()
+            )
+            .get_column("Descendant")
+            .unique(maintain_order=True)
+            .to_list()
+        )
+        # Add all FieldIDs belonging to those categories to the filter list
+        config["FieldIDs"].extend(
+            metadata["category_fields"]
+            .filter(pl.col("Category").is_in(config["Categories"]))
+            .get_column("FieldID")
+            .to_list()
+        )
+        config["FieldIDs"] = list(dict.fromkeys(config["FieldIDs"]))
+        # Print the loaded config
+        logging.info("Input configuration after Category expansion")
+        logging.info(format_config(config))
+
+    return config
+
+
+def scan_data(data_file: str, config: Config) -> pl.LazyFrame:
+    """
+    Lazily open melted data, skipping store parts which cannot match config.
+
+    Parameters
+    ----------
+    data_file : str
+        Melted .tsv, .arrow/.feather, or a melted store directory.
+    config : Config
+        Expanded extraction configuration, used for store pruning only.
+
+    Returns
+    -------
+    pl.LazyFrame
+        Melted data with a Categorical FieldValue, the row filters of config
+        are not yet applied, except for the SubjectID range of the selected
+        subjects. Must be collected under a pl.StringCache().
+    """
+    if is_melted_store(data_file):
+        # Partitioned store, only read the partitions and parts which can
+        # match the filters. InstanceIDs can only be used for pruning when
+        # non-instanced fields are not being replicated from instance 0
+        instance_ids = (
+            None if config["replicate_non_instanced"] else config["InstanceIDs"]
+        )
+        field_ids = config["FieldIDs"]
+        statistics = read_field_statistics(data_file)
+        if statistics is not None:
+            # The statistics index knows which fields have data at the
+            # requested instances, the others need not be read at all
+            field_ids = fields_with_data(statistics, instance_ids, field_ids)
+            skipped = sorted(set(config["FieldIDs"]) - set(field_ids))
+            if skipped:
+                logging.info(f"Skipping FieldIDs without data: {skipped}")
+            if not field_ids:
+                # An empty list of FieldIDs would read every part
+                return pl.DataFrame(schema=MELTED_SCHEMA).lazy().with_columns(
+                    pl.col("FieldValue").cast(pl.Categorical)
+                )
+        data = scan_melted_store(
+            data_file,
+            field_ids=field_ids,
+            instance_ids=instance_ids,
+            array_ids=config["ArrayIDs"],
+            subject_ids=selected_subjects(config),
+        )
+    else:
+        file_extension = p.Path(data_file).suffix
+
+        if file_extension == ".tsv":
+            # We setup a LazyFrame chain of filters based on the configuration
+            data = pl.scan_csv(
+                data_file,
+                separator="\t",
+                dtypes={
+                    "SubjectID": pl.Int64,
+                    "FieldID": pl.Int64,
+                    "InstanceID": pl.Int64,
+                    "ArrayID": pl.Int64,
+                    "FieldValue": pl.Categorical,
+                },
+                encoding="utf8-lossy",
+            )
+        elif file_extension in [".arrow", ".feather"]:
+            data = pl.scan_ipc(data_file).with_columns(
+                pl.col("FieldValue").cast(pl.Categorical)
+            )
+        else:
+            logging.error(f"Unsupported file extension: {file_extension}")
+            sys.exit(1)
+
+    cohort = cohort_statistics(config)
+    if cohort is not None and cohort["subjects"]:
+        # The cohort joins are not pushed down to the scan, this range filter
+        # is, so e.g. a subject shard only reads the rows of its own range
+        data = data.filter(
+            pl.col("SubjectID").is_between(
+                cohort["SubjectID_min"], cohort["SubjectID_max"]
+            )
+        )
+    return data
+
+
+def metadata_columns(config: Config) -> set[str]:
+    """Columns of the dictionary and codings used by the recoding of config."""
+    columns = set()
+    if config["drop_null_strings"] or config["recode_data_values"]:
+        columns.add("Meaning")
+    if (
+        config["convert_less_than_value_integer"] is not None
+        or config["convert_less_than_value_continuous"] is not None
+    ):
+        columns.add("ValueType")
+    if config["recode_field_names"]:
+        columns.add("Field")
+    return columns
+
+
+def join_metadata(
+    data: pl.LazyFrame,
+    metadata: Metadata,
+    columns: set[str] | None = None,
+    field_ids: list[int] | None = None,
+) -> pl.LazyFrame:
+    """
+    Join the dictionary (Field, ValueType) and coding Meaning.
+
+    Parameters
+    ----------
+    data : pl.LazyFrame
+        Melted data.
+    metadata : Metadata
+        Showcase metadata.
+    columns : set[str], optional
+        Only join these of Field, ValueType and Meaning, see
+        metadata_columns(). The meanings are not joined at all unless Meaning
+        is requested. None joins all columns.
+    field_ids : list[int], optional
+        FieldIDs of the data, used to restrict the dictionary and meanings to
+        the rows which can match before joining.
+    """
+    dictionary = metadata["dictionary"].lazy()
+    meanings = metadata["meanings"].lazy()
+    if columns is None:
+        columns = {"Field", "ValueType", "Meaning"}
+    if field_ids:
+        dictionary = dictionary.filter(pl.col("FieldID").is_in(field_ids))
+        meanings = meanings.filter(pl.col("FieldID").is_in(field_ids))
+
+    dictionary_columns = [column for column in ["Field", "ValueType"] if column in columns]
+    if dictionary_columns:
+        data = data.join(
+            dictionary.select(["FieldID"] + dictionary_columns),
+            on="FieldID",
+            how="left",
+        )
+    if "Meaning" not in columns:
+        return data
+    # The per-field lookup of the bundle is keyed on the FieldID and the
+    # dictionary-encoded value, so the recoding is a single join on integer
+    # codes rather than a join with the dictionary Coding and then the codings
+    meanings = meanings.with_columns(
+        [pl.col("Value").cast(pl.Categorical), pl.col("Meaning").cast(pl.Categorical)]
+    )
+    return data.join(
+        meanings,
+        left_on=["FieldID", "FieldValue"],
+        right_on=["FieldID", "Value"],
+        how="left",
+    )
+
+
+def scan_attended_instances(data_file: str, config: Config) -> pl.LazyFrame:
+    """
+    Lazily read the instances attended by every subject.
+
+    A subject attended an instance when the data holds its date of attending
+    the assessment centre (ATTENDANCE_FIELD_ID) at that instance. The visits
+    do not depend on the fields of config, so non-instanced fields are
+    replicated the same way whatever fields are extracted with them.
+
+    Parameters
+    ----------
+    data_file : str
+        Melted .tsv, .arrow/.feather, or a melted store directory.
+    config : Config
+        Expanded extraction configuration, its InstanceIDs and selected
+        SubjectID range restrict the visits read.
+
+    Returns
+    -------
+    pl.LazyFrame
+        Unique SubjectID and InstanceID pairs. Must be collected under a
+        pl.StringCache().
+    """
+    visits = scan_data(
+        data_file,
+        dict(
+            config,
+            FieldIDs=[ATTENDANCE_FIELD_ID],
+            ArrayIDs=[],
+            replicate_non_instanced=False,
+        ),
+    ).filter(pl.col("FieldID") == ATTENDANCE_FIELD_ID)
+    if config["InstanceIDs"]:
+        visits = visits.filter(pl.col("InstanceID").is_in(config["InstanceIDs"]))
+    return visits.select(["SubjectID", "InstanceID"]).unique(maintain_order=True)
+
+
+def replicate_non_instanced_rows(
+    data: pl.LazyFrame,
+    instanced: pl.DataFrame,
+    attended: pl.LazyFrame,
+    instance_ids: list[int],
+) -> pl.LazyFrame:
+    """
+    Replicate the values of non-instanced fields to every instance of a subject.
+
+    Non-instanced fields are stored at InstanceID 0. Only their rows are split
+    off and joined with the instances each subject attended, so the cost
+    scales with the number of non-instanced rows. Subjects without any
+    recorded visit keep their values at instance 0.
+
+    Parameters
+    ----------
+    data : pl.LazyFrame
+        Melted data.
+    instanced : pl.DataFrame
+        field_id and instanced flag of the data fields, see metadata.py.
+        Fields missing from it are considered instanced.
+    attended : pl.LazyFrame
+        SubjectID and InstanceID of the visits of every subject, see
+        scan_attended_instances().
+    instance_ids : list[int]
+        InstanceIDs to replicate to, all instances when empty.
+
+    Returns
+    -------
+    pl.LazyFrame
+        The instanced rows, followed by the non-instanced rows replicated to
+        the attended instances of each subject, and those of subjects without
+        visits.
+    """
+    non_instanced = pl.col("FieldID").is_in(
+        instanced.filter(pl.col("instanced") == 0).get_column("field_id")
+    )
+    # Evaluate the input once for the branches below
+    data = data.cache()
+    instanced_rows = data.filter(~non_instanced)
+    if instance_ids:
+        instanced_rows = instanced_rows.filter(pl.col("InstanceID").is_in(instance_ids))
+        attended = attended.filter(pl.col("InstanceID").is_in(instance_ids))
+    non_instanced_rows = data.filter(non_instanced)
+
+    replicated_rows = (
+        non_instanced_rows.drop("InstanceID")
+        .join(attended, on="SubjectID", how="inner")
+        .select(data.columns)
+    )
+    unattended_rows = non_instanced_rows.join(attended, on="SubjectID", how="anti")
+    return pl.concat([instanced_rows, replicated_rows, unattended_rows])
+
+
+def transform_data(
+    data: pl.LazyFrame,
+    config: Config,
+    metadata: Metadata,
+    attended: pl.LazyFrame | None = None,
+    joined: bool = False,
+    optimize: bool = False,
+    stages: list[tuple[str, pl.LazyFrame]] | None = None,
+    profile: Profile | None = None,
+) -> pl.LazyFrame:
+    """
+    Apply the filters and recoding of config to melted data.
+
+    The conservative plan applies the steps in the order of the config
+    options. The optimized plan applies the ID and value filters before the
+    dictionary and codings joins, and only joins the metadata columns the
+    config uses. Both give the same rows in the same order.
+
+    Parameters
+    ----------
+    data : pl.LazyFrame
+        Melted data as returned by scan_data().
+    config : Config
+        Expanded extraction configuration.
+    metadata : Metadata
+        Showcase metadata.
+    attended : pl.LazyFrame, optional
+        Instances attended by every subject, see scan_attended_instances().
+        Required with replicate_non_instanced.
+    joined : bool, default=False
+        Whether join_metadata() was already applied to data, e.g. for a
+        shared intermediate in extract_UKBB_tabular_data_batch().
+    optimize : bool, default=False
+        Build the optimized plan instead of the conservative one.
+    stages : list, optional
+        When given, (name, LazyFrame) pairs of the plan after each filtering
+        stage are appended to it, e.g. to log stage row counts.
+    profile : Profile, optional
+        When given, the data is collected after each stage and the stage is
+        measured in profile, see profiling.py.
+
+    Returns
+    -------
+    pl.LazyFrame
+        Narrow data with columns SubjectID, InstanceID, ArrayID, FieldID,
+        FieldValue, followed by the typed value columns when data has them.
+    """
+
+    def checkpoint(name: str, data: pl.LazyFrame) -> pl.LazyFrame:
+        if stages is not None:
+            stages.append((name, data))
+        if profile is not None:
+            data = profile.materialize(name, data, **collect_options(optimize))
+        return data
+
+    # Filter rows based on SubjectIDs and cohort files if provided
+    data = filter_subjects(data, config)
+
+    # Filter rows in data based on FieldID
+    if config["FieldIDs"]:
+        data = data.filter(pl.col("FieldID").is_in(config["FieldIDs"]))
+
+    # Replication does not change ArrayIDs, and only adds instances to
+    # non-instanced fields, so these filters can run before it
+    early_instance_filter = optimize and not config["replicate_non_instanced"]
+    if optimize:
+        if config["ArrayIDs"]:
+            data = data.filter(pl.col("ArrayID").is_in(config["ArrayIDs"]))
+        if early_instance_filter and config["InstanceIDs"]:
+            data = data.filter(pl.col("InstanceID").is_in(config["InstanceIDs"]))
+    data = checkpoint("ID filters", data)
+
+    if config["replicate_non_instanced"]:
+        # Some UKBB fields (e.g., Sex, genetic sex) are non-instanced, meaning they
+        # exist only once per subject rather than at each assessment instance.
+        # This section replicates those single values across the instances of
+        # each subject.
+        if metadata["instanced"].height == 0:
+            logging.error("Data field properties file (Schema 1) not found")
+            sys.exit(1)
+        data = replicate_non_instanced_rows(
+            data, metadata["instanced"], attended, config["InstanceIDs"]
+        )
+
+    # Filter rows based on InstanceIDs if provided
+    if config["InstanceIDs"] and not early_instance_filter:
+        data = data.filter(pl.col("InstanceID").is_in(config["InstanceIDs"]))
+
+    # Filter rows based on ArrayIDs if provided
+    if config["ArrayIDs"] and not optimize:
+        data = data.filter(pl.col("ArrayID").is_in(config["ArrayIDs"]))
+
+    if config["replicate_non_instanced"]:
+        data = checkpoint("replication", data)
+
+    # Drop empty strings
+    if config["drop_empty_strings"]:
+        data = data.filter(~(pl.col("FieldValue").cast(pl.Utf8).str.lengths() == 0))
+
+    # Typed value columns of the store, parsed once at ingest
+    typed = [column for column in TYPED_VALUE_COLUMNS if column in data.columns]
+    if "ValueFloat" in typed:
+        drop_null_numerics = pl.col("ValueFloat").is_in(config["drop_null_numerics"])
+    else:
+        drop_null_numerics = (
+            pl.col("FieldValue")
+            .cast(pl.Utf8)
+            .cast(pl.Float64, strict=False)
+            .is_in(config["drop_null_numerics"])
+        )
+    # Numeric null values only depend on FieldValue, drop them before joining
+    if optimize and config["drop_null_numerics"]:
+        data = data.filter(~drop_null_numerics)
+    data = checkpoint("value filters", data)
+
+    # Join the data dictionary to the dataset
+    if not joined:
+        if optimize:
+            data = join_metadata(
+                data, metadata, metadata_columns(config), config["FieldIDs"]
+            )
+        else:
+            data = join_metadata(data, metadata)
+        data = checkpoint("joins", data)
+
+    if config["drop_null_strings"]:
+        data = data.filter(~pl.col("Meaning").is_in(config["drop_null_strings"]))
+
+    if config["drop_null_numerics"] and not optimize:
+        data = data.filter(~drop_null_numerics)
+
+    # Take coding values and replace FieldValue with it if available
+    # Typed values no longer match the replaced values, which are typed
+    # from their strings instead
+    if config["recode_data_values"]:
+        data = data.with_columns(
+            [
+                pl.when(pl.col("Meaning").is_not_null())
+                .then(pl.col("Meaning"))
+                .otherwise(pl.col("FieldValue"))
+                .alias("FieldValue")
+            ]
+            + [
+                pl.when(pl.col("Meaning").is_null()).then(pl.col(column)).keep_name()
+                for column in typed
+            ]
+        )
+
+    # Take coding values which start with "Less than" and replace with a numeric
+    less_than = pl.col("FieldValue").cast(pl.Utf8).str.starts_with("Less than")
+    if config["convert_less_than_value_integer"] is not None:
+        is_converted = less_than & (pl.col("ValueType").is_in(["Integer"]))
+        data = data.with_columns(
+            [
+                pl.when(is_converted)
+                .then(
+                    pl.lit(config["convert_less_than_value_integer"])
+                    .cast(pl.Utf8)
+                    .cast(pl.Categorical)
+                )
+                .otherwise(pl.col("FieldValue"))
+                .keep_name()
+            ]
+            + [pl.when(~is_converted).then(pl.col(column)).keep_name() for column in typed]
+        )
+
+    if config["convert_less_than_value_continuous"] is not None:
+        is_converted = less_than & (pl.col("ValueType") == "Continuous")
+        data = data.with_columns(
+            [
+                pl.when(is_converted)
+                .then(
+                    pl.lit(config["convert_less_than_value_continuous"])
+                    .cast(pl.Utf8)
+                    .cast(pl.Categorical)
+                )
+                .otherwise(pl.col("FieldValue"))
+                .keep_name()
+            ]
+            + [pl.when(~is_converted).then(pl.col(column)).keep_name() for column in typed]
+        )
+
+    # Replace FieldID with concatenation of FieldID and Field
+    if config["recode_field_names"]:
+        data = data.with_columns(
+            pl.concat_str([pl.col("Field"), pl.col("FieldID")], separator="_").alias(
+                "FieldID"
+            )
+        )
+
+    # Drop extra columns and reorder
+    data = data.select(
+        ["SubjectID", "InstanceID", "ArrayID", "FieldID", "FieldValue"] + typed
+    )
+    data = checkpoint("metadata filters and recoding", data)
+
+    return data
+
+
+def collect_options(optimize: bool = False) -> dict:
+    """Options of LazyFrame.collect() for the plans of transform_data()."""
+    # Common subplan elimination is not supported by the streaming engine
+    return dict(streaming=True, no_optimization=not optimize, comm_subplan_elim=False)
+
+
+def collect_data(
+    data: pl.LazyFrame,
+    optimize: bool = False,
+    stages: list[tuple[str, pl.LazyFrame]] | None = None,
+    profile: Profile | None = None,
+) -> pl.DataFrame:
+    """
+    Collect a plan built by transform_data() with the streaming engine.
+
+    Parameters
+    ----------
+    data : pl.LazyFrame
+        Plan to collect.
+    optimize : bool, default=False
+        Enable the polars optimizer (predicate and projection pushdown) and
+        log the optimized plan. Otherwise the plan is run as written.
+    stages : list, optional
+        (name, LazyFrame) stages recorded by transform_data(), whose row
+        counts are logged. Each count runs its part of the plan again.
+    profile : Profile, optional
+        Measure the collection as stage "collect" in profile.
+
+    Returns
+    -------
+    pl.DataFrame
+        The collected data.
+    """
+    options = collect_options(optimize)
+    if optimize:
+        logging.info(
+            "Optimized query plan:\n"
+            + data.explain(streaming=True, comm_subplan_elim=False)
+        )
+    for name, stage in stages or []:
+        rows = stage.select(pl.count()).collect(**options).item()
+        logging.info(f"Rows after {name}: {rows}")
+    with profile_stage(profile, "collect") as record:
+        data = data.collect(**options)
+        record["rows_out"] = data.height
+    logging.info(f"Extracted {data.height} rows")
+    return data
+
+
+def scan_metadata(
+    config: Config, metadata: Metadata
+) -> tuple[pl.LazyFrame, pl.LazyFrame]:
+    """Lazily subset the dictionary and codings to the FieldIDs of config."""
+    dictionary = metadata["dictionary"].lazy()
+    codings = metadata["codings"].lazy()
+    if config["FieldIDs"]:
+        dictionary = dictionary.filter(pl.col("FieldID").is_in(config["FieldIDs"]))
+        codings = codings.join(
+            dictionary.select("Coding").unique(), on="Coding", how="semi"
+        )
+    return dictionary, codings
+
+
+def subset_metadata(
+    config: Config, metadata: Metadata
+) -> tuple[pl.DataFrame, pl.DataFrame]:
+    """Subset the dictionary and codings to the FieldIDs of config."""
+    dictionary, codings = scan_metadata(config, metadata)
+    return dictionary.collect(), codings.collect()
+
+
+def categorize_index(data: pl.DataFrame | pl.LazyFrame) -> pl.DataFrame | pl.LazyFrame:
+    """Cast InstanceID and ArrayID to Categorical to reduce memory usage."""
+    return data.with_columns(
+        [
+            pl.col("InstanceID").cast(pl.Utf8).cast(pl.Categorical),
+            pl.col("ArrayID").cast(pl.Utf8).cast(pl.Categorical),
+        ]
+    )
+
+
+def finalize_data(
+    data: pl.DataFrame,
+    dictionary: pl.DataFrame,
+    config: Config,
+    profile: Profile | None = None,
+) -> tuple[pl.DataFrame, pl.DataFrame | None]:
+    """
+    Categorize the index columns and, if configured, pivot to wide format.
+
+    When profile is given, the pivot and the typing of the wide columns are
+    measured in it.
+
+    Returns
+    -------
+    tuple containing the narrow data and the wide data (None unless
+    config['wide']). FieldValue of the narrow data is cast back to strings,
+    so that results can be combined outside a string cache.
+    """
+    data = categorize_index(data)
+    typed = [column for column in TYPED_VALUE_COLUMNS if column in data.columns]
+    narrow = data.drop(typed).with_columns(pl.col("FieldValue").cast(pl.Utf8))
+
+    if config["wide"] and narrow.height == 0:
+        # Polars can not pivot an empty frame
+        logging.warning("No data selected, the wide output has no field columns")
+        return narrow, narrow.select(WIDE_INDEX)
+
+    # Optional wide format output: pivot from long to wide format
+    # Each unique FieldID becomes a column, with one row per subject/instance/array
+    if config["wide"] and config["recode_wide_column_valuetypes"] and typed:
+        logging.info("Pivoting narrow DataFrame to wide using typed values")
+        with profile_stage(profile, "pivot and typing", data.height) as record:
+            data_wide = sort_wide(pivot_typed_values(data, dictionary, config))
+            record["rows_out"] = data_wide.height
+        return narrow, data_wide
+
+    if config["wide"]:
+        logging.info("Pivoting narrow DataFrame to wide")
+        with profile_stage(profile, "pivot", narrow.height) as record:
+            data_wide = sort_wide(
+                narrow.pivot(
+                    index=WIDE_INDEX,
+                    values="FieldValue",
+                    columns="FieldID",
+                    aggregate_function=None,
+                )
+            )
+            record["rows_out"] = data_wide.height
+
+        if config["recode_wide_column_valuetypes"]:
+            # After pivoting, all columns are strings. This section assigns proper
+            # data types based on the UKBB ValueType field from the data dictionary.
+            logging.info("Setting data types on columns")
+            with profile_stage(profile, "typing") as record:
+                data_wide = set_wide_column_types(data_wide, dictionary, config)
+                record["rows_out"] = data_wide.height
+
+        return narrow, data_wide
+
+    else:
+        return narrow, None
+
+
+class ExtractionQuery:
+    """
+    Lazy extraction of UKBB tabular data, see scan_UKBB_tabular_data().
+
+    The narrow data, wide data, dictionary and codings of the extraction are
+    returned as LazyFrames, so that callers can add their own filters,
+    aggregations and joins and have polars optimize the whole pipeline.
+    Nothing is read until a frame is collected.
+
+    FieldValue and the coding meanings are Categorical within the query, so
+    frames must be collected under a global string cache. Using the query as a context
+    manager enables one for the duration of the block:
+
+        with scan_UKBB_tabular_data(config, ...) as query:
+            females = query.wide().filter(pl.col("Sex_31") == "Female").collect()
+
+    Parameters
+    ----------
+    config : Config
+        Expanded extraction configuration, see expand_config().
+    data_file : str
+        Melted data file or store, see scan_data().
+    metadata : Metadata
+        Showcase metadata.
+    optimize : bool, default=True
+        Build the optimized query plan, see transform_data().
+    """
+
+    def __init__(
+        self, config: Config, data_file: str, metadata: Metadata, optimize: bool = True
+    ):
+        self.config = config
+        self.data_file = data_file
+        self.metadata = metadata
+        self.optimize = optimize
+        self._string_cache = None
+
+    def __enter__(self) -> ExtractionQuery:
+        self._string_cache = pl.StringCache()
+        self._string_cache.__enter__()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self._string_cache.__exit__(*args)
+        self._string_cache = None
+
+    def plan(
+        self,
+        stages: list[tuple[str, pl.LazyFrame]] | None = None,
+        profile: Profile | None = None,
+    ) -> pl.LazyFrame:
+        """
+        The plan of transform_data(), including the typed value columns.
+
+        stages and profile are passed on to transform_data(); with a profile
+        the stages are collected right away.
+        """
+        attended = None
+        if self.config["replicate_non_instanced"]:
+            attended = scan_attended_instances(self.data_file, self.config)
+        return transform_data(
+            scan_data(self.data_file, self.config),
+            self.config,
+            self.metadata,
+            attended,
+            optimize=self.optimize,
+            stages=stages,
+            profile=profile,
+        )
+
+    def narrow(self) -> pl.LazyFrame:
+        """Narrow data, as returned by extract_UKBB_tabular_data()."""
+        return categorize_index(
+            self.plan().select(pl.exclude(list(TYPED_VALUE_COLUMNS)))
+        ).with_columns(pl.col("FieldValue").cast(pl.Utf8))
+
+    def wide(self) -> pl.LazyFrame:
+        """
+        Wide data, as returned by extract_UKBB_tabular_data().
+
+        Polars only pivots DataFrames and a LazyFrame needs its columns up
+        front, so the narrow query is collected when wide() is called and
+        pivoted as by extract_UKBB_tabular_data(). Only the operations added
+        to the returned LazyFrame are lazy; filters which should reduce the
+        extraction itself belong in the config or on narrow().
+        """
+        data = collect_data(self.plan(), self.optimize)
+        return finalize_data(
+            data, self.dictionary().collect(), dict(self.config, wide=True)
+        )[1].lazy()
+
+    def wide_columns(self) -> list[str] | None:
+        """
+        Wide columns of the extraction, from the statistics index of a store.
+
+        None when the data is not a store with a statistics index, or when the
+        index cannot tell which fields keep rows, see
+        field_statistics.wide_fields().
+        """
+        if not is_melted_store(self.data_file):
+            return None
+        statistics = read_field_statistics(self.data_file)
+        if statistics is None:
+            return None
+        field_ids = wide_fields(
+            statistics, read_manifest(self.data_file)["statistics"], self.config
+        )
+        if field_ids is None:
+            return None
+        if not self.config["recode_field_names"]:
+            return [str(field_id) for field_id in field_ids]
+        names = dict(
+            self.metadata["dictionary"]
+            .filter(pl.col("FieldID").is_in(field_ids))
+            .select(["FieldID", "Field"])
+            .iter_rows()
+        )
+        if any(names.get(field_id) is None for field_id in field_ids):
+            # Fields missing from the dictionary
+            return None
+        return [f"{names[field_id]}_{field_id}" for field_id in field_ids]
+
+    def dictionary(self) -> pl.LazyFrame:
+        """Subset of the data dictionary matching the extracted FieldIDs."""
+        return scan_metadata(self.config, self.metadata)[0]
+
+    def codings(self) -> pl.LazyFrame:
+        """Subset of the codings used by the extracted FieldIDs."""
+        return scan_metadata(self.config, self.metadata)[1]
+
+
+def scan_UKBB_tabular_data(
+    config: Config,
+    data_file: str,
+    dictionary_file: str,
+    coding_file: str,
+    category_tree_file: str = None,
+    data_field_prop_file: str = None,
+    verbose: bool = False,
+    metadata_cache_dir: str | None = None,
+    optimize: bool = True,
+    profile: Profile | None = None,
+    metadata: Metadata | None = None,
+) -> ExtractionQuery:
+    """
+    Lazily extract, filter, and transform UK Biobank tabular data.
+
+    Only the metadata is loaded and the config expanded, the data is not
+    read until a frame of the returned query is collected.
+
+    Parameters
+    ----------
+    config, data_file, dictionary_file, coding_file, category_tree_file,
+    data_field_prop_file, verbose, metadata_cache_dir, optimize
+        See extract_UKBB_tabular_data().
+    profile : Profile, optional
+        When given, the metadata loading and category expansion are measured
+        in it.
+    metadata : Metadata, optional
+        Metadata already loaded from the Showcase files, e.g. kept resident
+        by server.py. The files are then not read.
+
+    Returns
+    -------
+    ExtractionQuery
+        The query, exposing narrow(), wide(), dictionary() and codings() as
+        LazyFrames.
+
+    Examples
+    --------
+    >>> config = load_config("myconfig.yaml")
+    >>> with scan_UKBB_tabular_data(
+    ...     config=config,
+    ...     data_file="current.melt.arrow",
+    ...     dictionary_file="Data_Dictionary_Showcase.tsv",
+    ...     coding_file="Codings.tsv",
+    ... ) as query:
+    ...     counts = query.narrow().groupby("FieldID").count().collect()
+    """
+    pl.Config.set_verbose(verbose)
+
+    if metadata is None:
+        with profile_stage(profile, "metadata"):
+            metadata = load_metadata(
+                dictionary_file,
+                coding_file,
+                category_tree_file,
+                data_field_prop_file,
+                cache_dir=metadata_cache_dir,
+            )
+
+    with profile_stage(profile, "category expansion") as record:
+        config = expand_config(config, metadata)
+        record["fields"] = len(config["FieldIDs"])
+
+    return ExtractionQuery(config, data_file, metadata, optimize)
 
 
 def extract_UKBB_tabular_data(
@@ -42,13 +1405,26 @@ def extract_UKBB_tabular_data(
     category_tree_file: str = None,
     data_field_prop_file: str = None,
     verbose: bool = False,
-) -> tuple[pl.DataFrame, pl.DataFrame | None, pl.DataFrame, pl.DataFrame]:
+    metadata_cache_dir: str | None = None,
+    optimize: bool = True,
+    profile: bool = False,
+    profile_plans: bool = False,
+    result_cache_dir: str | None = None,
+    result_cache_size: int = DEFAULT_RESULT_CACHE_SIZE,
+    metadata: Metadata | None = None,
+    pivot: bool = True,
+) -> (
+    tuple[pl.DataFrame, pl.DataFrame | None, pl.DataFrame, pl.DataFrame]
+    | tuple[pl.DataFrame, pl.DataFrame | None, pl.DataFrame, pl.DataFrame, Profile]
+):
     """
     Extract, filter, and transform UK Biobank tabular data.
 
     This function processes melted UKBB data through a pipeline of filtering,
     recoding, and optional pivoting operations. All operations use Polars
-    LazyFrames with streaming for memory efficiency on large datasets.
+    LazyFrames with streaming for memory efficiency on large datasets. It
+    collects the query of scan_UKBB_tabular_data(), use that function
+    instead to compose further operations lazily.
 
     Parameters
     ----------
@@ -65,6 +1441,8 @@ def extract_UKBB_tabular_data(
         Path to input data file. Supports:
         - .tsv: Tab-separated values (melted format)
         - .arrow/.feather: Compressed binary Arrow format
+        - A partitioned melted store directory built by ingest.py, in which
+          case only the partitions matching the filters are read
 
     dictionary_file : str
         Path to UKBB Data Dictionary Showcase TSV. Required columns:
@@ -83,7 +1461,46 @@ def extract_UKBB_tabular_data(
         replicate_non_instanced=True. Format: field_id, instanced
 
     verbose : bool, default=False
-        Enable verbose Polars output for debugging
+        Enable verbose Polars output for debugging, and log the row count
+        after each stage of the query plan
+
+    metadata_cache_dir : str, optional
+        Directory of preprocessed metadata bundles (see metadata.py). When
+        given, the Showcase files are only parsed when they changed since
+        the last run. None parses them on every call.
+
+    optimize : bool, default=True
+        Run the optimized query plan: ID and value filters before the
+        dictionary and codings joins, only the needed metadata joined, and
+        polars predicate/projection pushdown enabled. False runs the
+        conservative plan without optimizations, as a fallback should the
+        optimizer misbehave. Both produce the same output.
+
+    profile : bool, default=False
+        Measure every stage of the extraction (wall time, rows in and out,
+        peak memory) and return the measurements as a fifth element, see
+        profiling.py. The data is then collected after every stage.
+
+    profile_plans : bool, default=False
+        Also record the query plan of every stage in the profile.
+
+    result_cache_dir : str, optional
+        Directory of cached extraction results (see result_cache.py). When
+        given, the result is read from the cache when an earlier extraction
+        covers it, and added to the cache otherwise. None disables caching.
+
+    result_cache_size : int, default=DEFAULT_RESULT_CACHE_SIZE
+        Size limit of the result cache in bytes, least recently used results
+        are evicted beyond it.
+
+    metadata : Metadata, optional
+        Metadata already loaded from the Showcase files, see
+        scan_UKBB_tabular_data().
+
+    pivot : bool, default=True
+        Pivot the wide output of a config with wide=True. False returns no
+        wide data, for callers pivoting it in batches (see
+        iter_wide_batches()), without changing the config.
 
     Returns
     -------
@@ -91,24 +1508,30 @@ def extract_UKBB_tabular_data(
         - data_narrow : pl.DataFrame
             Filtered long format data with columns:
             SubjectID, InstanceID, ArrayID, FieldID, FieldValue
+            FieldValue holds strings, it is only dictionary-encoded
+            during the extraction
         - data_wide : pl.DataFrame or None
-            Pivoted wide format if config['wide']=True, otherwise None.
+            Pivoted wide format if config['wide']=True and pivot, otherwise None.
             Columns are SubjectID, InstanceID, ArrayID, plus one column
             per FieldID with proper typing applied
         - dictionary : pl.DataFrame
             Subset of data dictionary matching extracted FieldIDs
         - codings : pl.DataFrame
             Subset of codings used in extracted data
+        - profile : Profile
+            Only when profile=True, the per-stage measurements. Pass it to
+            write_outputs() to measure the writers too.
 
     Notes
     -----
     Processing Strategy:
-    - Uses Polars LazyFrames with streaming=True and no_optimization=True
-      throughout for memory efficiency on datasets exceeding RAM capacity
-    - Category expansion recursively traverses the category tree to find
-      all descendant FieldIDs
+    - Uses Polars LazyFrames with streaming=True throughout for memory
+      efficiency on datasets exceeding RAM capacity
+    - Category expansion uses the precomputed transitive closure of the
+      category tree to find all descendant FieldIDs
     - Non-instanced fields (e.g., Sex) exist only once per subject in the
-      raw data but can be replicated across all instances when requested
+      raw data but can be replicated to the instances each subject attended
+      when requested
     - InstanceID and ArrayID are cast to Categorical after collection
       to reduce memory usage
 
@@ -124,313 +1547,383 @@ def extract_UKBB_tabular_data(
     ...     data_field_prop_file="1.txt"
     ... )
     """
-    pl.Config.set_verbose(verbose)
-
-    # Mapping of UKBB ValueType strings to Polars data types
-    # Used when recode_wide_column_valuetypes=True to properly type pivoted columns
-    datatype_dictionary = {
-        "Date": pl.Date,
-        "Time": pl.Datetime,
-        "Continuous": pl.Float64,
-        "Text": pl.Utf8,
-        "Integer": pl.Int64,
-        "Categorical multiple": pl.Categorical,
-        "Categorical single": pl.Categorical,
-        "Compound": pl.Utf8,
-    }
-
-    dictionary = pl.scan_csv(
+    stage_profile = Profile(plans=profile_plans) if profile else None
+    query = scan_UKBB_tabular_data(
+        config,
+        data_file,
         dictionary_file,
-        separator="\t",
-        infer_schema_length=None,
-        encoding="utf8-lossy",
-        quote_char=None,
-    )
-
-    codings = pl.scan_csv(
         coding_file,
-        separator="\t",
-        dtypes={
-            "Coding": pl.Int64,
-            "Value": pl.Utf8,
-            "Meaning": pl.Utf8,
-        },
-        encoding="utf8-lossy",
+        category_tree_file,
+        data_field_prop_file,
+        verbose,
+        metadata_cache_dir,
+        optimize,
+        stage_profile,
+        metadata,
     )
 
-    file_extension = p.Path(data_file).suffix
-
-    if file_extension == ".tsv":
-        # We setup a LazyFrame chain of filters based on the configuration
-        data = pl.scan_csv(
-            data_file,
-            separator="\t",
-            dtypes={
-                "SubjectID": pl.Int64,
-                "FieldID": pl.Int64,
-                "InstanceID": pl.Int64,
-                "ArrayID": pl.Int64,
-                "FieldValue": pl.Utf8,
-            },
-            encoding="utf8-lossy",
-        )
-    elif file_extension in [".arrow", ".feather"]:
-        data = pl.scan_ipc(data_file)
-    else:
-        logging.error(f"Unsupported file extension: {file_extension}")
-        sys.exit(1)
-
-    # Expand list of IDs from SubjectIDFiles
-    if config["SubjectIDFiles"]:
-        for file in config["SubjectIDFiles"]:
-            try:
-                with open(file, "r") as stream:
-                    config["SubjectIDs"].extend(
-                        [int(x) for x in stream.read().splitlines()]
-                    )
-            except FileNotFoundError as exc:
-                logging.exception(exc)
-                sys.exit(1)
-        logging.info("Input configuration after loading SubjectIDFiles")
-        logging.info(pprint.pformat(config, compact=True))
-
-    # Filter rows based on SubjectIDs if provided
-    if config["SubjectIDs"]:
-        data = data.filter(pl.col("SubjectID").is_in(config["SubjectIDs"]))
-
-    # Expand FieldIDs if Categories are provided
-    if config["Categories"]:
-        logging.info(
-            "Categories provided, recursing down Category tree to ensure all FieldIDs are discovered"
-        )
-        # UKBB categories form a hierarchical tree. This loop recursively finds
-        # all descendants of the specified categories by iterating until no new
-        # children are discovered (the Categories list stops growing).
-        category_tree = pl.read_csv(category_tree_file, separator="\t")
-        old_length = 0
-        while len(config["Categories"]) > old_length:
-            old_length = len(config["Categories"])
-            config["Categories"].extend(
-                category_tree.filter(
-                    pl.col("parent_id").is_in(config["Categories"])
-                    & pl.col("child_id").is_in(config["Categories"]).is_not()
+    # FieldValue and the coding meanings are dictionary-encoded (Categorical)
+    # in a global string cache
+    with query:
+        cached = None
+        if result_cache_dir is not None:
+            with profile_stage(stage_profile, "result cache lookup"):
+                keys = result_keys(
+                    query.config,
+                    data_file,
+                    metadata_key(
+                        dictionary_file,
+                        coding_file,
+                        category_tree_file,
+                        data_field_prop_file,
+                    ),
                 )
-                .get_column("child_id")
-                .to_list()
+                cached = find_result(result_cache_dir, keys)
+
+        if cached is None:
+            stages = [] if verbose else None
+            data = query.plan(stages, stage_profile)
+
+            logging.info(f"Loading data from {data_file}")
+            data = collect_data(data, optimize, stages, stage_profile)
+            data_wide = None
+        else:
+            with profile_stage(stage_profile, "result cache read") as record:
+                data, data_wide = read_result(*cached, keys, query.config)
+                record["rows_out"] = data.height
+
+        dictionary = query.dictionary().collect()
+        codings = query.codings().collect()
+        narrow = data
+        if not pivot:
+            data_wide = None
+            data, _ = finalize_data(
+                data, dictionary, dict(query.config, wide=False), stage_profile
             )
-        # After collecting all descendant category IDs, find all FieldIDs
-        # belonging to those categories and add them to the filter list
-        config["FieldIDs"].extend(
-            dictionary.filter(pl.col("Category").is_in(config["Categories"]))
-            .select("FieldID")
-            .collect(streaming=True, no_optimization=True)
-            .to_series()
-            .to_list()
-        )
-        config["FieldIDs"] = list(dict.fromkeys(config["FieldIDs"]))
-        # Print the loaded config
-        logging.info("Input configuration after Category expansion")
-        logging.info(pprint.pformat(config, compact=True))
-
-    # Filter rows in data based on FieldID
-    if config["FieldIDs"]:
-        data = data.filter(pl.col("FieldID").is_in(config["FieldIDs"]))
-
-    if config["replicate_non_instanced"]:
-        # Some UKBB fields (e.g., Sex, genetic sex) are non-instanced, meaning they
-        # exist only once per subject rather than at each assessment instance.
-        # This section replicates those single values across all instances.
-        #
-        # Strategy:
-        # 1. Join with field properties to identify which fields are instanced (instanced=1)
-        #    vs non-instanced (instanced=0)
-        # 2. For non-instanced rows, repeat the row N times where N = number of instances
-        # 3. Assign sequential instance IDs to the repeated rows
-        # 4. Explode lists back to regular rows
-        instanced = pl.scan_csv(data_field_prop_file, separator="\t")
-        data = data.join(
-            instanced.select(["field_id", "instanced"]),
-            left_on="FieldID",
-            right_on="field_id",
-            how="left",
-        )
-        repeat_instances = config["InstanceIDs"] if config["InstanceIDs"] else list(range(4))
-        data = (
-            data.with_columns(
-                pl.when(pl.col("instanced") == 0)
-                .then(pl.lit(len(repeat_instances)).alias("repeats"))
-                .otherwise(1)
+        elif data_wide is None:
+            data, data_wide = finalize_data(
+                data, dictionary, query.config, stage_profile
             )
-            .select(pl.exclude("repeats").repeat_by("repeats"))
-            .with_columns(
-                pl.when(pl.col("InstanceID").list.lengths() > 1)
-                .then(repeat_instances)
-                .otherwise(pl.col("InstanceID"))
-                .alias("InstanceID")
+        else:
+            typed = [column for column in TYPED_VALUE_COLUMNS if column in data.columns]
+            data = categorize_index(data.drop(typed)).with_columns(
+                pl.col("FieldValue").cast(pl.Utf8)
             )
-            .explode(pl.all())
-        )
-        data = data.drop("instanced")
 
-    # Filter rows based on InstanceIDs if provided
-    if config["InstanceIDs"]:
-        data = data.filter(pl.col("InstanceID").is_in(config["InstanceIDs"]))
+        if result_cache_dir is not None:
+            # Results filtered from a larger entry are cached too, so that
+            # repeating the request skips the filter and the pivot
+            exact = cached is not None and cached[1]
+            write_result(
+                result_cache_dir,
+                keys,
+                None if exact else narrow,
+                data_wide,
+                result_cache_size,
+            )
+    if profile:
+        return data, data_wide, dictionary, codings, stage_profile
+    return data, data_wide, dictionary, codings
 
-    # Filter rows based on ArrayIDs if provided
-    if config["ArrayIDs"]:
-        data = data.filter(pl.col("ArrayID").is_in(config["ArrayIDs"]))
 
-    # Drop empty strings
-    if config["drop_empty_strings"]:
-        data = data.filter(~(pl.col("FieldValue").str.lengths() == 0))
+def _union_filter(configs: list[Config], key: str) -> list:
+    """Union of a filter list over configs, empty if any config has no filter."""
+    if not all(config[key] for config in configs):
+        return []
+    return list(dict.fromkeys(value for config in configs for value in config[key]))
 
-    # Join the data dictionary to the dataset
-    data = data.join(
-        dictionary.select(["FieldID", "Field", "ValueType", "Coding"]),
-        on="FieldID",
-        how="left",
-    )
-    data = data.join(
-        codings,
-        left_on=["Coding", "FieldValue"],
-        right_on=["Coding", "Value"],
-        how="left",
-    )
 
-    if config["drop_null_strings"]:
-        data = data.filter(~pl.col("Meaning").is_in(config["drop_null_strings"]))
+def extract_UKBB_tabular_data_batch(
+    configs: list[Config],
+    data_file: str,
+    dictionary_file: str,
+    coding_file: str,
+    category_tree_file: str = None,
+    data_field_prop_file: str = None,
+    verbose: bool = False,
+    metadata_cache_dir: str | None = None,
+    optimize: bool = True,
+    profile: bool = False,
+    profile_plans: bool = False,
+    pivot: list[bool] | None = None,
+) -> Iterator[tuple]:
+    """
+    Run several extractions with a single scan of the data.
 
-    if config["drop_null_numerics"]:
-        data = data.filter(
-            ~(
-                pl.col("FieldValue")
-                .cast(pl.Float64, strict=False)
-                .is_in(config["drop_null_numerics"])
-            )
-        )
+    The FieldID, SubjectID, InstanceID and ArrayID filters of all configs are
+    combined into their union, the data is scanned, filtered and joined with
+    the dictionary and codings once, and this shared intermediate is then
+    filtered and transformed for each config in turn.
 
-    # Take coding values and replace FieldValue with it if available
-    if config["recode_data_values"]:
-        data = data.with_columns(
-            pl.when(pl.col("Meaning").is_not_null())
-            .then(pl.col("Meaning"))
-            .otherwise(pl.col("FieldValue"))
-            .alias("FieldValue")
-        )
+    Parameters
+    ----------
+    configs : list[Config]
+        Extraction configurations.
+    data_file, dictionary_file, coding_file, category_tree_file,
+    data_field_prop_file, verbose, metadata_cache_dir, optimize, profile,
+    profile_plans
+        See extract_UKBB_tabular_data().
+    pivot : list[bool], optional
+        Whether to pivot the wide output of each config, see
+        extract_UKBB_tabular_data(). None pivots all of them.
+
+    Yields
+    ------
+    tuple
+        The results of extract_UKBB_tabular_data() for each config, in order.
+        The profile of each config starts with the stages of the shared
+        scan, marked as shared.
 
-    # Take coding values which start with "Less than" and replace with a numeric
-    if config["convert_less_than_value_integer"] is not None:
-        data = data.with_columns(
-            [
-                pl.when(
-                    (pl.col("FieldValue").str.starts_with("Less than"))
-                    & (pl.col("ValueType").is_in(["Integer"]))
-                )
-                .then(pl.lit(config["convert_less_than_value_integer"]))
-                .otherwise(pl.col("FieldValue"))
-                .keep_name()
-            ]
+    Notes
+    -----
+    The shared intermediate holds the union of all extractions in memory, so
+    batches should group configs with overlapping selections.
+    """
+    pl.Config.set_verbose(verbose)
+    shared_profile = Profile(plans=profile_plans) if profile else None
+
+    with profile_stage(shared_profile, "metadata"):
+        metadata = load_metadata(
+            dictionary_file,
+            coding_file,
+            category_tree_file,
+            data_field_prop_file,
+            cache_dir=metadata_cache_dir,
         )
-
-    if config["convert_less_than_value_continuous"] is not None:
-        data = data.with_columns(
-            [
-                pl.when(
-                    (pl.col("FieldValue").str.starts_with("Less than"))
-                    & (pl.col("ValueType") == "Continuous")
-                )
-                .then(pl.lit(config["convert_less_than_value_continuous"]))
-                .otherwise(pl.col("FieldValue"))
-                .keep_name()
-            ]
+    with profile_stage(shared_profile, "category expansion") as record:
+        configs = [expand_config(config, metadata) for config in configs]
+        record["fields"] = len(_union_filter(configs, "FieldIDs"))
+
+    # Non-instanced fields are stored at instance 0, so InstanceIDs can only
+    # be applied to the shared scan if no config replicates them
+    replicate_non_instanced = any(
+        config["replicate_non_instanced"] for config in configs
+    )
+    # The shared cohort is the union of the cohorts of all configs, unless a
+    # config selects all subjects; exclusions are left to each config
+    restricted = all(
+        config["SubjectIDs"] or config["SubjectIDFiles"] for config in configs
+    )
+    shared_config = {
+        "FieldIDs": _union_filter(configs, "FieldIDs"),
+        "SubjectIDs": list(
+            dict.fromkeys(
+                subject for config in configs for subject in config["SubjectIDs"]
+            )
+        )
+        if restricted
+        else [],
+        "SubjectIDFiles": list(
+            dict.fromkeys(file for config in configs for file in config["SubjectIDFiles"])
         )
+        if restricted
+        else [],
+        "InstanceIDs": []
+        if replicate_non_instanced
+        else _union_filter(configs, "InstanceIDs"),
+        "ArrayIDs": _union_filter(configs, "ArrayIDs"),
+        "replicate_non_instanced": replicate_non_instanced,
+    }
 
-    # Replace FieldID with concatenation of FieldID and Field
-    if config["recode_field_names"]:
-        data = data.with_columns(
-            pl.concat_str([pl.col("Field"), pl.col("FieldID")], separator="_").alias(
-                "FieldID"
+    with pl.StringCache():
+        shared = filter_subjects(scan_data(data_file, shared_config), shared_config)
+        for key, column in [
+            ("FieldIDs", "FieldID"),
+            ("InstanceIDs", "InstanceID"),
+            ("ArrayIDs", "ArrayID"),
+        ]:
+            if shared_config[key]:
+                shared = shared.filter(pl.col(column).is_in(shared_config[key]))
+        if optimize:
+            shared = join_metadata(
+                shared,
+                metadata,
+                set().union(*(metadata_columns(config) for config in configs)),
+                shared_config["FieldIDs"],
             )
-        )
+        else:
+            shared = join_metadata(shared, metadata)
+
+        logging.info(f"Loading data for {len(configs)} configurations from {data_file}")
+        shared = collect_data(shared, optimize, profile=shared_profile)
+        if profile:
+            shared_profile.stages[-1]["stage"] = "shared scan and joins"
+        attended = None
+        if replicate_non_instanced:
+            # The visits of the shared subjects, restricted by each config
+            attended = scan_attended_instances(data_file, shared_config).collect()
+
+        if pivot is None:
+            pivot = [True] * len(configs)
+        for config, pivot_config in zip(configs, pivot):
+            stages = [] if verbose else None
+            config_profile = None
+            if profile:
+                config_profile = Profile(plans=profile_plans)
+                config_profile.stages = [
+                    dict(record, shared=True) for record in shared_profile.stages
+                ]
+            data = transform_data(
+                shared.lazy(),
+                config,
+                metadata,
+                None if attended is None else attended.lazy(),
+                joined=True,
+                optimize=optimize,
+                stages=stages,
+                profile=config_profile,
+            )
+            data = collect_data(data, optimize, stages, config_profile)
+            dictionary, codings = subset_metadata(config, metadata)
+            data, data_wide = finalize_data(
+                data,
+                dictionary,
+                config if pivot_config else dict(config, wide=False),
+                config_profile,
+            )
+            if profile:
+                yield data, data_wide, dictionary, codings, config_profile
+            else:
+                yield data, data_wide, dictionary, codings
 
-    # Drop extra columns and reorder
-    data = data.select(["SubjectID", "InstanceID", "ArrayID", "FieldID", "FieldValue"])
 
-    logging.info(f"Loading data from {data_file}")
-    data = data.collect(streaming=True, no_optimization=True)
+def sink_UKBB_tabular_data(
+    config: Config,
+    data_file: str,
+    dictionary_file: str,
+    coding_file: str,
+    output_prefix: str,
+    output_formats: list[str],
+    category_tree_file: str = None,
+    data_field_prop_file: str = None,
+    verbose: bool = False,
+    metadata_cache_dir: str | None = None,
+    optimize: bool = True,
+    profile: Profile | None = None,
+    compression: str = "zstd",
+    compression_level: int | None = None,
+    row_group_size: int | None = None,
+    pivot: bool = True,
+) -> bool:
+    """
+    Extract the narrow data of config straight to the output files.
+
+    The narrow data is sunk from the query without being collected, see
+    writers.sink_frame(). This needs a config without wide output (or with
+    its pivot left to the caller) and a plan
+    that runs entirely in the polars streaming engine, which in this polars
+    version means a partitioned store or tsv input and no replication.
+    Otherwise nothing is written and False is
+    returned, so the caller can fall back to extract_UKBB_tabular_data().
 
-    # Generate a subsetted dictionary and codings
-    if config["FieldIDs"]:
-        dictionary = dictionary.filter(
-            pl.col("FieldID").is_in(config["FieldIDs"])
-        ).collect(streaming=True, no_optimization=True)
-        codings = codings.filter(
-            pl.col("Coding").is_in(dictionary.get_column("Coding"))
-        ).collect(streaming=True, no_optimization=True)
-    else:
-        dictionary = dictionary.collect(streaming=True, no_optimization=True)
-        codings = codings.collect(streaming=True, no_optimization=True)
+    Parameters
+    ----------
+    config, data_file, dictionary_file, coding_file, category_tree_file,
+    data_field_prop_file, verbose, metadata_cache_dir, optimize
+        See extract_UKBB_tabular_data().
+    output_prefix, output_formats, compression, compression_level,
+    row_group_size
+        See writers.write_outputs().
+    profile : Profile, optional
+        When given, the metadata loading, category expansion and every file
+        written are measured in it.
+    pivot : bool, default=True
+        False sinks the narrow data of a config with wide=True and writes no
+        wide output, for callers pivoting it in batches (see
+        iter_wide_batches()).
 
-    data = data.with_columns(pl.col("InstanceID").cast(pl.Utf8).cast(pl.Categorical))
-    data = data.with_columns(pl.col("ArrayID").cast(pl.Utf8).cast(pl.Categorical))
+    Returns
+    -------
+    bool
+        Whether the outputs were written.
+    """
+    if config["wide"] and pivot:
+        logging.warning("Wide output can not be sunk, collecting the data instead")
+        return False
+
+    # config is left as it is for a fallback to extract_UKBB_tabular_data()
+    query = scan_UKBB_tabular_data(
+        copy.deepcopy(config),
+        data_file,
+        dictionary_file,
+        coding_file,
+        category_tree_file,
+        data_field_prop_file,
+        verbose,
+        metadata_cache_dir,
+        optimize,
+        profile,
+    )
 
-    # Optional wide format output: pivot from long to wide format
-    # Each unique FieldID becomes a column, with one row per subject/instance/array
-    if config["wide"]:
-        logging.info("Pivoting narrow DataFrame to wide")
-        data_wide = data.pivot(
-            index=["SubjectID", "InstanceID", "ArrayID"],
-            values="FieldValue",
-            columns="FieldID",
-            aggregate_function=None,
+    with query:
+        data = query.narrow()
+        if not is_streamable(data, optimize):
+            logging.warning(
+                "The query plan does not run entirely in the streaming engine, "
+                "collecting the data instead"
+            )
+            return False
+        if optimize:
+            logging.info(
+                "Optimized query plan:\n"
+                + data.explain(streaming=True, comm_subplan_elim=False)
+            )
+        logging.info(f"Loading data from {data_file}")
+        sink_frame(
+            data,
+            output_prefix,
+            "narrow",
+            output_formats,
+            profile,
+            optimize,
+            compression,
+            compression_level,
+            row_group_size,
         )
 
-        if config["recode_wide_column_valuetypes"]:
-            # After pivoting, all columns are strings. This section assigns proper
-            # data types based on the UKBB ValueType field from the data dictionary.
-            #
-            # Note: Column names may be FieldID only or Field_FieldID depending on
-            # recode_field_names config, so we extract the numeric ID from the end.
-            logging.info("Setting data types on columns")
-            for col in data_wide.columns[3:]:
-                val_type = (
-                    dictionary.filter(
-                        pl.col("FieldID").cast(pl.Utf8) == col.split("_")[-1]
-                    )
-                    .select("ValueType")
-                    .item()
-                )
-                try:
-                    if val_type == "Date":
-                        data_wide = data_wide.with_columns(
-                            pl.col(col).str.strptime(pl.Date)
-                        )
-                    elif val_type == "Time":
-                        data_wide = data_wide.with_columns(
-                            pl.col(col).str.strptime(pl.Datetime)
-                        )
-                    elif val_type == "Compound" and config["convert_compound_to_list"]:
-                        # Compound fields contain comma-separated values
-                        data_wide = data_wide.with_columns(pl.col(col).str.split(","))
-                    else:
-                        data_wide = data_wide.with_columns(
-                            pl.col(col).cast(datatype_dictionary[val_type])
-                        )
-                except pl.exceptions.ComputeError as exe:
-                    logging.warning(exe)
-                    logging.warning(
-                        f"Column {col} data type could not be set due to mixed value types"
-                    )
+    write_outputs(
+        pl.DataFrame(),
+        None,
+        query.dictionary().collect(),
+        query.codings().collect(),
+        output_prefix,
+        [],
+        profile,
+    )
+    return True
 
-        return data, data_wide, dictionary, codings
 
-    else:
-        return data, None, dictionary, codings
+@contextlib.contextmanager
+def log_to(*handlers: logging.Handler) -> Iterator[None]:
+    """
+    Add handlers to the root logger for the duration of the block.
+
+    The CLI keeps a log file per output prefix and attaches it only while its
+    config is processed, so that each conversion.log holds its own messages.
+    """
+    root = logging.getLogger()
+    for handler in handlers:
+        root.addHandler(handler)
+    try:
+        yield
+    finally:
+        for handler in handlers:
+            root.removeHandler(handler)
 
 
 if __name__ == "__main__":
     import argparse
 
+    from planning import (
+        BUDGET_FRACTION,
+        estimate_extraction,
+        parse_memory,
+        plan_extraction,
+        plan_memory,
+    )
+    from sharding import SHARD_BY, extract_sharded
+    from wide_groups import parse_grouping, write_wide_groups
+
     parser = argparse.ArgumentParser(
         prog="UKBB Data Extractor",
         description="Transforms melted UKBB tabular data into a usable DataFrame for statistical analysis",
@@ -439,7 +1932,8 @@ if __name__ == "__main__":
 
     parser.add_argument(
         "--config-file",
-        help="YAML config file describing how to process UKBB table",
+        help="YAML config file describing how to process UKBB table, several config files are extracted together with a single scan of the data",
+        nargs="+",
         required=True,
     )
     parser.add_argument("--data-file", help="UKBB melted tabular data", required=True)
@@ -460,7 +1954,26 @@ if __name__ == "__main__":
         default="1.txt",
     )
     parser.add_argument(
-        "--output-prefix", help="Prefix for output files", required=True
+        "--metadata-cache-dir",
+        help="Directory caching preprocessed dictionary, codings, category tree and field properties, rebuilt when any of these files change. The metadata files are parsed on every run when not given",
+        default=None,
+    )
+    parser.add_argument(
+        "--result-cache-dir",
+        help="Directory caching extraction results, so that repeated extractions, or extractions of a subset of an earlier one, are served without scanning the data. Disabled when not given",
+        default=None,
+    )
+    parser.add_argument(
+        "--result-cache-size",
+        help="Size limit of the result cache, e.g. 50G, least recently used results are evicted beyond it",
+        type=parse_memory,
+        default=DEFAULT_RESULT_CACHE_SIZE,
+    )
+    parser.add_argument(
+        "--output-prefix",
+        help="Prefix for output files, one per config file",
+        nargs="+",
+        required=True,
     )
 
     parser.add_argument(
@@ -472,88 +1985,445 @@ if __name__ == "__main__":
     )
 
     parser.add_argument(
-        "-v", "--verbose", help="increase output verbosity", action="store_true"
+        "--wide-batch-size",
+        help="Pivot the wide output in batches of this many subjects, appending each batch to the outputs instead of pivoting all data at once",
+        type=int,
+        default=None,
     )
 
-    args = parser.parse_args()
+    parser.add_argument(
+        "--wide-groups",
+        help="Write the wide output as column-group files with a manifest in <prefix>wide/, grouped by 'category' or in chunks of this many columns",
+        type=parse_grouping,
+        default=None,
+    )
 
-    logging.basicConfig(
-        format="%(asctime)s %(message)s",
-        datefmt="%Y-%m-%dT%H:%M:%S",
-        level=logging.DEBUG,
-        handlers=[
-            logging.FileHandler(f"{args.output_prefix}conversion.log", mode="w"),
-            logging.StreamHandler(),
-        ],
+    parser.add_argument(
+        "--sink",
+        help="Stream the narrow output straight from the query to the output files without collecting it, for configs without wide output or with --wide-batch-size whose query runs in the streaming engine",
+        action="store_true",
     )
 
-    unknown_output_formats = set(args.output_formats).difference(
-        {"tsv", "csv", "arrow", "parquet", "feather"}
+    parser.add_argument(
+        "--compression",
+        help="Compression codec of arrow and parquet outputs",
+        choices=COMPRESSIONS,
+        default="zstd",
+    )
+
+    parser.add_argument(
+        "--compression-level",
+        help="Compression level of parquet outputs",
+        type=int,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--row-group-size",
+        help="Rows per row group of parquet outputs",
+        type=int,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--writer-threads",
+        help="Number of threads writing the output files of a config concurrently, defaults to one per file",
+        type=int,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--plan",
+        help="Only estimate the rows, columns, peak memory, output sizes and runtime of each extraction from store statistics, without reading the data, write them to <prefix>plan.json and print them",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--max-memory",
+        help="Memory budget, e.g. 16G: the size of each extraction is estimated beforehand, and extractions which would not fit are pivoted in batches, sunk, or run in subject shards spilled to disk",
+        type=parse_memory,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--shards",
+        help="Split each extraction into this many shards run as separate processes, then merge their outputs",
+        type=int,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--shard-by",
+        help="Shard by SubjectID ranges, or by FieldID groups",
+        choices=SHARD_BY,
+        default="subject",
+    )
+
+    parser.add_argument(
+        "--shard-workers",
+        help="Number of shards run at once, defaults to the number of CPUs",
+        type=int,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--shard-manifest-only",
+        help="Only write the shard manifest and a SLURM array job script to <prefix>shards/, to run the shards and merge them with sharding.py",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--no-optimization",
+        help="Run the conservative query plan with the polars optimizer disabled, instead of the optimized plan",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--profile",
+        help="Measure the wall time, rows and peak memory of every stage and write them to <prefix>profile.json",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--profile-plans",
+        help="Also record the query plan of every stage in the profile, implies --profile",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "-v", "--verbose", help="increase output verbosity", action="store_true"
     )
-    if unknown_output_formats:
-        logging.error(
-            f"Unknown output formats {pprint.pformat(unknown_output_formats, compact=True)}"
-        )
-        sys.exit(1)
 
-    if "csv" in args.output_formats:
-        logging.warning(
-            "Due to embedded quotes in some fields, CSV format is not recommended"
+    args = parser.parse_args()
+
+    if len(args.config_file) != len(args.output_prefix):
+        parser.error("--config-file and --output-prefix need the same number of values")
+
+    log_format = logging.Formatter("%(asctime)s %(message)s", "%Y-%m-%dT%H:%M:%S")
+    logging.basicConfig(level=logging.DEBUG, handlers=[logging.StreamHandler()])
+    logging.getLogger().handlers[0].setFormatter(log_format)
+    # The log file of each config, attached with log_to() while it is processed
+    log_files = {}
+    for output_prefix in args.output_prefix:
+        log_files[output_prefix] = logging.FileHandler(
+            f"{output_prefix}conversion.log", mode="w"
         )
+        log_files[output_prefix].setFormatter(log_format)
+
+    # Messages about all configs go to every log
+    with log_to(*log_files.values()):
+        unknown_output_formats = set(args.output_formats).difference(OUTPUT_FORMATS)
+        if unknown_output_formats:
+            logging.error(
+                f"Unknown output formats {pprint.pformat(unknown_output_formats, compact=True)}"
+            )
+            sys.exit(1)
 
-    config = load_config(args.config_file)
+        if "csv" in args.output_formats:
+            logging.warning(
+                "Due to embedded quotes in some fields, CSV format is not recommended"
+            )
 
-    # Print the loaded config
-    logging.info("Input configuration")
-    logging.info(pprint.pformat(config, compact=True))
+        configs = [load_config(config_file) for config_file in args.config_file]
 
-    data, data_wide, dictionary, codings = extract_UKBB_tabular_data(
-        config=config,
+    for config_file, output_prefix, config in zip(
+        args.config_file, args.output_prefix, configs
+    ):
+        # Print the loaded config
+        with log_to(log_files[output_prefix]):
+            logging.info(f"Input configuration {config_file}")
+            logging.info(format_config(config))
+
+    write_options = dict(
+        compression=args.compression,
+        compression_level=args.compression_level,
+        row_group_size=args.row_group_size,
+    )
+    shard_args = dict(
         data_file=args.data_file,
         dictionary_file=args.dictionary_file,
         coding_file=args.coding_file,
         category_tree_file=args.category_tree_file,
         data_field_prop_file=args.data_field_prop_file,
-        verbose=args.verbose,
+        metadata_cache_dir=args.metadata_cache_dir,
+        optimize=not args.no_optimization,
+        write_options=write_options,
     )
 
-    for format in args.output_formats:
-        if format == "tsv":
-            logging.info(f"Writing {args.output_prefix}narrow.tsv")
-            data.write_csv(f"{args.output_prefix}narrow.tsv", separator="\t")
-        elif format == "arrow" or format == "feather":
-            logging.info(f"Writing {args.output_prefix}narrow.{format}")
-            data.write_ipc(f"{args.output_prefix}narrow.{format}", compression="zstd")
-        elif format == "parquet":
-            logging.info(f"Writing {args.output_prefix}narrow.parquet")
-            data.write_parquet(
-                f"{args.output_prefix}narrow.parquet", compression="zstd"
-            )
-        elif format == "csv":
-            logging.info(f"Writing {args.output_prefix}narrow.csv")
-            data.write_csv(f"{args.output_prefix}narrow.csv")
-
-    logging.info(f"Writing {args.output_prefix}dictionary.tsv")
-    dictionary.write_csv(f"{args.output_prefix}dictionary.tsv", separator="\t")
-
-    logging.info(f"Writing {args.output_prefix}coding.tsv")
-    codings.write_csv(f"{args.output_prefix}coding.tsv", separator="\t")
-
-    if data_wide is not None:
-        for format in args.output_formats:
-            if format == "tsv":
-                logging.info(f"Writing {args.output_prefix}wide.tsv")
-                data_wide.write_csv(f"{args.output_prefix}wide.tsv", separator="\t")
-            elif format == "arrow" or format == "feather":
-                logging.info(f"Writing {args.output_prefix}wide.{format}")
-                data_wide.write_ipc(
-                    f"{args.output_prefix}wide.{format}", compression="zstd"
+    if args.plan:
+        metadata = load_metadata(
+            args.dictionary_file,
+            args.coding_file,
+            args.category_tree_file,
+            args.data_field_prop_file,
+            cache_dir=args.metadata_cache_dir,
+        )
+        plans = {}
+        for output_prefix, config in zip(args.output_prefix, configs):
+            with log_to(log_files[output_prefix]):
+                plan = plan_extraction(
+                    expand_config(config, metadata),
+                    args.data_file,
+                    metadata,
+                    args.output_formats,
+                    args.compression,
                 )
-            elif format == "parquet":
-                logging.info(f"Writing {args.output_prefix}wide.parquet")
-                data_wide.write_parquet(
-                    f"{args.output_prefix}wide.parquet", compression="zstd"
+                if args.max_memory is not None:
+                    try:
+                        plan["memory"] = plan_memory(plan, args.max_memory, config)
+                    except ValueError as exc:
+                        logging.error(exc)
+                        sys.exit(1)
+                logging.info(
+                    f"Plan of {output_prefix}: {plan['fields']} fields, "
+                    f"{plan['narrow_rows']} narrow rows, "
+                    f"{plan['wide_columns'] or 0} wide columns, "
+                    f"{plan['peak_bytes'] / 2**20:.0f} MiB peak memory, "
+                    f"{sum(plan['output_bytes'].values()) / 2**20:.0f} MiB of outputs, "
+                    f"about {plan['seconds']:.0f} s"
                 )
-            elif format == "csv":
-                logging.info(f"Writing {args.output_prefix}wide.csv")
-                data_wide.write_csv(f"{args.output_prefix}wide.csv")
+                logging.info(f"Writing {output_prefix}plan.json")
+                with open(f"{output_prefix}plan.json", "w") as stream:
+                    json.dump(plan, stream, indent=1)
+                plans[output_prefix] = plan
+        # The plans on stdout, the log goes to stderr
+        print(json.dumps(plans, indent=1))
+        sys.exit(0)
+
+    if args.shards is not None:
+        if (
+            args.sink
+            or args.wide_batch_size is not None
+            or args.wide_groups is not None
+            or args.profile
+            or args.profile_plans
+        ):
+            with log_to(*log_files.values()):
+                logging.warning(
+                    "--sink, --wide-batch-size, --wide-groups and --profile do not apply to sharded extractions"
+                )
+        for config, output_prefix in zip(configs, args.output_prefix):
+            with log_to(log_files[output_prefix]):
+                extract_sharded(
+                    config,
+                    output_prefix,
+                    args.output_formats,
+                    args.shards,
+                    shard_by=args.shard_by,
+                    workers=args.shard_workers,
+                    writer_threads=args.writer_threads,
+                    manifest_only=args.shard_manifest_only,
+                    **shard_args,
+                )
+        sys.exit(0)
+
+    # How each config is run within the memory budget, see planning.py
+    memory_plans = [None] * len(configs)
+    if args.max_memory is not None:
+        metadata = load_metadata(
+            args.dictionary_file,
+            args.coding_file,
+            args.category_tree_file,
+            args.data_field_prop_file,
+            cache_dir=args.metadata_cache_dir,
+        )
+        for i, (output_prefix, config) in enumerate(zip(args.output_prefix, configs)):
+            with log_to(log_files[output_prefix]):
+                estimate = estimate_extraction(
+                    expand_config(copy.deepcopy(config), metadata), args.data_file, metadata
+                )
+                try:
+                    memory_plans[i] = plan_memory(estimate, args.max_memory, config)
+                except ValueError as exc:
+                    logging.error(exc)
+                    sys.exit(1)
+                memory_plans[i]["peak_bytes"] = estimate["peak_bytes"]
+                logging.info(
+                    f"Estimated {estimate['narrow_rows']} narrow rows and "
+                    f"{estimate['peak_bytes'] / 2**20:.0f} MiB peak memory for {output_prefix}, "
+                    f"running it with the {memory_plans[i]['strategy']} strategy"
+                )
+                if memory_plans[i]["strategy"] == "shards":
+                    logging.info(
+                        f"{memory_plans[i]['shards']} shards of "
+                        f"{memory_plans[i]['shard_peak_bytes'] / 2**20:.0f} MiB peak memory"
+                    )
+
+    def extract_in_shards(i: int) -> None:
+        """Extract config i in subject shards which fit the memory budget."""
+        extract_sharded(
+            configs[i],
+            args.output_prefix[i],
+            args.output_formats,
+            memory_plans[i]["shards"],
+            workers=memory_plans[i]["shard_workers"],
+            writer_threads=memory_plans[i]["writer_threads"],
+            stream=True,
+            **shard_args,
+        )
+
+    sharded = [
+        plan is not None and plan["strategy"] == "shards" for plan in memory_plans
+    ]
+    for i in range(len(configs)):
+        if sharded[i]:
+            with log_to(log_files[args.output_prefix[i]]):
+                extract_in_shards(i)
+
+    # The streaming pivot is run batch by batch after extraction, the
+    # extraction itself only produces the narrow data of these configs
+    wide_batch_sizes = [
+        args.wide_batch_size if config["wide"] else None for config in configs
+    ]
+    for i, plan in enumerate(memory_plans):
+        if plan is not None and plan["strategy"] == "wide_batches":
+            wide_batch_sizes[i] = plan["wide_batch_size"]
+
+    profiling = args.profile or args.profile_plans
+    extract_args = dict(
+        data_file=args.data_file,
+        dictionary_file=args.dictionary_file,
+        coding_file=args.coding_file,
+        category_tree_file=args.category_tree_file,
+        data_field_prop_file=args.data_field_prop_file,
+        verbose=args.verbose,
+        metadata_cache_dir=args.metadata_cache_dir,
+        optimize=not args.no_optimization,
+    )
+
+    def write_wide_in_batches(
+        i: int,
+        narrow: pl.LazyFrame,
+        dictionary: pl.DataFrame,
+        profile: Profile | None,
+        columns: list[str] | None = None,
+    ) -> None:
+        """Pivot the narrow data of config i to the wide outputs in batches."""
+        output_prefix = args.output_prefix[i]
+        if args.wide_groups is not None:
+            logging.warning(
+                f"Streamed wide output of {output_prefix} is written to single files, not column groups"
+            )
+        with profile_stage(profile, "streamed pivot and write wide"):
+            write_wide_batches(
+                iter_wide_batches(
+                    narrow, dictionary, configs[i], wide_batch_sizes[i], columns
+                ),
+                output_prefix,
+                args.output_formats,
+                **write_options,
+            )
+
+    # Configs whose narrow output is sunk without collecting it
+    sunk = [False] * len(configs)
+    for i, (output_prefix, config) in enumerate(zip(args.output_prefix, configs)):
+        plan = memory_plans[i]
+        budget_sink = plan is not None and plan["strategy"] == "sink"
+        if sharded[i] or not (args.sink or budget_sink):
+            continue
+        with log_to(log_files[output_prefix]):
+            if budget_sink:
+                pl.Config.set_streaming_chunk_size(plan["streaming_chunk_size"])
+            profile = Profile(plans=args.profile_plans) if profiling else None
+            sunk[i] = sink_UKBB_tabular_data(
+                config,
+                output_prefix=output_prefix,
+                output_formats=args.output_formats,
+                profile=profile,
+                pivot=wide_batch_sizes[i] is None,
+                **extract_args,
+                **write_options,
+            )
+            if sunk[i] and wide_batch_sizes[i] is not None:
+                # Every batch is collected from the query, so the narrow
+                # data is never held in memory. The columns come from the
+                # statistics index of a store when it can tell them
+                with scan_UKBB_tabular_data(
+                    copy.deepcopy(config), **extract_args
+                ) as query:
+                    write_wide_in_batches(
+                        i,
+                        query.narrow(),
+                        query.dictionary().collect(),
+                        profile,
+                        query.wide_columns(),
+                    )
+            if sunk[i] and profile is not None:
+                logging.info(f"Writing {output_prefix}profile.json")
+                profile.write(f"{output_prefix}profile.json")
+            if budget_sink and not sunk[i]:
+                # The query does not stream, shard it instead of collecting it
+                extract_in_shards(i)
+                sharded[i] = True
+
+    collected = [i for i in range(len(configs)) if not sunk[i] and not sharded[i]]
+    extract_args.update(profile=profiling, profile_plans=args.profile_plans)
+    if args.result_cache_dir is not None:
+        extract_args.update(
+            result_cache_dir=args.result_cache_dir,
+            result_cache_size=args.result_cache_size,
+        )
+    # Each config is looked up in the result cache on its own
+    batch = len(collected) > 1 and args.result_cache_dir is None
+    if (
+        batch
+        and args.max_memory is not None
+        and sum(memory_plans[i]["peak_bytes"] for i in collected)
+        > args.max_memory * BUDGET_FRACTION
+    ):
+        with log_to(*(log_files[args.output_prefix[i]] for i in collected)):
+            logging.info(
+                "The configs do not fit the memory budget together, extracting them one at a time"
+            )
+        batch = False
+    if batch:
+        results = extract_UKBB_tabular_data_batch(
+            configs=[configs[i] for i in collected],
+            pivot=[wide_batch_sizes[i] is None for i in collected],
+            **extract_args,
+        )
+    else:
+        results = (
+            extract_UKBB_tabular_data(
+                config=configs[i], pivot=wide_batch_sizes[i] is None, **extract_args
+            )
+            for i in collected
+        )
+
+    # The shared scan of a batch is logged with the first config
+    results = iter(results)
+    for i in collected:
+        output_prefix, config = args.output_prefix[i], configs[i]
+        with log_to(log_files[output_prefix]):
+            data, data_wide, dictionary, codings, *profile = next(results)
+            profile = profile[0] if profile else None
+            wide_groups = args.wide_groups is not None and data_wide is not None
+            write_outputs(
+                data,
+                None if wide_groups else data_wide,
+                dictionary,
+                codings,
+                output_prefix,
+                args.output_formats,
+                profile,
+                workers=memory_plans[i]["writer_threads"]
+                if memory_plans[i] is not None and memory_plans[i]["writer_threads"]
+                else args.writer_threads,
+                **write_options,
+            )
+            if wide_groups:
+                with profile_stage(profile, "write wide groups", data_wide.height):
+                    write_wide_groups(
+                        data_wide,
+                        dictionary,
+                        output_prefix,
+                        args.output_formats,
+                        args.wide_groups,
+                        **write_options,
+                    )
+            if wide_batch_sizes[i] is not None:
+                with pl.StringCache():
+                    write_wide_in_batches(i, data.lazy(), dictionary, profile)
+            if profile is not None:
+                logging.info(f"Writing {output_prefix}profile.json")
+                profile.write(f"{output_prefix}profile.json")
@@ -0,0 +1,293 @@
+"""
+UKBB Showcase Metadata Cache
+
+This module loads the UKBB Showcase metadata files used by the extractor and
+keeps a preprocessed copy of them in a binary cache, so that repeated
+extractions do not re-parse and re-infer the source files.
+
+A metadata bundle holds:
+- dictionary: the typed Data_Dictionary_Showcase.tsv
+- codings: the typed Codings.tsv
+- meanings: the Meaning of every coded Value of every FieldID, the codings
+  joined with the dictionary once so that recoding is a single lookup
+- category_closure: every category with all of its descendant categories
+  (including itself), from the category tree (Schema 13)
+- category_fields: every category with all FieldIDs found in it or in any of
+  its descendant categories
+- instanced: the instanced flag of every field (Schema 1)
+
+Bundles are stored as uncompressed Arrow IPC files in a directory named after
+a hash of the source files' contents, so a bundle is rebuilt whenever any of
+its inputs change and loading an existing one only memory-maps a few files.
+"""
+from __future__ import annotations
+
+import hashlib
+import logging
+import os
+import pathlib as p
+import shutil
+import tempfile
+from typing import TypedDict
+
+import polars as pl
+
+# Bump when the bundle contents change, to invalidate existing caches
+BUNDLE_VERSION = "2"
+
+BUNDLE_TABLES = [
+    "dictionary",
+    "codings",
+    "meanings",
+    "category_closure",
+    "category_fields",
+    "instanced",
+]
+
+
+class Metadata(TypedDict):
+    """
+    Preprocessed UKBB Showcase metadata.
+
+    Attributes
+    ----------
+    dictionary : pl.DataFrame
+        Data dictionary, including FieldID, Field, ValueType, Coding, Category.
+    codings : pl.DataFrame
+        Codings with Coding, Value, Meaning.
+    meanings : pl.DataFrame
+        FieldID, Value and Meaning of every code of a coded field.
+    category_closure : pl.DataFrame
+        Category and each of its Descendant categories, itself included.
+        Empty when no category tree file is available.
+    category_fields : pl.DataFrame
+        Category and each FieldID found in it or in its descendants.
+    instanced : pl.DataFrame
+        field_id and instanced flag of every data field. Empty when no data
+        field properties file is available.
+    """
+
+    dictionary: pl.DataFrame
+    codings: pl.DataFrame
+    meanings: pl.DataFrame
+    category_closure: pl.DataFrame
+    category_fields: pl.DataFrame
+    instanced: pl.DataFrame
+
+
+def file_digest(path: str | None) -> str:
+    """SHA-256 of a file's contents, or a fixed marker for missing files."""
+    if path is None or not p.Path(path).is_file():
+        return "absent"
+    digest = hashlib.sha256()
+    with open(path, "rb") as stream:
+        for block in iter(lambda: stream.read(1024**2), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def metadata_key(
+    dictionary_file: str,
+    coding_file: str,
+    category_tree_file: str | None,
+    data_field_prop_file: str | None,
+) -> str:
+    """Cache key of the bundle built from the given source files."""
+    digest = hashlib.sha256(BUNDLE_VERSION.encode())
+    for path in [dictionary_file, coding_file, category_tree_file, data_field_prop_file]:
+        digest.update(file_digest(path).encode())
+    return digest.hexdigest()[:32]
+
+
+def expand_category_tree(
+    category_tree: pl.DataFrame, categories: pl.Series
+) -> pl.DataFrame:
+    """
+    Compute the transitive closure of the UKBB category tree.
+
+    Parameters
+    ----------
+    category_tree : pl.DataFrame
+        Category tree edges with parent_id and child_id.
+    categories : pl.Series
+        Additional categories to include, e.g. those of the dictionary.
+
+    Returns
+    -------
+    pl.DataFrame
+        Category, Descendant pairs: every category paired with itself and
+        with all categories below it in the tree.
+    """
+    edges = category_tree.select(
+        [pl.col("parent_id").cast(pl.Int64), pl.col("child_id").cast(pl.Int64)]
+    )
+    all_categories = pl.concat(
+        [
+            edges.get_column("parent_id"),
+            edges.get_column("child_id"),
+            categories.cast(pl.Int64),
+        ]
+    ).unique()
+    closure = pl.DataFrame(
+        {"Category": all_categories, "Descendant": all_categories}
+    )
+    frontier = closure
+    # Walk one level further down the tree each iteration, until no pair
+    # not already in the closure is found
+    while frontier.height:
+        frontier = (
+            frontier.join(edges, left_on="Descendant", right_on="parent_id")
+            .select(["Category", pl.col("child_id").alias("Descendant")])
+            .unique()
+            .join(closure, on=["Category", "Descendant"], how="anti")
+        )
+        closure = pl.concat([closure, frontier])
+    return closure.sort(["Category", "Descendant"])
+
+
+def build_metadata(
+    dictionary_file: str,
+    coding_file: str,
+    category_tree_file: str | None = None,
+    data_field_prop_file: str | None = None,
+) -> Metadata:
+    """
+    Parse the UKBB Showcase files into a metadata bundle.
+
+    Parameters
+    ----------
+    dictionary_file : str
+        Path to Data_Dictionary_Showcase.tsv.
+    coding_file : str
+        Path to Codings.tsv.
+    category_tree_file : str, optional
+        Path to the category tree (Schema 13), may be missing.
+    data_field_prop_file : str, optional
+        Path to the data field properties (Schema 1), may be missing.
+
+    Returns
+    -------
+    Metadata
+        The parsed and preprocessed metadata.
+    """
+    dictionary = pl.read_csv(
+        dictionary_file,
+        separator="\t",
+        infer_schema_length=None,
+        encoding="utf8-lossy",
+        quote_char=None,
+    )
+
+    codings = pl.read_csv(
+        coding_file,
+        separator="\t",
+        dtypes={
+            "Coding": pl.Int64,
+            "Value": pl.Utf8,
+            "Meaning": pl.Utf8,
+        },
+        encoding="utf8-lossy",
+    )
+
+    meanings = (
+        dictionary.select(["FieldID", "Coding"])
+        .drop_nulls()
+        .join(codings, on="Coding")
+        .select(["FieldID", "Value", "Meaning"])
+        .sort(["FieldID", "Value"])
+    )
+
+    if category_tree_file is not None and p.Path(category_tree_file).is_file():
+        category_tree = pl.read_csv(category_tree_file, separator="\t")
+        category_closure = expand_category_tree(
+            category_tree, dictionary.get_column("Category")
+        )
+    else:
+        category_closure = pl.DataFrame(
+            schema={"Category": pl.Int64, "Descendant": pl.Int64}
+        )
+    category_fields = (
+        category_closure.join(
+            dictionary.select(
+                [pl.col("Category").cast(pl.Int64).alias("Descendant"), "FieldID"]
+            ),
+            on="Descendant",
+        )
+        .select(["Category", "FieldID"])
+        .unique(maintain_order=True)
+    )
+
+    if data_field_prop_file is not None and p.Path(data_field_prop_file).is_file():
+        instanced = pl.read_csv(data_field_prop_file, separator="\t").select(
+            ["field_id", "instanced"]
+        )
+    else:
+        instanced = pl.DataFrame(schema={"field_id": pl.Int64, "instanced": pl.Int64})
+
+    return {
+        "dictionary": dictionary,
+        "codings": codings,
+        "meanings": meanings,
+        "category_closure": category_closure,
+        "category_fields": category_fields,
+        "instanced": instanced,
+    }
+
+
+def load_metadata(
+    dictionary_file: str,
+    coding_file: str,
+    category_tree_file: str | None = None,
+    data_field_prop_file: str | None = None,
+    cache_dir: str | None = None,
+) -> Metadata:
+    """
+    Load UKBB Showcase metadata, from the cache when it is up to date.
+
+    Parameters
+    ----------
+    dictionary_file, coding_file, category_tree_file, data_field_prop_file
+        Source files, see build_metadata().
+    cache_dir : str, optional
+        Directory holding metadata bundles. When None, the metadata is parsed
+        from the source files without caching.
+
+    Returns
+    -------
+    Metadata
+        The parsed and preprocessed metadata.
+    """
+    if cache_dir is None:
+        return build_metadata(
+            dictionary_file, coding_file, category_tree_file, data_field_prop_file
+        )
+
+    key = metadata_key(
+        dictionary_file, coding_file, category_tree_file, data_field_prop_file
+    )
+    bundle_dir = p.Path(cache_dir) / key
+    if bundle_dir.is_dir():
+        logging.info(f"Loading metadata bundle {bundle_dir}")
+        return {
+            table: pl.read_ipc(bundle_dir / f"{table}.arrow", memory_map=True)
+            for table in BUNDLE_TABLES
+        }
+
+    logging.info(f"Building metadata bundle {bundle_dir}")
+    metadata = build_metadata(
+        dictionary_file, coding_file, category_tree_file, data_field_prop_file
+    )
+    bundle_dir.parent.mkdir(parents=True, exist_ok=True)
+    # Write to a temporary directory first so concurrent extractions never
+    # see a partial bundle
+    tmp_dir = tempfile.mkdtemp(prefix=f".{key}.", dir=bundle_dir.parent)
+    try:
+        for table in BUNDLE_TABLES:
+            metadata[table].write_ipc(
+                p.Path(tmp_dir) / f"{table}.arrow", compression="uncompressed"
+            )
+        os.rename(tmp_dir, bundle_dir)
+    except OSError:
+        # Another process completed the same bundle first
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return metadata
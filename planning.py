@@ -0,0 +1,607 @@
+"""
+UKBB Extraction Planning
+
+This module estimates the size of an extraction before it runs, from
+statistics which are available without scanning the data:
+
+- the field statistics index of a melted store (see field_statistics.py),
+  which records the rows of every FieldID at every InstanceID
+- the manifest of a partitioned store, which records the rows of every part
+  file together with its FieldID, InstanceIDs and ArrayIDs
+- the manifest and subject index of a subject-sorted store
+- the Items, Participants and Array columns of the data dictionary, as
+  found in the UKBB Showcase dictionary
+- otherwise the number of rows of the data file, spread evenly over the
+  fields of the dictionary
+
+Estimates ignore the value filters (drop_empty_strings, drop_null_strings,
+drop_null_numerics) and are meant as upper bounds, except for the null
+strings and numerics counted by a field statistics index.
+
+From an estimate and a memory budget, plan_memory() chooses how to run the
+extraction: collected as usual, with the wide pivot in batches of subjects,
+sunk to the outputs without collecting it, or split into subject shards run
+one after the other and merged to the outputs batch by batch. Shards run in
+a process of their own, so there are as many as it takes for one of them to
+fit the budget next to the process which started it.
+
+plan_extraction() adds the resolved filters, the size of every output file
+and the runtime to an estimate, for the --plan dry run of the extractor.
+Output sizes and runtimes use rates measured on one core with synthetic data
+(see synthetic.py), so they are rough upper bounds.
+"""
+from __future__ import annotations
+
+import math
+import os
+import pathlib as p
+import re
+
+import polars as pl
+
+from cohort import cohort_statistics
+from config import Config
+from metadata import Metadata
+from store import (
+    SUBJECT_SORTED_LAYOUT,
+    is_melted_store,
+    read_field_statistics,
+    read_manifest,
+)
+
+# In-memory size of a narrow row: four Int64 index columns, a Categorical
+# FieldValue and its share of the categories
+NARROW_ROW_BYTES = 56
+
+# Memory of an extraction process before it reads any data: the interpreter,
+# Polars and its thread pools, plus METADATA_OVERHEAD times the in-memory
+# size of the Showcase metadata
+PROCESS_BYTES = 200 * 2**20
+METADATA_OVERHEAD = 2
+
+# Peak memory of a collected extraction, measured on synthetic stores and
+# files (see synthetic.py) from 0.1 to 6 million rows: per row read from the
+# data, before the instance filter when non-instanced fields are replicated,
+# and per narrow row of the result, which covers the dictionary and codings
+# joins, the Categorical collect, the typed columns and the writes of the
+# outputs. Measured peaks were 60-95% of the estimate
+SCAN_ROW_BYTES = 200
+EXTRACTION_ROW_BYTES = 240
+
+# In-memory size of a wide cell, and peak memory of the pivot and typing
+# relative to the size of the wide result. The narrow result is held during
+# the pivot
+WIDE_CELL_BYTES = 8
+PIVOT_OVERHEAD = 3
+
+# Memory per row of the streaming chunk size: every part file scanned by a
+# sunk query holds a chunk of rows, and so does every operator of its
+# pipelines
+STREAMING_ROW_BYTES = 10_000
+
+# Smallest streaming chunk size used, smaller chunks write Categorical
+# columns to sunk Parquet files that polars 0.18 fails to read back
+MIN_STREAMING_CHUNK_SIZE = 10_000
+
+# Bytes per narrow row and per wide cell of the output files, with zstd
+# compression for arrow and parquet
+NARROW_FORMAT_BYTES = {"tsv": 51, "csv": 51, "arrow": 5, "feather": 5, "parquet": 17}
+WIDE_FORMAT_BYTES = {"tsv": 4.2, "csv": 4.2, "arrow": 0.8, "feather": 0.8, "parquet": 0.7}
+
+# Seconds per narrow row of the query and of the pivot and typing, and per
+# narrow row and wide cell of each output format
+QUERY_ROW_SECONDS = 2.7e-6
+PIVOT_ROW_SECONDS = 1.6e-6
+NARROW_FORMAT_SECONDS = {
+    "tsv": 0.85e-6,
+    "csv": 0.85e-6,
+    "arrow": 0.3e-6,
+    "feather": 0.3e-6,
+    "parquet": 0.7e-6,
+}
+WIDE_FORMAT_SECONDS = {
+    "tsv": 0.12e-6,
+    "csv": 0.12e-6,
+    "arrow": 0.03e-6,
+    "feather": 0.03e-6,
+    "parquet": 0.03e-6,
+}
+
+# Instances of instanced UKBB fields (0-3)
+UKBB_INSTANCES = 4
+
+# Share of the memory budget planned for, the rest is left for allocator
+# slack and the errors of the estimates
+BUDGET_FRACTION = 0.8
+
+MEMORY_UNITS = {"": 1, "K": 2**10, "M": 2**20, "G": 2**30, "T": 2**40}
+
+
+def parse_memory(size: str) -> int:
+    """
+    Parse a memory size such as 512M, 16G or 16GiB into bytes.
+
+    Raises
+    ------
+    ValueError
+        If size is not a number followed by an optional K, M, G or T unit.
+    """
+    match = re.fullmatch(r"\s*([0-9.]+)\s*([KMGT]?)(i?B)?\s*", size, re.IGNORECASE)
+    if match is None:
+        raise ValueError(f"Invalid memory size {size}")
+    return int(float(match.group(1)) * MEMORY_UNITS[match.group(2).upper()])
+
+
+def data_statistics(data_file: str, metadata: Metadata) -> dict:
+    """
+    Row statistics of melted data, without scanning it.
+
+    Parameters
+    ----------
+    data_file : str
+        Melted .tsv, .arrow/.feather, or a melted store directory.
+    metadata : Metadata
+        Showcase metadata.
+
+    Returns
+    -------
+    dict
+        rows: total rows; subjects: number of subjects, None if unknown;
+        fields: frame of FieldID, InstanceIDs (list, None if unknown),
+        ArrayID_max and rows, None if only the total is known; instances:
+        the field statistics index, None without one; null_strings,
+        null_numerics: the null values it counts, None if not counted;
+        source: the statistics used.
+    """
+    dictionary = metadata["dictionary"]
+    if is_melted_store(data_file):
+        manifest = read_manifest(data_file)
+        instances = read_field_statistics(data_file)
+        if instances is not None:
+            fields = instances.groupby("FieldID", maintain_order=True).agg(
+                [
+                    pl.col("InstanceID").alias("InstanceIDs"),
+                    pl.col("ArrayID_max").max(),
+                    pl.col("rows").sum(),
+                ]
+            )
+            return {
+                "rows": fields.get_column("rows").sum(),
+                # Only a subject-sorted store records its subjects, otherwise
+                # the most subjects with data for a field is a lower bound
+                "subjects": manifest.get("subjects")
+                or instances.get_column("subjects").max(),
+                "fields": fields,
+                "instances": instances,
+                "null_strings": manifest["statistics"]["null_strings"],
+                "null_numerics": manifest["statistics"]["null_numerics"],
+                "source": "field statistics",
+            }
+        if manifest.get("layout") == SUBJECT_SORTED_LAYOUT:
+            return {
+                "rows": manifest["rows"],
+                "subjects": manifest["subjects"],
+                "fields": None,
+                "source": "store manifest",
+            }
+        parts = pl.DataFrame(
+            [
+                {
+                    "FieldID": part["FieldID"],
+                    "InstanceIDs": part["InstanceIDs"],
+                    "ArrayID_max": part["ArrayID_max"],
+                    "rows": part["rows"],
+                }
+                for part in manifest["parts"]
+            ],
+            schema={
+                "FieldID": pl.Int64,
+                "InstanceIDs": pl.List(pl.Int64),
+                "ArrayID_max": pl.Int64,
+                "rows": pl.Int64,
+            },
+        )
+        fields = parts.groupby("FieldID", maintain_order=True).agg(
+            [
+                pl.col("InstanceIDs").flatten().unique().sort(),
+                pl.col("ArrayID_max").max(),
+                pl.col("rows").sum(),
+            ]
+        )
+        # Single-valued non-instanced fields such as Sex hold one row per
+        # subject
+        single = fields.filter(
+            (pl.col("InstanceIDs").list.lengths() == 1) & (pl.col("ArrayID_max") == 0)
+        )
+        return {
+            "rows": fields.get_column("rows").sum(),
+            "subjects": single.get_column("rows").max() if single.height else None,
+            "fields": fields,
+            "source": "store manifest",
+        }
+
+    if "Items" in dictionary.columns:
+        array_max = pl.lit(None, dtype=pl.Int64)
+        if "Array" in dictionary.columns:
+            array_max = pl.col("Array").cast(pl.Int64, strict=False) - 1
+        fields = dictionary.select(
+            [
+                pl.col("FieldID").cast(pl.Int64),
+                pl.lit(None, dtype=pl.List(pl.Int64)).alias("InstanceIDs"),
+                array_max.alias("ArrayID_max"),
+                pl.col("Items").cast(pl.Int64, strict=False).fill_null(0).alias("rows"),
+            ]
+        )
+        subjects = None
+        if "Participants" in dictionary.columns:
+            subjects = dictionary.get_column("Participants").cast(pl.Int64, strict=False).max()
+        return {
+            "rows": fields.get_column("rows").sum(),
+            "subjects": subjects,
+            "fields": fields,
+            "source": "dictionary",
+        }
+
+    file_extension = p.Path(data_file).suffix
+    if file_extension in [".arrow", ".feather"]:
+        rows = pl.scan_ipc(data_file).select(pl.count()).collect().item()
+    else:
+        # Average line length of the first MiB
+        with open(data_file, "rb") as stream:
+            sample = stream.read(2**20)
+        line_bytes = len(sample) / max(sample.count(b"\n"), 1)
+        rows = int(os.path.getsize(data_file) / line_bytes)
+    return {"rows": rows, "subjects": None, "fields": None, "source": "data file size"}
+
+
+def non_instanced_fields(config: Config, metadata: Metadata) -> list[int]:
+    """FieldIDs replicated from instance 0, empty if none are."""
+    if not config["replicate_non_instanced"]:
+        return []
+    return (
+        metadata["instanced"]
+        .filter(pl.col("instanced") == 0)
+        .get_column("field_id")
+        .to_list()
+    )
+
+
+def exact_field_rows(
+    config: Config, statistics: dict, metadata: Metadata
+) -> pl.DataFrame:
+    """
+    Rows of every field at the requested instances, from a statistics index.
+
+    Rows of null strings and numerics are left out when the config drops at
+    least those counted by the index.
+
+    Returns
+    -------
+    pl.DataFrame
+        FieldID, InstanceIDs, ArrayID_max and rows, like the fields of
+        data_statistics().
+    """
+    instances = statistics["instances"]
+    if config["InstanceIDs"]:
+        # Non-instanced fields keep their rows, replicated later on
+        instances = instances.filter(
+            pl.col("InstanceID").is_in(config["InstanceIDs"])
+            | pl.col("FieldID").is_in(non_instanced_fields(config, metadata))
+        )
+    rows = pl.col("rows")
+    null_strings = statistics["null_strings"]
+    if null_strings is not None and set(null_strings) <= set(
+        config["drop_null_strings"]
+    ):
+        rows = rows - pl.col("null_strings")
+    if set(statistics["null_numerics"]) <= set(config["drop_null_numerics"]):
+        rows = rows - pl.col("null_numerics")
+    return instances.groupby("FieldID", maintain_order=True).agg(
+        [
+            pl.col("InstanceID").alias("InstanceIDs"),
+            pl.col("ArrayID_max").max(),
+            rows.sum().alias("rows"),
+        ]
+    )
+
+
+def selected_rows(
+    config: Config, statistics: dict, metadata: Metadata
+) -> tuple[int, int, int]:
+    """
+    Rows, fields and arrays selected by the field filters of config.
+
+    Parameters
+    ----------
+    config : Config
+        Expanded extraction configuration, its cohort is not applied.
+    statistics : dict
+        Result of data_statistics().
+    metadata : Metadata
+        Showcase metadata.
+
+    Returns
+    -------
+    tuple[int, int, int]
+        Narrow rows after the replication of non-instanced fields, number of
+        fields with data and ArrayIDs per field.
+    """
+    fields = statistics["fields"]
+    n_dictionary_fields = metadata["dictionary"].height
+
+    if statistics.get("instances") is not None:
+        fields = exact_field_rows(config, statistics, metadata)
+    if fields is None:
+        n_fields = len(config["FieldIDs"]) or n_dictionary_fields
+        rows = statistics["rows"] * min(n_fields / max(n_dictionary_fields, 1), 1)
+        return int(rows), n_fields, 1
+
+    if config["FieldIDs"]:
+        fields = fields.filter(pl.col("FieldID").is_in(config["FieldIDs"]))
+    fields = fields.filter(pl.col("rows") > 0)
+    non_instanced = non_instanced_fields(config, metadata)
+    if config["InstanceIDs"] and statistics.get("instances") is None:
+        # Rows are assumed evenly spread over the instances of a field
+        fields = fields.with_columns(
+            pl.when(
+                pl.col("InstanceIDs").is_not_null()
+                & pl.col("FieldID").is_in(non_instanced).is_not()
+            )
+            .then(
+                pl.col("rows")
+                * pl.col("InstanceIDs")
+                .list.eval(pl.element().is_in(config["InstanceIDs"]))
+                .list.sum()
+                / pl.col("InstanceIDs").list.lengths()
+            )
+            .otherwise(pl.col("rows"))
+            .cast(pl.Int64)
+        )
+    # Non-instanced rows are replicated to at most every instance
+    fields = fields.with_columns(
+        pl.when(pl.col("FieldID").is_in(non_instanced))
+        .then(pl.col("rows") * (len(config["InstanceIDs"]) or UKBB_INSTANCES))
+        .otherwise(pl.col("rows"))
+    )
+    rows = fields.get_column("rows").sum() or 0
+    arrays = (fields.get_column("ArrayID_max").max() or 0) + 1
+    return rows, fields.height, arrays
+
+
+def estimate_extraction(config: Config, data_file: str, metadata: Metadata) -> dict:
+    """
+    Estimate the size of an extraction without running it.
+
+    Parameters
+    ----------
+    config : Config
+        Expanded extraction configuration.
+    data_file : str
+        Melted data or store.
+    metadata : Metadata
+        Showcase metadata.
+
+    Returns
+    -------
+    dict
+        narrow_rows, scanned_rows (rows read from the data), subjects,
+        fields, wide_rows, wide_columns, the in-memory narrow_bytes and
+        wide_bytes of the results, and the process_bytes of a process
+        before the extraction and peak_bytes of a process running it, see
+        the module docstring.
+    """
+    statistics = data_statistics(data_file, metadata)
+    rows, n_fields, arrays = selected_rows(config, statistics, metadata)
+    scanned_rows = rows
+    if config["replicate_non_instanced"]:
+        # Rows are replicated before the instance filter, every instance of
+        # the fields is read
+        scanned_rows = selected_rows(
+            dict(config, InstanceIDs=[], replicate_non_instanced=False),
+            statistics,
+            metadata,
+        )[0]
+
+    subjects = statistics["subjects"]
+    cohort = cohort_statistics(config)
+    selected_subjects = cohort["subjects"] if cohort is not None else 0
+    subject_fraction = 1.0
+    if selected_subjects:
+        if subjects:
+            subject_fraction = min(selected_subjects / subjects, 1.0)
+        subjects = min(selected_subjects, subjects or selected_subjects)
+    rows = int(rows * subject_fraction)
+    scanned_rows = int(scanned_rows * subject_fraction)
+
+    narrow_bytes = rows * NARROW_ROW_BYTES
+    estimate = {
+        "source": statistics["source"],
+        "narrow_rows": rows,
+        "scanned_rows": scanned_rows,
+        "subjects": subjects,
+        "fields": n_fields,
+        "narrow_bytes": narrow_bytes,
+        "wide_rows": None,
+        "wide_columns": None,
+        "wide_bytes": 0,
+    }
+    if config["wide"]:
+        # Every wide row is a SubjectID, InstanceID, ArrayID combination
+        instances = len(config["InstanceIDs"]) or UKBB_INSTANCES
+        wide_rows = min((subjects or rows) * instances * arrays, rows)
+        estimate["wide_rows"] = wide_rows
+        estimate["wide_columns"] = n_fields + 3
+        estimate["wide_bytes"] = wide_rows * (n_fields + 3) * WIDE_CELL_BYTES
+    estimate["process_bytes"] = PROCESS_BYTES + METADATA_OVERHEAD * sum(
+        frame.estimated_size() for frame in metadata.values()
+    )
+    estimate["peak_bytes"] = estimate["process_bytes"] + max(
+        scanned_rows * SCAN_ROW_BYTES + rows * EXTRACTION_ROW_BYTES,
+        narrow_bytes + estimate["wide_bytes"] * PIVOT_OVERHEAD,
+    )
+    return estimate
+
+
+def shard_peak_bytes(estimate: dict, shards: int) -> int:
+    """Estimated peak memory of the process running one of shards subject shards."""
+    return estimate["process_bytes"] + math.ceil(
+        (estimate["peak_bytes"] - estimate["process_bytes"]) / shards
+    )
+
+
+def plan_memory(estimate: dict, max_memory: int, config: Config) -> dict:
+    """
+    Choose how to run an extraction within a memory budget.
+
+    Parameters
+    ----------
+    estimate : dict
+        Result of estimate_extraction().
+    max_memory : int
+        Memory budget in bytes.
+    config : Config
+        Expanded extraction configuration.
+
+    Returns
+    -------
+    dict
+        strategy: one of collect, wide_batches, sink or shards;
+        wide_batch_size: subjects per wide batch (wide_batches);
+        shards, shard_workers: number of subject shards and shards run at
+        once (shards, or when a sunk query turns out not to stream);
+        shard_peak_bytes: estimated peak memory of a shard process;
+        writer_threads: number of concurrent writers;
+        streaming_chunk_size: rows per chunk of the streaming engine (sink).
+
+    Raises
+    ------
+    ValueError
+        If the budget cannot hold the process running a shard next to the
+        process which started it.
+    """
+    budget = max_memory * BUDGET_FRACTION
+    pivot_bytes = estimate["wide_bytes"] * PIVOT_OVERHEAD
+    plan = {
+        "strategy": "collect",
+        "wide_batch_size": None,
+        "shards": None,
+        "shard_workers": None,
+        "shard_peak_bytes": None,
+        # Writers of all files at once hold their buffers concurrently
+        "writer_threads": None if estimate["peak_bytes"] <= budget / 2 else 1,
+        "streaming_chunk_size": None,
+    }
+    if estimate["peak_bytes"] <= budget:
+        return plan
+
+    # Subject shards run one after the other, each in a process of its own
+    # next to the process which started it and merges them. Shards are added
+    # until the estimated peak of a shard fits the rest of the budget
+    shard_budget = budget - estimate["process_bytes"]
+    if estimate["process_bytes"] >= shard_budget:
+        raise ValueError(
+            f"A memory budget of {max_memory / 2**20:.0f} MiB cannot hold two "
+            f"extraction processes of {estimate['process_bytes'] / 2**20:.0f} MiB"
+        )
+    shards = 1
+    while (
+        shard_peak_bytes(estimate, shards) > shard_budget
+        and shards < (estimate["subjects"] or estimate["narrow_rows"] or 1)
+    ):
+        shards += 1
+    plan["shards"] = shards
+    plan["shard_workers"] = 1
+    plan["shard_peak_bytes"] = shard_peak_bytes(estimate, shards)
+
+    collect_bytes = (
+        estimate["process_bytes"]
+        + estimate["scanned_rows"] * SCAN_ROW_BYTES
+        + estimate["narrow_rows"] * EXTRACTION_ROW_BYTES
+    )
+    if collect_bytes <= budget / 2 and config["wide"] and estimate["subjects"]:
+        # The narrow result fits, pivot it in batches of subjects
+        subject_bytes = pivot_bytes / estimate["subjects"]
+        plan["strategy"] = "wide_batches"
+        free_bytes = budget - estimate["process_bytes"] - estimate["narrow_bytes"]
+        plan["wide_batch_size"] = max(int(free_bytes / subject_bytes), 1)
+    elif not config["wide"]:
+        # Rows are streamed through chunks of the streaming engine, given a
+        # quarter of the budget
+        plan["strategy"] = "sink"
+        plan["streaming_chunk_size"] = min(
+            max(int(budget / 4 / STREAMING_ROW_BYTES), MIN_STREAMING_CHUNK_SIZE), 100_000
+        )
+    else:
+        plan["strategy"] = "shards"
+    return plan
+
+
+def plan_extraction(
+    config: Config,
+    data_file: str,
+    metadata: Metadata,
+    output_formats: list[str],
+    compression: str = "zstd",
+) -> dict:
+    """
+    Estimate an extraction and its outputs without running it.
+
+    Parameters
+    ----------
+    config : Config
+        Expanded extraction configuration.
+    data_file : str
+        Melted data or store.
+    metadata : Metadata
+        Showcase metadata.
+    output_formats : list[str]
+        Output formats among tsv, csv, arrow/feather, parquet.
+    compression : str, default="zstd"
+        Codec of the arrow and parquet outputs; uncompressed outputs are
+        estimated at their in-memory size.
+
+    Returns
+    -------
+    dict
+        The estimate of estimate_extraction(), with the resolved filters
+        (FieldIDs, InstanceIDs and ArrayIDs counts, empty for all, and
+        subjects selected by the cohort, None for all), output_bytes of every
+        output file and the estimated runtime in seconds.
+    """
+    estimate = estimate_extraction(config, data_file, metadata)
+    cohort = cohort_statistics(config)
+    plan = {
+        "filters": {
+            "FieldIDs": len(config["FieldIDs"]),
+            "InstanceIDs": config["InstanceIDs"],
+            "ArrayIDs": config["ArrayIDs"],
+            "subjects": cohort["subjects"] if cohort is not None else None,
+            "excluded_subject_files": len(config.get("ExcludeSubjectIDFiles") or []),
+        },
+        **estimate,
+    }
+
+    narrow_rows = estimate["narrow_rows"]
+    wide_cells = (estimate["wide_rows"] or 0) * (estimate["wide_columns"] or 0)
+    output_bytes = {}
+    seconds = narrow_rows * QUERY_ROW_SECONDS
+    if config["wide"]:
+        seconds += narrow_rows * PIVOT_ROW_SECONDS
+    for format in output_formats:
+        compressed = format in ["tsv", "csv"] or compression != "uncompressed"
+        output_bytes[f"narrow.{format}"] = int(
+            narrow_rows * NARROW_FORMAT_BYTES[format]
+            if compressed
+            else estimate["narrow_bytes"]
+        )
+        seconds += narrow_rows * NARROW_FORMAT_SECONDS[format]
+        if config["wide"]:
+            output_bytes[f"wide.{format}"] = int(
+                wide_cells * WIDE_FORMAT_BYTES[format]
+                if compressed
+                else estimate["wide_bytes"]
+            )
+            seconds += wide_cells * WIDE_FORMAT_SECONDS[format]
+    plan["output_bytes"] = output_bytes
+    plan["seconds"] = round(seconds, 1)
+    return plan
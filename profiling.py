@@ -0,0 +1,196 @@
+"""
+UKBB Extraction Profiling
+
+This module records per-stage measurements of an extraction: wall time, the
+number of rows going in and out, and the peak resident memory of the process
+during the stage, optionally with the polars query plan of the stage.
+
+A Profile is filled in by extract_UKBB_tabular_data() and write_outputs()
+when profiling is requested. Since the extraction is otherwise a single lazy
+query, profiling materializes the data after every stage so that the cost of
+each stage can be told apart; the total time of a profiled run can therefore
+differ from that of a regular run, but the outputs are the same.
+
+Example JSON report:
+    {
+      "created": "2024-06-01T12:00:00",
+      "total_wall_seconds": 12.3,
+      "peak_rss_bytes": 2147483648,
+      "stages": [
+        {"stage": "ID filters", "rows_in": null, "rows_out": 1234,
+         "wall_seconds": 4.5, "peak_rss_bytes": 1073741824},
+        ...
+      ]
+    }
+"""
+from __future__ import annotations
+
+import contextlib
+import datetime
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from collections.abc import Iterator
+
+import polars as pl
+
+# Interval between two samples of the resident set size, in seconds
+RSS_SAMPLE_INTERVAL = 0.01
+
+
+def current_rss() -> int | None:
+    """Resident set size of the process in bytes, None if unavailable."""
+    try:
+        with open("/proc/self/statm") as stream:
+            return int(stream.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def max_rss() -> int:
+    """Peak resident set size of the process so far, in bytes."""
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class RSSSampler:
+    """
+    Track the peak resident set size between start() and stop().
+
+    The resident set size is sampled from a background thread. Where it
+    cannot be read (no /proc), the peak of the whole process is reported.
+    """
+
+    def __init__(self, interval: float = RSS_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.peak = current_rss()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self) -> None:
+        while not self._stop.wait(self.interval):
+            rss = current_rss()
+            if rss is not None:
+                self.peak = max(self.peak, rss)
+
+    def start(self) -> RSSSampler:
+        if self.peak is not None:
+            self._thread = threading.Thread(target=self._sample, daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self) -> int:
+        if self._thread is None:
+            return max_rss()
+        self._stop.set()
+        self._thread.join()
+        return max(self.peak, current_rss() or 0)
+
+
+class Profile:
+    """
+    Per-stage measurements of an extraction.
+
+    Parameters
+    ----------
+    plans : bool, default=False
+        Record the polars query plan of every materialized stage.
+
+    Attributes
+    ----------
+    stages : list[dict]
+        One record per stage, in order, with keys stage, rows_in, rows_out,
+        wall_seconds, peak_rss_bytes and, when recorded, plan.
+    """
+
+    def __init__(self, plans: bool = False):
+        self.plans = plans
+        self.stages: list[dict] = []
+        self._start = time.perf_counter()
+
+    @property
+    def rows(self) -> int | None:
+        """Rows out of the last stage that counted rows."""
+        for record in reversed(self.stages):
+            if record["rows_out"] is not None:
+                return record["rows_out"]
+        return None
+
+    @contextlib.contextmanager
+    def stage(self, name: str, rows_in: int | None = None) -> Iterator[dict]:
+        """
+        Measure the code run inside the context as stage name.
+
+        rows_in defaults to the rows out of the previous stage. The record of
+        the stage is yielded so that rows_out (and other details) can be set
+        on it.
+        """
+        if rows_in is None:
+            rows_in = self.rows
+        record = {"stage": name, "rows_in": rows_in, "rows_out": None}
+        sampler = RSSSampler().start()
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record["wall_seconds"] = time.perf_counter() - start
+            record["peak_rss_bytes"] = sampler.stop()
+            self.stages.append(record)
+
+    def materialize(
+        self, name: str, data: pl.LazyFrame, **collect_options
+    ) -> pl.LazyFrame:
+        """
+        Collect data as stage name and continue lazily from the result.
+
+        Parameters
+        ----------
+        name : str
+            Name of the stage.
+        data : pl.LazyFrame
+            Plan of the stage, starting from the previous materialized stage.
+        **collect_options
+            Passed on to LazyFrame.collect(), and the matching options to
+            LazyFrame.explain().
+        """
+        with self.stage(name) as record:
+            if self.plans:
+                record["plan"] = data.explain(
+                    optimized=not collect_options.get("no_optimization", False),
+                    streaming=collect_options.get("streaming", False),
+                    comm_subplan_elim=collect_options.get("comm_subplan_elim", True),
+                )
+            collected = data.collect(**collect_options)
+            record["rows_out"] = collected.height
+        return collected.lazy()
+
+    def report(self) -> dict:
+        """The measurements as a JSON-serializable dictionary."""
+        return {
+            "created": datetime.datetime.now().isoformat(timespec="seconds"),
+            "total_wall_seconds": time.perf_counter() - self._start,
+            # statm and ru_maxrss count pages slightly differently, so the
+            # sampled stage peaks may exceed the kernel's high-water mark
+            "peak_rss_bytes": max(
+                [max_rss()] + [record["peak_rss_bytes"] for record in self.stages]
+            ),
+            "stages": self.stages,
+        }
+
+    def write(self, path: str) -> None:
+        """Write the report as JSON to path."""
+        with open(path, "w") as stream:
+            json.dump(self.report(), stream, indent=2)
+
+
+def profile_stage(
+    profile: Profile | None, name: str, rows_in: int | None = None
+) -> contextlib.AbstractContextManager[dict]:
+    """Profile.stage() of profile, or a context doing nothing if it is None."""
+    if profile is None:
+        return contextlib.nullcontext({})
+    return profile.stage(name, rows_in)
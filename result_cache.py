@@ -0,0 +1,384 @@
+"""
+UKBB Extraction Result Cache
+
+This module keeps the results of extractions in a content-addressed cache, so
+that repeated extractions do not scan, filter and join the data again.
+
+Results are grouped by everything which changes their values: the output
+options of the config (recoding, value filters, replication), a fingerprint
+of the data (the manifest of a store, or the size and modification time of a
+data file) and the hash of the metadata files (see metadata.metadata_key()).
+Within a group, each entry holds the narrow result of one selection of
+FieldIDs, InstanceIDs, ArrayIDs and subjects. Cohort files are part of the
+selection by the hash of their contents, they are never loaded into lists:
+
+    <cache_dir>/<group>/<entry>/
+        entry.json            the selection, rows and last use of the entry
+        narrow.arrow          the narrow result, with the typed value columns
+        wide_<options>.arrow  the wide result, per set of wide options
+
+A request with the selection of an entry is answered from it, including the
+wide output once it has been pivoted. A request whose selection is a subset
+of an entry (fewer fields, instances, arrays, SubjectIDs or cohort files, or
+more exclusion files) is answered by filtering the narrow result of the
+smallest such entry, and pivoting it.
+Non-instanced fields are replicated to the instances each subject attended,
+whatever else is selected, so replicated results are filtered the same way.
+
+Entries are written as uncompressed Arrow IPC files so they are memory
+mapped when read. Once the cache grows past its size limit, the least
+recently used entries are removed.
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os
+import pathlib as p
+import shutil
+import tempfile
+import time
+
+import polars as pl
+
+from cohort import filter_subjects
+from config import Config
+from metadata import file_digest
+from store import MANIFEST_FILE, is_melted_store
+
+# Bump when the entry contents change, to invalidate existing caches
+RESULT_CACHE_VERSION = "3"
+
+# Default size limit of the result cache
+DEFAULT_RESULT_CACHE_SIZE = 20 * 2**30
+
+ENTRY_FILE = "entry.json"
+
+# Config options which only change the wide output
+WIDE_OPTIONS = [
+    "wide",
+    "recode_wide_column_valuetypes",
+    "convert_compound_to_list",
+]
+
+# Config options of the selection, compared for subsets rather than hashed
+SELECTION_OPTIONS = [
+    "FieldIDs",
+    "InstanceIDs",
+    "ArrayIDs",
+    "SubjectIDs",
+    "SubjectIDFiles",
+    "ExcludeSubjectIDFiles",
+    "Categories",
+]
+
+
+def default_result_cache_dir() -> str:
+    """Default result cache directory, following the XDG convention."""
+    cache_home = os.environ.get("XDG_CACHE_HOME", p.Path.home() / ".cache")
+    return str(p.Path(cache_home) / "ukbb_tabular_processing" / "results")
+
+
+def _digest(value) -> str:
+    """Short SHA-256 of a JSON-serializable value."""
+    return hashlib.sha256(
+        json.dumps(value, sort_keys=True, default=str).encode()
+    ).hexdigest()[:32]
+
+
+def data_fingerprint(data_file: str) -> str:
+    """
+    Fingerprint of melted data, without reading it.
+
+    Stores are fingerprinted by the contents of their manifest, which every
+    ingest and update rewrites, data files by their size and modification
+    time.
+    """
+    if is_melted_store(data_file):
+        return file_digest(str(p.Path(data_file) / MANIFEST_FILE))
+    stat = os.stat(data_file)
+    return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def _normalize(value):
+    """Sort list options so that their order does not change the key."""
+    if isinstance(value, list):
+        return sorted(value, key=lambda item: (str(type(item)), item))
+    return value
+
+
+def result_keys(config: Config, data_file: str, metadata_key: str) -> dict:
+    """
+    Cache keys and selection of an extraction.
+
+    Parameters
+    ----------
+    config : Config
+        Expanded extraction configuration.
+    data_file : str
+        Melted data or store.
+    metadata_key : str
+        Hash of the metadata files, see metadata.metadata_key().
+
+    Returns
+    -------
+    dict
+        group, entry and wide keys, and the selection: sorted FieldIDs,
+        InstanceIDs and ArrayIDs (empty for all), subjects (sorted
+        SubjectIDs of the config), subject_files and excluded_files (sorted
+        content hashes of the SubjectIDFiles and ExcludeSubjectIDFiles).
+        All subjects are selected when subjects and subject_files are empty.
+    """
+    options = {
+        key: _normalize(value)
+        for key, value in config.items()
+        if key not in SELECTION_OPTIONS and key not in WIDE_OPTIONS
+    }
+    selection = {
+        "FieldIDs": sorted(set(config["FieldIDs"])),
+        "InstanceIDs": sorted(set(config["InstanceIDs"])),
+        "ArrayIDs": sorted(set(config["ArrayIDs"])),
+        "subjects": sorted(set(config["SubjectIDs"])),
+        "subject_files": sorted(
+            {file_digest(file) for file in config["SubjectIDFiles"]}
+        ),
+        "excluded_files": sorted(
+            {file_digest(file) for file in config.get("ExcludeSubjectIDFiles") or []}
+        ),
+    }
+    return {
+        "group": _digest(
+            [RESULT_CACHE_VERSION, options, data_fingerprint(data_file), metadata_key]
+        ),
+        "entry": _digest(selection),
+        "wide": _digest({key: config.get(key) for key in WIDE_OPTIONS}),
+        "selection": selection,
+    }
+
+
+def _covers(cached: list, requested: list) -> bool:
+    """Whether a cached filter list includes a requested one, empty for all."""
+    if not cached:
+        return True
+    return bool(requested) and set(requested) <= set(cached)
+
+
+def _covers_subjects(cached: dict, requested: dict) -> bool:
+    """
+    Whether the subjects of a cached selection include the requested ones.
+
+    Cohort files are only known by their hash, so a request is covered when
+    it keeps every exclusion file of the entry, and selects all subjects
+    only if the entry does, or otherwise a subset of its SubjectIDs and
+    cohort files.
+    """
+    if not set(cached["excluded_files"]) <= set(requested["excluded_files"]):
+        return False
+    if not cached["subjects"] and not cached["subject_files"]:
+        return True
+    if not requested["subjects"] and not requested["subject_files"]:
+        return False
+    return set(requested["subject_files"]) <= set(cached["subject_files"]) and set(
+        requested["subjects"]
+    ) <= set(cached["subjects"])
+
+
+def covers(cached: dict, requested: dict) -> bool:
+    """Whether a cached selection holds every row of a requested selection."""
+    return (
+        _covers(cached["FieldIDs"], requested["FieldIDs"])
+        and _covers(cached["InstanceIDs"], requested["InstanceIDs"])
+        and _covers(cached["ArrayIDs"], requested["ArrayIDs"])
+        and _covers_subjects(cached, requested)
+    )
+
+
+def _read_entry(entry_dir: p.Path) -> dict:
+    """Read the entry.json of a cache entry."""
+    with open(entry_dir / ENTRY_FILE, "r") as stream:
+        return json.load(stream)
+
+
+def _touch(entry_dir: p.Path) -> None:
+    """Mark an entry as used now, for the LRU eviction."""
+    os.utime(entry_dir / ENTRY_FILE)
+
+
+def find_result(cache_dir: str, keys: dict) -> tuple[p.Path, bool] | None:
+    """
+    Find the cache entry which can answer an extraction.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Result cache directory.
+    keys : dict
+        Result of result_keys().
+
+    Returns
+    -------
+    tuple or None
+        The entry directory and whether it holds exactly the requested
+        selection, or None if no entry covers it.
+    """
+    group_dir = p.Path(cache_dir) / keys["group"]
+    entry_dir = group_dir / keys["entry"]
+    if (entry_dir / ENTRY_FILE).is_file():
+        return entry_dir, True
+    if not group_dir.is_dir():
+        return None
+
+    # The smallest entry whose selection includes the requested one
+    candidates = []
+    for entry_dir in group_dir.iterdir():
+        if not (entry_dir / ENTRY_FILE).is_file():
+            continue
+        try:
+            entry = _read_entry(entry_dir)
+        except (OSError, ValueError):
+            # Entry removed by a concurrent eviction
+            continue
+        if covers(entry["selection"], keys["selection"]):
+            candidates.append((entry["rows"], entry_dir))
+    if not candidates:
+        return None
+    return min(candidates)[1], False
+
+
+def read_result(
+    entry_dir: p.Path, exact: bool, keys: dict, config: Config
+) -> tuple[pl.DataFrame, pl.DataFrame | None]:
+    """
+    Read the result of an extraction from a cache entry.
+
+    Parameters
+    ----------
+    entry_dir : p.Path
+        Entry found by find_result().
+    exact : bool
+        Whether the entry holds exactly the requested selection, otherwise
+        its narrow result is filtered to the selection of config.
+    keys : dict
+        Result of result_keys().
+    config : Config
+        Expanded extraction configuration.
+
+    Returns
+    -------
+    tuple containing the narrow result with the typed value columns, as
+    collected by extract_UKBB_tabular_data(), and the wide result when
+    exact and it was cached for the wide options of config, otherwise None.
+    Must be called under a pl.StringCache().
+    """
+    _touch(entry_dir)
+    data = pl.scan_ipc(entry_dir / "narrow.arrow", memory_map=True)
+    if exact:
+        data_wide = None
+        wide_file = entry_dir / f"wide_{keys['wide']}.arrow"
+        if config["wide"] and wide_file.is_file():
+            data_wide = pl.read_ipc(wide_file, memory_map=True)
+        logging.info(f"Reading cached result {entry_dir}")
+        return data.collect(), data_wide
+
+    logging.info(f"Filtering cached result {entry_dir}")
+    data = filter_subjects(data, config)
+    if config["FieldIDs"]:
+        # FieldIDs may have been recoded to <Field>_<FieldID>
+        data = data.filter(
+            pl.col("FieldID")
+            .cast(pl.Utf8)
+            .str.extract(r"(\d+)$")
+            .cast(pl.Int64)
+            .is_in(config["FieldIDs"])
+        )
+    if config["InstanceIDs"]:
+        data = data.filter(pl.col("InstanceID").is_in(config["InstanceIDs"]))
+    if config["ArrayIDs"]:
+        data = data.filter(pl.col("ArrayID").is_in(config["ArrayIDs"]))
+    return data.collect(), None
+
+
+def write_result(
+    cache_dir: str,
+    keys: dict,
+    data: pl.DataFrame | None,
+    data_wide: pl.DataFrame | None,
+    max_bytes: int = DEFAULT_RESULT_CACHE_SIZE,
+) -> None:
+    """
+    Add the result of an extraction to the cache, then evict old entries.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Result cache directory.
+    keys : dict
+        Result of result_keys().
+    data : pl.DataFrame or None
+        Narrow result with the typed value columns, None if the entry
+        already exists.
+    data_wide : pl.DataFrame or None
+        Wide result, None to not cache it.
+    max_bytes : int, default=DEFAULT_RESULT_CACHE_SIZE
+        Size limit of the cache.
+    """
+    entry_dir = p.Path(cache_dir) / keys["group"] / keys["entry"]
+    entry_dir.parent.mkdir(parents=True, exist_ok=True)
+    if data is not None and not entry_dir.is_dir():
+        # Write to a temporary directory first so concurrent extractions
+        # never see a partial entry
+        tmp_dir = p.Path(
+            tempfile.mkdtemp(prefix=f".{keys['entry']}.", dir=entry_dir.parent)
+        )
+        try:
+            # A single record batch, Categorical columns written in many
+            # batches are slow to read back into the string cache
+            data.rechunk().write_ipc(tmp_dir / "narrow.arrow", compression="uncompressed")
+            with open(tmp_dir / ENTRY_FILE, "w") as stream:
+                json.dump(
+                    {
+                        "selection": keys["selection"],
+                        "rows": data.height,
+                        "created": time.time(),
+                    },
+                    stream,
+                )
+            os.rename(tmp_dir, entry_dir)
+            logging.info(f"Cached result {entry_dir}")
+        except OSError:
+            # Another process completed the same entry first
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    wide_file = entry_dir / f"wide_{keys['wide']}.arrow"
+    if data_wide is not None and entry_dir.is_dir() and not wide_file.is_file():
+        tmp_file = entry_dir / f".{wide_file.name}.{os.getpid()}"
+        data_wide.rechunk().write_ipc(tmp_file, compression="uncompressed")
+        os.replace(tmp_file, wide_file)
+
+    evict(cache_dir, max_bytes, keep=entry_dir)
+
+
+def evict(cache_dir: str, max_bytes: int, keep: p.Path | None = None) -> None:
+    """
+    Remove the least recently used entries until the cache fits max_bytes.
+
+    The entry keep, typically the one just written, is never removed.
+    """
+    entries = []
+    for entry_file in p.Path(cache_dir).glob(f"*/*/{ENTRY_FILE}"):
+        entry_dir = entry_file.parent
+        try:
+            size = sum(file.stat().st_size for file in entry_dir.iterdir())
+            entries.append((entry_file.stat().st_mtime, size, entry_dir))
+        except OSError:
+            continue
+    total = sum(size for _, size, _ in entries)
+    for _, size, entry_dir in sorted(entries):
+        if total <= max_bytes:
+            break
+        if entry_dir == keep:
+            continue
+        logging.info(f"Evicting cached result {entry_dir}")
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        total -= size
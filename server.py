@@ -0,0 +1,627 @@
+"""
+UKBB Extraction Server
+
+A long-running extraction process for interactive analyses and notebooks
+which run many small extractions. A command-line extraction imports polars,
+parses the Showcase metadata and opens the data on every run; the server
+does so once and keeps them resident:
+
+- the dictionary, codings, category closure and instanced flags, reloaded
+  when one of the Showcase files changes
+- the memory-mapped data and subject index of a subject-sorted store (see
+  store.read_mapped_ipc()), or the part files of a partitioned store, which
+  stay in the page cache between requests
+
+Requests are HTTP, on localhost or on a Unix socket, and run on a pool of
+worker threads which limits the number of concurrent extractions:
+
+    GET  /status    the data file, metadata files and active extractions
+    POST /extract   run an extraction
+
+The body of /extract is a config, in the YAML of load_config() or as JSON,
+or a JSON object holding the config under "config" together with options:
+
+    output_prefix   write the outputs to files at this prefix, as the
+                    command line does, and answer with a JSON summary; the
+                    prefix is relative to the --output-root of the server,
+                    and must stay inside it
+    output_formats  formats of these files, arrow by default
+    frame           otherwise, the frame sent back: narrow, wide,
+                    dictionary or codings; wide when the config has wide
+                    output, narrow otherwise
+    format          format of the frame sent back: arrow (an Arrow IPC
+                    file), parquet, tsv or csv; arrow by default
+
+Frames are sent back with chunked transfer encoding, streamed as they are
+written rather than serialized in full first. Failed requests are answered
+with status 400 and a JSON {"error": ...} body, the details are in the server
+log.
+
+Examples
+--------
+$ python server.py --data-file current.melt.bysubject --socket /tmp/ukbb.sock &
+$ curl --unix-socket /tmp/ukbb.sock --data-binary @myconfig.yaml \\
+    http://localhost/extract > mysubset_wide.arrow
+
+>>> from server import request_extraction
+>>> wide = request_extraction(load_config("myconfig.yaml"), socket_path="/tmp/ukbb.sock")
+"""
+from __future__ import annotations
+
+import concurrent.futures
+import http.client
+import http.server
+import io
+import json
+import logging
+import os
+import pathlib as p
+import signal
+import socket
+import socketserver
+import threading
+import time
+import urllib.parse
+
+import polars as pl
+import yaml
+
+from config import Config, clean_config
+from melted_UKBB_extract import extract_UKBB_tabular_data
+from metadata import Metadata, load_metadata
+from writers import OUTPUT_FORMATS, write_frame, write_outputs
+
+DEFAULT_PORT = 8750
+
+FRAMES = ["narrow", "wide", "dictionary", "codings"]
+
+CONTENT_TYPES = {
+    "arrow": "application/vnd.apache.arrow.file",
+    "feather": "application/vnd.apache.arrow.file",
+    "parquet": "application/vnd.apache.parquet",
+    "tsv": "text/tab-separated-values",
+    "csv": "text/csv",
+}
+
+# Maximum bytes per chunk of a response body
+RESPONSE_BLOCK_SIZE = 2**20
+
+
+class ExtractionService:
+    """
+    Resident metadata and data of the server, and the pool running extractions.
+
+    Parameters
+    ----------
+    data_file : str
+        Melted data file or store, see extract_UKBB_tabular_data().
+    dictionary_file, coding_file, category_tree_file, data_field_prop_file
+        Showcase files, see extract_UKBB_tabular_data().
+    metadata_cache_dir : str, optional
+        Directory of metadata bundles, see metadata.load_metadata().
+    result_cache_dir : str, optional
+        Directory of cached results, see result_cache.py.
+    workers : int, default=2
+        Number of extractions run at once, further requests wait for one
+        to complete.
+    optimize : bool, default=True
+        Run the optimized query plan, see extract_UKBB_tabular_data().
+    output_root : str, optional
+        Directory the outputs of requests giving an output_prefix are written
+        to, see output_prefix(). None rejects such requests.
+    """
+
+    def __init__(
+        self,
+        data_file: str,
+        dictionary_file: str,
+        coding_file: str,
+        category_tree_file: str | None = None,
+        data_field_prop_file: str | None = None,
+        metadata_cache_dir: str | None = None,
+        result_cache_dir: str | None = None,
+        workers: int = 2,
+        optimize: bool = True,
+        output_root: str | None = None,
+    ):
+        self.data_file = data_file
+        self.metadata_files = [
+            dictionary_file,
+            coding_file,
+            category_tree_file,
+            data_field_prop_file,
+        ]
+        self.metadata_cache_dir = metadata_cache_dir
+        self.result_cache_dir = result_cache_dir
+        self.workers = workers
+        self.optimize = optimize
+        self.output_root = output_root
+        self.pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="extraction"
+        )
+        self.active = 0
+        # Concurrent extractions share the global string cache, as a
+        # pl.StringCache() exiting in one thread would disable it under the
+        # others. It is held while any extraction is active, and cleared
+        # once the last one completes so that it does not grow without bound.
+        self._string_cache = None
+        self._lock = threading.Lock()
+        self._metadata = None
+        self._metadata_stamp = None
+
+    def _stamp(self) -> list:
+        """Modification times of the metadata files, None for missing ones."""
+        return [
+            os.stat(path).st_mtime_ns if path and p.Path(path).is_file() else None
+            for path in self.metadata_files
+        ]
+
+    def metadata(self) -> Metadata:
+        """The resident metadata, reloaded when a Showcase file changed."""
+        with self._lock:
+            stamp = self._stamp()
+            if stamp != self._metadata_stamp:
+                logging.info("Loading metadata")
+                self._metadata = load_metadata(
+                    *self.metadata_files, cache_dir=self.metadata_cache_dir
+                )
+                self._metadata_stamp = stamp
+            return self._metadata
+
+    def status(self) -> dict:
+        """Summary of the service, answered by GET /status."""
+        return {
+            "data_file": self.data_file,
+            "metadata_files": self.metadata_files,
+            "workers": self.workers,
+            "active": self.active,
+            "output_root": self.output_root,
+        }
+
+    def output_prefix(self, prefix: str) -> str:
+        """
+        The path of a requested output_prefix, relative to output_root.
+
+        Raises
+        ------
+        ValueError
+            If the server has no output root, or the outputs of the prefix
+            would be written outside of it.
+        """
+        if self.output_root is None:
+            raise ValueError(
+                "Writing outputs is disabled, the server has no output root"
+            )
+        root = p.Path(self.output_root).resolve()
+        # Outputs are named by appending to the prefix, e.g. prefix + "narrow.arrow"
+        if root not in (root / f"{prefix}narrow").resolve().parents:
+            raise ValueError(f"Output prefix {prefix} is outside the output root")
+        return os.path.join(root, prefix)
+
+    def _extract(self, config: Config) -> tuple:
+        try:
+            return extract_UKBB_tabular_data(
+                config,
+                self.data_file,
+                *self.metadata_files,
+                optimize=self.optimize,
+                result_cache_dir=self.result_cache_dir,
+                metadata=self.metadata(),
+            )
+        finally:
+            with self._lock:
+                self.active -= 1
+                if self.active == 0:
+                    self._string_cache.__exit__(None, None, None)
+                    self._string_cache = None
+
+    def extract(self, config: Config) -> tuple:
+        """
+        Run an extraction on the worker pool and wait for its result.
+
+        Returns
+        -------
+        tuple
+            The result of extract_UKBB_tabular_data().
+        """
+        with self._lock:
+            if self.active == 0:
+                self._string_cache = pl.StringCache()
+                self._string_cache.__enter__()
+            self.active += 1
+        return self.pool.submit(self._extract, config).result()
+
+
+def parse_request(body: bytes) -> dict:
+    """
+    Parse the body of an /extract request, see the module docstring.
+
+    Raises
+    ------
+    ValueError
+        If the body is not a config, or holds unknown frames or formats.
+    """
+    try:
+        payload = yaml.safe_load(body)
+    except yaml.YAMLError as exc:
+        raise ValueError(f"Invalid request: {exc}")
+    if not isinstance(payload, dict):
+        raise ValueError("The request must be a config or an object holding one")
+    if "config" not in payload:
+        payload = {"config": payload}
+    if not isinstance(payload["config"], dict):
+        raise ValueError("The config must be a mapping")
+
+    request = {
+        "config": clean_config(payload["config"]),
+        "output_prefix": payload.get("output_prefix"),
+        "output_formats": payload.get("output_formats") or ["arrow"],
+        "frame": payload.get("frame"),
+        "format": payload.get("format") or "arrow",
+    }
+    if request["frame"] is not None and request["frame"] not in FRAMES:
+        raise ValueError(f"Unknown frame {request['frame']}, expected one of {FRAMES}")
+    unknown_formats = set(request["output_formats"] + [request["format"]]).difference(
+        OUTPUT_FORMATS
+    )
+    if unknown_formats:
+        raise ValueError(f"Unknown output formats {sorted(unknown_formats)}")
+    return request
+
+
+class ChunkedWriter:
+    """
+    File-like object sending what is written to it as a chunked HTTP body.
+
+    Frames are written to it by writers.write_frame() and sent as they are
+    serialized, in chunks of at most RESPONSE_BLOCK_SIZE bytes, rather than
+    serialized to a buffer first: the server does not hold a second copy of
+    the frame. polars requires the read and seek methods of a file, which
+    are not used when writing.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, content) -> int:
+        content = memoryview(content).cast("B")
+        # An empty chunk would end the body
+        for offset in range(0, len(content), RESPONSE_BLOCK_SIZE):
+            block = content[offset : offset + RESPONSE_BLOCK_SIZE]
+            self.stream.write(b"%x\r\n" % len(block))
+            self.stream.write(block)
+            self.stream.write(b"\r\n")
+        return len(content)
+
+    def flush(self) -> None:
+        self.stream.flush()
+
+    def read(self, *args) -> bytes:
+        raise io.UnsupportedOperation("read")
+
+    def seek(self, *args) -> int:
+        raise io.UnsupportedOperation("seek")
+
+    def close(self) -> None:
+        """End the body."""
+        self.stream.write(b"0\r\n\r\n")
+        self.stream.flush()
+
+
+class ExtractionHandler(http.server.BaseHTTPRequestHandler):
+    """HTTP handler of the extraction server, see the module docstring."""
+
+    # Chunked responses need HTTP/1.1, connections are still closed after
+    # every response
+    protocol_version = "HTTP/1.1"
+
+    def address_string(self) -> str:
+        # Clients of a Unix socket have no address
+        return self.client_address[0] if self.client_address else "local"
+
+    def log_message(self, format: str, *args) -> None:
+        logging.info(f"{self.address_string()} {format % args}")
+
+    def _send_json(self, status: int, body: dict) -> None:
+        content = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self) -> None:
+        if self.path != "/status":
+            self._send_json(404, {"error": f"Unknown path {self.path}"})
+            return
+        self._send_json(200, self.server.service.status())
+
+    def do_POST(self) -> None:
+        if self.path != "/extract":
+            self._send_json(404, {"error": f"Unknown path {self.path}"})
+            return
+        start = time.perf_counter()
+        try:
+            request = parse_request(
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            )
+            if request["output_prefix"] is not None:
+                request["output_prefix"] = self.server.service.output_prefix(
+                    request["output_prefix"]
+                )
+        except ValueError as exc:
+            self._send_json(400, {"error": str(exc)})
+            return
+
+        try:
+            data, data_wide, dictionary, codings = self.server.service.extract(
+                request["config"]
+            )
+        except (SystemExit, Exception) as exc:
+            # Configuration errors of the extraction are logged, then exit
+            logging.exception(exc)
+            self._send_json(400, {"error": "Extraction failed, see the server log"})
+            return
+
+        if request["output_prefix"] is not None:
+            write_outputs(
+                data,
+                data_wide,
+                dictionary,
+                codings,
+                request["output_prefix"],
+                request["output_formats"],
+            )
+            self._send_json(
+                200,
+                {
+                    "output_prefix": request["output_prefix"],
+                    "output_formats": request["output_formats"],
+                    "narrow_rows": data.height,
+                    "wide_rows": None if data_wide is None else data_wide.height,
+                    "seconds": time.perf_counter() - start,
+                },
+            )
+            return
+
+        frame = request["frame"] or ("wide" if data_wide is not None else "narrow")
+        frames = {
+            "narrow": data,
+            "wide": data_wide,
+            "dictionary": dictionary,
+            "codings": codings,
+        }
+        if frames[frame] is None:
+            self._send_json(400, {"error": "The config has no wide output"})
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPES[request["format"]])
+        self.send_header("Transfer-Encoding", "chunked")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        writer = ChunkedWriter(self.wfile)
+        try:
+            write_frame(frames[frame], writer, request["format"])
+        except Exception as exc:
+            # The status is sent already, the client sees a truncated body
+            logging.exception(exc)
+            return
+        writer.close()
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """HTTP server on a Unix socket, one thread per connection."""
+
+    daemon_threads = True
+
+
+def serve(
+    service: ExtractionService, port: int = DEFAULT_PORT, socket_path: str | None = None
+) -> None:
+    """
+    Serve extraction requests until interrupted.
+
+    Parameters
+    ----------
+    service : ExtractionService
+        Metadata, data and worker pool of the server.
+    port : int, default=DEFAULT_PORT
+        Port on localhost, when socket_path is not given.
+    socket_path : str, optional
+        Path of a Unix socket to listen on instead.
+    """
+    if socket_path is not None:
+        if p.Path(socket_path).is_socket():
+            # Left behind by a server which did not shut down
+            os.unlink(socket_path)
+        server = UnixHTTPServer(socket_path, ExtractionHandler)
+        logging.info(f"Serving extractions of {service.data_file} on {socket_path}")
+    else:
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", port), ExtractionHandler)
+        logging.info(
+            f"Serving extractions of {service.data_file} on http://127.0.0.1:{port}"
+        )
+    server.service = service
+    # Load the metadata before the first request
+    service.metadata()
+    # Shut down cleanly on SIGTERM too, e.g. from a job scheduler
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.pool.shutdown()
+        if socket_path is not None:
+            os.unlink(socket_path)
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    """HTTP connection over a Unix socket."""
+
+    def __init__(self, socket_path: str):
+        super().__init__("localhost")
+        self.socket_path = socket_path
+
+    def connect(self) -> None:
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.socket_path)
+
+
+def request_extraction(
+    config: Config,
+    url: str = f"http://127.0.0.1:{DEFAULT_PORT}",
+    socket_path: str | None = None,
+    frame: str | None = None,
+    format: str = "arrow",
+    output_prefix: str | None = None,
+    output_formats: list[str] | None = None,
+) -> pl.DataFrame | dict:
+    """
+    Run an extraction on a running server.
+
+    Parameters
+    ----------
+    config : Config
+        Extraction configuration, e.g. from load_config().
+    url : str, default="http://127.0.0.1:DEFAULT_PORT"
+        Address of the server, when socket_path is not given.
+    socket_path : str, optional
+        Unix socket of the server.
+    frame, format, output_prefix, output_formats
+        Options of the request, see the module docstring.
+
+    Returns
+    -------
+    pl.DataFrame or dict
+        The requested frame, or the summary of the written outputs when
+        output_prefix is given.
+
+    Raises
+    ------
+    RuntimeError
+        If the server answered with an error.
+    """
+    if socket_path is not None:
+        connection = _UnixHTTPConnection(socket_path)
+    else:
+        address = urllib.parse.urlsplit(url)
+        connection = http.client.HTTPConnection(address.hostname, address.port)
+    body = {
+        "config": config,
+        "frame": frame,
+        "format": format,
+        "output_prefix": output_prefix,
+        "output_formats": output_formats,
+    }
+    try:
+        connection.request(
+            "POST",
+            "/extract",
+            json.dumps(body).encode(),
+            {"Content-Type": "application/json"},
+        )
+        response = connection.getresponse()
+        content = response.read()
+    finally:
+        connection.close()
+
+    if response.status != 200:
+        raise RuntimeError(json.loads(content)["error"])
+    if output_prefix is not None:
+        return json.loads(content)
+    if format == "parquet":
+        return pl.read_parquet(io.BytesIO(content))
+    if format in ["tsv", "csv"]:
+        return pl.read_csv(io.BytesIO(content), separator="\t" if format == "tsv" else ",")
+    return pl.read_ipc(io.BytesIO(content))
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog="UKBB Extraction Server",
+        description="Serve extractions of UKBB data with resident metadata and data",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "--data-file", help="UKBB melted tabular data or store", required=True
+    )
+    parser.add_argument(
+        "--dictionary-file",
+        help="UKBB data dictionary showcase file",
+        default="Data_Dictionary_Showcase.tsv",
+    )
+    parser.add_argument(
+        "--coding-file", help="UKBB coding file", default="Codings.tsv"
+    )
+    parser.add_argument(
+        "--category-tree-file",
+        help="UKBB Category tree file (Schema 13)",
+        default="13.txt",
+    )
+    parser.add_argument(
+        "--data-field-prop-file",
+        help="UKBB Data field properties file (Schema 1)",
+        default="1.txt",
+    )
+    parser.add_argument(
+        "--metadata-cache-dir",
+        help="Directory of preprocessed metadata bundles, the metadata files are parsed when not given",
+        default=None,
+    )
+    parser.add_argument(
+        "--result-cache-dir",
+        help="Directory caching extraction results, disabled when not given",
+        default=None,
+    )
+    parser.add_argument(
+        "--output-root",
+        help="Directory the outputs of requests giving an output_prefix are written to, such requests are rejected when not given",
+        default=None,
+    )
+    parser.add_argument(
+        "--port", help="Port to listen on, on localhost", type=int, default=DEFAULT_PORT
+    )
+    parser.add_argument(
+        "--socket", help="Unix socket to listen on instead of a port", default=None
+    )
+    parser.add_argument(
+        "--workers",
+        help="Number of extractions run at once, further requests wait",
+        type=int,
+        default=2,
+    )
+    parser.add_argument(
+        "--no-optimization",
+        help="Run the conservative query plan with the polars optimizer disabled",
+        action="store_true",
+    )
+
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format="%(asctime)s %(message)s",
+        datefmt="%Y-%m-%dT%H:%M:%S",
+        level=logging.INFO,
+    )
+
+    serve(
+        ExtractionService(
+            args.data_file,
+            args.dictionary_file,
+            args.coding_file,
+            args.category_tree_file,
+            args.data_field_prop_file,
+            metadata_cache_dir=args.metadata_cache_dir,
+            result_cache_dir=args.result_cache_dir,
+            workers=args.workers,
+            optimize=not args.no_optimization,
+            output_root=args.output_root,
+        ),
+        port=args.port,
+        socket_path=args.socket,
+    )
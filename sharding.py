@@ -0,0 +1,676 @@
+#!/usr/bin/env python
+"""
+UKBB Sharded Extraction
+
+This module splits one extraction into shards which run as independent
+processes, and merges their results into the usual outputs. Shards are
+either:
+
+- subject: contiguous ranges of the selected SubjectIDs, each shard runs the
+  full config on its subjects. The merged wide output stacks the shards.
+- field: groups of the selected FieldIDs, balanced by row count, each shard
+  runs the config on its fields. The merged wide output joins the shards on
+  SubjectID, InstanceID and ArrayID. Non-instanced fields are replicated to
+  the instances a subject attended whatever its shard, as in a single run.
+
+plan_shards() writes a shard directory <prefix>shards/ holding the shard
+manifest (manifest.json), the SubjectIDs of each subject shard, and an array
+job script for SLURM. Shards are then run locally on a process pool
+(run_shards()) or as array jobs, one shard per task, before merge_shards()
+writes the outputs:
+
+    $ python melted_UKBB_extract.py ... --shards 64 --shard-manifest-only
+    $ sbatch mysubset_shards/array_job.sh
+    $ python sharding.py --manifest mysubset_shards/manifest.json --merge
+
+Shard results are kept as Parquet, so that the merge keeps the column types.
+The merged wide output has the union of the columns of all shards; columns
+typed differently by different shards (e.g. when some shard holds a value
+which does not convert) are merged as strings.
+"""
+from __future__ import annotations
+
+import concurrent.futures
+import copy
+import datetime
+import functools
+import json
+import logging
+import multiprocessing
+import os
+import pathlib as p
+import shutil
+import sys
+from collections.abc import Iterator
+
+import polars as pl
+
+from cohort import filter_subjects
+from config import Config, format_config
+from melted_UKBB_extract import (
+    WIDE_INDEX,
+    expand_config,
+    extract_UKBB_tabular_data,
+    scan_data,
+    sort_wide,
+    subset_metadata,
+    wide_column_order,
+    write_wide_batches,
+)
+from metadata import load_metadata
+from writers import sink_frame, write_outputs
+
+SHARD_BY = ["subject", "field"]
+
+MANIFEST_FILE = "manifest.json"
+
+# Marker written by a shard once all its outputs are complete
+DONE_FILE = "done.json"
+
+ARRAY_JOB_SCRIPT = """#!/bin/bash
+#SBATCH --job-name={job_name}
+#SBATCH --array=0-{last_shard}
+#SBATCH --output={shard_dir}/shard_%a.out
+# Run one shard of {output_prefix} per array task, then merge them with
+#   python {script} --manifest {manifest} --merge
+python {script} --manifest {manifest} --shard-index "$SLURM_ARRAY_TASK_ID"
+"""
+
+
+def _absolute(paths: list[str]) -> list[str]:
+    """Absolute paths, so that shards can run from any directory."""
+    return [str(p.Path(path).resolve()) for path in paths]
+
+
+def _absolute_prefix(prefix: str) -> str:
+    """Absolute output prefix, keeping a trailing directory separator."""
+    return os.path.abspath(prefix) + (os.sep if prefix.endswith(os.sep) else "")
+
+
+def shard_subjects(data_file: str, config: Config, n_shards: int) -> list[pl.Series]:
+    """
+    Split the subjects selected by config into contiguous SubjectID ranges.
+
+    Parameters
+    ----------
+    data_file : str
+        Melted data or store.
+    config : Config
+        Expanded extraction configuration.
+    n_shards : int
+        Number of shards, fewer are returned when there are fewer subjects.
+
+    Returns
+    -------
+    list[pl.Series]
+        Sorted SubjectIDs of every shard, of nearly equal sizes.
+    """
+    # A streaming groupby holds the subjects only, a streaming unique() holds
+    # far more of the scanned rows
+    subjects = (
+        filter_subjects(scan_data(data_file, config).select("SubjectID"), config)
+        .groupby("SubjectID")
+        .agg(pl.count())
+        .select("SubjectID")
+        .sort("SubjectID")
+        .collect(streaming=True)
+    )
+    subjects = subjects.with_columns(
+        (pl.arange(0, subjects.height) * n_shards // max(subjects.height, 1)).alias(
+            "shard"
+        )
+    )
+    return [
+        shard.get_column("SubjectID")
+        for shard in subjects.partition_by("shard", maintain_order=True)
+    ]
+
+
+def shard_fields(data_file: str, config: Config, n_shards: int) -> list[list[int]]:
+    """
+    Split the fields selected by config into groups of similar row counts.
+
+    Fields are assigned largest first to the group with the fewest rows so
+    far, and keep their order within a group.
+
+    Parameters
+    ----------
+    data_file, config, n_shards
+        See shard_subjects().
+
+    Returns
+    -------
+    list[list[int]]
+        FieldIDs of every non-empty shard.
+    """
+    data = filter_subjects(
+        scan_data(data_file, config).select(["SubjectID", "FieldID"]), config
+    )
+    if config["FieldIDs"]:
+        data = data.filter(pl.col("FieldID").is_in(config["FieldIDs"]))
+    counts = (
+        data.groupby("FieldID")
+        .agg(pl.count().alias("rows"))
+        .sort("FieldID")
+        .collect(streaming=True)
+    )
+    order = {field_id: i for i, field_id in enumerate(config["FieldIDs"])}
+    groups = [[] for _ in range(n_shards)]
+    rows = [0] * n_shards
+    for field_id, field_rows in counts.sort("rows", descending=True).iter_rows():
+        smallest = rows.index(min(rows))
+        groups[smallest].append(field_id)
+        rows[smallest] += field_rows
+    return [
+        sorted(group, key=lambda field_id: order.get(field_id, field_id))
+        for group in groups
+        if group
+    ]
+
+
+def plan_shards(
+    config: Config,
+    data_file: str,
+    dictionary_file: str,
+    coding_file: str,
+    output_prefix: str,
+    output_formats: list[str],
+    n_shards: int,
+    shard_by: str = "subject",
+    category_tree_file: str = None,
+    data_field_prop_file: str = None,
+    metadata_cache_dir: str | None = None,
+    optimize: bool = True,
+    write_options: dict | None = None,
+) -> str:
+    """
+    Split an extraction into shards and write the shard directory.
+
+    Parameters
+    ----------
+    config : Config
+        Extraction configuration, not modified.
+    data_file, dictionary_file, coding_file, category_tree_file,
+    data_field_prop_file, metadata_cache_dir, optimize
+        See extract_UKBB_tabular_data().
+    output_prefix : str
+        Prefix of the merged output files; the shards are written to
+        <output_prefix>shards/.
+    output_formats : list[str]
+        Formats of the merged outputs.
+    n_shards : int
+        Number of shards.
+    shard_by : str, default="subject"
+        Split the work by SubjectID ranges or FieldID groups, see SHARD_BY.
+    write_options : dict, optional
+        Compression options of the merged outputs, see write_outputs().
+
+    Returns
+    -------
+    str
+        Path to the shard manifest.
+    """
+    metadata = load_metadata(
+        dictionary_file,
+        coding_file,
+        category_tree_file,
+        data_field_prop_file,
+        cache_dir=metadata_cache_dir,
+    )
+    config = expand_config(copy.deepcopy(config), metadata)
+    # Categories were expanded into FieldIDs, cohort files must be found
+    # from wherever the shards run
+    config["Categories"] = []
+    config["SubjectIDFiles"] = _absolute(config["SubjectIDFiles"])
+    config["ExcludeSubjectIDFiles"] = _absolute(
+        config.get("ExcludeSubjectIDFiles") or []
+    )
+
+    shard_dir = p.Path(f"{output_prefix}shards").resolve()
+    if shard_dir.exists():
+        shutil.rmtree(shard_dir)
+    shard_dir.mkdir(parents=True)
+
+    shards = []
+    if shard_by == "subject":
+        for i, subjects in enumerate(shard_subjects(data_file, config, n_shards)):
+            subjects_file = shard_dir / f"shard_{i:05d}.subjects.parquet"
+            subjects.to_frame().write_parquet(subjects_file)
+            shard_config = dict(
+                config,
+                SubjectIDs=[],
+                SubjectIDFiles=[str(subjects_file)],
+                ExcludeSubjectIDFiles=[],
+            )
+            shards.append(
+                {
+                    "SubjectID_min": subjects.min(),
+                    "SubjectID_max": subjects.max(),
+                    "subjects": len(subjects),
+                    "config": shard_config,
+                }
+            )
+    elif shard_by == "field":
+        for field_ids in shard_fields(data_file, config, n_shards):
+            shards.append(
+                {"fields": len(field_ids), "config": dict(config, FieldIDs=field_ids)}
+            )
+    else:
+        logging.error(f"Unknown shard mode {shard_by}, use one of {SHARD_BY}")
+        sys.exit(1)
+    if not shards:
+        logging.error(f"No data selected by the config in {data_file}, nothing to shard")
+        sys.exit(1)
+    for i, shard in enumerate(shards):
+        shard["index"] = i
+        shard["prefix"] = str(shard_dir / f"shard_{i:05d}_")
+
+    manifest = {
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "shard_by": shard_by,
+        "output_prefix": _absolute_prefix(output_prefix),
+        "output_formats": output_formats,
+        "write_options": write_options or {},
+        "config": config,
+        "extract_args": {
+            "data_file": str(p.Path(data_file).resolve()),
+            "dictionary_file": str(p.Path(dictionary_file).resolve()),
+            "coding_file": str(p.Path(coding_file).resolve()),
+            "category_tree_file": _absolute([category_tree_file])[0]
+            if category_tree_file
+            else None,
+            "data_field_prop_file": _absolute([data_field_prop_file])[0]
+            if data_field_prop_file
+            else None,
+            "metadata_cache_dir": metadata_cache_dir,
+            "optimize": optimize,
+        },
+        "shards": shards,
+    }
+    manifest_file = shard_dir / MANIFEST_FILE
+    with open(manifest_file, "w") as stream:
+        json.dump(manifest, stream, indent=2)
+
+    with open(shard_dir / "array_job.sh", "w") as stream:
+        stream.write(
+            ARRAY_JOB_SCRIPT.format(
+                job_name=p.Path(output_prefix).name.rstrip("_") or "ukbb_extract",
+                last_shard=len(shards) - 1,
+                shard_dir=shard_dir,
+                output_prefix=output_prefix,
+                script=p.Path(__file__).resolve(),
+                manifest=manifest_file,
+            )
+        )
+    logging.info(f"Wrote {len(shards)} {shard_by} shards to {manifest_file}")
+    return str(manifest_file)
+
+
+def read_shard_manifest(manifest_file: str) -> dict:
+    """Read a shard manifest written by plan_shards()."""
+    try:
+        with open(manifest_file, "r") as stream:
+            return json.load(stream)
+    except FileNotFoundError as exc:
+        logging.exception(exc)
+        sys.exit(1)
+
+
+def run_shard(manifest_file: str, index: int) -> dict:
+    """
+    Run one shard of a manifest, writing its results as Parquet.
+
+    Returns
+    -------
+    dict
+        Summary of the shard, also written to its done marker.
+    """
+    manifest = read_shard_manifest(manifest_file)
+    shard = manifest["shards"][index]
+    if not logging.getLogger().handlers:
+        # Spawned worker of run_shards()
+        logging.basicConfig(
+            format="%(asctime)s %(message)s",
+            datefmt="%Y-%m-%dT%H:%M:%S",
+            level=logging.INFO,
+            handlers=[logging.FileHandler(f"{shard['prefix']}conversion.log", mode="w")],
+        )
+    logging.info(f"Running shard {index} of {manifest_file}")
+    logging.info(format_config(shard["config"]))
+
+    data, data_wide, dictionary, codings = extract_UKBB_tabular_data(
+        config=shard["config"], **manifest["extract_args"]
+    )
+    write_outputs(data, data_wide, dictionary, codings, shard["prefix"], ["parquet"])
+
+    summary = {
+        "index": index,
+        "rows": data.height,
+        "wide_shape": list(data_wide.shape) if data_wide is not None else None,
+    }
+    with open(f"{shard['prefix']}{DONE_FILE}", "w") as stream:
+        json.dump(summary, stream)
+    return summary
+
+
+def run_shards(manifest_file: str, workers: int | None = None) -> list[dict]:
+    """
+    Run all shards of a manifest on a local process pool.
+
+    Parameters
+    ----------
+    manifest_file : str
+        Manifest written by plan_shards().
+    workers : int, optional
+        Number of shards run at once, defaults to the number of CPUs. The
+        CPUs are shared between the Polars thread pools of the workers.
+
+    Returns
+    -------
+    list[dict]
+        Summaries of the shards, see run_shard().
+    """
+    manifest = read_shard_manifest(manifest_file)
+    n_shards = len(manifest["shards"])
+    workers = min(workers or os.cpu_count(), n_shards)
+    logging.info(f"Running {n_shards} shards on {workers} processes")
+
+    # Share the cores between the workers' Polars thread pools, the variable
+    # is read by the spawned processes when they import Polars
+    polars_max_threads = os.environ.get("POLARS_MAX_THREADS")
+    os.environ["POLARS_MAX_THREADS"] = str(max(1, os.cpu_count() // workers))
+    try:
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            summaries = list(
+                executor.map(
+                    functools.partial(run_shard, manifest_file), range(n_shards)
+                )
+            )
+    finally:
+        if polars_max_threads is None:
+            del os.environ["POLARS_MAX_THREADS"]
+        else:
+            os.environ["POLARS_MAX_THREADS"] = polars_max_threads
+    for summary in summaries:
+        logging.info(f"Shard {summary['index']}: {summary['rows']} rows")
+    return summaries
+
+
+def _merge_column_types(frames: list[pl.DataFrame]) -> list[pl.DataFrame]:
+    """Cast the columns whose type differs between frames to strings."""
+    types = {}
+    for frame in frames:
+        for column, dtype in frame.schema.items():
+            types.setdefault(column, set()).add(dtype)
+    mixed = [column for column, dtypes in types.items() if len(dtypes) > 1]
+    if mixed:
+        logging.warning(f"Merging differently typed columns as strings: {mixed}")
+    return [
+        frame.with_columns(
+            [pl.col(column).cast(pl.Utf8) for column in mixed if column in frame.columns]
+        )
+        for frame in frames
+    ]
+
+
+def merge_wide(frames: list[pl.DataFrame], shard_by: str) -> pl.DataFrame:
+    """
+    Merge the wide outputs of shards.
+
+    Subject shards are stacked, field shards are joined on the wide index
+    and sorted by it. Either way the result has the columns of all shards.
+    """
+    frames = _merge_column_types(frames)
+    if shard_by == "subject":
+        # Shards hold consecutive subjects, so the rows stay sorted
+        merged = pl.concat(frames, how="diagonal")
+        return merged.select(
+            WIDE_INDEX + wide_column_order(merged.columns[len(WIDE_INDEX) :])
+        )
+
+    merged = frames[0]
+    for frame in frames[1:]:
+        merged = merged.join(frame, on=WIDE_INDEX, how="outer")
+    return sort_wide(merged)
+
+
+def _wide_schema(files: list[str]) -> dict:
+    """Union of the columns of wide shard files, mixed types as strings."""
+    types = {}
+    for file in files:
+        for column, dtype in pl.read_parquet_schema(file).items():
+            types.setdefault(column, []).append(dtype)
+    columns = [column for column in types if column not in WIDE_INDEX]
+    return {
+        column: types[column][0] if len(set(types[column])) == 1 else pl.Utf8
+        for column in WIDE_INDEX + wide_column_order(columns)
+    }
+
+
+def iter_wide_shards(files: list[str]) -> Iterator[pl.DataFrame]:
+    """
+    Read the wide outputs of subject shards one at a time.
+
+    Every shard is given the columns of all shards, see merge_wide(), so that
+    they can be appended to the outputs with write_wide_batches().
+    """
+    schema = _wide_schema(files)
+    for file in files:
+        frame = pl.read_parquet(file)
+        yield frame.select(
+            [
+                pl.col(column).cast(dtype)
+                if column in frame.columns
+                else pl.lit(None, dtype=dtype).alias(column)
+                for column, dtype in schema.items()
+            ]
+        )
+
+
+def merge_shards(
+    manifest_file: str,
+    workers: int | None = None,
+    keep_shards: bool = False,
+    stream: bool = False,
+) -> None:
+    """
+    Merge the results of all shards of a manifest into the outputs.
+
+    Parameters
+    ----------
+    manifest_file : str
+        Manifest written by plan_shards().
+    workers : int, optional
+        Number of writer threads, see write_outputs().
+    keep_shards : bool, default=False
+        Keep the shard directory once the outputs are written.
+    stream : bool, default=False
+        Bound the memory of the merge: the narrow shards are sunk to the
+        outputs, and the wide outputs of subject shards are appended one
+        shard at a time (see write_wide_batches()), instead of holding all
+        shards in memory.
+    """
+    manifest = read_shard_manifest(manifest_file)
+    shards = manifest["shards"]
+    missing = [
+        shard["index"]
+        for shard in shards
+        if not p.Path(f"{shard['prefix']}{DONE_FILE}").is_file()
+    ]
+    if missing:
+        logging.error(f"Shards {missing} of {manifest_file} did not complete")
+        sys.exit(1)
+
+    config = manifest["config"]
+    extract_args = manifest["extract_args"]
+    output_prefix = manifest["output_prefix"]
+    output_formats = manifest["output_formats"]
+    metadata = load_metadata(
+        extract_args["dictionary_file"],
+        extract_args["coding_file"],
+        extract_args["category_tree_file"],
+        extract_args["data_field_prop_file"],
+        cache_dir=extract_args["metadata_cache_dir"],
+    )
+    dictionary, codings = subset_metadata(config, metadata)
+    narrow_files = [f"{shard['prefix']}narrow.parquet" for shard in shards]
+    wide_files = [f"{shard['prefix']}wide.parquet" for shard in shards]
+
+    logging.info(f"Merging {len(shards)} shards of {manifest_file}")
+    with pl.StringCache():
+        if stream and manifest["shard_by"] == "subject":
+            sink_frame(
+                pl.concat([pl.scan_parquet(file) for file in narrow_files]),
+                output_prefix,
+                "narrow",
+                output_formats,
+                **manifest["write_options"],
+            )
+            if config["wide"]:
+                write_wide_batches(
+                    iter_wide_shards(wide_files),
+                    output_prefix,
+                    output_formats,
+                    **manifest["write_options"],
+                )
+            write_outputs(
+                pl.DataFrame(), None, dictionary, codings, output_prefix, []
+            )
+        else:
+            if stream:
+                logging.warning("Field shards are joined in memory to merge them")
+            data = pl.concat([pl.read_parquet(file) for file in narrow_files])
+            data_wide = None
+            if config["wide"]:
+                data_wide = merge_wide(
+                    [pl.read_parquet(file) for file in wide_files],
+                    manifest["shard_by"],
+                )
+            write_outputs(
+                data,
+                data_wide,
+                dictionary,
+                codings,
+                output_prefix,
+                output_formats,
+                workers=workers,
+                **manifest["write_options"],
+            )
+
+    if not keep_shards:
+        shutil.rmtree(p.Path(manifest_file).parent)
+
+
+def extract_sharded(
+    config: Config,
+    output_prefix: str,
+    output_formats: list[str],
+    n_shards: int,
+    shard_by: str = "subject",
+    workers: int | None = None,
+    writer_threads: int | None = None,
+    manifest_only: bool = False,
+    stream: bool = False,
+    **plan_args,
+) -> str:
+    """
+    Plan, run and merge a sharded extraction.
+
+    Parameters
+    ----------
+    config, output_prefix, output_formats, n_shards, shard_by
+        See plan_shards().
+    workers : int, optional
+        Number of shards run at once, see run_shards().
+    writer_threads : int, optional
+        Number of threads writing the merged outputs.
+    manifest_only : bool, default=False
+        Only write the shard directory, to run the shards elsewhere.
+    stream : bool, default=False
+        Merge the shards with bounded memory, see merge_shards().
+    **plan_args
+        Input files and options, see plan_shards().
+
+    Returns
+    -------
+    str
+        Path to the shard manifest.
+    """
+    manifest_file = plan_shards(
+        config,
+        output_prefix=output_prefix,
+        output_formats=output_formats,
+        n_shards=n_shards,
+        shard_by=shard_by,
+        **plan_args,
+    )
+    if manifest_only:
+        logging.info(
+            f"Submit {p.Path(manifest_file).parent / 'array_job.sh'}, then run "
+            f"python sharding.py --manifest {manifest_file} --merge"
+        )
+    else:
+        run_shards(manifest_file, workers)
+        merge_shards(manifest_file, writer_threads, stream=stream)
+    return manifest_file
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog="UKBB Sharded Extraction",
+        description="Runs one shard of a sharded extraction, e.g. as a SLURM array task, or merges the shards into the outputs",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "--manifest",
+        help="Shard manifest written by melted_UKBB_extract.py --shards",
+        required=True,
+    )
+    parser.add_argument(
+        "--shard-index",
+        help="Shard to run, defaults to $SLURM_ARRAY_TASK_ID",
+        type=int,
+        default=os.environ.get("SLURM_ARRAY_TASK_ID"),
+    )
+    parser.add_argument(
+        "--merge",
+        help="Merge the results of all shards into the outputs instead of running a shard",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--keep-shards",
+        help="Keep the shard directory after merging",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--stream-merge",
+        help="Merge subject shards with bounded memory, appending them to the outputs one at a time",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--writer-threads",
+        help="Number of threads writing the merged outputs, defaults to one per file",
+        type=int,
+        default=None,
+    )
+
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format="%(asctime)s %(message)s",
+        datefmt="%Y-%m-%dT%H:%M:%S",
+        level=logging.INFO,
+    )
+
+    if args.merge:
+        merge_shards(
+            args.manifest, args.writer_threads, args.keep_shards, args.stream_merge
+        )
+    elif args.shard_index is not None:
+        run_shard(args.manifest, int(args.shard_index))
+    else:
+        parser.error("--shard-index or --merge is required")
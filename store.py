@@ -0,0 +1,1276 @@
+"""
+Partitioned Melted Store
+
+This module implements on-disk layouts for melted UKBB tabular data which
+allow the extractor to read only the parts of the release a configuration
+actually asks for. A store is a directory with a _manifest.json describing
+its layout.
+
+The default "fieldid-partitioned" layout is a Hive-style Parquet dataset
+partitioned by FieldID, with every partition sorted by SubjectID, InstanceID
+and ArrayID and split into SubjectID-clustered part files:
+
+    current.melt.store/
+        _manifest.json
+        FieldID=31/part-00000.parquet
+        FieldID=53/part-00000.parquet
+        FieldID=53/part-00001.parquet
+        ...
+
+FieldValue is stored dictionary-encoded (Categorical) in the part files and
+each part file is written with Parquet min/max statistics per row group.
+The manifest records, for every part file, its row count, SubjectID range,
+InstanceIDs and maximum ArrayID, so partitions and parts which cannot match
+the FieldID, InstanceID, ArrayID and SubjectID filters are skipped without
+being opened.
+
+The part files can instead be written as Arrow IPC ("arrow" part format,
+the "mapped" layout of ingest.py), uncompressed or LZ4-compressed, with
+FieldValue stored as plain strings and every part cut into record batches of
+row_group_size rows. Uncompressed parts are memory-mapped without decoding
+or copying, so concurrent extractions on the same node share a single copy
+of the data through the page cache. LZ4 parts take about a quarter of the
+disk space but are decoded whole when read.
+
+When built with a data dictionary, the part files also carry typed
+companion columns of FieldValue (ValueFloat, ValueInt, ValueDate and
+ValueDatetime, see typed_values()) filled once according to the field's
+ValueType, so that extractions can filter and type values without parsing
+strings again.
+
+The "subject-sorted" layout is meant for cohort extractions. It holds a
+single uncompressed Arrow IPC file sorted by SubjectID, FieldID, InstanceID
+and ArrayID, with a sidecar index giving the row offset and row count of
+every subject:
+
+    current.melt.bysubject/
+        _manifest.json
+        data.arrow
+        subject_index.arrow
+
+The data file is memory-mapped and only the row ranges of the requested
+subjects are read, so extraction time scales with the cohort size rather
+than the release size.
+
+Stores of both layouts also hold a statistics index with the rows,
+subjects, largest ArrayID, numeric range and null value counts of every
+FieldID and InstanceID, computed while the store is built (see
+field_statistics.py):
+
+    current.melt.store/
+        _manifest.json
+        field_statistics.arrow
+        ...
+
+Partitioned stores can be updated in place with a new release or basket
+(see update_melted_store()): only partitions whose rows changed, or which
+held withdrawn participants, are rewritten, and the manifest records the
+release every part file came from.
+
+Stores are built by streaming batches of melted rows through
+MeltedStoreWriter (or SubjectSortedStoreWriter), which spills sorted runs to
+disk and then merges them one partition (or SubjectID range) at a time, so
+memory use is bounded by the largest partition rather than the full release.
+See ingest.py for the command-line entry point.
+"""
+from __future__ import annotations
+
+import bisect
+import datetime
+import functools
+import json
+import logging
+import os
+import pathlib as p
+import shutil
+
+import polars as pl
+
+from field_statistics import (
+    STATISTICS_FILE,
+    STATISTICS_SCHEMA,
+    combine_statistics,
+    field_statistics,
+    template_null_values,
+)
+
+MANIFEST_FILE = "_manifest.json"
+STORE_FORMAT = "ukbb-melted-store"
+STORE_VERSION = 1
+
+# Schema of melted UKBB data, as produced by ukb_awk/melt_tab.awk
+MELTED_SCHEMA = {
+    "SubjectID": pl.Int64,
+    "FieldID": pl.Int64,
+    "InstanceID": pl.Int64,
+    "ArrayID": pl.Int64,
+    "FieldValue": pl.Utf8,
+}
+
+# Typed companion columns of FieldValue in the partitioned layout, filled at
+# ingest according to the dictionary ValueType of every FieldID
+TYPED_VALUE_COLUMNS = {
+    "ValueFloat": pl.Float64,
+    "ValueInt": pl.Int64,
+    "ValueDate": pl.Date,
+    "ValueDatetime": pl.Datetime,
+}
+
+# Typed column holding the values of each ValueType. ValueFloat is filled
+# for every value which parses as a number, whatever its ValueType
+VALUE_TYPE_COLUMNS = {
+    "Continuous": "ValueFloat",
+    "Integer": "ValueInt",
+    "Date": "ValueDate",
+    "Time": "ValueDatetime",
+}
+
+# Sort order within each FieldID partition
+PARTITION_SORT = ["SubjectID", "InstanceID", "ArrayID"]
+
+# Sort order of the subject-sorted layout
+SUBJECT_SORT = ["SubjectID", "FieldID", "InstanceID", "ArrayID"]
+
+PARTITIONED_LAYOUT = "fieldid-partitioned"
+SUBJECT_SORTED_LAYOUT = "subject-sorted"
+
+# File formats of the part files of the partitioned layout, and the codecs
+# keeping arrow parts cheap to map
+PART_FORMATS = ["parquet", "arrow"]
+MAPPED_COMPRESSIONS = ["uncompressed", "lz4"]
+
+SUBJECT_DATA_FILE = "data.arrow"
+SUBJECT_INDEX_FILE = "subject_index.arrow"
+
+# Above this many disjoint row ranges, reading the requested subjects from
+# the subject-sorted layout falls back to a filtered scan
+MAX_SUBJECT_RANGES = 100_000
+
+# Memory-mapped files kept open by read_mapped_ipc()
+MAPPED_FILES = 8
+
+
+def is_melted_store(path: str) -> bool:
+    """Return True if path is a partitioned melted store directory."""
+    return (p.Path(path) / MANIFEST_FILE).is_file()
+
+
+def read_manifest(store_path: str) -> dict:
+    """
+    Load the manifest of a partitioned melted store.
+
+    Parameters
+    ----------
+    store_path : str
+        Path to the store directory.
+
+    Returns
+    -------
+    dict
+        Manifest with store-level settings and a "parts" list holding one
+        entry per part file (path, FieldID, rows, SubjectID_min,
+        SubjectID_max, InstanceIDs, ArrayID_max).
+    """
+    with open(p.Path(store_path) / MANIFEST_FILE, "r") as stream:
+        manifest = json.load(stream)
+    if manifest.get("format") != STORE_FORMAT:
+        raise ValueError(f"{store_path} is not a {STORE_FORMAT} directory")
+    return manifest
+
+
+def write_manifest(store_path: str, manifest: dict) -> None:
+    """Atomically replace the manifest of a partitioned melted store."""
+    manifest_path = p.Path(store_path) / MANIFEST_FILE
+    tmp_path = manifest_path.with_suffix(".json.tmp")
+    with open(tmp_path, "w") as stream:
+        json.dump(manifest, stream, indent=1)
+    os.replace(tmp_path, manifest_path)
+
+
+def read_field_statistics(store_path: str) -> pl.DataFrame | None:
+    """
+    Load the statistics index of a melted store.
+
+    Returns
+    -------
+    pl.DataFrame | None
+        One row per FieldID and InstanceID, see field_statistics.py, or None
+        for stores built without statistics. Statistics added to the index
+        since the store was built are null.
+    """
+    manifest = read_manifest(store_path)
+    if "statistics" not in manifest:
+        return None
+    statistics = read_mapped_ipc(p.Path(store_path) / manifest["statistics"]["file"])
+    return statistics.with_columns(
+        [
+            pl.lit(None, dtype=dtype).alias(column)
+            for column, dtype in STATISTICS_SCHEMA.items()
+            if column not in statistics.columns
+        ]
+    )
+
+
+def write_field_statistics(store_path: str, statistics: pl.DataFrame) -> None:
+    """Atomically replace the statistics index of a melted store."""
+    statistics_path = p.Path(store_path) / STATISTICS_FILE
+    tmp_path = statistics_path.with_suffix(".arrow.tmp")
+    statistics.write_ipc(tmp_path, compression="uncompressed")
+    os.replace(tmp_path, statistics_path)
+
+
+def statistics_entry(null_codes: pl.DataFrame | None) -> dict:
+    """Manifest entry of the statistics index, with the null values counted."""
+    null_strings, null_numerics = template_null_values()
+    return {
+        "file": STATISTICS_FILE,
+        "null_strings": null_strings if null_codes is not None else None,
+        "null_numerics": null_numerics,
+    }
+
+
+def partition_dir(field_id: int) -> str:
+    """Hive-style directory name of the partition holding field_id."""
+    return f"FieldID={field_id}"
+
+
+def _part_overlaps_subjects(part: dict, subject_ids: list[int]) -> bool:
+    """Check whether any of the sorted subject_ids falls in the part's range."""
+    i = bisect.bisect_left(subject_ids, part["SubjectID_min"])
+    return i < len(subject_ids) and subject_ids[i] <= part["SubjectID_max"]
+
+
+def select_parts(
+    manifest: dict,
+    field_ids: list[int] | None = None,
+    instance_ids: list[int] | None = None,
+    array_ids: list[int] | None = None,
+    subject_ids: list[int] | pl.LazyFrame | None = None,
+) -> list[dict]:
+    """
+    Select the part files of a store which may hold rows matching the filters.
+
+    Filters which are None or empty match everything. Pruning is conservative:
+    a selected part may still contain non-matching rows, so the caller must
+    apply the row-level filters as usual.
+
+    Parameters
+    ----------
+    manifest : dict
+        Store manifest as returned by read_manifest().
+    field_ids, instance_ids, array_ids, subject_ids : list[int], optional
+        Row filters, as found in the extraction Config. subject_ids may also
+        be a lazy cohort (see cohort.selected_subjects()), parts are then
+        pruned by its SubjectID range.
+
+    Returns
+    -------
+    list[dict]
+        Manifest entries of the parts which need to be read.
+    """
+    parts = manifest["parts"]
+    if field_ids:
+        wanted_fields = set(field_ids)
+        parts = [part for part in parts if part["FieldID"] in wanted_fields]
+    if instance_ids:
+        wanted_instances = set(instance_ids)
+        parts = [
+            part for part in parts if wanted_instances.intersection(part["InstanceIDs"])
+        ]
+    if array_ids:
+        min_array = min(array_ids)
+        parts = [part for part in parts if part["ArrayID_max"] >= min_array]
+    if isinstance(subject_ids, pl.LazyFrame):
+        low, high = (
+            subject_ids.select(
+                [pl.min("SubjectID").alias("low"), pl.max("SubjectID").alias("high")]
+            )
+            .collect(streaming=True)
+            .row(0)
+        )
+        parts = [
+            part
+            for part in parts
+            if low is not None
+            and part["SubjectID_max"] >= low
+            and part["SubjectID_min"] <= high
+        ]
+    elif subject_ids:
+        sorted_subjects = sorted(set(subject_ids))
+        parts = [
+            part for part in parts if _part_overlaps_subjects(part, sorted_subjects)
+        ]
+    return parts
+
+
+@functools.lru_cache(maxsize=MAPPED_FILES)
+def _read_mapped(path: str, mtime_ns: int) -> pl.DataFrame:
+    return pl.read_ipc(path, memory_map=True)
+
+
+def read_mapped_ipc(path: str | p.Path) -> pl.DataFrame:
+    """
+    Memory-map an uncompressed Arrow IPC file.
+
+    The mapping is reused for as long as the file is not replaced, so that a
+    long-running process (see server.py) keeps the data and subject index of
+    a subject-sorted store mapped across extractions.
+    """
+    path = str(path)
+    return _read_mapped(path, os.stat(path).st_mtime_ns)
+
+
+def scan_subject_sorted_store(
+    store_path: str,
+    manifest: dict,
+    subject_ids: list[int] | pl.LazyFrame | None = None,
+) -> pl.LazyFrame:
+    """
+    Read the rows of the requested subjects from a subject-sorted store.
+
+    The row ranges of the subjects are looked up in the subject index,
+    adjacent ranges are merged, and the ranges are sliced out of the
+    memory-mapped data file without scanning the rest of it.
+
+    Parameters
+    ----------
+    store_path : str
+        Path to the store directory.
+    manifest : dict
+        Store manifest as returned by read_manifest().
+    subject_ids : list[int] or pl.LazyFrame, optional
+        Subjects to read, a list or a lazy cohort which is joined with the
+        subject index. None or empty reads the whole store.
+
+    Returns
+    -------
+    pl.LazyFrame
+        Melted data with the columns of MELTED_SCHEMA.
+    """
+    data_path = p.Path(store_path) / manifest["data"]
+    if subject_ids is None or isinstance(subject_ids, list) and not subject_ids:
+        return pl.scan_ipc(data_path)
+
+    index = read_mapped_ipc(p.Path(store_path) / manifest["index"]).lazy()
+    if isinstance(subject_ids, pl.LazyFrame):
+        index = index.join(subject_ids.unique(), on="SubjectID", how="semi")
+    else:
+        index = index.filter(pl.col("SubjectID").is_in(subject_ids))
+    ranges = (
+        index.with_columns(
+            (pl.col("offset") != (pl.col("offset") + pl.col("length")).shift(1))
+            .fill_null(True)
+            .cumsum()
+            .alias("range")
+        )
+        .groupby("range", maintain_order=True)
+        .agg([pl.col("offset").first(), pl.col("length").sum()])
+        .collect()
+    )
+    if ranges.height > MAX_SUBJECT_RANGES:
+        logging.info(
+            f"{ranges.height} subject ranges requested, scanning {data_path}"
+        )
+        return pl.scan_ipc(data_path)
+
+    logging.info(f"Reading {ranges.height} subject ranges from {data_path}")
+    data = read_mapped_ipc(data_path)
+    return pl.concat(
+        [pl.DataFrame(schema=MELTED_SCHEMA)]
+        + [
+            data.slice(offset, length)
+            for offset, length in ranges.select(["offset", "length"]).iter_rows()
+        ]
+    ).lazy()
+
+
+def scan_melted_store(
+    store_path: str,
+    field_ids: list[int] | None = None,
+    instance_ids: list[int] | None = None,
+    array_ids: list[int] | None = None,
+    subject_ids: list[int] | pl.LazyFrame | None = None,
+) -> pl.LazyFrame:
+    """
+    Lazily scan a melted store, skipping data which cannot match the filters.
+
+    For the fieldid-partitioned layout, partitions and part files are pruned
+    using the manifest (see select_parts()). Within the remaining files,
+    Parquet row-group statistics allow Polars to skip further row groups
+    whenever predicate pushdown is enabled for the query. Arrow IPC parts are
+    read up front instead, memory-mapped when uncompressed. For the
+    subject-sorted layout, only the rows of the requested subjects are read
+    (see scan_subject_sorted_store()).
+
+    Parameters
+    ----------
+    store_path : str
+        Path to the store directory.
+    field_ids, instance_ids, array_ids, subject_ids : list[int], optional
+        Row filters used for pruning, subject_ids may also be a lazy cohort
+        (see select_parts()).
+
+    Returns
+    -------
+    pl.LazyFrame
+        Melted data with the columns of MELTED_SCHEMA, except for FieldValue
+        which is Categorical, so the scan must be collected under a
+        pl.StringCache(). The row filters themselves are not applied.
+    """
+    manifest = read_manifest(store_path)
+    if manifest.get("layout", PARTITIONED_LAYOUT) == SUBJECT_SORTED_LAYOUT:
+        return scan_subject_sorted_store(
+            store_path, manifest, subject_ids
+        ).with_columns(pl.col("FieldValue").cast(pl.Categorical))
+
+    parts = select_parts(manifest, field_ids, instance_ids, array_ids, subject_ids)
+    logging.info(
+        f"Reading {len(parts)} of {len(manifest['parts'])} parts from {store_path}"
+    )
+    if not parts:
+        data = pl.DataFrame(schema=MELTED_SCHEMA).lazy()
+    elif manifest.get("part_format", "parquet") == "arrow":
+        # Unions of IPC scans do not run in the streaming engine, the parts
+        # are mapped up front and left in their own chunks
+        data = pl.concat(
+            [
+                read_arrow_part(
+                    p.Path(store_path) / part["path"], manifest["compression"]
+                )
+                for part in parts
+            ],
+            rechunk=False,
+        ).lazy()
+    else:
+        data = pl.concat(
+            [pl.scan_parquet(p.Path(store_path) / part["path"]) for part in parts]
+        )
+    return data.with_columns(pl.col("FieldValue").cast(pl.Categorical))
+
+
+def read_arrow_part(path: p.Path, compression: str) -> pl.DataFrame:
+    """Read an arrow part file, memory-mapped when uncompressed."""
+    if compression == "uncompressed":
+        return read_mapped_ipc(path)
+    return pl.read_ipc(path, memory_map=False)
+
+
+def read_part(path: p.Path, part_format: str) -> pl.DataFrame:
+    """Read a part file whole."""
+    if part_format == "arrow":
+        return pl.read_ipc(path, memory_map=False)
+    return pl.read_parquet(path)
+
+
+def write_part(
+    part: pl.DataFrame,
+    path: p.Path,
+    part_format: str,
+    compression: str,
+    row_group_size: int,
+) -> None:
+    """
+    Write a part file in part_format.
+
+    Parquet parts store FieldValue dictionary-encoded, as UKBB values mostly
+    come from small code sets, with min/max statistics per row group. Arrow
+    parts store it as plain strings, which are memory-mapped as they are,
+    with a record batch every row_group_size rows.
+    """
+    if part_format == "arrow":
+        batches = pl.concat(
+            [
+                part.slice(offset, row_group_size)
+                for offset in range(0, part.height, row_group_size)
+            ],
+            rechunk=False,
+        )
+        batches.with_columns(pl.col("FieldValue").cast(pl.Utf8)).write_ipc(
+            path, compression=compression
+        )
+    else:
+        part.with_columns(pl.col("FieldValue").cast(pl.Categorical)).write_parquet(
+            path,
+            compression=compression,
+            statistics=True,
+            row_group_size=row_group_size,
+        )
+
+
+def write_spill_run(
+    batch: pl.DataFrame, run_path: str, key: str = "FieldID"
+) -> pl.DataFrame:
+    """
+    Write one batch of melted rows as a spill run sorted by key.
+
+    Runs are uncompressed Arrow IPC so they can later be memory-mapped and
+    sliced without copying. This function is safe to call from worker
+    processes.
+
+    Parameters
+    ----------
+    batch : pl.DataFrame
+        Melted rows with the columns of MELTED_SCHEMA.
+    run_path : str
+        Destination of the run file.
+    key : str, default="FieldID"
+        Column the run is sorted and indexed by, FieldID or SubjectID. The
+        other ID columns are used as secondary sort keys.
+
+    Returns
+    -------
+    pl.DataFrame
+        Run index with one row per key value: key, offset, length.
+    """
+    batch = batch.select(
+        [pl.col(name).cast(dtype) for name, dtype in MELTED_SCHEMA.items()]
+    ).sort([key] + [column for column in SUBJECT_SORT if column != key])
+    batch.write_ipc(run_path, compression="uncompressed")
+    index = batch.groupby(key, maintain_order=True).agg(
+        pl.count().cast(pl.Int64).alias("length")
+    )
+    return index.with_columns(
+        (pl.col("length").cumsum() - pl.col("length")).alias("offset")
+    ).select([key, "offset", "length"])
+
+
+def rows_digest(data: pl.DataFrame) -> int:
+    """
+    Order-independent digest of melted rows.
+
+    The sum of the row hashes (wrapping at 64 bits), so that the digest of a
+    partition is the sum of the digests of its parts, and rows can be
+    removed from a part or moved between parts without rehashing the rest.
+    Digests are only comparable within one polars version.
+    """
+    if data.height == 0:
+        return 0
+    hashes = data.select(
+        [pl.col(name).cast(dtype) for name, dtype in MELTED_SCHEMA.items()]
+    ).hash_rows(seed=0, seed_1=1, seed_2=2, seed_3=3)
+    return hashes.sum()
+
+
+def part_entry(
+    relative_path: str, field_id: int, part: pl.DataFrame, release: str | None
+) -> dict:
+    """Manifest entry describing one part file of a partitioned store."""
+    return {
+        "path": relative_path,
+        "FieldID": field_id,
+        "rows": part.height,
+        "digest": rows_digest(part),
+        "SubjectID_min": part[0, "SubjectID"],
+        "SubjectID_max": part[-1, "SubjectID"],
+        "InstanceIDs": part.get_column("InstanceID").unique().sort().to_list(),
+        "ArrayID_max": part.get_column("ArrayID").max(),
+        "release": release,
+    }
+
+
+def typed_values(data: pl.DataFrame, value_type: str | None) -> pl.DataFrame:
+    """
+    Add the TYPED_VALUE_COLUMNS to the rows of one FieldID.
+
+    Values which do not parse as the column's type are left null, as are
+    the columns not matching value_type (except ValueFloat).
+    """
+    value = pl.col("FieldValue").cast(pl.Utf8)
+    expressions = {
+        "ValueFloat": value.cast(pl.Float64, strict=False),
+        "ValueInt": value.cast(pl.Int64, strict=False),
+        "ValueDate": value.str.strptime(pl.Date, strict=False),
+        "ValueDatetime": value.str.strptime(pl.Datetime, strict=False),
+    }
+    return data.with_columns(
+        [
+            (
+                expressions[column]
+                if column == "ValueFloat" or VALUE_TYPE_COLUMNS.get(value_type) == column
+                else pl.lit(None)
+            )
+            .cast(dtype)
+            .alias(column)
+            for column, dtype in TYPED_VALUE_COLUMNS.items()
+        ]
+    )
+
+
+def write_partition(
+    store_path: str,
+    field_id: int,
+    data: pl.DataFrame,
+    rows_per_part: int,
+    row_group_size: int,
+    compression: str,
+    release: str | None = None,
+    typed: bool = False,
+    value_type: str | None = None,
+    part_format: str = "parquet",
+) -> list[dict]:
+    """
+    Write the sorted rows of one FieldID as SubjectID-clustered part files.
+
+    Parts are cut at SubjectID boundaries so that a subject never spans two
+    part files. The release the rows came from is recorded in the entries.
+    When typed, the TYPED_VALUE_COLUMNS are added according to the field's
+    ValueType (see typed_values()). Parts are written in part_format, see
+    write_part().
+
+    Returns
+    -------
+    list[dict]
+        Manifest entries for the written parts.
+    """
+    directory = p.Path(store_path) / partition_dir(field_id)
+    directory.mkdir(parents=True, exist_ok=True)
+    if typed:
+        data = typed_values(data, value_type)
+    parts = []
+    offset = 0
+    while offset < data.height:
+        end = min(offset + rows_per_part, data.height)
+        if end < data.height:
+            # Extend the part until the SubjectID changes
+            last_subject = data[end - 1, "SubjectID"]
+            subjects = data.get_column("SubjectID").slice(end)
+            end += subjects.search_sorted(last_subject, side="right")
+        part = data.slice(offset, end - offset)
+        relative_path = (
+            f"{partition_dir(field_id)}/part-{len(parts):05d}.{part_format}"
+        )
+        write_part(
+            part,
+            p.Path(store_path) / relative_path,
+            part_format,
+            compression,
+            row_group_size,
+        )
+        parts.append(part_entry(relative_path, field_id, part, release))
+        offset = end
+    return parts
+
+
+def read_partition(
+    store_path: str, parts: list[dict], part_format: str = "parquet"
+) -> pl.DataFrame:
+    """Read and concatenate the part files of one partition."""
+    return pl.concat(
+        [pl.DataFrame(schema=MELTED_SCHEMA)]
+        + [
+            read_part(p.Path(store_path) / part["path"], part_format)
+            .select(list(MELTED_SCHEMA))
+            .with_columns(pl.col("FieldValue").cast(pl.Utf8))
+            for part in parts
+        ]
+    )
+
+
+def partition_digest(
+    store_path: str,
+    parts: list[dict],
+    subject_ids: list[int],
+    part_format: str = "parquet",
+) -> tuple[int, int]:
+    """
+    Rows and digest of a partition once the given subjects are removed.
+
+    Only the parts holding one of the sorted subject_ids, or written before
+    digests were recorded in the manifest, are read.
+
+    Returns
+    -------
+    tuple[int, int]
+        Number of rows and rows_digest() of the remaining rows.
+    """
+    rows, digest = 0, 0
+    for part in parts:
+        if "digest" in part and not (
+            subject_ids and _part_overlaps_subjects(part, subject_ids)
+        ):
+            rows += part["rows"]
+            digest += part["digest"]
+            continue
+        data = read_part(p.Path(store_path) / part["path"], part_format)
+        if subject_ids:
+            data = data.filter(pl.col("SubjectID").is_in(subject_ids).is_not())
+        rows += data.height
+        digest += rows_digest(data)
+    return rows, digest % 2**64
+
+
+def diff_partitions(old: pl.DataFrame, new: pl.DataFrame) -> dict:
+    """
+    Count the differences between two versions of a partition.
+
+    Returns
+    -------
+    dict
+        rows_added, rows_removed and values_changed, rows being matched on
+        SubjectID, InstanceID and ArrayID.
+    """
+    matched = old.join(new, on=PARTITION_SORT, how="inner", suffix="_new")
+    return {
+        "rows_added": new.height - matched.height,
+        "rows_removed": old.height - matched.height,
+        "values_changed": matched.filter(
+            pl.col("FieldValue") != pl.col("FieldValue_new")
+        ).height,
+    }
+
+
+def remove_subjects(
+    store_path: str, parts: list[dict], subject_ids: list[int], settings: dict
+) -> list[dict]:
+    """
+    Remove the rows of the given subjects from part files, in place.
+
+    Only parts whose SubjectID range covers one of the subjects are read,
+    and only parts which actually held them are rewritten. Parts left empty
+    are deleted.
+
+    Parameters
+    ----------
+    store_path : str
+        Path to the store directory.
+    parts : list[dict]
+        Manifest entries of the parts to process.
+    subject_ids : list[int]
+        Sorted SubjectIDs to remove.
+    settings : dict
+        Store manifest, for the part writer settings.
+
+    Returns
+    -------
+    list[dict]
+        Updated manifest entries of the remaining parts.
+    """
+    kept = []
+    for part in parts:
+        if not subject_ids or not _part_overlaps_subjects(part, subject_ids):
+            kept.append(part)
+            continue
+        path = p.Path(store_path) / part["path"]
+        part_format = settings.get("part_format", "parquet")
+        data = read_part(path, part_format)
+        remaining = data.filter(pl.col("SubjectID").is_in(subject_ids).is_not())
+        if remaining.height == data.height:
+            kept.append(part)
+        elif remaining.height == 0:
+            path.unlink()
+        else:
+            tmp_path = path.with_suffix(f".{part_format}.tmp")
+            write_part(
+                remaining,
+                tmp_path,
+                part_format,
+                settings["compression"],
+                settings["row_group_size"],
+            )
+            os.replace(tmp_path, path)
+            kept.append(
+                part_entry(part["path"], part["FieldID"], remaining, part["release"])
+            )
+    return kept
+
+
+def update_melted_store(
+    store_path: str,
+    staging_path: str,
+    release: str | None = None,
+    withdrawn_subjects: list[int] | None = None,
+    null_codes: pl.DataFrame | None = None,
+) -> dict:
+    """
+    Merge a newly ingested release into an existing partitioned store.
+
+    The new release must already be ingested into a staging store (with the
+    same layout settings). Every FieldID present in the staging store is
+    considered authoritative for that field: its partition is added, or
+    replaced when any row was added, removed or changed, and left untouched
+    otherwise. Fields absent from the new release are kept. The rows of
+    withdrawn participants are removed from all partitions.
+
+    Partitions are first compared by the row counts and digests recorded in
+    the manifests (see partition_digest()), and only the partitions which
+    differ are read and diffed row by row.
+
+    Parameters
+    ----------
+    store_path : str
+        Path to the existing fieldid-partitioned store.
+    staging_path : str
+        Partitioned store holding the new release, removed once merged.
+    release : str, optional
+        Name of the new release, recorded for the parts it provides.
+    withdrawn_subjects : list[int], optional
+        SubjectIDs of participants who withdrew.
+    null_codes : pl.DataFrame, optional
+        Coded null strings of every field, required when the statistics
+        index of the store counts null strings. The statistics of the
+        rewritten fields are computed again.
+
+    Returns
+    -------
+    dict
+        The updated store manifest. Its "releases" list ends with a summary
+        of the update.
+    """
+    manifest = read_manifest(store_path)
+    if manifest.get("layout", PARTITIONED_LAYOUT) != PARTITIONED_LAYOUT:
+        raise ValueError(f"Only {PARTITIONED_LAYOUT} stores can be updated")
+    staged = read_manifest(staging_path)
+    if "value_types" in manifest and "value_types" not in staged:
+        raise ValueError(
+            f"{store_path} has typed value columns, the update must be ingested"
+            " with a dictionary file"
+        )
+    value_types = staged.get("value_types")
+    settings = {
+        "rows_per_part": manifest.get("rows_per_part", 1_000_000),
+        "row_group_size": manifest["row_group_size"],
+        "compression": manifest["compression"],
+        "part_format": manifest.get("part_format", "parquet"),
+    }
+    if staged.get("part_format", "parquet") != settings["part_format"]:
+        raise ValueError(
+            f"{store_path} has {settings['part_format']} parts, the update must"
+            " be ingested with the same layout"
+        )
+    withdrawn = sorted(set(withdrawn_subjects or []))
+    statistics = read_field_statistics(store_path)
+    if statistics is not None:
+        if manifest["statistics"]["null_strings"] is None:
+            null_codes = None
+        elif null_codes is None:
+            raise ValueError(
+                f"{store_path} counts null strings in its field statistics, the"
+                " update needs a dictionary and coding file"
+            )
+    null_numerics = template_null_values()[1]
+    # Statistics of the fields rewritten by the update
+    updated_statistics = {}
+
+    old_parts: dict[int, list[dict]] = {}
+    for part in manifest["parts"]:
+        old_parts.setdefault(part["FieldID"], []).append(part)
+    new_parts: dict[int, list[dict]] = {}
+    for part in staged["parts"]:
+        new_parts.setdefault(part["FieldID"], []).append(part)
+
+    summary = {
+        "release": release,
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "fields_added": 0,
+        "fields_changed": 0,
+        "fields_unchanged": 0,
+        "fields_kept": 0,
+        "rows_added": 0,
+        "rows_removed": 0,
+        "values_changed": 0,
+        "withdrawn_subjects": len(withdrawn),
+    }
+    trash_dir = p.Path(store_path) / "_trash"
+    trash_dir.mkdir(exist_ok=True)
+    parts = []
+
+    def keep_partition(field_id: int, old_rows: int) -> None:
+        """Keep the partition of an unchanged field, without withdrawn rows."""
+        summary["fields_unchanged"] += 1
+        kept = remove_subjects(store_path, old_parts[field_id], withdrawn, settings)
+        parts.extend(kept)
+        if sum(part["rows"] for part in kept) != old_rows:
+            updated_statistics[field_id] = field_statistics(
+                read_partition(store_path, kept, settings["part_format"]),
+                null_numerics,
+                null_codes,
+            )
+
+    for field_id in sorted(set(old_parts) | set(new_parts)):
+        if field_id not in new_parts:
+            # Not part of this release, only withdrawals apply
+            summary["fields_kept"] += 1
+            kept = remove_subjects(store_path, old_parts[field_id], withdrawn, settings)
+            rows_removed = sum(part["rows"] for part in old_parts[field_id]) - sum(
+                part["rows"] for part in kept
+            )
+            summary["rows_removed"] += rows_removed
+            if rows_removed:
+                updated_statistics[field_id] = field_statistics(
+                    read_partition(store_path, kept, settings["part_format"]),
+                    null_numerics,
+                    null_codes,
+                )
+            parts.extend(kept)
+            continue
+
+        if field_id in old_parts:
+            # Withdrawals are not a change of the field, the new release is
+            # compared with the rows which remain
+            old_rows = sum(part["rows"] for part in old_parts[field_id])
+            remaining = partition_digest(
+                store_path, old_parts[field_id], withdrawn, settings["part_format"]
+            )
+            summary["rows_removed"] += old_rows - remaining[0]
+            if remaining == partition_digest(
+                staging_path, new_parts[field_id], withdrawn, settings["part_format"]
+            ):
+                keep_partition(field_id, old_rows)
+                continue
+
+        new_data = read_partition(
+            staging_path, new_parts[field_id], settings["part_format"]
+        )
+        if withdrawn:
+            new_data = new_data.filter(pl.col("SubjectID").is_in(withdrawn).is_not())
+        if field_id in old_parts:
+            old_data = read_partition(
+                store_path, old_parts[field_id], settings["part_format"]
+            )
+            if withdrawn:
+                old_data = old_data.filter(
+                    pl.col("SubjectID").is_in(withdrawn).is_not()
+                )
+            if old_data.frame_equal(new_data):
+                # Equal rows with digests of another polars version
+                keep_partition(field_id, old_rows)
+                continue
+            for key, count in diff_partitions(old_data, new_data).items():
+                summary[key] += count
+            summary["fields_changed"] += 1
+            os.rename(
+                p.Path(store_path) / partition_dir(field_id),
+                trash_dir / partition_dir(field_id),
+            )
+        else:
+            summary["fields_added"] += 1
+            summary["rows_added"] += new_data.height
+        logging.debug(f"Updating partition FieldID={field_id}")
+        updated_statistics[field_id] = field_statistics(
+            new_data, null_numerics, null_codes
+        )
+        if new_data.height:
+            parts.extend(
+                write_partition(
+                    store_path,
+                    field_id,
+                    new_data,
+                    settings["rows_per_part"],
+                    settings["row_group_size"],
+                    settings["compression"],
+                    release,
+                    typed=value_types is not None,
+                    value_type=(value_types or {}).get(str(field_id)),
+                    part_format=settings["part_format"],
+                )
+            )
+
+    manifest["parts"] = parts
+    if value_types is not None:
+        manifest["value_types"] = {**manifest.get("value_types", {}), **value_types}
+    manifest["releases"] = manifest.get("releases", []) + [summary]
+    if statistics is not None:
+        write_field_statistics(
+            store_path,
+            pl.concat(
+                [
+                    statistics.filter(
+                        pl.col("FieldID").is_in(list(updated_statistics)).is_not()
+                    )
+                ]
+                + list(updated_statistics.values())
+            ).sort(["FieldID", "InstanceID"]),
+        )
+    write_manifest(store_path, manifest)
+    shutil.rmtree(trash_dir)
+    shutil.rmtree(staging_path)
+    logging.info(
+        f"Updated {store_path} to release {release}:"
+        f" {summary['fields_added']} fields added,"
+        f" {summary['fields_changed']} changed,"
+        f" {summary['fields_unchanged']} unchanged,"
+        f" {summary['withdrawn_subjects']} withdrawn participants"
+    )
+    return manifest
+
+
+class MeltedStoreWriter:
+    """
+    Build a partitioned melted store from a stream of melted batches.
+
+    Batches are sorted and spilled to disk as they arrive; close() then
+    merges all runs one FieldID partition at a time and writes the manifest
+    and the statistics index. The null strings are only counted in the index
+    when null_codes are given (see field_statistics.read_null_codes()).
+
+    Example
+    -------
+    >>> writer = MeltedStoreWriter("current.melt.store")
+    >>> for batch in batches:
+    ...     writer.write_batch(batch)
+    >>> writer.close()
+    """
+
+    # Column the spill runs are sorted by, see write_spill_run()
+    spill_key = "FieldID"
+
+    def __init__(
+        self,
+        store_path: str,
+        rows_per_part: int = 1_000_000,
+        row_group_size: int = 100_000,
+        compression: str = "zstd",
+        release: str | None = None,
+        value_types: dict[int, str] | None = None,
+        part_format: str = "parquet",
+        null_codes: pl.DataFrame | None = None,
+    ):
+        if part_format not in PART_FORMATS:
+            raise ValueError(f"Unknown part format {part_format}")
+        if part_format == "arrow" and compression not in MAPPED_COMPRESSIONS:
+            raise ValueError(
+                f"Arrow parts are written {' or '.join(MAPPED_COMPRESSIONS)},"
+                f" not {compression}"
+            )
+        self.store_path = p.Path(store_path)
+        self.rows_per_part = rows_per_part
+        self.row_group_size = row_group_size
+        self.compression = compression
+        self.release = release
+        self.value_types = value_types
+        self.part_format = part_format
+        self.null_codes = null_codes
+        self.null_numerics = template_null_values()[1]
+        if self.store_path.exists() and any(self.store_path.iterdir()):
+            raise FileExistsError(f"Store directory {store_path} is not empty")
+        self.spill_dir = self.store_path / "_spill"
+        self.spill_dir.mkdir(parents=True, exist_ok=True)
+        self.runs: list[str] = []
+        self.run_indexes: list[pl.DataFrame] = []
+
+    def next_run_path(self) -> str:
+        """Reserve the path of the next spill run."""
+        run_path = str(self.spill_dir / f"run-{len(self.runs):05d}.arrow")
+        self.runs.append(run_path)
+        return run_path
+
+    def add_run(self, run_path: str, index: pl.DataFrame) -> None:
+        """Register a run written by write_spill_run() (e.g. in a worker)."""
+        self.run_indexes.append(
+            index.with_columns(pl.lit(self.runs.index(run_path)).alias("run"))
+        )
+
+    def write_batch(self, batch: pl.DataFrame) -> None:
+        """Sort and spill one batch of melted rows."""
+        if batch.height == 0:
+            return
+        run_path = self.next_run_path()
+        self.add_run(run_path, write_spill_run(batch, run_path, self.spill_key))
+
+    def close(self) -> dict:
+        """
+        Merge the spilled runs into FieldID partitions and write the manifest.
+
+        Returns
+        -------
+        dict
+            The store manifest.
+        """
+        runs = [pl.read_ipc(run, memory_map=True) for run in self.runs]
+        if self.run_indexes:
+            index = pl.concat(self.run_indexes).sort(["FieldID", "run"])
+        else:
+            index = pl.DataFrame(
+                schema={
+                    "FieldID": pl.Int64,
+                    "offset": pl.Int64,
+                    "length": pl.Int64,
+                    "run": pl.Int32,
+                }
+            )
+        parts = []
+        statistics = []
+        for slices in index.partition_by("FieldID", maintain_order=True):
+            field_id = slices[0, "FieldID"]
+            data = pl.concat(
+                [
+                    runs[run].slice(offset, length)
+                    for offset, length, run in slices.select(
+                        ["offset", "length", "run"]
+                    ).iter_rows()
+                ]
+            ).sort(PARTITION_SORT)
+            parts.extend(
+                write_partition(
+                    self.store_path,
+                    field_id,
+                    data,
+                    self.rows_per_part,
+                    self.row_group_size,
+                    self.compression,
+                    self.release,
+                    typed=self.value_types is not None,
+                    value_type=(self.value_types or {}).get(field_id),
+                    part_format=self.part_format,
+                )
+            )
+            statistics.append(
+                field_statistics(data, self.null_numerics, self.null_codes)
+            )
+            logging.debug(f"Wrote partition FieldID={field_id} ({data.height} rows)")
+        del runs
+        shutil.rmtree(self.spill_dir)
+        write_field_statistics(self.store_path, combine_statistics(statistics))
+        manifest = {
+            "format": STORE_FORMAT,
+            "version": STORE_VERSION,
+            "layout": PARTITIONED_LAYOUT,
+            "sorted_by": PARTITION_SORT,
+            "partitioned_by": "FieldID",
+            "rows_per_part": self.rows_per_part,
+            "row_group_size": self.row_group_size,
+            "compression": self.compression,
+            "part_format": self.part_format,
+            "statistics": statistics_entry(self.null_codes),
+            "releases": [
+                {
+                    "release": self.release,
+                    "date": datetime.datetime.now().isoformat(timespec="seconds"),
+                    "rows": sum(part["rows"] for part in parts),
+                }
+            ],
+            "parts": parts,
+        }
+        if self.value_types is not None:
+            # ValueType of every stored field, kept to type future updates
+            field_ids = {part["FieldID"] for part in parts}
+            manifest["value_types"] = {
+                str(field_id): value_type
+                for field_id, value_type in self.value_types.items()
+                if field_id in field_ids
+            }
+        write_manifest(self.store_path, manifest)
+        logging.info(
+            f"Wrote {sum(part['rows'] for part in parts)} rows in {len(parts)} parts"
+            f" to {self.store_path}"
+        )
+        return manifest
+
+
+class SubjectSortedStoreWriter(MeltedStoreWriter):
+    """
+    Build a subject-sorted melted store from a stream of melted batches.
+
+    Batches are spilled as SubjectID-sorted runs while the number of rows of
+    every subject is accumulated. close() then merges the runs one SubjectID
+    range at a time into a single uncompressed Arrow IPC file, and writes the
+    subject index mapping each SubjectID to its row offset and row count,
+    and the statistics index.
+    """
+
+    spill_key = "SubjectID"
+
+    def __init__(
+        self,
+        store_path: str,
+        rows_per_part: int = 1_000_000,
+        row_group_size: int = 100_000,
+        compression: str = "uncompressed",
+        null_codes: pl.DataFrame | None = None,
+    ):
+        super().__init__(
+            store_path,
+            rows_per_part,
+            row_group_size,
+            compression,
+            null_codes=null_codes,
+        )
+        self.subject_counts = pl.DataFrame(
+            schema={"SubjectID": pl.Int64, "length": pl.Int64}
+        )
+
+    def add_run(self, run_path: str, index: pl.DataFrame) -> None:
+        """Register a run and accumulate its per-subject row counts."""
+        self.subject_counts = (
+            pl.concat([self.subject_counts, index.select(["SubjectID", "length"])])
+            .groupby("SubjectID")
+            .agg(pl.col("length").sum())
+        )
+
+    def close(self) -> dict:
+        """
+        Merge the spilled runs into the sorted data file and subject index.
+
+        Returns
+        -------
+        dict
+            The store manifest.
+        """
+        runs = [pl.read_ipc(run, memory_map=True) for run in self.runs]
+        index = (
+            self.subject_counts.sort("SubjectID")
+            .with_columns(
+                (pl.col("length").cumsum() - pl.col("length")).alias("offset")
+            )
+            .select(["SubjectID", "offset", "length"])
+        )
+        # Merge the runs in SubjectID ranges of about rows_per_part rows
+        ranges = (
+            index.groupby(pl.col("offset") // self.rows_per_part, maintain_order=True)
+            .agg(
+                [
+                    pl.col("SubjectID").min().alias("first"),
+                    pl.col("SubjectID").max().alias("last"),
+                ]
+            )
+            .select(["first", "last"])
+        )
+        merge_dir = self.spill_dir / "merged"
+        merge_dir.mkdir()
+        merged = pl.DataFrame(schema=MELTED_SCHEMA)
+        merged.write_parquet(merge_dir / "range-00000.parquet")
+        # Subject ranges are disjoint, their statistics add up
+        statistics = []
+        for i, (first, last) in enumerate(ranges.iter_rows(), start=1):
+            slices = []
+            for run in runs:
+                subjects = run.get_column("SubjectID")
+                start = subjects.search_sorted(first, side="left")
+                end = subjects.search_sorted(last, side="right")
+                slices.append(run.slice(start, end - start))
+            merged = pl.concat(slices).sort(SUBJECT_SORT)
+            merged.write_parquet(
+                merge_dir / f"range-{i:05d}.parquet", compression="lz4"
+            )
+            statistics.append(
+                field_statistics(merged, self.null_numerics, self.null_codes)
+            )
+            logging.debug(f"Merged subjects {first} to {last}")
+        del runs, merged
+        ipc_compression = None if self.compression == "uncompressed" else self.compression
+        pl.scan_parquet(merge_dir / "range-*.parquet").sink_ipc(
+            self.store_path / SUBJECT_DATA_FILE, compression=ipc_compression
+        )
+        index.write_ipc(
+            self.store_path / SUBJECT_INDEX_FILE, compression="uncompressed"
+        )
+        write_field_statistics(self.store_path, combine_statistics(statistics))
+        shutil.rmtree(self.spill_dir)
+        manifest = {
+            "format": STORE_FORMAT,
+            "version": STORE_VERSION,
+            "layout": SUBJECT_SORTED_LAYOUT,
+            "sorted_by": SUBJECT_SORT,
+            "compression": self.compression,
+            "data": SUBJECT_DATA_FILE,
+            "index": SUBJECT_INDEX_FILE,
+            "statistics": statistics_entry(self.null_codes),
+            "rows": index.get_column("length").sum() or 0,
+            "subjects": index.height,
+        }
+        write_manifest(self.store_path, manifest)
+        logging.info(
+            f"Wrote {manifest['rows']} rows of {manifest['subjects']} subjects"
+            f" to {self.store_path}"
+        )
+        return manifest
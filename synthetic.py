@@ -0,0 +1,598 @@
+#!/usr/bin/env python
+"""
+Synthetic UKBB Data Generator
+
+This module generates a synthetic stand-in for a UKBB release, so that the
+extractor can be developed, benchmarked and shared without access to real
+participant data. The generated files mirror the layout of the real ones:
+
+- Data_Dictionary_Showcase.tsv: the data dictionary
+- Codings.tsv: value codings, including the usual special codes (-1 "Do not
+  know", -3 "Prefer not to answer", -10 "Less than one")
+- 13.txt: the category tree (Schema 13)
+- 1.txt: the data field properties (Schema 1)
+- current.melt.tsv / current.melt.arrow: melted data, as produced by
+  ukb_awk/melt_tab.awk
+- current.tab: the raw ultra-wide tabular file
+
+The scale and mix of the data are configurable: number of subjects and
+fields, instances, array sizes, the fraction of coded (categorical) fields
+and the number of non-instanced fields. Field 31 (Sex) and field 53 (Date of
+attending assessment centre) are always present.
+
+Values are derived from hashes of the row keys and the seed, so a dataset is
+reproducible and does not depend on the batch size. Rows are generated one
+batch of subjects at a time, so memory use is bounded by the batch.
+"""
+from __future__ import annotations
+
+import json
+import logging
+import pathlib as p
+import random
+import tempfile
+
+import polars as pl
+
+# Relative frequency of the ValueTypes of non-coded fields
+VALUE_TYPE_WEIGHTS = {
+    "Integer": 3,
+    "Continuous": 5,
+    "Date": 1,
+    "Time": 1,
+    "Text": 1,
+    "Compound": 1,
+}
+
+# Special codes shared by most UKBB codings
+SPECIAL_CODES = [("-1", "Do not know"), ("-3", "Prefer not to answer")]
+
+# Coding of integer fields, as in UKBB coding 100291
+INTEGER_CODES = SPECIAL_CODES + [("-10", "Less than one")]
+
+OUTPUT_FORMATS = ["tsv", "arrow", "tab"]
+
+
+def make_fields(
+    n_fields: int,
+    coded_fraction: float = 0.6,
+    n_non_instanced: int = 2,
+    max_array: int = 1,
+    n_categories: int = 10,
+    seed: int = 0,
+) -> pl.DataFrame:
+    """
+    Draw the data fields of a synthetic release.
+
+    Parameters
+    ----------
+    n_fields : int
+        Number of fields, including Sex (31) and Date of attending (53).
+    coded_fraction : float, default=0.6
+        Fraction of fields with a categorical coding.
+    n_non_instanced : int, default=2
+        Number of non-instanced fields, Sex included.
+    max_array : int, default=1
+        Largest array size, array sizes are drawn from 1 to max_array.
+    n_categories : int, default=10
+        Number of categories of the category tree, see make_category_tree().
+    seed : int, default=0
+        Random seed.
+
+    Returns
+    -------
+    pl.DataFrame
+        FieldID, Field, ValueType, Coding, Category, instanced, array_size.
+    """
+    rng = random.Random(seed)
+    n_fields = max(n_fields, 2)
+    n_non_instanced = min(max(n_non_instanced, 1), n_fields - 1)
+    categories = list(range(100, 100 + n_categories))
+    fields = [
+        (31, "Sex", "Categorical single", 9, categories[0], 0, 1),
+        (53, "Date of attending assessment centre", "Date", None, categories[0], 1, 1),
+    ]
+    field_id = 1000
+    for i in range(2, n_fields):
+        field_id += rng.randint(1, 20)
+        instanced = 0 if i < n_non_instanced + 1 else 1
+        array_size = rng.randint(1, max_array) if instanced else 1
+        if rng.random() < coded_fraction:
+            value_type = rng.choice(["Categorical single", "Categorical multiple"])
+            coding = 1000 + i
+            if value_type == "Categorical multiple":
+                array_size = max(array_size, min(max_array, 3))
+        else:
+            value_type = rng.choices(
+                list(VALUE_TYPE_WEIGHTS), weights=list(VALUE_TYPE_WEIGHTS.values())
+            )[0]
+            # Some integer fields carry special codes, e.g. "Less than one"
+            coding = 100291 if value_type == "Integer" and rng.random() < 0.3 else None
+        fields.append(
+            (
+                field_id,
+                f"Synthetic field {field_id}",
+                value_type,
+                coding,
+                rng.choice(categories),
+                instanced,
+                array_size,
+            )
+        )
+    return pl.DataFrame(
+        fields,
+        schema={
+            "FieldID": pl.Int64,
+            "Field": pl.Utf8,
+            "ValueType": pl.Utf8,
+            "Coding": pl.Int64,
+            "Category": pl.Int64,
+            "instanced": pl.Int64,
+            "array_size": pl.Int64,
+        },
+    )
+
+
+def make_codings(fields: pl.DataFrame, seed: int = 0) -> pl.DataFrame:
+    """
+    Build the codings of the coded fields.
+
+    Every categorical coding has 2 to 12 options followed by the special
+    codes, coding 9 is Sex and coding 100291 holds the integer special codes.
+
+    Returns
+    -------
+    pl.DataFrame
+        Coding, Value, Meaning.
+    """
+    rng = random.Random(seed)
+    rows = [(9, "0", "Female"), (9, "1", "Male")]
+    rows += [(100291, value, meaning) for value, meaning in INTEGER_CODES]
+    for coding in (
+        fields.filter(pl.col("ValueType").str.starts_with("Categorical"))
+        .get_column("Coding")
+        .unique()
+        .sort()
+    ):
+        if coding == 9:
+            continue
+        n_options = rng.randint(2, 12)
+        rows += [(coding, str(i), f"Option {i} of {coding}") for i in range(1, n_options + 1)]
+        rows += [(coding, value, meaning) for value, meaning in SPECIAL_CODES]
+    return pl.DataFrame(
+        rows, schema={"Coding": pl.Int64, "Value": pl.Utf8, "Meaning": pl.Utf8}
+    )
+
+
+def make_category_tree(n_categories: int) -> pl.DataFrame:
+    """
+    Build a category tree (Schema 13) with three children per category.
+
+    Category 1 is the root, categories 100 onwards hang below it.
+    """
+    categories = list(range(100, 100 + n_categories))
+    parents = [1] + [categories[(i - 1) // 3] for i in range(1, n_categories)]
+    return pl.DataFrame(
+        {
+            "parent_id": parents[: len(categories)],
+            "child_id": categories,
+            "showcase_order": list(range(len(categories))),
+        },
+        schema={"parent_id": pl.Int64, "child_id": pl.Int64, "showcase_order": pl.Int64},
+    )
+
+
+def make_dictionary(fields: pl.DataFrame, n_subjects: int) -> pl.DataFrame:
+    """Build Data_Dictionary_Showcase.tsv from the fields."""
+    return fields.select(
+        [
+            pl.lit("Synthetic > Category").alias("Path"),
+            "Category",
+            "FieldID",
+            "Field",
+            pl.lit(n_subjects).alias("Participants"),
+            # Values of every instance and array index, at most
+            (
+                n_subjects
+                * pl.when(pl.col("instanced") == 1).then(4).otherwise(1)
+                * pl.col("array_size")
+            ).alias("Items"),
+            pl.lit("Complete").alias("Stability"),
+            "ValueType",
+            pl.lit(None, dtype=pl.Utf8).alias("Units"),
+            pl.lit("Data").alias("ItemType"),
+            pl.lit("Primary").alias("Strata"),
+            pl.lit("Unisex").alias("Sexed"),
+            pl.when(pl.col("instanced") == 1).then(4).otherwise(1).alias("Instances"),
+            pl.col("array_size").alias("Array"),
+            "Coding",
+            pl.lit("Synthetic data field").alias("Notes"),
+            (
+                pl.lit("http://biobank.ndph.ox.ac.uk/showcase/field.cgi?id=")
+                + pl.col("FieldID").cast(pl.Utf8)
+            ).alias("Link"),
+        ]
+    )
+
+
+def make_field_properties(fields: pl.DataFrame) -> pl.DataFrame:
+    """Build the data field properties (Schema 1) from the fields."""
+    return fields.select(
+        [
+            pl.col("FieldID").alias("field_id"),
+            pl.col("Field").alias("title"),
+            "instanced",
+            (pl.col("array_size") > 1).cast(pl.Int64).alias("arrayed"),
+            pl.col("Category").alias("main_category"),
+            pl.col("Coding").fill_null(0).alias("encoding_id"),
+            pl.lit(0).alias("instance_min"),
+            pl.when(pl.col("instanced") == 1).then(3).otherwise(0).alias("instance_max"),
+            pl.lit(0).alias("array_min"),
+            (pl.col("array_size") - 1).alias("array_max"),
+        ]
+    )
+
+
+def make_slots(fields: pl.DataFrame, n_instances: int, codings: pl.DataFrame) -> pl.DataFrame:
+    """
+    Expand fields into their (FieldID, InstanceID, ArrayID) value slots.
+
+    Non-instanced fields only have instance 0. The number of codes of the
+    field's coding is added for drawing coded values.
+    """
+    instances = pl.DataFrame({"InstanceID": list(range(n_instances))})
+    arrays = pl.DataFrame({"ArrayID": list(range(fields.get_column("array_size").max()))})
+    n_codes = codings.groupby("Coding").agg(pl.count().cast(pl.Int64).alias("n_codes"))
+    return (
+        fields.join(instances, how="cross")
+        .filter((pl.col("instanced") == 1) | (pl.col("InstanceID") == 0))
+        .join(arrays, how="cross")
+        .filter(pl.col("ArrayID") < pl.col("array_size"))
+        .join(n_codes, on="Coding", how="left")
+        .select(["FieldID", "InstanceID", "ArrayID", "ValueType", "Coding", "n_codes"])
+        .sort(["FieldID", "InstanceID", "ArrayID"])
+    )
+
+
+def melt_batch(
+    subjects: pl.DataFrame,
+    slots: pl.DataFrame,
+    codings: pl.DataFrame,
+    missing: float = 0.2,
+    seed: int = 0,
+) -> pl.DataFrame:
+    """
+    Generate the melted rows of a batch of subjects.
+
+    Parameters
+    ----------
+    subjects : pl.DataFrame
+        SubjectID and attended, the number of instances the subject attended.
+    slots : pl.DataFrame
+        Value slots, see make_slots().
+    codings : pl.DataFrame
+        Codings, see make_codings().
+    missing : float, default=0.2
+        Fraction of missing values. Further array items are increasingly
+        likely to be missing.
+    seed : int, default=0
+        Random seed.
+
+    Returns
+    -------
+    pl.DataFrame
+        SubjectID, FieldID, InstanceID, ArrayID, FieldValue.
+    """
+    key = pl.concat_str(
+        [pl.col(column) for column in ["SubjectID", "FieldID", "InstanceID", "ArrayID"]],
+        separator=".",
+    )
+    code_index = codings.with_columns(
+        pl.col("Value").cumcount().over("Coding").cast(pl.Int64).alias("code")
+    ).select(["Coding", "code", "Value"])
+    draw = pl.col("draw")
+    rows = (
+        subjects.join(slots, how="cross")
+        .filter(pl.col("InstanceID") < pl.col("attended"))
+        .with_columns(
+            [
+                (key.hash(seed) % 1_000_000).cast(pl.Int64).alias("keep"),
+                (key.hash(seed + 1) % 1_000_000_000).cast(pl.Int64).alias("draw"),
+            ]
+        )
+        # Date of attending is present at every attended instance
+        .filter(
+            (pl.col("FieldID") == 53)
+            | (
+                pl.col("keep")
+                >= 1_000_000 * (1 - (1 - missing) * 0.6 ** pl.col("ArrayID"))
+            )
+        )
+        .with_columns(
+            pl.when(
+                pl.col("ValueType").str.starts_with("Categorical")
+                | (pl.col("n_codes").is_not_null() & (draw % 100 < 3))
+            )
+            .then(draw % pl.col("n_codes").fill_null(1))
+            .alias("code")
+        )
+        .join(code_index, on=["Coding", "code"], how="left")
+    )
+    generated = (
+        pl.when(pl.col("ValueType") == "Integer")
+        .then((1900 + draw % 120).cast(pl.Utf8))
+        .when(pl.col("ValueType") == "Continuous")
+        .then(((draw % 100_000) / 1000).cast(pl.Utf8))
+        .when(pl.col("ValueType") == "Date")
+        .then(
+            (pl.date(2006, 1, 1) + pl.duration(days=draw % 5000)).dt.strftime("%Y-%m-%d")
+        )
+        .when(pl.col("ValueType") == "Time")
+        .then(
+            (pl.datetime(2006, 1, 1) + pl.duration(seconds=draw % (5000 * 86400)))
+            .dt.strftime("%Y-%m-%dT%H:%M:%S")
+        )
+        .when(pl.col("ValueType") == "Compound")
+        .then(
+            pl.concat_str(
+                [(draw % 10).cast(pl.Utf8), (draw // 10 % 10).cast(pl.Utf8)],
+                separator=",",
+            )
+        )
+        # Text, with the occasional empty string found in real releases
+        .when(draw % 20 == 0)
+        .then(pl.lit(""))
+        .otherwise(pl.lit("text ") + (draw % 1000).cast(pl.Utf8))
+    )
+    return rows.select(
+        [
+            "SubjectID",
+            "FieldID",
+            "InstanceID",
+            "ArrayID",
+            pl.coalesce([pl.col("Value"), generated]).alias("FieldValue"),
+        ]
+    ).sort(["SubjectID", "FieldID", "InstanceID", "ArrayID"])
+
+
+def tab_columns(slots: pl.DataFrame) -> list[str]:
+    """Column names of the raw .tab file for the value slots."""
+    return [
+        f"f.{field_id}.{instance_id}.{array_id}"
+        for field_id, instance_id, array_id in slots.select(
+            ["FieldID", "InstanceID", "ArrayID"]
+        ).iter_rows()
+    ]
+
+
+def widen_batch(batch: pl.DataFrame, columns: list[str]) -> pl.DataFrame:
+    """Pivot melted rows to the raw .tab layout with the given value columns."""
+    wide = batch.with_columns(
+        pl.concat_str(
+            [
+                pl.lit("f."),
+                pl.col("FieldID").cast(pl.Utf8),
+                pl.lit("."),
+                pl.col("InstanceID").cast(pl.Utf8),
+                pl.lit("."),
+                pl.col("ArrayID").cast(pl.Utf8),
+            ]
+        ).alias("column")
+    ).pivot(
+        index="SubjectID", columns="column", values="FieldValue", aggregate_function=None
+    )
+    return wide.select(
+        [pl.col("SubjectID").alias("f.eid")]
+        + [
+            pl.col(column) if column in wide.columns else pl.lit(None, dtype=pl.Utf8).alias(column)
+            for column in columns
+        ]
+    )
+
+
+def generate_dataset(
+    output_dir: str,
+    n_subjects: int = 10_000,
+    n_fields: int = 100,
+    n_instances: int = 4,
+    max_array: int = 5,
+    coded_fraction: float = 0.6,
+    n_non_instanced: int = 5,
+    n_categories: int = 10,
+    missing: float = 0.2,
+    batch_subjects: int = 10_000,
+    output_formats: list[str] | None = None,
+    seed: int = 0,
+) -> dict:
+    """
+    Generate a synthetic UKBB release.
+
+    Parameters
+    ----------
+    output_dir : str
+        Directory the files are written to, created if needed.
+    n_subjects : int, default=10_000
+        Number of subjects, SubjectIDs start at 1000000.
+    n_fields : int, default=100
+        Number of fields.
+    n_instances : int, default=4
+        Number of instances (assessment visits), at most 4. Each subject
+        attends between 1 and n_instances of them.
+    max_array : int, default=5
+        Largest array size.
+    coded_fraction : float, default=0.6
+        Fraction of coded (categorical) fields, the others are numeric,
+        date, time, text and compound fields.
+    n_non_instanced : int, default=5
+        Number of non-instanced fields.
+    n_categories : int, default=10
+        Number of categories in the category tree.
+    missing : float, default=0.2
+        Fraction of missing values.
+    batch_subjects : int, default=10_000
+        Subjects generated per batch, bounds memory use.
+    output_formats : list[str], optional
+        Data files to write among tsv (current.melt.tsv), arrow
+        (current.melt.arrow) and tab (current.tab). Defaults to tsv and arrow.
+    seed : int, default=0
+        Random seed.
+
+    Returns
+    -------
+    dict
+        Description of the dataset, also written to synthetic.json.
+    """
+    output_formats = output_formats or ["tsv", "arrow"]
+    output_dir = p.Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    n_instances = min(max(n_instances, 1), 4)
+
+    fields = make_fields(
+        n_fields, coded_fraction, n_non_instanced, max_array, n_categories, seed
+    )
+    codings = make_codings(fields, seed)
+    make_dictionary(fields, n_subjects).write_csv(
+        output_dir / "Data_Dictionary_Showcase.tsv", separator="\t"
+    )
+    codings.write_csv(output_dir / "Codings.tsv", separator="\t")
+    make_category_tree(n_categories).write_csv(output_dir / "13.txt", separator="\t")
+    make_field_properties(fields).write_csv(output_dir / "1.txt", separator="\t")
+
+    slots = make_slots(fields, n_instances, codings)
+    columns = tab_columns(slots)
+    subject_ids = pl.DataFrame(
+        {"SubjectID": pl.arange(1_000_000, 1_000_000 + n_subjects, eager=True)}
+    ).with_columns(
+        (
+            1 + pl.col("SubjectID").cast(pl.Utf8).hash(seed + 2) % n_instances
+        ).cast(pl.Int64).alias("attended")
+    )
+
+    rows = 0
+    with tempfile.TemporaryDirectory(dir=output_dir) as tmp_dir:
+        streams = {}
+        if "tsv" in output_formats:
+            streams["tsv"] = open(output_dir / "current.melt.tsv", "w")
+        if "tab" in output_formats:
+            streams["tab"] = open(output_dir / "current.tab", "w")
+        try:
+            for i, offset in enumerate(range(0, n_subjects, batch_subjects)):
+                batch = melt_batch(
+                    subject_ids.slice(offset, batch_subjects),
+                    slots,
+                    codings,
+                    missing,
+                    seed,
+                )
+                rows += batch.height
+                if "tsv" in streams:
+                    batch.write_csv(streams["tsv"], separator="\t", has_header=i == 0)
+                if "tab" in streams:
+                    widen_batch(batch, columns).write_csv(
+                        streams["tab"], separator="\t", has_header=i == 0, null_value="NA"
+                    )
+                if "arrow" in output_formats:
+                    batch.write_parquet(
+                        p.Path(tmp_dir) / f"batch-{i:05d}.parquet", compression="lz4"
+                    )
+                logging.info(
+                    f"Generated {min(offset + batch_subjects, n_subjects)} subjects, {rows} rows"
+                )
+        finally:
+            for stream in streams.values():
+                stream.close()
+        if "arrow" in output_formats:
+            pl.scan_parquet(p.Path(tmp_dir) / "batch-*.parquet").sink_ipc(
+                output_dir / "current.melt.arrow", compression="zstd"
+            )
+
+    description = {
+        "subjects": n_subjects,
+        "fields": fields.height,
+        "instances": n_instances,
+        "max_array": max_array,
+        "coded_fraction": coded_fraction,
+        "non_instanced": fields.filter(pl.col("instanced") == 0).height,
+        "categories": n_categories,
+        "missing": missing,
+        "seed": seed,
+        "rows": rows,
+        "value_types": dict(fields.groupby("ValueType").count().sort("ValueType").iter_rows()),
+        "output_formats": output_formats,
+    }
+    with open(output_dir / "synthetic.json", "w") as stream:
+        json.dump(description, stream, indent=2)
+    return description
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog="UKBB Synthetic Data Generator",
+        description="Generates a synthetic UKBB release (dictionary, codings, category tree, field properties and melted/raw data) for development and benchmarking",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("--output-dir", help="Output directory", required=True)
+    parser.add_argument("--subjects", help="Number of subjects", type=int, default=10_000)
+    parser.add_argument("--fields", help="Number of fields", type=int, default=100)
+    parser.add_argument(
+        "--instances", help="Number of instances, at most 4", type=int, default=4
+    )
+    parser.add_argument("--max-array", help="Largest array size", type=int, default=5)
+    parser.add_argument(
+        "--coded-fraction",
+        help="Fraction of coded (categorical) fields",
+        type=float,
+        default=0.6,
+    )
+    parser.add_argument(
+        "--non-instanced", help="Number of non-instanced fields", type=int, default=5
+    )
+    parser.add_argument(
+        "--categories", help="Number of categories in the category tree", type=int, default=10
+    )
+    parser.add_argument(
+        "--missing", help="Fraction of missing values", type=float, default=0.2
+    )
+    parser.add_argument(
+        "--batch-subjects",
+        help="Number of subjects generated per batch",
+        type=int,
+        default=10_000,
+    )
+    parser.add_argument(
+        "--output-formats",
+        help="Data files to write: tsv (current.melt.tsv), arrow (current.melt.arrow), tab (current.tab)",
+        choices=OUTPUT_FORMATS,
+        nargs="+",
+        default=["tsv", "arrow"],
+    )
+    parser.add_argument("--seed", help="Random seed", type=int, default=0)
+    parser.add_argument(
+        "-v", "--verbose", help="increase output verbosity", action="store_true"
+    )
+
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format="%(asctime)s %(message)s",
+        datefmt="%Y-%m-%dT%H:%M:%S",
+        level=logging.DEBUG if args.verbose else logging.INFO,
+    )
+
+    description = generate_dataset(
+        output_dir=args.output_dir,
+        n_subjects=args.subjects,
+        n_fields=args.fields,
+        n_instances=args.instances,
+        max_array=args.max_array,
+        coded_fraction=args.coded_fraction,
+        n_non_instanced=args.non_instanced,
+        n_categories=args.categories,
+        missing=args.missing,
+        batch_subjects=args.batch_subjects,
+        output_formats=args.output_formats,
+        seed=args.seed,
+    )
+    logging.info(f"Wrote {description['rows']} melted rows to {args.output_dir}")
@@ -0,0 +1,59 @@
+"""
+Shared fixtures of the test suite.
+
+Tests run against a small synthetic release generated once per session with
+synthetic.py, in every data format the generator writes.
+"""
+from __future__ import annotations
+
+import pathlib as p
+import sys
+
+import polars as pl
+import pytest
+
+REPO_DIR = p.Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(REPO_DIR))
+
+from config import load_config  # noqa: E402
+from synthetic import generate_dataset  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def release(tmp_path_factory) -> p.Path:
+    """Directory of a synthetic release with tsv, arrow and tab data files."""
+    release_dir = tmp_path_factory.mktemp("release")
+    generate_dataset(
+        str(release_dir),
+        n_subjects=300,
+        n_fields=30,
+        max_array=3,
+        batch_subjects=100,
+        output_formats=["tsv", "arrow", "tab"],
+        seed=3,
+    )
+    return release_dir
+
+
+@pytest.fixture
+def metadata_files(release) -> dict:
+    """Showcase files of the release, as keyword arguments of the extractor."""
+    return dict(
+        dictionary_file=str(release / "Data_Dictionary_Showcase.tsv"),
+        coding_file=str(release / "Codings.tsv"),
+        category_tree_file=str(release / "13.txt"),
+        data_field_prop_file=str(release / "1.txt"),
+    )
+
+
+def make_config(**options) -> dict:
+    """The defaults of config.template.yaml for all fields, updated with options."""
+    config = load_config(REPO_DIR / "config.template.yaml")
+    config["FieldIDs"] = []
+    config.update(options)
+    return config
+
+
+def strings(data: pl.DataFrame) -> pl.DataFrame:
+    """Categorical columns as strings, to compare frames of separate string caches."""
+    return data.with_columns(pl.col(pl.Categorical).cast(pl.Utf8))
@@ -0,0 +1,71 @@
+import logging
+
+import polars as pl
+import pytest
+from conftest import make_config, strings
+
+from melted_UKBB_extract import extract_UKBB_tabular_data, extract_UKBB_tabular_data_batch
+
+NARROW_SORT = ["SubjectID", "FieldID", "InstanceID", "ArrayID"]
+
+CONFIGS = {
+    "fields": dict(FieldIDs=[31, 53, 1008], InstanceIDs=[0, 2]),
+    "cohort": dict(SubjectIDs=[1_000_001, 1_000_010, 1_000_200], FieldIDs=[]),
+    "category": dict(FieldIDs=[], Categories=[101], replicate_non_instanced=False),
+    "arrays": dict(FieldIDs=[1292, 1306], ArrayIDs=[0, 2], wide=False),
+}
+
+
+def assert_results_equal(batch: tuple, single: tuple):
+    assert single[0].height > 0
+    assert strings(batch[0]).sort(NARROW_SORT).frame_equal(
+        strings(single[0]).sort(NARROW_SORT), null_equal=True
+    )
+    if single[1] is None:
+        assert batch[1] is None
+    else:
+        assert strings(batch[1]).frame_equal(strings(single[1]), null_equal=True)
+    assert batch[2].frame_equal(single[2], null_equal=True)
+    assert batch[3].frame_equal(single[3], null_equal=True)
+
+
+@pytest.mark.parametrize("optimize", [True, False])
+@pytest.mark.parametrize(
+    "names", [list(CONFIGS), ["cohort", "fields"], ["arrays", "category"]]
+)
+def test_batch_matches_single_extractions(release, metadata_files, names, optimize):
+    data_file = str(release / "current.melt.arrow")
+    configs = [make_config(**CONFIGS[name]) for name in names]
+    batch = list(
+        extract_UKBB_tabular_data_batch(
+            [dict(config) for config in configs],
+            data_file,
+            optimize=optimize,
+            **metadata_files,
+        )
+    )
+    assert len(batch) == len(configs)
+    for config, result in zip(configs, batch):
+        single = extract_UKBB_tabular_data(
+            dict(config), data_file, optimize=optimize, **metadata_files
+        )
+        assert_results_equal(result, single)
+
+
+def test_cohorts_share_one_scan(release, metadata_files, caplog):
+    configs = [
+        make_config(SubjectIDs=[1_000_001, 1_000_002]),
+        make_config(SubjectIDs=[1_000_002, 1_000_003], FieldIDs=[31]),
+    ]
+    with caplog.at_level(logging.INFO):
+        results = list(
+            extract_UKBB_tabular_data_batch(
+                configs, str(release / "current.melt.arrow"), **metadata_files
+            )
+        )
+    assert [message for message in caplog.messages if "Loading data" in message] == [
+        f"Loading data for 2 configurations from {release / 'current.melt.arrow'}"
+    ]
+    assert set(results[0][0].get_column("SubjectID")) == {1_000_001, 1_000_002}
+    assert set(results[1][0].get_column("SubjectID")) == {1_000_002, 1_000_003}
+    assert set(results[1][0].get_column("FieldID").cast(pl.Utf8)) == {"Sex_31"}
@@ -0,0 +1,67 @@
+import subprocess
+import sys
+
+import yaml
+from conftest import REPO_DIR, make_config
+
+
+def run_extractor(release, tmp_path, configs: dict, *options) -> None:
+    """Run the extractor CLI with a config file and output prefix per name."""
+    config_files, prefixes = [], []
+    for name, config in configs.items():
+        config_files.append(str(tmp_path / f"{name}.yaml"))
+        prefixes.append(str(tmp_path / f"{name}_"))
+        with open(config_files[-1], "w") as stream:
+            yaml.safe_dump(config, stream)
+    subprocess.run(
+        [
+            sys.executable,
+            str(REPO_DIR / "melted_UKBB_extract.py"),
+            "--config-file",
+            *config_files,
+            "--output-prefix",
+            *prefixes,
+            "--data-file",
+            str(release / "current.melt.arrow"),
+            "--dictionary-file",
+            str(release / "Data_Dictionary_Showcase.tsv"),
+            "--coding-file",
+            str(release / "Codings.tsv"),
+            "--category-tree-file",
+            str(release / "13.txt"),
+            "--data-field-prop-file",
+            str(release / "1.txt"),
+            "--output-formats",
+            "arrow",
+            *options,
+        ],
+        check=True,
+        capture_output=True,
+    )
+
+
+def test_each_config_has_its_own_log(release, tmp_path):
+    configs = {
+        "sex": make_config(FieldIDs=[31], wide=False),
+        "visits": make_config(FieldIDs=[53], wide=True),
+    }
+    run_extractor(release, tmp_path, configs)
+    for name, other in [("sex", "visits"), ("visits", "sex")]:
+        log = (tmp_path / f"{name}_conversion.log").read_text()
+        assert f"{name}.yaml" in log
+        assert f"{name}_narrow.arrow" in log
+        assert f"{other}.yaml" not in log
+        assert f"{other}_" not in log
+
+
+def test_metadata_cache_is_opt_in(release, tmp_path, monkeypatch):
+    home = tmp_path / "home"
+    monkeypatch.setenv("HOME", str(home))
+    monkeypatch.delenv("XDG_CACHE_HOME", raising=False)
+    config = {"sex": make_config(FieldIDs=[31])}
+    run_extractor(release, tmp_path, config)
+    assert not home.exists()
+    cache_dir = tmp_path / "metadata"
+    run_extractor(release, tmp_path, config, "--metadata-cache-dir", str(cache_dir))
+    assert len(list(cache_dir.iterdir())) == 1
+    assert not home.exists()
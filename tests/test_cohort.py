@@ -0,0 +1,93 @@
+import polars as pl
+import pytest
+from conftest import make_config, strings
+
+from cohort import cohort_statistics, scan_subject_ids, selected_subjects
+from config import LOG_LIST_LENGTH, format_config
+from melted_UKBB_extract import extract_UKBB_tabular_data
+
+NARROW_SORT = ["SubjectID", "FieldID", "InstanceID", "ArrayID"]
+
+
+@pytest.fixture
+def subjects(release) -> list[int]:
+    """Every third SubjectID of the release."""
+    data = pl.read_ipc(release / "current.melt.arrow", memory_map=False)
+    return data.get_column("SubjectID").unique().sort().to_list()[::3]
+
+
+def write_cohort(subject_ids: list[int], path, format: str) -> str:
+    """Write subject_ids to path as a cohort file of format."""
+    table = pl.DataFrame({"eid": subject_ids, "group": ["case"] * len(subject_ids)})
+    if format == "parquet":
+        table.write_parquet(path)
+    elif format == "arrow":
+        table.write_ipc(path)
+    elif format == "tsv":
+        table.write_csv(path, separator="\t")
+    elif format == "csv":
+        table.rename({"eid": "SubjectID"}).select(["group", "SubjectID"]).write_csv(path)
+    else:
+        path.write_text("".join(f" {subject_id}\n" for subject_id in subject_ids))
+    return str(path)
+
+
+@pytest.mark.parametrize(
+    "format, name",
+    [
+        ("parquet", "cohort.parquet"),
+        ("arrow", "cohort.arrow"),
+        ("tsv", "cohort.tsv"),
+        ("csv", "cohort.csv"),
+        ("list", "cohort.txt"),
+        ("list", "cohort.tsv"),
+    ],
+)
+def test_cohort_formats(subjects, tmp_path, format, name):
+    file = write_cohort(subjects, tmp_path / name, format)
+    assert scan_subject_ids(file).collect().get_column("SubjectID").to_list() == subjects
+
+
+def test_missing_cohort_file_exits(tmp_path):
+    with pytest.raises(SystemExit):
+        scan_subject_ids(str(tmp_path / "missing.parquet"))
+
+
+def test_selection_and_exclusion(release, metadata_files, subjects, tmp_path):
+    data_file = str(release / "current.melt.arrow")
+    excluded = subjects[::2]
+    config = make_config(
+        FieldIDs=[31, 53],
+        wide=False,
+        SubjectIDs=[subjects[0] + 1],
+        SubjectIDFiles=[write_cohort(subjects, tmp_path / "cohort.parquet", "parquet")],
+        ExcludeSubjectIDFiles=[write_cohort(excluded, tmp_path / "excluded.txt", "list")],
+    )
+    # The cohort stays a lazy scan, only its statistics are collected
+    selected = subjects + [subjects[0] + 1]
+    assert isinstance(selected_subjects(config), pl.LazyFrame)
+    assert cohort_statistics(config) == {
+        "subjects": len(selected),
+        "SubjectID_min": min(selected),
+        "SubjectID_max": max(selected),
+    }
+    assert cohort_statistics(dict(config, SubjectIDFiles=[], SubjectIDs=[])) is None
+
+    data = extract_UKBB_tabular_data(dict(config), data_file, **metadata_files)[0]
+    selected = sorted(set(subjects + [subjects[0] + 1]) - set(excluded))
+    expected = extract_UKBB_tabular_data(
+        make_config(FieldIDs=[31, 53], wide=False, SubjectIDs=selected),
+        data_file,
+        **metadata_files,
+    )[0]
+    assert set(data.get_column("SubjectID")) <= set(selected)
+    assert strings(data).sort(NARROW_SORT).frame_equal(
+        strings(expected).sort(NARROW_SORT), null_equal=True
+    )
+
+
+def test_long_lists_are_logged_as_counts():
+    subject_ids = list(range(LOG_LIST_LENGTH + 1))
+    logged = format_config(make_config(SubjectIDs=subject_ids, FieldIDs=[31]))
+    assert f"<{len(subject_ids)} values>" in logged
+    assert "[31]" in logged
@@ -0,0 +1,197 @@
+import logging
+import shutil
+import subprocess
+import sys
+
+import polars as pl
+import pytest
+from conftest import REPO_DIR, make_config, strings
+
+from field_statistics import fields_with_data
+from ingest import ingest_melted_data
+from melted_UKBB_extract import extract_UKBB_tabular_data, scan_UKBB_tabular_data
+from store import STATISTICS_FILE, read_field_statistics, read_manifest
+
+NARROW_SORT = ["SubjectID", "FieldID", "InstanceID", "ArrayID"]
+
+
+@pytest.fixture(scope="module")
+def stores(release, tmp_path_factory) -> dict:
+    """Stores of the release by layout, the partitioned one also without metadata."""
+    store_dir = tmp_path_factory.mktemp("statistics")
+    files = dict(
+        dictionary_file=str(release / "Data_Dictionary_Showcase.tsv"),
+        coding_file=str(release / "Codings.tsv"),
+    )
+    stores = {}
+    for name, layout, metadata in [
+        ("partitioned", "partitioned", files),
+        ("subject", "subject", files),
+        ("no metadata", "partitioned", {}),
+    ]:
+        stores[name] = str(store_dir / name.replace(" ", "_"))
+        ingest_melted_data(
+            str(release / "current.melt.arrow"),
+            stores[name],
+            rows_per_part=2_000,
+            layout=layout,
+            **metadata,
+        )
+    return stores
+
+
+@pytest.fixture(scope="module")
+def release_data(release) -> pl.DataFrame:
+    return pl.read_ipc(release / "current.melt.arrow", memory_map=False)
+
+
+def test_index_counts_the_release(stores, release_data):
+    statistics = read_field_statistics(stores["partitioned"])
+    null_numerics = read_manifest(stores["partitioned"])["statistics"]["null_numerics"]
+    number = pl.col("FieldValue").cast(pl.Float64, strict=False)
+    expected = (
+        release_data.groupby(["FieldID", "InstanceID"])
+        .agg(
+            [
+                pl.count().cast(pl.Int64).alias("rows"),
+                pl.col("SubjectID").n_unique().cast(pl.Int64).alias("subjects"),
+                pl.col("ArrayID").max().cast(pl.Int64).alias("ArrayID_max"),
+                number.filter(number.is_in(null_numerics).is_not()).max().alias(
+                    "value_max"
+                ),
+                number.is_in(null_numerics).sum().cast(pl.Int64).alias("null_numerics"),
+            ]
+        )
+        .sort(["FieldID", "InstanceID"])
+    )
+    assert statistics.select(expected.columns).frame_equal(expected, null_equal=True)
+    assert statistics.get_column("null_strings").null_count() == 0
+
+
+def test_index_of_every_layout(stores):
+    statistics = read_field_statistics(stores["partitioned"])
+    assert read_field_statistics(stores["subject"]).frame_equal(
+        statistics, null_equal=True
+    )
+    # Null strings are only counted with the codings
+    without = read_field_statistics(stores["no metadata"])
+    assert without.get_column("null_strings").null_count() == without.height
+    assert without.drop("null_strings").frame_equal(
+        statistics.drop("null_strings"), null_equal=True
+    )
+
+
+@pytest.mark.parametrize(
+    "instance_ids, field_ids", [(None, None), ([2], None), ([1, 3], [31, 53, 1292])]
+)
+def test_fields_with_data(stores, release_data, instance_ids, field_ids):
+    data = release_data
+    if instance_ids:
+        data = data.filter(pl.col("InstanceID").is_in(instance_ids))
+    if field_ids:
+        data = data.filter(pl.col("FieldID").is_in(field_ids))
+    statistics = read_field_statistics(stores["partitioned"])
+    assert fields_with_data(statistics, instance_ids, field_ids) == sorted(
+        data.get_column("FieldID").unique().to_list()
+    )
+
+
+def test_fields_without_data_are_skipped(release, metadata_files, stores, caplog):
+    # Sex is only recorded at instance 0
+    config = make_config(
+        FieldIDs=[31, 53], InstanceIDs=[2], replicate_non_instanced=False
+    )
+    with caplog.at_level(logging.INFO):
+        data, data_wide, _, _ = extract_UKBB_tabular_data(
+            dict(config), stores["partitioned"], **metadata_files
+        )
+    assert "Skipping FieldIDs without data: [31]" in caplog.text
+    expected, expected_wide, _, _ = extract_UKBB_tabular_data(
+        dict(config), str(release / "current.melt.arrow"), **metadata_files
+    )
+    assert strings(data).sort(NARROW_SORT).frame_equal(
+        strings(expected).sort(NARROW_SORT), null_equal=True
+    )
+    assert strings(data_wide).frame_equal(strings(expected_wide), null_equal=True)
+
+    data, _, _, _ = extract_UKBB_tabular_data(
+        make_config(FieldIDs=[31], InstanceIDs=[2], replicate_non_instanced=False),
+        stores["partitioned"],
+        **metadata_files,
+    )
+    assert data.height == 0
+
+
+def test_field_ids_command(stores, release_data):
+    result = subprocess.run(
+        [
+            sys.executable,
+            str(REPO_DIR / "field_statistics.py"),
+            "--store",
+            stores["partitioned"],
+            "--instances",
+            "2",
+            "--field-ids",
+        ],
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    expected = release_data.filter(pl.col("InstanceID") == 2).get_column("FieldID")
+    assert [int(line) for line in result.stdout.split()] == sorted(
+        expected.unique().to_list()
+    )
+
+
+@pytest.mark.parametrize(
+    "options",
+    [
+        {},
+        {"recode_field_names": False},
+        {"InstanceIDs": [2], "replicate_non_instanced": False},
+        {"drop_empty_strings": False, "drop_null_strings": []},
+        {"FieldIDs": [31, 53, 1292], "drop_null_numerics": []},
+    ],
+)
+def test_wide_columns_from_the_index(stores, metadata_files, options):
+    config = make_config(**options)
+    with scan_UKBB_tabular_data(
+        dict(config), stores["partitioned"], **metadata_files
+    ) as query:
+        columns = query.wide_columns()
+    _, data_wide, _, _ = extract_UKBB_tabular_data(
+        dict(config), stores["partitioned"], **metadata_files
+    )
+    assert columns == data_wide.columns[3:]
+
+
+@pytest.mark.parametrize(
+    "store, options",
+    [
+        ("partitioned", {"SubjectIDs": [1_000_001]}),
+        ("partitioned", {"ArrayIDs": [0]}),
+        ("partitioned", {"InstanceIDs": [2]}),
+        ("partitioned", {"drop_null_strings": ["Do not know"]}),
+        ("no metadata", {}),
+    ],
+)
+def test_wide_columns_the_index_cannot_tell(stores, metadata_files, store, options):
+    with scan_UKBB_tabular_data(
+        make_config(**options), stores[store], **metadata_files
+    ) as query:
+        assert query.wide_columns() is None
+
+
+def test_index_without_empty_strings(stores, metadata_files, tmp_path):
+    # Indexes built before the empty strings were counted
+    store = tmp_path / "store"
+    shutil.copytree(stores["partitioned"], store)
+    statistics = pl.read_ipc(store / STATISTICS_FILE, memory_map=False)
+    statistics.drop("empty_strings").write_ipc(store / STATISTICS_FILE)
+    assert read_field_statistics(str(store)).get_column("empty_strings").null_count()
+    with scan_UKBB_tabular_data(make_config(), str(store), **metadata_files) as query:
+        assert query.wide_columns() is None
+    with scan_UKBB_tabular_data(
+        make_config(drop_empty_strings=False), str(store), **metadata_files
+    ) as query:
+        assert query.wide_columns() is not None
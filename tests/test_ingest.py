@@ -0,0 +1,87 @@
+import polars as pl
+import pytest
+
+from ingest import ingest_melted_data, ingest_tab_file, parse_tab_header, unquote_values
+from store import read_field_statistics, read_manifest, scan_melted_store
+
+
+def read_store(store_path) -> pl.DataFrame:
+    """All rows of a store, sorted, with FieldValue as strings."""
+    with pl.StringCache():
+        data = scan_melted_store(str(store_path)).collect()
+    return (
+        data.select(["SubjectID", "FieldID", "InstanceID", "ArrayID", "FieldValue"])
+        .with_columns(pl.col("FieldValue").cast(pl.Utf8))
+        .sort(["SubjectID", "FieldID", "InstanceID", "ArrayID"])
+    )
+
+
+def test_parse_tab_header():
+    header = parse_tab_header(["f.eid", "f.31.0.0", "21001-2.1"])
+    assert header.rows() == [(31, 0, 0), (21001, 2, 1)]
+    with pytest.raises(ValueError):
+        parse_tab_header(["f.eid", "sex"])
+
+
+def test_unquote_values():
+    values = pl.Series(["", '""', "text", '"a""b"', '"', 'a"b', None])
+    assert pl.select(unquote_values(pl.lit(values))).to_series().to_list() == [
+        "",
+        "",
+        "text",
+        'a"b',
+        '"',
+        'a"b',
+        None,
+    ]
+
+
+@pytest.fixture(scope="module")
+def stores(release, tmp_path_factory):
+    """Stores of the same release ingested from the .tab, Arrow and TSV files."""
+    store_dir = tmp_path_factory.mktemp("ingest")
+    files = dict(
+        dictionary_file=str(release / "Data_Dictionary_Showcase.tsv"),
+        coding_file=str(release / "Codings.tsv"),
+    )
+    ingest_tab_file(
+        str(release / "current.tab"),
+        str(store_dir / "tab"),
+        workers=2,
+        chunk_bytes=20_000,
+        rows_per_part=2_000,
+        **files,
+    )
+    for name in ["arrow", "tsv"]:
+        ingest_melted_data(
+            str(release / f"current.melt.{name}"),
+            str(store_dir / name),
+            batch_size=3_000,
+            rows_per_part=2_000,
+            **files,
+        )
+    return store_dir
+
+
+@pytest.mark.parametrize("name", ["arrow", "tsv"])
+def test_tab_ingest_matches_melted_ingest(stores, name):
+    tab = read_store(stores / "tab")
+    melted = read_store(stores / name)
+    assert tab.height == melted.height
+    assert tab.frame_equal(melted, null_equal=True)
+    assert read_field_statistics(stores / "tab").frame_equal(
+        read_field_statistics(stores / name), null_equal=True
+    )
+    assert read_manifest(stores / "tab")["value_types"] == read_manifest(stores / name)[
+        "value_types"
+    ]
+
+
+def test_store_holds_the_release(release, stores):
+    data = pl.read_ipc(release / "current.melt.arrow", memory_map=False).sort(
+        ["SubjectID", "FieldID", "InstanceID", "ArrayID"]
+    )
+    store = read_store(stores / "arrow")
+    assert store.frame_equal(data.select(store.columns))
+    # Empty strings are kept as values, as in the melted files
+    assert (read_store(stores / "tab").get_column("FieldValue") == "").sum() > 0
@@ -0,0 +1,89 @@
+import os
+
+import polars as pl
+import pytest
+from conftest import make_config, strings
+
+from ingest import ingest_melted_data
+from melted_UKBB_extract import extract_UKBB_tabular_data
+from store import read_manifest, read_mapped_ipc, scan_melted_store
+
+SORT = ["SubjectID", "FieldID", "InstanceID", "ArrayID"]
+
+
+def read_store(store_path) -> pl.DataFrame:
+    with pl.StringCache():
+        data = scan_melted_store(str(store_path)).collect()
+    return strings(data).sort(SORT)
+
+
+@pytest.fixture(scope="module")
+def stores(release, tmp_path_factory) -> dict:
+    """Stores of the release in the partitioned and mapped layouts."""
+    store_dir = tmp_path_factory.mktemp("stores")
+    stores = {}
+    for layout, compression in [
+        ("partitioned", None),
+        ("mapped", None),
+        ("mapped", "lz4"),
+    ]:
+        stores[layout, compression] = store_dir / f"{layout}_{compression}"
+        ingest_melted_data(
+            str(release / "current.melt.arrow"),
+            str(stores[layout, compression]),
+            rows_per_part=2_000,
+            compression=compression,
+            layout=layout,
+            dictionary_file=str(release / "Data_Dictionary_Showcase.tsv"),
+            coding_file=str(release / "Codings.tsv"),
+        )
+    return stores
+
+
+@pytest.mark.parametrize("compression", [None, "lz4"])
+def test_mapped_store_holds_the_partitioned_data(stores, compression):
+    store_path = stores["mapped", compression]
+    manifest = read_manifest(store_path)
+    assert manifest["part_format"] == "arrow"
+    assert manifest["compression"] == (compression or "uncompressed")
+    assert all(part["path"].endswith(".arrow") for part in manifest["parts"])
+    assert read_store(store_path).frame_equal(
+        read_store(stores["partitioned", None]), null_equal=True
+    )
+
+
+def test_mapped_parts_need_an_arrow_codec(release, tmp_path):
+    with pytest.raises(ValueError):
+        ingest_melted_data(
+            str(release / "current.melt.arrow"),
+            str(tmp_path / "store"),
+            compression="zstd",
+            layout="mapped",
+        )
+
+
+@pytest.mark.parametrize("compression", [None, "lz4"])
+def test_mapped_store_extraction(release, metadata_files, stores, compression):
+    config = make_config(FieldIDs=[31, 53, 1292], InstanceIDs=[0, 2])
+    data, data_wide, _, _ = extract_UKBB_tabular_data(
+        dict(config), str(stores["mapped", compression]), **metadata_files
+    )
+    expected, expected_wide, _, _ = extract_UKBB_tabular_data(
+        dict(config), str(release / "current.melt.arrow"), **metadata_files
+    )
+    assert strings(data).sort(SORT).frame_equal(
+        strings(expected).sort(SORT), null_equal=True
+    )
+    assert strings(data_wide).frame_equal(strings(expected_wide), null_equal=True)
+
+
+def test_mapping_is_reused_until_the_file_changes(tmp_path):
+    path = tmp_path / "data.arrow"
+    pl.DataFrame({"x": [1, 2, 3]}).write_ipc(path, compression="uncompressed")
+    data = read_mapped_ipc(path)
+    assert read_mapped_ipc(str(path)) is data
+    pl.DataFrame({"x": [4]}).write_ipc(path, compression="uncompressed")
+    stat = path.stat()
+    # Replaced within the timestamp resolution of the file system
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    assert read_mapped_ipc(path).get_column("x").to_list() == [4]
@@ -0,0 +1,112 @@
+import logging
+import shutil
+
+import polars as pl
+import pytest
+
+from metadata import BUNDLE_TABLES, expand_category_tree, load_metadata, metadata_key
+
+SOURCES = ["Data_Dictionary_Showcase.tsv", "Codings.tsv", "13.txt", "1.txt"]
+
+
+@pytest.fixture
+def sources(release, tmp_path) -> list[str]:
+    """Copies of the Showcase files of the release, which tests may modify."""
+    for source in SOURCES:
+        shutil.copy(release / source, tmp_path / source)
+    return [str(tmp_path / source) for source in SOURCES]
+
+
+def assert_metadata_equal(left: dict, right: dict):
+    assert set(left) == set(right) == set(BUNDLE_TABLES)
+    for table in BUNDLE_TABLES:
+        assert left[table].frame_equal(right[table], null_equal=True), table
+
+
+def test_bundle_matches_the_sources(sources, tmp_path, caplog):
+    cache_dir = tmp_path / "cache"
+    parsed = load_metadata(*sources)
+    with caplog.at_level(logging.INFO):
+        built = load_metadata(*sources, cache_dir=str(cache_dir))
+        cached = load_metadata(*sources, cache_dir=str(cache_dir))
+    assert "Building metadata bundle" in caplog.messages[0]
+    assert "Loading metadata bundle" in caplog.messages[1]
+    assert_metadata_equal(built, parsed)
+    assert_metadata_equal(cached, parsed)
+    bundle_dir = cache_dir / metadata_key(*sources)
+    assert sorted(path.name for path in bundle_dir.iterdir()) == sorted(
+        f"{table}.arrow" for table in BUNDLE_TABLES
+    )
+
+
+def test_meanings_are_looked_up_per_field(sources):
+    metadata = load_metadata(*sources)
+    dictionary, meanings = metadata["dictionary"], metadata["meanings"]
+    coded = dictionary.filter(pl.col("Coding").is_not_null())
+    assert set(meanings.get_column("FieldID")) == set(coded.get_column("FieldID"))
+    field_id, coding = coded.select(["FieldID", "Coding"]).row(0)
+    codes = metadata["codings"].filter(pl.col("Coding") == coding)
+    assert meanings.filter(pl.col("FieldID") == field_id).drop("FieldID").frame_equal(
+        codes.select(["Value", "Meaning"]).sort("Value")
+    )
+
+
+def test_bundle_is_rebuilt_when_a_source_changes(sources, tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    load_metadata(*sources, cache_dir=cache_dir)
+    key = metadata_key(*sources)
+    dictionary = pl.read_csv(sources[0], separator="\t", infer_schema_length=None)
+    dictionary.with_columns(
+        pl.when(pl.col("FieldID") == 31)
+        .then(pl.lit("Renamed sex"))
+        .otherwise(pl.col("Field"))
+        .alias("Field")
+    ).write_csv(sources[0], separator="\t")
+    assert metadata_key(*sources) != key
+    metadata = load_metadata(*sources, cache_dir=cache_dir)
+    assert metadata["dictionary"].filter(pl.col("FieldID") == 31).get_column(
+        "Field"
+    ).to_list() == ["Renamed sex"]
+    assert len(list((tmp_path / "cache").iterdir())) == 2
+
+
+def test_missing_optional_sources(sources, tmp_path):
+    metadata = load_metadata(
+        sources[0],
+        sources[1],
+        str(tmp_path / "missing_13.txt"),
+        None,
+        cache_dir=str(tmp_path / "cache"),
+    )
+    assert metadata["category_closure"].height == 0
+    assert metadata["category_fields"].height == 0
+    assert metadata["instanced"].height == 0
+
+
+def test_category_closure():
+    # 1 -> 2 -> 3 -> 4, and 1 -> 5
+    tree = pl.DataFrame({"parent_id": [1, 2, 3, 1], "child_id": [2, 3, 4, 5]})
+    closure = expand_category_tree(tree, pl.Series([6]))
+    descendants = {
+        category: set(group.get_column("Descendant"))
+        for category, group in closure.partition_by("Category", as_dict=True).items()
+    }
+    assert descendants == {
+        1: {1, 2, 3, 4, 5},
+        2: {2, 3, 4},
+        3: {3, 4},
+        4: {4},
+        5: {5},
+        6: {6},
+    }
+
+
+def test_category_fields(release):
+    metadata = load_metadata(*(str(release / source) for source in SOURCES))
+    dictionary = metadata["dictionary"]
+    closure = metadata["category_closure"]
+    for category in [100, 101, 104]:
+        below = closure.filter(pl.col("Category") == category).get_column("Descendant")
+        expected = dictionary.filter(pl.col("Category").is_in(below)).get_column("FieldID")
+        fields = metadata["category_fields"].filter(pl.col("Category") == category)
+        assert sorted(fields.get_column("FieldID")) == sorted(expected)
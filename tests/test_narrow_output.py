@@ -0,0 +1,37 @@
+import polars as pl
+from conftest import make_config
+
+from melted_UKBB_extract import (
+    extract_UKBB_tabular_data,
+    extract_UKBB_tabular_data_batch,
+    scan_UKBB_tabular_data,
+)
+
+
+def test_results_concatenate_outside_a_string_cache(release, metadata_files):
+    data_file = str(release / "current.melt.arrow")
+    results = [
+        extract_UKBB_tabular_data(make_config(FieldIDs=fields), data_file, **metadata_files)[0]
+        for fields in [[31], [53, 21001]]
+    ]
+    assert all(result.schema["FieldValue"] == pl.Utf8 for result in results)
+    combined = pl.concat([result.drop(["InstanceID", "ArrayID"]) for result in results])
+    assert combined.height == sum(result.height for result in results)
+
+
+def test_modes_agree_on_the_value_type(release, metadata_files):
+    data_file = str(release / "current.melt.arrow")
+    config = make_config(FieldIDs=[31, 53], recode_data_values=True)
+    narrow = extract_UKBB_tabular_data(config, data_file, **metadata_files)[0]
+    batch = next(extract_UKBB_tabular_data_batch([config], data_file, **metadata_files))[0]
+    with scan_UKBB_tabular_data(config, data_file, **metadata_files) as query:
+        lazy = query.narrow().collect()
+    for data in [batch, lazy]:
+        assert data.schema["FieldValue"] == pl.Utf8
+        assert data.sort(["SubjectID", "FieldID", "InstanceID", "ArrayID"]).select(
+            ["SubjectID", "FieldID", "FieldValue"]
+        ).frame_equal(
+            narrow.sort(["SubjectID", "FieldID", "InstanceID", "ArrayID"]).select(
+                ["SubjectID", "FieldID", "FieldValue"]
+            )
+        )
@@ -0,0 +1,56 @@
+import logging
+
+import polars as pl
+import pytest
+from conftest import make_config, strings
+
+from melted_UKBB_extract import extract_UKBB_tabular_data
+
+NARROW_SORT = ["SubjectID", "FieldID", "InstanceID", "ArrayID"]
+
+
+@pytest.mark.parametrize("data", ["current.melt.arrow", "current.melt.tsv"])
+@pytest.mark.parametrize(
+    "options",
+    [
+        {},
+        {"InstanceIDs": [1, 2], "ArrayIDs": [0]},
+        {"InstanceIDs": [2], "replicate_non_instanced": False},
+        {"recode_data_values": False, "recode_field_names": False},
+        {"drop_null_strings": [], "drop_null_numerics": [], "drop_empty_strings": False},
+        {"convert_less_than_value_integer": 0, "convert_less_than_value_continuous": 0.5},
+        {"SubjectIDs": [1_000_005, 1_000_100], "Categories": [102], "FieldIDs": []},
+    ],
+)
+def test_optimized_plan_matches_the_conservative_plan(
+    release, metadata_files, data, options
+):
+    config = make_config(**options)
+    results = [
+        extract_UKBB_tabular_data(
+            dict(config), str(release / data), optimize=optimize, **metadata_files
+        )
+        for optimize in [True, False]
+    ]
+    optimized, conservative = results
+    assert optimized[0].height > 0
+    assert strings(optimized[0]).sort(NARROW_SORT).frame_equal(
+        strings(conservative[0]).sort(NARROW_SORT), null_equal=True
+    )
+    assert strings(optimized[1]).frame_equal(strings(conservative[1]), null_equal=True)
+
+
+def test_plan_and_stage_rows_are_logged(release, metadata_files, caplog):
+    data_file = release / "current.melt.arrow"
+    config = make_config(FieldIDs=[53, 1008], InstanceIDs=[0], replicate_non_instanced=False)
+    with caplog.at_level(logging.INFO):
+        extract_UKBB_tabular_data(
+            config, str(data_file), verbose=True, optimize=True, **metadata_files
+        )
+    assert any(message.startswith("Optimized query plan") for message in caplog.messages)
+    expected = (
+        pl.read_ipc(data_file, memory_map=False)
+        .filter(pl.col("FieldID").is_in([53, 1008]) & (pl.col("InstanceID") == 0))
+        .height
+    )
+    assert f"Rows after ID filters: {expected}" in caplog.messages
@@ -0,0 +1,90 @@
+import json
+
+import pytest
+from conftest import make_config
+from test_cli import run_extractor
+
+from ingest import ingest_melted_data
+from melted_UKBB_extract import expand_config, extract_UKBB_tabular_data
+from metadata import load_metadata
+from planning import plan_extraction
+
+CONFIGS = [
+    dict(),
+    dict(replicate_non_instanced=False),
+    dict(InstanceIDs=[0, 2]),
+    dict(FieldIDs=[31, 53, 1292]),
+    dict(SubjectIDs=list(range(1_000_000, 1_000_100))),
+]
+
+
+@pytest.fixture(scope="module")
+def store(release, tmp_path_factory) -> str:
+    store_path = tmp_path_factory.mktemp("plan") / "store"
+    ingest_melted_data(
+        str(release / "current.melt.arrow"),
+        str(store_path),
+        dictionary_file=str(release / "Data_Dictionary_Showcase.tsv"),
+        coding_file=str(release / "Codings.tsv"),
+    )
+    return str(store_path)
+
+
+@pytest.mark.parametrize("options", CONFIGS)
+@pytest.mark.parametrize("data", ["store", "current.melt.arrow"])
+def test_plan_bounds_the_extraction(release, metadata_files, store, options, data):
+    data_file = store if data == "store" else str(release / data)
+    metadata = load_metadata(**metadata_files)
+    plan = plan_extraction(
+        expand_config(make_config(**options), metadata),
+        data_file,
+        metadata,
+        ["tsv", "parquet"],
+    )
+    assert plan["source"] == ("field statistics" if data == "store" else "dictionary")
+    data, data_wide, _, _ = extract_UKBB_tabular_data(
+        make_config(**options), data_file, **metadata_files
+    )
+    assert data.height <= plan["narrow_rows"]
+    assert data_wide.height <= plan["wide_rows"]
+    assert plan["fields"] == data.get_column("FieldID").n_unique()
+    assert plan["wide_columns"] == data_wide.width
+    assert set(plan["output_bytes"]) == {
+        "narrow.tsv",
+        "narrow.parquet",
+        "wide.tsv",
+        "wide.parquet",
+    }
+    assert plan["peak_bytes"] > plan["process_bytes"]
+
+
+def test_field_statistics_drop_null_rows(release, metadata_files, store):
+    metadata = load_metadata(**metadata_files)
+    config = expand_config(make_config(replicate_non_instanced=False), metadata)
+    plan = plan_extraction(config, store, metadata, ["parquet"])
+    kept = plan_extraction(
+        dict(config, drop_null_strings=[], drop_null_numerics=[]),
+        store,
+        metadata,
+        ["parquet"],
+    )
+    assert plan["narrow_rows"] < kept["narrow_rows"]
+
+
+def test_plan_dry_run(release, tmp_path):
+    configs = {
+        "sex": make_config(FieldIDs=[31], wide=False),
+        "visits": make_config(FieldIDs=[53], InstanceIDs=[0, 1]),
+    }
+    run_extractor(release, tmp_path, configs, "--plan", "--max-memory", "4G")
+    for name, config in configs.items():
+        with open(tmp_path / f"{name}_plan.json") as stream:
+            plan = json.load(stream)
+        assert plan["fields"] == 1
+        assert plan["filters"]["InstanceIDs"] == config["InstanceIDs"]
+        assert plan["memory"]["strategy"] == "collect"
+        assert set(plan["output_bytes"]) == {
+            f"{kind}.arrow" for kind in ["narrow", "wide"][: 1 + config["wide"]]
+        }
+        # Nothing is extracted
+        assert not (tmp_path / f"{name}_narrow.arrow").exists()
@@ -0,0 +1,126 @@
+import copy
+import json
+import subprocess
+import sys
+
+import pytest
+from conftest import REPO_DIR, make_config
+
+from ingest import ingest_melted_data
+from melted_UKBB_extract import expand_config
+from metadata import load_metadata
+from planning import (
+    BUDGET_FRACTION,
+    estimate_extraction,
+    parse_memory,
+    plan_memory,
+    shard_peak_bytes,
+)
+from sharding import plan_shards
+from synthetic import generate_dataset
+
+MAX_MEMORY = parse_memory("600M")
+
+
+def peak_rss(code: str) -> int:
+    """Peak resident set size in bytes of a Python process running code."""
+    measure = (
+        "import resource, subprocess, sys\n"
+        f"subprocess.run([sys.executable, '-c', {code!r}], check=True)\n"
+        "print(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)\n"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", measure],
+        cwd=REPO_DIR,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = int(result.stdout.split()[-1])
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+@pytest.fixture(scope="module")
+def large_release(tmp_path_factory):
+    """A release of about a million rows and its store, too large for MAX_MEMORY."""
+    release_dir = tmp_path_factory.mktemp("large_release")
+    generate_dataset(
+        str(release_dir),
+        n_subjects=10_000,
+        n_fields=40,
+        max_array=3,
+        output_formats=["arrow"],
+        seed=5,
+    )
+    files = dict(
+        dictionary_file=str(release_dir / "Data_Dictionary_Showcase.tsv"),
+        coding_file=str(release_dir / "Codings.tsv"),
+        category_tree_file=str(release_dir / "13.txt"),
+        data_field_prop_file=str(release_dir / "1.txt"),
+    )
+    ingest_melted_data(
+        str(release_dir / "current.melt.arrow"),
+        str(release_dir / "store"),
+        dictionary_file=files["dictionary_file"],
+        coding_file=files["coding_file"],
+    )
+    return release_dir, files
+
+
+def test_shards_are_added_until_one_fits():
+    estimate = {
+        "process_bytes": 200 * 2**20,
+        "peak_bytes": 4 * 2**30,
+        "narrow_rows": 10_000_000,
+        "scanned_rows": 10_000_000,
+        "narrow_bytes": 10_000_000 * 56,
+        "wide_bytes": 10**9,
+        "subjects": 100_000,
+    }
+    for max_memory in ["600M", "1G", "4G"]:
+        budget = parse_memory(max_memory) * BUDGET_FRACTION
+        plan = plan_memory(estimate, parse_memory(max_memory), make_config(wide=True))
+        assert plan["strategy"] == "shards"
+        # A shard runs next to the process which started it
+        assert plan["shard_peak_bytes"] + estimate["process_bytes"] <= budget
+        assert (
+            shard_peak_bytes(estimate, plan["shards"] - 1) + estimate["process_bytes"]
+            > budget
+        )
+    with pytest.raises(ValueError):
+        plan_memory(estimate, parse_memory("400M"), make_config(wide=True))
+
+
+@pytest.mark.parametrize("data", ["store", "current.melt.arrow"])
+def test_shard_peak_rss_within_budget(large_release, tmp_path, data):
+    release_dir, files = large_release
+    data_file = str(release_dir / data)
+    config = make_config(wide=True, replicate_non_instanced=True)
+    metadata = load_metadata(**files)
+    estimate = estimate_extraction(
+        expand_config(copy.deepcopy(config), metadata), data_file, metadata
+    )
+    plan = plan_memory(estimate, MAX_MEMORY, config)
+    assert plan["strategy"] == "shards"
+    assert plan["shards"] > 1
+
+    manifest_file = plan_shards(
+        config,
+        data_file,
+        files["dictionary_file"],
+        files["coding_file"],
+        str(tmp_path / "out_"),
+        ["parquet"],
+        plan["shards"],
+        category_tree_file=files["category_tree_file"],
+        data_field_prop_file=files["data_field_prop_file"],
+    )
+    with open(manifest_file) as stream:
+        subjects = [shard["subjects"] for shard in json.load(stream)["shards"]]
+    largest = subjects.index(max(subjects))
+    peak = peak_rss(
+        f"from sharding import run_shard; run_shard({manifest_file!r}, {largest})"
+    )
+    assert peak <= plan["shard_peak_bytes"]
+    assert peak + estimate["process_bytes"] <= MAX_MEMORY * BUDGET_FRACTION
@@ -0,0 +1,67 @@
+import json
+
+import polars as pl
+import pytest
+from conftest import make_config, strings
+from test_cli import run_extractor
+
+from melted_UKBB_extract import extract_UKBB_tabular_data
+from profiling import Profile, profile_stage
+
+NARROW_SORT = ["SubjectID", "FieldID", "InstanceID", "ArrayID"]
+
+
+def test_stages_chain_their_rows():
+    profile = Profile(plans=True)
+    data = pl.LazyFrame({"x": list(range(10))})
+    data = profile.materialize("filter", data.filter(pl.col("x") < 4))
+    with profile.stage("count") as record:
+        record["rows_out"] = data.collect().height
+    with profile_stage(None, "ignored") as record:
+        record["rows_out"] = 1
+    assert [record["stage"] for record in profile.stages] == ["filter", "count"]
+    assert profile.stages[0]["rows_out"] == 4
+    assert profile.stages[0]["plan"]
+    assert "plan" not in profile.stages[1]
+    assert profile.stages[1]["rows_in"] == 4
+    report = profile.report()
+    assert json.loads(json.dumps(report))["stages"] == profile.stages
+    for record in report["stages"]:
+        assert record["wall_seconds"] >= 0
+        assert 0 < record["peak_rss_bytes"] <= report["peak_rss_bytes"]
+
+
+@pytest.mark.parametrize("optimize", [True, False])
+def test_profiled_extraction_matches_the_extraction(release, metadata_files, optimize):
+    data_file = str(release / "current.melt.arrow")
+    config = make_config(InstanceIDs=[0, 2])
+    data, wide, _, _, profile = extract_UKBB_tabular_data(
+        dict(config), data_file, optimize=optimize, profile=True, **metadata_files
+    )
+    expected = extract_UKBB_tabular_data(
+        dict(config), data_file, optimize=optimize, **metadata_files
+    )
+    assert strings(data).sort(NARROW_SORT).frame_equal(
+        strings(expected[0]).sort(NARROW_SORT), null_equal=True
+    )
+    assert strings(wide).frame_equal(strings(expected[1]), null_equal=True)
+
+    stages = {record["stage"]: record for record in profile.stages}
+    order = ["metadata", "ID filters", "replication", "collect", "pivot", "typing"]
+    assert [name for name in stages if name in order] == order
+    assert stages["collect"]["rows_out"] == data.height
+    assert stages["pivot"]["rows_out"] == wide.height
+    # Every stage starts from the rows of the stage before it
+    counted = [record for record in profile.stages if record["rows_out"] is not None]
+    for before, after in zip(counted, counted[1:]):
+        assert after["rows_in"] == before["rows_out"]
+
+
+def test_profile_report_is_written(release, tmp_path):
+    run_extractor(release, tmp_path, {"sex": make_config(FieldIDs=[31])}, "--profile")
+    with open(tmp_path / "sex_profile.json") as stream:
+        report = json.load(stream)
+    names = [record["stage"] for record in report["stages"]]
+    assert "collect" in names
+    assert any(name.startswith("write") for name in names)
+    assert report["peak_rss_bytes"] > 0
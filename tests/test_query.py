@@ -0,0 +1,44 @@
+import polars as pl
+import pytest
+from conftest import make_config
+
+from melted_UKBB_extract import extract_UKBB_tabular_data, scan_UKBB_tabular_data
+
+
+@pytest.mark.parametrize("recode_wide_column_valuetypes", [True, False])
+@pytest.mark.parametrize("optimize", [True, False])
+def test_query_matches_the_extraction(
+    release, metadata_files, recode_wide_column_valuetypes, optimize
+):
+    data_file = str(release / "current.melt.arrow")
+    config = make_config(recode_wide_column_valuetypes=recode_wide_column_valuetypes)
+    with pl.StringCache():
+        narrow, wide, dictionary, codings = extract_UKBB_tabular_data(
+            config, data_file, optimize=optimize, **metadata_files
+        )
+        with scan_UKBB_tabular_data(
+            config, data_file, optimize=optimize, **metadata_files
+        ) as query:
+            assert query.wide().collect().frame_equal(wide, null_equal=True)
+            assert query.narrow().collect().frame_equal(narrow, null_equal=True)
+            assert query.dictionary().collect().frame_equal(dictionary, null_equal=True)
+            assert query.codings().collect().frame_equal(codings, null_equal=True)
+
+
+def test_operations_on_the_wide_query(release, metadata_files):
+    config = make_config(FieldIDs=[31, 53], wide=False)
+    with scan_UKBB_tabular_data(
+        config, str(release / "current.melt.arrow"), **metadata_files
+    ) as query:
+        females = (
+            query.wide()
+            .filter(pl.col("Sex_31") == "Female")
+            .select(["SubjectID", "Date of attending assessment centre_53"])
+            .collect()
+        )
+        narrow = query.narrow().collect()
+    expected = narrow.filter(
+        (pl.col("FieldID") == "Sex_31") & (pl.col("FieldValue") == "Female")
+    ).get_column("SubjectID")
+    assert set(females.get_column("SubjectID")) == set(expected)
+    assert females.schema["Date of attending assessment centre_53"] == pl.Date
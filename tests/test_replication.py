@@ -0,0 +1,111 @@
+import polars as pl
+import pytest
+from conftest import make_config, strings
+
+from melted_UKBB_extract import extract_UKBB_tabular_data, replicate_non_instanced_rows
+
+SORT = ["SubjectID", "InstanceID", "ArrayID"]
+
+
+def extract(release, metadata_files, optimize=True, **options) -> pl.DataFrame:
+    config = make_config(
+        replicate_non_instanced=True,
+        recode_field_names=False,
+        wide=False,
+        **options,
+    )
+    data = extract_UKBB_tabular_data(
+        config, str(release / "current.melt.arrow"), optimize=optimize, **metadata_files
+    )[0]
+    return data.with_columns(
+        [
+            pl.col("InstanceID").cast(pl.Utf8).cast(pl.Int64),
+            pl.col("FieldID").cast(pl.Int64),
+        ]
+    )
+
+
+@pytest.fixture
+def sex(release) -> pl.DataFrame:
+    data = pl.read_ipc(release / "current.melt.arrow", memory_map=False)
+    return data.filter(pl.col("FieldID") == 31)
+
+
+@pytest.fixture
+def visits(release) -> pl.DataFrame:
+    """SubjectID and InstanceID of every date of attending, field 53."""
+    data = pl.read_ipc(release / "current.melt.arrow", memory_map=False)
+    return data.filter(pl.col("FieldID") == 53).select(["SubjectID", "InstanceID"])
+
+
+def instances_of(data: pl.DataFrame) -> dict[int, list[int]]:
+    """Sorted InstanceIDs of every SubjectID."""
+    return dict(
+        data.groupby("SubjectID")
+        .agg(pl.col("InstanceID").sort())
+        .iter_rows()
+    )
+
+
+@pytest.mark.parametrize("optimize", [True, False])
+@pytest.mark.parametrize("instance_ids", [[2], [1, 3], []])
+def test_non_instanced_only(
+    release, metadata_files, sex, visits, instance_ids, optimize
+):
+    data = extract(
+        release, metadata_files, optimize, FieldIDs=[31], InstanceIDs=instance_ids
+    )
+    if instance_ids:
+        visits = visits.filter(pl.col("InstanceID").is_in(instance_ids))
+    attended = instances_of(visits)
+    # Subjects are only copied to the instances they attended, and keep their
+    # value at instance 0 without any visit
+    expected = {
+        subject: attended.get(subject, [] if instance_ids else [0])
+        for subject in sex.get_column("SubjectID")
+    }
+    assert instances_of(data) == {
+        subject: instances for subject, instances in expected.items() if instances
+    }
+    assert data.height == sum(map(len, expected.values()))
+
+
+def test_replication_ignores_the_other_fields(release, metadata_files):
+    alone = extract(release, metadata_files, FieldIDs=[31])
+    with_fields = extract(release, metadata_files, FieldIDs=[31, 1292, 1306])
+    assert strings(alone).sort(SORT).frame_equal(
+        strings(with_fields.filter(pl.col("FieldID") == 31)).sort(SORT)
+    )
+
+
+def test_replicated_to_subject_instances(release, metadata_files, sex):
+    data = extract(release, metadata_files, FieldIDs=[31, 53])
+    visits = data.filter(pl.col("FieldID") == 53).select(["SubjectID", "InstanceID"])
+    replicated = data.filter(pl.col("FieldID") == 31).select(["SubjectID", "InstanceID"])
+    # Date of attending is present at every attended instance
+    assert replicated.sort(["SubjectID", "InstanceID"]).frame_equal(
+        visits.filter(pl.col("SubjectID").is_in(sex.get_column("SubjectID"))).sort(
+            ["SubjectID", "InstanceID"]
+        )
+    )
+
+
+def test_subjects_without_visits_keep_instance_0():
+    data = pl.LazyFrame(
+        {
+            "SubjectID": [1, 1, 2],
+            "FieldID": [31, 1292, 31],
+            "InstanceID": [0, 1, 0],
+            "ArrayID": [0, 0, 0],
+            "FieldValue": ["Female", "5", "Male"],
+        }
+    )
+    instanced = pl.DataFrame({"field_id": [31, 1292], "instanced": [0, 1]})
+    attended = pl.LazyFrame({"SubjectID": [1, 1], "InstanceID": [0, 2]})
+    replicated = replicate_non_instanced_rows(data, instanced, attended, []).collect()
+    assert replicated.select(["SubjectID", "FieldID", "InstanceID"]).rows() == [
+        (1, 1292, 1),
+        (1, 31, 0),
+        (1, 31, 2),
+        (2, 31, 0),
+    ]
@@ -0,0 +1,147 @@
+import logging
+
+import pytest
+from conftest import make_config, strings
+
+from melted_UKBB_extract import extract_UKBB_tabular_data
+from result_cache import ENTRY_FILE, covers, evict, result_keys
+
+NARROW_SORT = ["SubjectID", "FieldID", "InstanceID", "ArrayID"]
+
+
+@pytest.fixture
+def extract(release, metadata_files, tmp_path):
+    """Extract a config from the release, with or without the result cache."""
+
+    def extract(cached: bool = True, **options):
+        config = make_config(**options)
+        return extract_UKBB_tabular_data(
+            config,
+            str(release / "current.melt.arrow"),
+            result_cache_dir=str(tmp_path / "cache") if cached else None,
+            **metadata_files,
+        )
+
+    return extract
+
+
+def check_results(results, expected):
+    """Narrow and wide results are equal, ignoring string caches."""
+    assert strings(results[0]).sort(NARROW_SORT).frame_equal(
+        strings(expected[0]).sort(NARROW_SORT), null_equal=True
+    )
+    if expected[1] is None:
+        assert results[1] is None
+    else:
+        assert strings(results[1]).frame_equal(strings(expected[1]), null_equal=True)
+
+
+def entries(tmp_path) -> list:
+    return sorted((tmp_path / "cache").glob(f"*/*/{ENTRY_FILE}"))
+
+
+def test_repeated_extraction_reads_the_entry(extract, tmp_path, caplog):
+    options = dict(FieldIDs=[31, 53, 1292], InstanceIDs=[0, 2])
+    expected = extract(cached=False, **options)
+    check_results(extract(**options), expected)
+    assert len(entries(tmp_path)) == 1
+    with caplog.at_level(logging.INFO):
+        results = extract(**options)
+    assert "Reading cached result" in caplog.text
+    assert "Loading data from" not in caplog.text
+    check_results(results, expected)
+    # The wide output is cached alongside the narrow result
+    assert len(list(entries(tmp_path)[0].parent.glob("wide_*.arrow"))) == 1
+
+
+@pytest.mark.parametrize(
+    "cached_options, options",
+    [
+        (
+            dict(FieldIDs=[31, 53, 1292], replicate_non_instanced=False),
+            dict(FieldIDs=[53, 1292], InstanceIDs=[1], replicate_non_instanced=False),
+        ),
+        (
+            dict(FieldIDs=[31, 53]),
+            dict(FieldIDs=[31, 53], SubjectIDs=list(range(1_000_000, 1_000_100))),
+        ),
+        # Replicated instances do not depend on the other fields
+        (dict(FieldIDs=[31, 53, 1292]), dict(FieldIDs=[31], InstanceIDs=[1, 3])),
+    ],
+)
+def test_subset_is_filtered_from_an_entry(
+    extract, tmp_path, caplog, cached_options, options
+):
+    extract(**cached_options)
+    with caplog.at_level(logging.INFO):
+        results = extract(**options)
+    assert "Filtering cached result" in caplog.text
+    check_results(results, extract(cached=False, **options))
+    # The filtered result becomes an entry of its own
+    assert len(entries(tmp_path)) == 2
+
+
+def test_covers():
+    cached = {
+        "FieldIDs": [31, 53],
+        "InstanceIDs": [],
+        "ArrayIDs": [],
+        "subjects": [],
+        "subject_files": [],
+        "excluded_files": ["a"],
+    }
+    assert covers(cached, dict(cached, FieldIDs=[31], InstanceIDs=[2]))
+    assert not covers(cached, dict(cached, FieldIDs=[31, 1292]))
+    assert not covers(dict(cached, InstanceIDs=[0, 1]), dict(cached, InstanceIDs=[]))
+    # Subjects excluded from the entry cannot be served
+    assert not covers(cached, dict(cached, excluded_files=[]))
+    assert not covers(cached, dict(cached, subjects=[4, 5], excluded_files=["b"]))
+    assert covers(cached, dict(cached, subjects=[4, 5]))
+    assert covers(cached, dict(cached, excluded_files=["a", "b"]))
+    # Cohort files are compared by their hashes
+    cohort = dict(cached, subjects=[4], subject_files=["c"])
+    assert covers(cohort, dict(cohort, subjects=[]))
+    assert not covers(cohort, dict(cohort, subject_files=["c", "d"]))
+    assert not covers(cohort, dict(cohort, subjects=[], subject_files=[]))
+
+
+def test_keys(release, tmp_path):
+    data_file = str(release / "current.melt.arrow")
+    config = make_config(FieldIDs=[53, 31])
+    keys = result_keys(config, data_file, "metadata")
+    assert keys == result_keys(make_config(FieldIDs=[31, 53]), data_file, "metadata")
+    assert keys["selection"]["FieldIDs"] == [31, 53]
+    wide = result_keys(dict(config, convert_compound_to_list=True), data_file, "metadata")
+    assert (wide["group"], wide["entry"]) == (keys["group"], keys["entry"])
+    assert wide["wide"] != keys["wide"]
+    recoded = result_keys(dict(config, recode_data_values=False), data_file, "metadata")
+    assert recoded["group"] != keys["group"]
+    assert result_keys(config, data_file, "other")["group"] != keys["group"]
+    # Cohort files are keyed by their contents, not their paths
+    cohorts = []
+    for name, subjects in [("a.txt", "1000001\n"), ("b.txt", "1000001\n"), ("c.txt", "1\n")]:
+        (tmp_path / name).write_text(subjects)
+        cohorts.append(
+            result_keys(
+                dict(config, SubjectIDFiles=[str(tmp_path / name)]), data_file, "metadata"
+            )["entry"]
+        )
+    assert cohorts[0] == cohorts[1] != cohorts[2]
+
+
+def test_least_recently_used_entries_are_evicted(extract, tmp_path):
+    for field_ids in [[31], [53], [1292]]:
+        extract(FieldIDs=field_ids)
+    first, second, third = [
+        entry.parent
+        for entry in sorted(entries(tmp_path), key=lambda entry: entry.stat().st_mtime)
+    ]
+    # Reading an entry makes it the most recently used
+    extract(FieldIDs=[31])
+    size = sum(
+        file.stat().st_size for entry in entries(tmp_path) for file in entry.parent.iterdir()
+    )
+    evict(str(tmp_path / "cache"), size - 1)
+    assert first.exists() and not second.exists() and third.exists()
+    evict(str(tmp_path / "cache"), 0, keep=third)
+    assert [entry.parent for entry in entries(tmp_path)] == [third]
@@ -0,0 +1,111 @@
+import http.client
+import http.server
+import json
+import threading
+import urllib.parse
+
+import polars as pl
+import pytest
+from conftest import make_config
+
+from melted_UKBB_extract import extract_UKBB_tabular_data
+import server as server_module
+from server import ExtractionHandler, ExtractionService, request_extraction
+
+
+def strings(data: pl.DataFrame) -> pl.DataFrame:
+    """Categorical columns as strings, to compare frames of separate string caches."""
+    return data.with_columns(pl.col(pl.Categorical).cast(pl.Utf8))
+
+
+@pytest.fixture
+def server(release, metadata_files, tmp_path):
+    """Address and service of a server running on a free port."""
+    service = ExtractionService(
+        str(release / "current.melt.arrow"),
+        *metadata_files.values(),
+        output_root=str(tmp_path / "outputs"),
+    )
+    (tmp_path / "outputs").mkdir()
+    httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), ExtractionHandler)
+    httpd.service = service
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}", service
+    httpd.shutdown()
+    httpd.server_close()
+    service.pool.shutdown()
+
+
+def test_frames_match_the_extraction(release, metadata_files, server):
+    url, _ = server
+    config = make_config(FieldIDs=[31, 53])
+    _, wide, _, codings = extract_UKBB_tabular_data(
+        config, str(release / "current.melt.arrow"), **metadata_files
+    )
+    assert strings(request_extraction(config, url)).frame_equal(
+        strings(wide), null_equal=True
+    )
+    assert request_extraction(config, url, frame="codings").frame_equal(codings)
+    # The string cache is only held while extractions run
+    assert not pl.using_string_cache()
+
+
+def test_outputs_are_written_inside_the_output_root(server, tmp_path):
+    url, _ = server
+    summary = request_extraction(make_config(FieldIDs=[31]), url, output_prefix="sex_")
+    assert summary["output_prefix"] == str(tmp_path / "outputs" / "sex_")
+    assert (tmp_path / "outputs" / "sex_narrow.arrow").is_file()
+
+
+@pytest.mark.parametrize("prefix", ["../sex_", "/tmp/sex_", "sub/../../sex_"])
+def test_outputs_outside_the_output_root_are_rejected(server, tmp_path, prefix):
+    url, _ = server
+    with pytest.raises(RuntimeError, match="outside the output root"):
+        request_extraction(make_config(FieldIDs=[31]), url, output_prefix=prefix)
+    assert not (tmp_path / "sex_narrow.arrow").exists()
+
+
+def test_outputs_need_an_output_root(server):
+    url, service = server
+    service.output_root = None
+    with pytest.raises(RuntimeError, match="no output root"):
+        request_extraction(make_config(FieldIDs=[31]), url, output_prefix="sex_")
+
+
+@pytest.mark.parametrize("format", ["arrow", "parquet", "tsv"])
+def test_frames_are_streamed_in_chunks(
+    release, metadata_files, server, monkeypatch, format
+):
+    url, _ = server
+    monkeypatch.setattr(server_module, "RESPONSE_BLOCK_SIZE", 4096)
+    config = make_config(FieldIDs=[31, 53, 1292], wide=False)
+    data, _, _, _ = extract_UKBB_tabular_data(
+        config, str(release / "current.melt.arrow"), **metadata_files
+    )
+    address = urllib.parse.urlsplit(url)
+    connection = http.client.HTTPConnection(address.hostname, address.port)
+    connection.request(
+        "POST", "/extract", json.dumps({"config": config, "format": format}).encode()
+    )
+    response = connection.getresponse()
+    assert response.status == 200
+    assert response.getheader("Transfer-Encoding") == "chunked"
+    assert response.getheader("Content-Length") is None
+    blocks = []
+    while True:
+        block = response.read1()
+        if not block:
+            break
+        blocks.append(block)
+    connection.close()
+    assert len(blocks) > 1 and max(len(block) for block in blocks) <= 4096
+
+    received = request_extraction(config, url, format=format)
+    if format == "tsv":
+        expected = data.select(pl.all().cast(pl.Utf8))
+        received = received.select(pl.all().cast(pl.Utf8))
+    else:
+        expected = strings(data)
+        received = strings(received)
+    assert received.frame_equal(expected, null_equal=True)
@@ -0,0 +1,114 @@
+import polars as pl
+import pytest
+from conftest import make_config
+
+from melted_UKBB_extract import extract_UKBB_tabular_data
+from sharding import extract_sharded, shard_fields, shard_subjects
+from writers import write_outputs
+
+NARROW_SORT = ["SubjectID", "FieldID", "InstanceID", "ArrayID"]
+FIELD_IDS = [31, 53, 1008, 1292, 1306]
+
+
+def read_parquet(path, sort: list[str]) -> pl.DataFrame:
+    """A parquet output as strings, in a row order shared by all extractions."""
+    data = pl.read_parquet(path)
+    return data.select(pl.all().cast(pl.Utf8)).sort(sort)
+
+
+@pytest.fixture(scope="module")
+def unsharded(release, tmp_path_factory):
+    """Parquet outputs of the unsharded extraction, by replication."""
+    prefixes = {}
+    for replicate in [True, False]:
+        config = make_config(FieldIDs=FIELD_IDS, replicate_non_instanced=replicate)
+        prefix = tmp_path_factory.mktemp("unsharded") / "out_"
+        results = extract_UKBB_tabular_data(
+            config,
+            str(release / "current.melt.arrow"),
+            str(release / "Data_Dictionary_Showcase.tsv"),
+            str(release / "Codings.tsv"),
+            str(release / "13.txt"),
+            str(release / "1.txt"),
+        )
+        write_outputs(*results, str(prefix), ["parquet"])
+        prefixes[replicate] = prefix
+    return prefixes
+
+
+def test_shards_cover_the_selection(release):
+    data_file = str(release / "current.melt.arrow")
+    config = make_config(FieldIDs=FIELD_IDS)
+    subjects = shard_subjects(data_file, config, 4)
+    assert len(subjects) == 4
+    merged = pl.concat(subjects)
+    assert merged.is_sorted() and merged.is_unique().all()
+    data = pl.read_ipc(data_file, memory_map=False)
+    assert merged.len() == data.get_column("SubjectID").n_unique()
+    assert max(map(len, subjects)) - min(map(len, subjects)) <= 1
+
+    fields = shard_fields(data_file, config, 3)
+    assert sorted(field_id for group in fields for field_id in group) == sorted(
+        FIELD_IDS
+    )
+    # Fields keep the order of the config within a shard
+    for group in fields:
+        assert group == [field_id for field_id in FIELD_IDS if field_id in group]
+
+
+@pytest.mark.parametrize(
+    "shard_by, stream, replicate",
+    [
+        ("subject", False, True),
+        ("subject", True, True),
+        ("field", False, True),
+        ("field", False, False),
+    ],
+)
+def test_merged_shards_match_the_extraction(
+    release, metadata_files, unsharded, tmp_path, shard_by, stream, replicate
+):
+    prefix = tmp_path / "out_"
+    manifest_file = extract_sharded(
+        make_config(FieldIDs=FIELD_IDS, replicate_non_instanced=replicate),
+        str(prefix),
+        ["parquet"],
+        3,
+        shard_by,
+        workers=2,
+        stream=stream,
+        data_file=str(release / "current.melt.arrow"),
+        **metadata_files,
+    )
+    assert not (tmp_path / "out_shards").exists()
+    assert manifest_file.endswith("manifest.json")
+
+    expected = unsharded[replicate]
+    for name, sort in [
+        ("narrow.parquet", NARROW_SORT),
+        ("wide.parquet", ["SubjectID", "InstanceID", "ArrayID"]),
+    ]:
+        merged = read_parquet(f"{prefix}{name}", sort)
+        unsplit = read_parquet(f"{expected}{name}", sort)
+        assert sorted(merged.columns) == sorted(unsplit.columns)
+        assert merged.select(unsplit.columns).frame_equal(unsplit, null_equal=True)
+    dictionary = pl.read_csv(f"{prefix}dictionary.tsv", separator="\t")
+    assert dictionary.frame_equal(
+        pl.read_csv(f"{expected}dictionary.tsv", separator="\t"), null_equal=True
+    )
+
+
+def test_manifest_only_keeps_the_shard_directory(release, metadata_files, tmp_path):
+    extract_sharded(
+        make_config(FieldIDs=[31]),
+        str(tmp_path / "out_"),
+        ["parquet"],
+        2,
+        manifest_only=True,
+        data_file=str(release / "current.melt.arrow"),
+        **metadata_files,
+    )
+    shard_dir = tmp_path / "out_shards"
+    assert (shard_dir / "manifest.json").is_file()
+    assert "--array=0-1" in (shard_dir / "array_job.sh").read_text()
+    assert not (tmp_path / "out_narrow.parquet").exists()
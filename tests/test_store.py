@@ -0,0 +1,76 @@
+import polars as pl
+import pytest
+from conftest import make_config, strings
+
+from ingest import ingest_melted_data
+from melted_UKBB_extract import extract_UKBB_tabular_data
+from store import PARTITION_SORT, read_manifest, scan_melted_store, select_parts
+
+NARROW_SORT = ["SubjectID", "FieldID", "InstanceID", "ArrayID"]
+
+
+@pytest.fixture(scope="module")
+def store(release, tmp_path_factory):
+    """The release ingested into a partitioned store of several parts per field."""
+    store_path = tmp_path_factory.mktemp("store") / "store"
+    ingest_melted_data(
+        str(release / "current.melt.arrow"),
+        str(store_path),
+        batch_size=5_000,
+        rows_per_part=300,
+        dictionary_file=str(release / "Data_Dictionary_Showcase.tsv"),
+        coding_file=str(release / "Codings.tsv"),
+    )
+    return store_path
+
+
+def test_parts_are_sorted_by_subject(store):
+    manifest = read_manifest(store)
+    assert manifest["partitioned_by"] == "FieldID"
+    for part in manifest["parts"]:
+        assert part["path"].startswith(f"FieldID={part['FieldID']}/")
+        data = pl.read_parquet(store / part["path"])
+        assert data.height == part["rows"]
+        assert data.frame_equal(data.sort(PARTITION_SORT))
+        assert data.get_column("SubjectID").min() == part["SubjectID_min"]
+        assert data.get_column("SubjectID").max() == part["SubjectID_max"]
+
+
+def test_parts_are_pruned(store):
+    manifest = read_manifest(store)
+    parts = select_parts(manifest, field_ids=[53])
+    assert len(parts) > 1
+    assert {part["FieldID"] for part in parts} == {53}
+    subject = parts[0]["SubjectID_max"]
+    assert select_parts(manifest, field_ids=[53], subject_ids=[subject]) == [parts[0]]
+    with pl.StringCache():
+        data = scan_melted_store(str(store), field_ids=[53], subject_ids=[subject]).collect()
+    assert data.get_column("FieldID").unique().to_list() == [53]
+    assert data.height == parts[0]["rows"]
+    # Non-instanced fields hold instance 0 only
+    assert {part["FieldID"] for part in select_parts(manifest, instance_ids=[2])} < {
+        part["FieldID"] for part in manifest["parts"]
+    }
+
+
+@pytest.mark.parametrize(
+    "options",
+    [
+        {},
+        {"FieldIDs": [31, 53, 1008], "InstanceIDs": [0, 2]},
+        {"SubjectIDs": [1_000_003, 1_000_150, 1_000_299], "replicate_non_instanced": False},
+        {"ArrayIDs": [1, 2], "wide": False},
+    ],
+)
+def test_store_matches_the_arrow_file(release, store, metadata_files, options):
+    config = make_config(**options)
+    arrow = extract_UKBB_tabular_data(
+        config, str(release / "current.melt.arrow"), **metadata_files
+    )
+    stored = extract_UKBB_tabular_data(config, str(store), **metadata_files)
+    assert stored[0].height > 0
+    assert strings(stored[0]).sort(NARROW_SORT).frame_equal(
+        strings(arrow[0]).sort(NARROW_SORT), null_equal=True
+    )
+    if config["wide"]:
+        assert strings(stored[1]).frame_equal(strings(arrow[1]), null_equal=True)
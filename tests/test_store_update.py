@@ -0,0 +1,154 @@
+import polars as pl
+import pytest
+
+import store as store_module
+from field_statistics import field_statistics, read_null_codes, template_null_values
+from ingest import ingest_melted_data, update_store
+from store import read_field_statistics, read_manifest, scan_melted_store
+
+SORT = ["SubjectID", "FieldID", "InstanceID", "ArrayID"]
+
+
+def read_store(store_path) -> pl.DataFrame:
+    with pl.StringCache():
+        data = scan_melted_store(str(store_path)).collect()
+    return (
+        data.select(SORT + ["FieldValue"])
+        .with_columns(pl.col("FieldValue").cast(pl.Utf8))
+        .sort(SORT)
+    )
+
+
+@pytest.fixture
+def files(release) -> dict:
+    return dict(
+        dictionary_file=str(release / "Data_Dictionary_Showcase.tsv"),
+        coding_file=str(release / "Codings.tsv"),
+    )
+
+
+@pytest.fixture
+def store(release, files, tmp_path):
+    store_path = tmp_path / "store"
+    ingest_melted_data(
+        str(release / "current.melt.arrow"),
+        str(store_path),
+        rows_per_part=2_000,
+        release="r1",
+        **files,
+    )
+    return store_path
+
+
+@pytest.fixture
+def release_data(release) -> pl.DataFrame:
+    return pl.read_ipc(release / "current.melt.arrow", memory_map=False)
+
+
+def check_statistics(store_path, files):
+    """The statistics index matches statistics computed from the store rows."""
+    null_strings, null_numerics = template_null_values()
+    null_codes = read_null_codes(files["dictionary_file"], files["coding_file"], null_strings)
+    with pl.StringCache():
+        data = scan_melted_store(str(store_path)).collect()
+    assert read_field_statistics(store_path).frame_equal(
+        field_statistics(data, null_numerics, null_codes), null_equal=True
+    )
+
+
+def test_identical_release(release, store, files):
+    fields = read_manifest(store)["parts"]
+    update_store(str(release / "current.melt.arrow"), str(store), release="r2", **files)
+    summary = read_manifest(store)["releases"][-1]
+    assert summary["fields_changed"] == 0
+    assert summary["fields_unchanged"] == len({part["FieldID"] for part in fields})
+    assert {part["release"] for part in read_manifest(store)["parts"]} == {"r1"}
+
+
+@pytest.fixture
+def read_fields(monkeypatch) -> list:
+    """FieldIDs of the partitions read whole by the update."""
+    fields = []
+    read_partition = store_module.read_partition
+
+    def recorded(store_path, parts, part_format="parquet"):
+        fields.extend({part["FieldID"] for part in parts})
+        return read_partition(store_path, parts, part_format)
+
+    monkeypatch.setattr(store_module, "read_partition", recorded)
+    return fields
+
+
+def test_unchanged_partitions_are_not_read(release, store, files, read_fields):
+    update_store(str(release / "current.melt.arrow"), str(store), release="r2", **files)
+    assert read_fields == []
+    assert all("digest" in part for part in read_manifest(store)["parts"])
+
+
+def test_subject_sorted_store_is_not_updated(release, files, tmp_path):
+    ingest_melted_data(
+        str(release / "current.melt.arrow"), str(tmp_path / "store"), layout="subject"
+    )
+    with pytest.raises(ValueError, match="stores can be updated"):
+        update_store(str(release / "current.melt.arrow"), str(tmp_path / "store"))
+    assert not (tmp_path / "store" / "_staging").exists()
+
+
+def test_changed_release(release_data, store, files, tmp_path, read_fields):
+    changed = release_data.with_columns(
+        pl.when((pl.col("FieldID") == 53) & (pl.col("InstanceID") == 0))
+        .then(pl.lit("2020-01-01"))
+        .otherwise(pl.col("FieldValue"))
+        .alias("FieldValue")
+    )
+    changed.write_ipc(tmp_path / "r2.arrow")
+    update_store(str(tmp_path / "r2.arrow"), str(store), release="r2", **files)
+    summary = read_manifest(store)["releases"][-1]
+    assert summary["fields_changed"] == 1
+    assert summary["rows_added"] == summary["rows_removed"] == 0
+    visits = release_data.filter((pl.col("FieldID") == 53) & (pl.col("InstanceID") == 0))
+    assert summary["values_changed"] == visits.filter(
+        pl.col("FieldValue") != "2020-01-01"
+    ).height
+    assert read_store(store).frame_equal(changed.select(SORT + ["FieldValue"]).sort(SORT))
+    check_statistics(store, files)
+    # Only the changed partition is diffed
+    assert set(read_fields) == {53}
+
+
+def test_withdrawal(release, release_data, store, files, tmp_path):
+    withdrawn = [1_000_000, 1_000_007, 1_000_150]
+    (tmp_path / "withdrawn.txt").write_text("\n".join(map(str, withdrawn)))
+    fields = {part["FieldID"] for part in read_manifest(store)["parts"]}
+    update_store(
+        str(release / "current.melt.arrow"),
+        str(store),
+        release="r2",
+        withdrawn_file=str(tmp_path / "withdrawn.txt"),
+        **files,
+    )
+    summary = read_manifest(store)["releases"][-1]
+    assert summary["fields_changed"] == 0
+    assert summary["fields_unchanged"] == len(fields)
+    assert summary["rows_removed"] == release_data.filter(
+        pl.col("SubjectID").is_in(withdrawn)
+    ).height
+    assert summary["withdrawn_subjects"] == 3
+    remaining = release_data.filter(pl.col("SubjectID").is_in(withdrawn).is_not())
+    assert read_store(store).frame_equal(remaining.select(SORT + ["FieldValue"]).sort(SORT))
+    check_statistics(store, files)
+
+
+def test_fields_outside_the_update_keep_their_parts(release, store, files):
+    update_store(
+        str(release / "current.melt.arrow"),
+        str(store),
+        release="r2",
+        field_ids=[31],
+        **files,
+    )
+    summary = read_manifest(store)["releases"][-1]
+    assert summary["fields_unchanged"] == 1
+    assert summary["fields_kept"] == len(
+        {part["FieldID"] for part in read_manifest(store)["parts"]}
+    ) - 1
@@ -0,0 +1,76 @@
+import polars as pl
+import pytest
+from conftest import make_config, strings
+
+from ingest import ingest_melted_data
+from melted_UKBB_extract import extract_UKBB_tabular_data
+from store import SUBJECT_SORT, read_manifest, read_mapped_ipc, scan_melted_store
+
+SUBJECTS = [1_000_000, 1_000_001, 1_000_002, 1_000_150, 1_000_298, 1_000_299]
+
+
+@pytest.fixture(scope="module")
+def store(release, tmp_path_factory):
+    """The release ingested in several batches into a subject-sorted store."""
+    store_path = tmp_path_factory.mktemp("subject_store") / "store"
+    ingest_melted_data(
+        str(release / "current.melt.arrow"),
+        str(store_path),
+        batch_size=5_000,
+        layout="subject",
+    )
+    return store_path
+
+
+@pytest.fixture(scope="module")
+def release_data(release) -> pl.DataFrame:
+    return pl.read_ipc(release / "current.melt.arrow", memory_map=False)
+
+
+def test_index_points_at_the_rows_of_every_subject(store, release_data):
+    manifest = read_manifest(store)
+    data = read_mapped_ipc(store / manifest["data"])
+    index = read_mapped_ipc(store / manifest["index"])
+    assert data.height == release_data.height
+    assert data.frame_equal(data.sort(SUBJECT_SORT))
+    assert index.get_column("length").sum() == data.height
+    for subject, offset, length in index.select(
+        ["SubjectID", "offset", "length"]
+    ).iter_rows():
+        assert data.slice(offset, length).get_column("SubjectID").unique().to_list() == [
+            subject
+        ]
+
+
+@pytest.mark.parametrize("lazy", [False, True])
+def test_scan_reads_the_requested_subjects(store, release_data, lazy):
+    # A lazy cohort is joined with the subject index
+    subject_ids = pl.LazyFrame({"SubjectID": SUBJECTS * 2}) if lazy else SUBJECTS
+    with pl.StringCache():
+        data = scan_melted_store(str(store), subject_ids=subject_ids).collect()
+    expected = release_data.filter(pl.col("SubjectID").is_in(SUBJECTS))
+    assert strings(data).select(expected.columns).sort(SUBJECT_SORT).frame_equal(
+        expected.sort(SUBJECT_SORT)
+    )
+
+
+@pytest.mark.parametrize(
+    "options",
+    [
+        {"SubjectIDs": SUBJECTS},
+        {"SubjectIDs": SUBJECTS[:2], "FieldIDs": [31, 53], "InstanceIDs": [0]},
+        {},
+    ],
+)
+def test_store_matches_the_arrow_file(release, store, metadata_files, options):
+    config = make_config(**options)
+    arrow = extract_UKBB_tabular_data(
+        config, str(release / "current.melt.arrow"), **metadata_files
+    )
+    stored = extract_UKBB_tabular_data(config, str(store), **metadata_files)
+    sort = ["SubjectID", "FieldID", "InstanceID", "ArrayID"]
+    assert stored[0].height > 0
+    assert strings(stored[0]).sort(sort).frame_equal(
+        strings(arrow[0]).sort(sort), null_equal=True
+    )
+    assert strings(stored[1]).frame_equal(strings(arrow[1]), null_equal=True)
@@ -0,0 +1,36 @@
+import json
+
+import polars as pl
+
+from synthetic import generate_dataset
+
+
+def test_release_files(release):
+    description = json.loads((release / "synthetic.json").read_text())
+    data = pl.read_ipc(release / "current.melt.arrow", memory_map=False)
+    assert data.height == description["rows"]
+    assert data.columns == ["SubjectID", "FieldID", "InstanceID", "ArrayID", "FieldValue"]
+    assert data.get_column("SubjectID").n_unique() == description["subjects"]
+    for name in ["Data_Dictionary_Showcase.tsv", "Codings.tsv", "13.txt", "1.txt"]:
+        assert (release / name).exists()
+
+
+def test_tsv_matches_arrow(release):
+    tsv = pl.read_csv(
+        release / "current.melt.tsv",
+        separator="\t",
+        dtypes={"FieldValue": pl.Utf8},
+    )
+    arrow = pl.read_ipc(release / "current.melt.arrow", memory_map=False)
+    assert tsv.with_columns(pl.col("FieldValue").fill_null("")).frame_equal(
+        arrow.with_columns(pl.col("FieldValue").fill_null(""))
+    )
+
+
+def test_reproducible_across_batch_sizes(tmp_path):
+    options = dict(n_subjects=50, n_fields=10, output_formats=["arrow"], seed=3)
+    generate_dataset(str(tmp_path / "a"), batch_subjects=50, **options)
+    generate_dataset(str(tmp_path / "b"), batch_subjects=7, **options)
+    assert pl.read_ipc(tmp_path / "a" / "current.melt.arrow", memory_map=False).frame_equal(
+        pl.read_ipc(tmp_path / "b" / "current.melt.arrow", memory_map=False)
+    )
@@ -0,0 +1,77 @@
+import polars as pl
+import pytest
+from conftest import make_config, strings
+
+from ingest import ingest_melted_data
+from melted_UKBB_extract import extract_UKBB_tabular_data
+from store import TYPED_VALUE_COLUMNS, VALUE_TYPE_COLUMNS, read_manifest, scan_melted_store
+
+NARROW_SORT = ["SubjectID", "FieldID", "InstanceID", "ArrayID"]
+
+
+@pytest.fixture(scope="module")
+def stores(release, tmp_path_factory) -> dict:
+    """The release ingested with typed value columns, and without."""
+    store_dir = tmp_path_factory.mktemp("typed_values")
+    ingest_melted_data(
+        str(release / "current.melt.arrow"),
+        str(store_dir / "typed"),
+        dictionary_file=str(release / "Data_Dictionary_Showcase.tsv"),
+        coding_file=str(release / "Codings.tsv"),
+    )
+    ingest_melted_data(str(release / "current.melt.arrow"), str(store_dir / "untyped"))
+    return {name: str(store_dir / name) for name in ["typed", "untyped"]}
+
+
+def test_typed_columns_hold_the_parsed_values(stores):
+    value_types = read_manifest(stores["typed"])["value_types"]
+    with pl.StringCache():
+        data = scan_melted_store(stores["typed"]).collect()
+    data = data.with_columns(pl.col("FieldValue").cast(pl.Utf8))
+    assert set(TYPED_VALUE_COLUMNS) <= set(data.columns)
+    value = pl.col("FieldValue")
+    parsed = {
+        "ValueFloat": value.cast(pl.Float64, strict=False),
+        "ValueInt": value.cast(pl.Int64, strict=False),
+        "ValueDate": value.str.strptime(pl.Date, strict=False),
+        "ValueDatetime": value.str.strptime(pl.Datetime, strict=False),
+    }
+    for field_id, field in data.partition_by("FieldID", as_dict=True).items():
+        typed_column = VALUE_TYPE_COLUMNS.get(value_types[str(field_id)])
+        for column, expression in parsed.items():
+            values = field.get_column(column)
+            if column == "ValueFloat" or column == typed_column:
+                expected = field.select(expression.cast(values.dtype).alias(column))
+                assert values.series_equal(expected.to_series(), null_equal=True), (
+                    field_id,
+                    column,
+                )
+            else:
+                assert values.null_count() == field.height, (field_id, column)
+
+
+@pytest.mark.parametrize(
+    "options",
+    [
+        {},
+        {"convert_less_than_value_integer": 0, "convert_less_than_value_continuous": 0.5},
+        {"drop_null_numerics": [-1, 99999], "recode_data_values": False},
+        {"drop_null_numerics": [], "recode_wide_column_valuetypes": False},
+    ],
+)
+def test_typed_store_matches_the_strings(release, stores, metadata_files, options):
+    config = make_config(**options)
+    results = {
+        name: extract_UKBB_tabular_data(dict(config), data_file, **metadata_files)
+        for name, data_file in dict(
+            stores, arrow=str(release / "current.melt.arrow")
+        ).items()
+    }
+    expected = results.pop("arrow")
+    for data, wide, *_ in results.values():
+        assert data.height > 0
+        assert strings(data).sort(NARROW_SORT).frame_equal(
+            strings(expected[0]).sort(NARROW_SORT), null_equal=True
+        )
+        assert wide.schema == expected[1].schema
+        assert strings(wide).frame_equal(strings(expected[1]), null_equal=True)
@@ -0,0 +1,110 @@
+import polars as pl
+import pytest
+from conftest import make_config, strings
+from test_cli import run_extractor
+
+from ingest import ingest_melted_data
+from melted_UKBB_extract import (
+    extract_UKBB_tabular_data,
+    iter_wide_batches,
+    scan_UKBB_tabular_data,
+    write_wide_batches,
+)
+
+
+@pytest.fixture(scope="module")
+def extraction(release):
+    return extract_UKBB_tabular_data(
+        make_config(),
+        str(release / "current.melt.arrow"),
+        str(release / "Data_Dictionary_Showcase.tsv"),
+        str(release / "Codings.tsv"),
+        str(release / "13.txt"),
+        str(release / "1.txt"),
+    )
+
+
+@pytest.mark.parametrize("source", ["query", "frame", "shuffled"])
+@pytest.mark.parametrize("batch_size", [1, 37, 1000])
+def test_batches_match_the_eager_pivot(
+    release, metadata_files, extraction, batch_size, source
+):
+    data, wide, dictionary, _ = extraction
+    if source == "shuffled":
+        data = data.sample(fraction=1.0, shuffle=True, seed=1)
+    with scan_UKBB_tabular_data(
+        make_config(), str(release / "current.melt.arrow"), **metadata_files
+    ) as query:
+        # The lazy query is collected one range of subjects at a time
+        narrow = query.narrow() if source == "query" else data
+        batches = list(iter_wide_batches(narrow, dictionary, make_config(), batch_size))
+        merged = pl.concat(batches)
+    subjects = data.get_column("SubjectID").n_unique()
+    assert len(batches) == -(-subjects // batch_size)
+    assert all(
+        batch.get_column("SubjectID").n_unique() <= batch_size for batch in batches
+    )
+    assert merged.schema == wide.schema
+    assert strings(merged).frame_equal(strings(wide), null_equal=True)
+
+
+def test_no_data(extraction):
+    data, wide, dictionary, _ = extraction
+    batches = list(iter_wide_batches(data.clear(), dictionary, make_config(), 10))
+    assert len(batches) == 1
+    assert batches[0].height == 0
+
+
+def test_streamed_outputs_keep_the_values(extraction, tmp_path):
+    data, wide, dictionary, _ = extraction
+    with pl.StringCache():
+        write_wide_batches(
+            iter_wide_batches(data, dictionary, make_config(), 50),
+            str(tmp_path / "out_"),
+            ["parquet", "arrow"],
+        )
+    # Parquet keeps the Categorical columns
+    parquet = pl.read_parquet(tmp_path / "out_wide.parquet")
+    assert parquet.schema == wide.schema
+    assert strings(parquet).frame_equal(strings(wide), null_equal=True)
+    # Arrow IPC files hold a single dictionary per column, Categorical
+    # columns are written as strings
+    arrow = pl.read_ipc(tmp_path / "out_wide.arrow", memory_map=False)
+    assert arrow.schema == strings(wide).schema
+    assert pl.Categorical in wide.dtypes and pl.Categorical not in arrow.dtypes
+    assert arrow.frame_equal(strings(wide), null_equal=True)
+
+
+@pytest.mark.parametrize("options", [[], ["--sink"]])
+def test_cli_batches_match_the_wide_output(release, tmp_path, options):
+    config = make_config(FieldIDs=[31, 53, 1292])
+    run_extractor(release, tmp_path, {"eager": config})
+    run_extractor(
+        release, tmp_path, {"batched": config}, "--wide-batch-size", "40", *options
+    )
+    for name in ["narrow", "wide"]:
+        batched = pl.read_ipc(tmp_path / f"batched_{name}.arrow", memory_map=False)
+        eager = pl.read_ipc(tmp_path / f"eager_{name}.arrow", memory_map=False)
+        assert batched.frame_equal(strings(eager), null_equal=True)
+    log = (tmp_path / "batched_conversion.log").read_text()
+    assert "in batches of 40" in log
+
+
+def test_batches_with_the_index_columns(release, metadata_files, extraction, tmp_path):
+    _, wide, dictionary, _ = extraction
+    store = str(tmp_path / "store")
+    ingest_melted_data(
+        str(release / "current.melt.arrow"),
+        store,
+        rows_per_part=2_000,
+        dictionary_file=metadata_files["dictionary_file"],
+        coding_file=metadata_files["coding_file"],
+    )
+    with scan_UKBB_tabular_data(make_config(), store, **metadata_files) as query:
+        columns = query.wide_columns()
+        assert columns is not None
+        merged = pl.concat(
+            iter_wide_batches(query.narrow(), dictionary, make_config(), 100, columns)
+        )
+    assert merged.schema == wide.schema
+    assert strings(merged).frame_equal(strings(wide), null_equal=True)
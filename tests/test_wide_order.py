@@ -0,0 +1,60 @@
+import json
+
+import polars as pl
+import pytest
+from conftest import make_config
+
+from ingest import ingest_melted_data
+from melted_UKBB_extract import WIDE_INDEX, extract_UKBB_tabular_data, iter_wide_batches
+from wide_groups import write_wide_groups
+
+
+def strings(data: pl.DataFrame) -> pl.DataFrame:
+    """Categorical columns as strings, to compare frames of separate string caches."""
+    return data.with_columns(pl.col(pl.Categorical).cast(pl.Utf8))
+
+
+@pytest.fixture(scope="module")
+def inputs(release, tmp_path_factory) -> dict:
+    """The release as a melted Arrow file and as a partitioned store."""
+    store = tmp_path_factory.mktemp("wide_order") / "store"
+    ingest_melted_data(
+        str(release / "current.melt.arrow"),
+        str(store),
+        rows_per_part=2_000,
+        dictionary_file=str(release / "Data_Dictionary_Showcase.tsv"),
+        coding_file=str(release / "Codings.tsv"),
+    )
+    return {"arrow": str(release / "current.melt.arrow"), "store": str(store)}
+
+
+def test_wide_order_does_not_depend_on_the_input(inputs, metadata_files, tmp_path):
+    manifests = {}
+    wides = {}
+    for name, data_file in inputs.items():
+        _, wide, dictionary, _ = extract_UKBB_tabular_data(
+            make_config(), data_file, **metadata_files
+        )
+        wides[name] = strings(wide)
+        manifests[name] = write_wide_groups(
+            wide, dictionary, str(tmp_path / f"{name}_"), ["arrow"], 5
+        )
+    assert wides["arrow"].frame_equal(wides["store"], null_equal=True)
+    assert manifests["arrow"] == manifests["store"]
+    field_ids = [int(column.rsplit("_", 1)[-1]) for column in manifests["arrow"]["columns"]]
+    assert field_ids == sorted(field_ids)
+    keys = wides["arrow"].select(
+        [pl.col(column).cast(pl.Int64) for column in WIDE_INDEX]
+    )
+    assert keys.frame_equal(keys.sort(WIDE_INDEX))
+    with open(tmp_path / "arrow_wide" / "manifest.json") as stream:
+        assert json.load(stream) == manifests["arrow"]
+
+
+def test_batches_match_the_eager_pivot(inputs, metadata_files):
+    data, wide, dictionary, _ = extract_UKBB_tabular_data(
+        make_config(), inputs["store"], **metadata_files
+    )
+    with pl.StringCache():
+        batches = pl.concat(list(iter_wide_batches(data, dictionary, make_config(), 70)))
+    assert strings(batches).frame_equal(strings(wide), null_equal=True)
@@ -0,0 +1,90 @@
+import polars as pl
+import pytest
+from conftest import make_config, strings
+
+from melted_UKBB_extract import (
+    WIDE_INDEX,
+    datatype_dictionary,
+    extract_UKBB_tabular_data,
+    set_wide_column_types,
+    wide_column_expression,
+)
+
+
+@pytest.fixture(scope="module")
+def untyped(release):
+    """Wide data of all fields with string columns, and the dictionary.
+
+    "Less than one" values are converted, so that every column can be typed.
+    """
+    metadata_files = dict(
+        dictionary_file=str(release / "Data_Dictionary_Showcase.tsv"),
+        coding_file=str(release / "Codings.tsv"),
+        category_tree_file=str(release / "13.txt"),
+        data_field_prop_file=str(release / "1.txt"),
+    )
+    _, wide, dictionary, _ = extract_UKBB_tabular_data(
+        make_config(
+            recode_wide_column_valuetypes=False,
+            convert_less_than_value_integer=0,
+            convert_less_than_value_continuous=0.5,
+        ),
+        str(release / "current.melt.arrow"),
+        **metadata_files,
+    )
+    return wide, dictionary
+
+
+def value_types(dictionary: pl.DataFrame) -> dict[str, str]:
+    return {
+        str(field_id): val_type
+        for field_id, val_type in dictionary.select(["FieldID", "ValueType"]).iter_rows()
+    }
+
+
+@pytest.mark.parametrize("convert_compound_to_list", [False, True])
+def test_single_pass_matches_column_by_column(untyped, convert_compound_to_list):
+    wide, dictionary = untyped
+    config = make_config(convert_compound_to_list=convert_compound_to_list)
+    types = value_types(dictionary)
+    expected = wide
+    for column in wide.columns[len(WIDE_INDEX) :]:
+        val_type = types[column.rsplit("_", 1)[-1]]
+        expected = expected.with_columns(wide_column_expression(column, val_type, config))
+    with pl.StringCache():
+        typed = set_wide_column_types(wide, dictionary, config)
+    assert strings(typed).frame_equal(strings(expected), null_equal=True)
+
+
+def test_columns_have_their_value_type(untyped):
+    wide, dictionary = untyped
+    types = value_types(dictionary)
+    with pl.StringCache():
+        typed = set_wide_column_types(wide, dictionary, make_config())
+    for column in typed.columns[len(WIDE_INDEX) :]:
+        val_type = types[column.rsplit("_", 1)[-1]]
+        assert typed.schema[column] == datatype_dictionary[val_type]
+
+
+def test_failing_columns_are_left_as_strings(untyped):
+    wide, dictionary = untyped
+    types = value_types(dictionary)
+    integer, date = [
+        next(
+            column
+            for column in wide.columns
+            if types.get(column.rsplit("_", 1)[-1]) == val_type
+        )
+        for val_type in ["Integer", "Date"]
+    ]
+    mixed = wide.with_columns(
+        pl.when(pl.col("SubjectID") == wide.get_column("SubjectID").min())
+        .then(pl.lit("not a number"))
+        .otherwise(pl.col(integer))
+        .alias(integer)
+    )
+    with pl.StringCache():
+        typed = set_wide_column_types(mixed, dictionary, make_config())
+    assert typed.schema[integer] == pl.Utf8
+    assert typed.get_column(integer).series_equal(mixed.get_column(integer), null_equal=True)
+    assert typed.schema[date] == pl.Date
@@ -0,0 +1,103 @@
+import polars as pl
+import pytest
+from conftest import make_config, strings
+
+from melted_UKBB_extract import extract_UKBB_tabular_data, sink_UKBB_tabular_data
+from writers import COMPRESSIONS, write_outputs
+
+NARROW_SORT = ["SubjectID", "FieldID", "InstanceID", "ArrayID"]
+
+
+def read_output(path) -> pl.DataFrame:
+    """An output file of any format as a frame of strings."""
+    if path.suffix == ".tsv":
+        return pl.read_csv(path, separator="\t", infer_schema_length=0)
+    if path.suffix == ".csv":
+        return pl.read_csv(path, infer_schema_length=0)
+    if path.suffix == ".parquet":
+        data = pl.read_parquet(path)
+    else:
+        data = pl.read_ipc(path, memory_map=False)
+    return data.select(pl.all().cast(pl.Utf8))
+
+
+@pytest.fixture(scope="module")
+def results(release):
+    return extract_UKBB_tabular_data(
+        make_config(FieldIDs=[31, 53, 1292], wide=True),
+        str(release / "current.melt.arrow"),
+        str(release / "Data_Dictionary_Showcase.tsv"),
+        str(release / "Codings.tsv"),
+        str(release / "13.txt"),
+        str(release / "1.txt"),
+    )
+
+
+def test_concurrent_and_serial_outputs_are_identical(results, tmp_path):
+    formats = ["tsv", "csv", "arrow", "parquet"]
+    for prefix, workers in [("concurrent_", None), ("serial_", 1)]:
+        write_outputs(*results, str(tmp_path / prefix), formats, workers=workers)
+    names = [f"{kind}.{format}" for kind in ["narrow", "wide"] for format in formats]
+    for name in names + ["dictionary.tsv", "coding.tsv"]:
+        concurrent = read_output(tmp_path / f"concurrent_{name}")
+        assert concurrent.frame_equal(
+            read_output(tmp_path / f"serial_{name}"), null_equal=True
+        )
+    data, data_wide = results[0], results[1]
+    assert read_output(tmp_path / "serial_narrow.parquet").height == data.height
+    assert read_output(tmp_path / "serial_wide.tsv").frame_equal(
+        read_output(tmp_path / "serial_wide.arrow"), null_equal=True
+    )
+    assert read_output(tmp_path / "serial_wide.arrow").columns == data_wide.columns
+
+
+@pytest.mark.parametrize("compression", COMPRESSIONS)
+def test_compressed_outputs_read_back(results, tmp_path, compression):
+    write_outputs(
+        *results,
+        str(tmp_path / "out_"),
+        ["arrow", "parquet"],
+        compression=compression,
+        row_group_size=100,
+    )
+    data = strings(results[0])
+    for format in ["arrow", "parquet"]:
+        assert read_output(tmp_path / f"out_narrow.{format}").frame_equal(
+            data.select(pl.all().cast(pl.Utf8)), null_equal=True
+        )
+
+
+def test_sunk_outputs_match_the_extraction(release, metadata_files, tmp_path):
+    data_file = str(release / "current.melt.tsv")
+    # Value recoding and null filters keep the plan in the streaming engine
+    config = make_config(
+        FieldIDs=[31, 53, 1292], wide=False, replicate_non_instanced=False
+    )
+    formats = ["tsv", "arrow", "parquet"]
+    assert sink_UKBB_tabular_data(
+        dict(config),
+        data_file,
+        output_prefix=str(tmp_path / "sunk_"),
+        output_formats=formats,
+        **metadata_files,
+    )
+    results = extract_UKBB_tabular_data(dict(config), data_file, **metadata_files)
+    write_outputs(*results, str(tmp_path / "collected_"), formats)
+    for name in [f"narrow.{format}" for format in formats] + ["dictionary.tsv"]:
+        sunk = read_output(tmp_path / f"sunk_{name}")
+        collected = read_output(tmp_path / f"collected_{name}")
+        if name.startswith("narrow"):
+            sunk, collected = sunk.sort(NARROW_SORT), collected.sort(NARROW_SORT)
+        assert sunk.frame_equal(collected, null_equal=True)
+    assert not (tmp_path / "sunk_wide.tsv").exists()
+
+
+def test_wide_config_is_not_sunk(release, metadata_files, tmp_path):
+    assert not sink_UKBB_tabular_data(
+        make_config(FieldIDs=[31], wide=True),
+        str(release / "current.melt.tsv"),
+        output_prefix=str(tmp_path / "out_"),
+        output_formats=["tsv"],
+        **metadata_files,
+    )
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,259 @@
+"""
+UKBB Column-Grouped Wide Output
+
+The wide output of a large extraction has thousands of columns, while an
+analysis usually reads a few dozen of them. Instead of a single wide file,
+the wide output can be written as a dataset of column-group files:
+
+    <prefix>wide/
+        manifest.json
+        <group>.<format>     SubjectID, InstanceID, ArrayID and the group columns
+
+Columns are grouped by their UKBB Category, or in chunks of a fixed number
+of columns. Every group file holds the SubjectID/InstanceID/ArrayID key
+followed by its columns, with the rows in the same order in every file, so
+groups are put back together side by side without a join. The manifest maps
+every FieldID to its group, its columns and its files.
+
+read_wide_groups() loads only the groups holding the requested fields, and
+only the requested columns of the arrow and parquet group files.
+"""
+from __future__ import annotations
+
+import json
+import logging
+import pathlib as p
+import re
+
+import polars as pl
+
+from melted_UKBB_extract import WIDE_INDEX, wide_column_order
+from writers import write_frame
+
+MANIFEST_FILE = "manifest.json"
+MANIFEST_VERSION = 1
+
+# Formats read_wide_groups() prefers, those reading column subsets first
+READ_FORMATS = ["arrow", "feather", "parquet", "tsv", "csv"]
+
+
+def column_field_id(column: str) -> int:
+    """FieldID of a wide column named FieldID or Field_FieldID."""
+    return int(re.search(r"(\d+)$", column).group(1))
+
+
+def parse_grouping(grouping: str) -> str | int:
+    """Parse a grouping, either "category" or a number of columns per group."""
+    if grouping == "category":
+        return grouping
+    try:
+        columns = int(grouping)
+    except ValueError:
+        raise ValueError(
+            f"Column grouping {grouping!r} is neither 'category' nor a number of columns"
+        ) from None
+    if columns < 1:
+        raise ValueError(f"Column groups need at least one column, got {columns}")
+    return columns
+
+
+def group_columns(
+    columns: list[str], dictionary: pl.DataFrame, grouping: str | int
+) -> dict[str, list[str]]:
+    """
+    Split the wide columns into named groups.
+
+    Parameters
+    ----------
+    columns : list[str]
+        Wide columns, without the SubjectID/InstanceID/ArrayID key.
+    dictionary : pl.DataFrame
+        Data dictionary with FieldID and Category.
+    grouping : str | int
+        "category" to group the columns by the Category of their FieldID, or
+        a number of columns per group.
+
+    Returns
+    -------
+    dict[str, list[str]]
+        Columns of each group, in the column order of the wide output.
+    """
+    if grouping != "category":
+        return {
+            f"columns_{start // grouping:04d}": columns[start : start + grouping]
+            for start in range(0, len(columns), grouping)
+        }
+    categories = dict(
+        dictionary.select(["FieldID", "Category"]).unique(subset="FieldID").iter_rows()
+    )
+    groups = {}
+    for column in columns:
+        category = categories.get(column_field_id(column))
+        name = "uncategorized" if category is None else f"category_{category}"
+        groups.setdefault(name, []).append(column)
+    return groups
+
+
+def write_wide_groups(
+    data_wide: pl.DataFrame,
+    dictionary: pl.DataFrame,
+    output_prefix: str,
+    output_formats: list[str],
+    grouping: str | int,
+    compression: str = "zstd",
+    compression_level: int | None = None,
+    row_group_size: int | None = None,
+) -> dict:
+    """
+    Write the wide output as column-group files and their manifest.
+
+    Parameters
+    ----------
+    data_wide : pl.DataFrame
+        Wide output of extract_UKBB_tabular_data().
+    dictionary : pl.DataFrame
+        Data dictionary with FieldID and Category.
+    output_prefix : str
+        Prefix of the output files, the groups are written to <prefix>wide/.
+    output_formats : list[str]
+        Output formats among tsv, csv, arrow/feather, parquet.
+    grouping : str | int
+        See group_columns().
+    compression, compression_level, row_group_size
+        See writers.write_outputs().
+
+    Returns
+    -------
+    dict
+        The manifest written to <prefix>wide/manifest.json.
+    """
+    directory = p.Path(f"{output_prefix}wide")
+    directory.mkdir(parents=True, exist_ok=True)
+    # Groups and manifest list the columns by FieldID, whatever the input
+    columns = wide_column_order(data_wide.columns[len(WIDE_INDEX) :])
+    groups = group_columns(columns, dictionary, grouping)
+    manifest = {
+        "version": MANIFEST_VERSION,
+        "grouping": grouping,
+        "key": WIDE_INDEX,
+        "rows": data_wide.height,
+        "columns": columns,
+        "formats": output_formats,
+        "groups": {},
+        "fields": {},
+    }
+    for name, columns in groups.items():
+        files = {format: f"{name}.{format}" for format in output_formats}
+        logging.info(f"Writing {len(columns)} columns to {directory}/{name}.*")
+        group = data_wide.select(WIDE_INDEX + columns)
+        for format, file in files.items():
+            write_frame(
+                group,
+                str(directory / file),
+                format,
+                compression,
+                compression_level,
+                row_group_size,
+            )
+        manifest["groups"][name] = {"columns": columns, "files": files}
+        for column in columns:
+            field = manifest["fields"].setdefault(
+                str(column_field_id(column)), {"group": name, "columns": []}
+            )
+            field["columns"].append(column)
+    with open(directory / MANIFEST_FILE, "w") as stream:
+        json.dump(manifest, stream, indent=1)
+    return manifest
+
+
+def read_wide_manifest(path: str) -> dict:
+    """Read the manifest of a column-grouped wide output directory."""
+    with open(p.Path(path) / MANIFEST_FILE) as stream:
+        return json.load(stream)
+
+
+def read_group(file: str, format: str, columns: list[str]) -> pl.DataFrame:
+    """Read columns of a group file, only those columns for arrow and parquet."""
+    if format == "arrow" or format == "feather":
+        return pl.read_ipc(file, columns=columns, memory_map=False)
+    elif format == "parquet":
+        return pl.read_parquet(file, columns=columns)
+    return pl.read_csv(
+        file, separator="\t" if format == "tsv" else ",", columns=columns
+    )
+
+
+def read_wide_groups(
+    path: str,
+    field_ids: list[int] | None = None,
+    format: str | None = None,
+) -> pl.DataFrame:
+    """
+    Load the wide columns of some fields from a column-grouped wide output.
+
+    Only the groups holding the fields are read. The csv and tsv group files
+    keep no column types, which are inferred when read.
+
+    Parameters
+    ----------
+    path : str
+        The <prefix>wide/ directory written by write_wide_groups().
+    field_ids : list[int], optional
+        FieldIDs to load, all of them by default.
+    format : str, optional
+        Format of the group files to read, by default the first written of
+        arrow, feather, parquet, tsv and csv.
+
+    Returns
+    -------
+    pl.DataFrame
+        SubjectID, InstanceID, ArrayID and the columns of the fields, in the
+        column order of the wide output.
+
+    Raises
+    ------
+    ValueError
+        If a field or the format is not in the output, or no fields are
+        requested.
+    """
+    manifest = read_wide_manifest(path)
+    if format is None:
+        format = next(f for f in READ_FORMATS if f in manifest["formats"])
+    elif format not in manifest["formats"]:
+        raise ValueError(f"The wide output {path} has no {format} files")
+
+    if field_ids is None:
+        wanted = None
+    else:
+        missing = [
+            field_id for field_id in field_ids if str(field_id) not in manifest["fields"]
+        ]
+        if missing:
+            raise ValueError(f"FieldIDs {missing} are not in the wide output {path}")
+        wanted = {
+            column
+            for field_id in field_ids
+            for column in manifest["fields"][str(field_id)]["columns"]
+        }
+
+    frames = []
+    for name, group in manifest["groups"].items():
+        columns = [
+            column for column in group["columns"] if wanted is None or column in wanted
+        ]
+        if not columns:
+            continue
+        logging.info(f"Reading {len(columns)} columns of group {name}")
+        frame = read_group(
+            str(p.Path(path) / group["files"][format]), format, WIDE_INDEX + columns
+        )
+        # The key is the same in all the groups, it is kept once
+        frames.append(frame if not frames else frame.drop(WIDE_INDEX))
+    if not frames:
+        raise ValueError(f"No columns to read from the wide output {path}")
+    data_wide = pl.concat(frames, how="horizontal")
+    # Groups by Category interleave in the wide output
+    return data_wide.select(
+        WIDE_INDEX
+        + [column for column in manifest["columns"] if column in data_wide.columns]
+    )
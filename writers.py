@@ -0,0 +1,216 @@
+"""
+UKBB Extraction Output Writers
+
+This module writes the results of an extraction to the requested output
+formats (tsv, csv, arrow/feather, parquet).
+
+Materialized frames are written to all their files concurrently on a thread
+pool, as the polars writers release the GIL. A narrow LazyFrame whose plan
+runs entirely in the streaming engine can instead be sunk to the outputs
+without ever being collected: the query is run once into a Parquet file, and
+the other formats are streamed from it.
+
+Compression (zstd, lz4 or uncompressed) applies to the arrow and parquet
+outputs, the compression level and row group size to parquet outputs only.
+"""
+from __future__ import annotations
+
+import concurrent.futures
+import logging
+import pathlib as p
+import tempfile
+
+import polars as pl
+
+from profiling import Profile, profile_stage
+
+OUTPUT_FORMATS = ["tsv", "csv", "arrow", "feather", "parquet"]
+
+# Codecs supported by both the arrow and the parquet writers
+COMPRESSIONS = ["zstd", "lz4", "uncompressed"]
+
+
+def write_frame(
+    frame: pl.DataFrame,
+    path: str,
+    format: str,
+    compression: str = "zstd",
+    compression_level: int | None = None,
+    row_group_size: int | None = None,
+) -> None:
+    """Write frame to path in format, one of tsv, csv, arrow/feather, parquet."""
+    if format == "tsv":
+        frame.write_csv(path, separator="\t")
+    elif format == "arrow" or format == "feather":
+        frame.write_ipc(path, compression=compression)
+    elif format == "parquet":
+        frame.write_parquet(
+            path,
+            compression=compression,
+            compression_level=compression_level,
+            row_group_size=row_group_size,
+        )
+    elif format == "csv":
+        frame.write_csv(path)
+
+
+def write_outputs(
+    data: pl.DataFrame,
+    data_wide: pl.DataFrame | None,
+    dictionary: pl.DataFrame,
+    codings: pl.DataFrame,
+    output_prefix: str,
+    output_formats: list[str],
+    profile: Profile | None = None,
+    compression: str = "zstd",
+    compression_level: int | None = None,
+    row_group_size: int | None = None,
+    workers: int | None = None,
+) -> None:
+    """
+    Write the results of extract_UKBB_tabular_data() to files.
+
+    All files are written concurrently.
+
+    Parameters
+    ----------
+    data, data_wide, dictionary, codings
+        Results of extract_UKBB_tabular_data().
+    output_prefix : str
+        Prefix of the output file names.
+    output_formats : list[str]
+        Output formats among tsv, csv, arrow/feather, parquet.
+    profile : Profile, optional
+        When given, every file written is measured as a stage in profile.
+        The stages overlap in time.
+    compression : str, default="zstd"
+        Codec of the arrow and parquet outputs, see COMPRESSIONS.
+    compression_level : int, optional
+        Compression level of the parquet outputs.
+    row_group_size : int, optional
+        Rows per row group of the parquet outputs.
+    workers : int, optional
+        Number of writer threads, defaults to one per file.
+    """
+    outputs = [(f"narrow.{format}", data, format) for format in output_formats]
+    outputs += [("dictionary.tsv", dictionary, "tsv"), ("coding.tsv", codings, "tsv")]
+    if data_wide is not None:
+        outputs += [(f"wide.{format}", data_wide, format) for format in output_formats]
+
+    def write(name: str, frame: pl.DataFrame, format: str) -> None:
+        logging.info(f"Writing {output_prefix}{name}")
+        with profile_stage(profile, f"write {name}", frame.height) as record:
+            write_frame(
+                frame,
+                f"{output_prefix}{name}",
+                format,
+                compression,
+                compression_level,
+                row_group_size,
+            )
+            record["rows_out"] = frame.height
+
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=workers or len(outputs)
+    ) as executor:
+        # The writers borrow the frame mutably, each thread needs its own
+        # handle of the (shared) data
+        futures = [
+            executor.submit(write, name, frame.clone(), format)
+            for name, frame, format in outputs
+        ]
+        for future in futures:
+            future.result()
+
+
+def is_streamable(data: pl.LazyFrame, optimize: bool = True) -> bool:
+    """Whether the whole plan of data runs in the streaming engine."""
+    plan = data.explain(optimized=optimize, streaming=True, comm_subplan_elim=False)
+    return plan.startswith("--- PIPELINE") or plan.startswith("--- STREAMING")
+
+
+def sink_frame(
+    data: pl.LazyFrame,
+    output_prefix: str,
+    name: str,
+    output_formats: list[str],
+    profile: Profile | None = None,
+    optimize: bool = True,
+    compression: str = "zstd",
+    compression_level: int | None = None,
+    row_group_size: int | None = None,
+) -> None:
+    """
+    Sink a LazyFrame to the output files without collecting it.
+
+    The query runs once, into the parquet output or a temporary Parquet
+    file. Arrow outputs are streamed from it, and tsv/csv outputs are written
+    from an uncompressed memory-mapped Arrow copy, so the data is never held
+    in memory.
+
+    Parameters
+    ----------
+    data : pl.LazyFrame
+        Plan to sink, see is_streamable().
+    output_prefix : str
+        Prefix of the output file names.
+    name : str
+        Name of the output, e.g. narrow for <prefix>narrow.<format>.
+    output_formats : list[str]
+        Output formats among tsv, csv, arrow/feather, parquet.
+    profile : Profile, optional
+        When given, every file written is measured as a stage in profile.
+    optimize : bool, default=True
+        Enable the polars optimizer for the query.
+    compression, compression_level, row_group_size
+        See write_outputs().
+
+    Notes
+    -----
+    Arrow IPC files only allow one dictionary per column, so Categorical
+    columns are written as strings to sunk arrow/feather outputs; use parquet
+    to keep them categorical.
+    """
+    with tempfile.TemporaryDirectory(
+        prefix=f"{name}_sink_", dir=p.Path(f"{output_prefix}{name}").parent
+    ) as sink_dir:
+        if "parquet" in output_formats:
+            parquet = f"{output_prefix}{name}.parquet"
+        else:
+            parquet = f"{sink_dir}/{name}.parquet"
+        logging.info(f"Sinking {output_prefix}{name} to {parquet}")
+        with profile_stage(profile, f"sink {name}.parquet") as record:
+            data.sink_parquet(
+                parquet,
+                compression=compression,
+                compression_level=compression_level,
+                row_group_size=row_group_size,
+                no_optimization=not optimize,
+            )
+            rows = pl.scan_parquet(parquet).select(pl.count()).collect().item()
+            record["rows_out"] = rows
+        logging.info(f"Sank {rows} rows")
+
+        stream = pl.scan_parquet(parquet).with_columns(
+            pl.col(pl.Categorical).cast(pl.Utf8)
+        )
+        for format in output_formats:
+            if format in ["arrow", "feather"]:
+                logging.info(f"Writing {output_prefix}{name}.{format}")
+                with profile_stage(profile, f"write {name}.{format}", rows) as record:
+                    stream.sink_ipc(
+                        f"{output_prefix}{name}.{format}",
+                        compression=None if compression == "uncompressed" else compression,
+                    )
+                    record["rows_out"] = rows
+
+        text_formats = [format for format in output_formats if format in ["tsv", "csv"]]
+        if text_formats:
+            stream.sink_ipc(f"{sink_dir}/{name}.arrow", compression=None)
+            frame = pl.read_ipc(f"{sink_dir}/{name}.arrow", memory_map=True)
+            for format in text_formats:
+                logging.info(f"Writing {output_prefix}{name}.{format}")
+                with profile_stage(profile, f"write {name}.{format}", rows) as record:
+                    write_frame(frame, f"{output_prefix}{name}.{format}", format)
+                    record["rows_out"] = rows
+            del frame